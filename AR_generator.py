@@ -1,15 +1,18 @@
 import app
 import argparse
+import tracing
+import checkpoints
 from transformers import PreTrainedTokenizerFast, AutoModelForCausalLM, AutoTokenizer, XLNetLMHeadModel, XLNetTokenizer
 from tranception import config, model_pytorch
 import tranception
 import pandas as pd
 import os
 import util
+from journal import GenerationJournal
 from AR_sampling import ARtop_k_sampling, ARtemperature_sampler, ARtop_p_sampling, ARtypical_sampling, ARmirostat_sampling, ARrandom_sampling, ARbeam_search
 import time
+import random
 import AR_MCTS
-from EVmutation.model import CouplingsModel
 from tqdm.auto import tqdm
 import sys
 from app import process_prompt_protxlnet
@@ -18,7 +21,7 @@ from app import process_prompt_protxlnet
 parser = argparse.ArgumentParser()
 parser.add_argument('--sequence', type=str, help='Sequence to do mutation or DE')
 parser.add_argument('--model', type=str, choices=['small', 'medium', 'large'], help='Tranception model size')
-parser.add_argument('--Tmodel', type=str, help='Tranception model path')
+parser.add_argument('--Tmodel', type=str, help='Tranception model path (a regular or a converted checkpoint, see checkpoints.py)')
 parser.add_argument('--model_name', type=str, choices=['Tranception', 'RITA', 'ProtXLNet'], help='Model name', required=True)
 parser.add_argument('--use_scoring_mirror', action='store_true', help='Whether to score the sequence from both ends')
 parser.add_argument('--batch', type=int, default=20, help='Batch size for scoring')
@@ -40,7 +43,12 @@ parser.add_argument('--extension_factor', type=int, default=1, help='Number of A
 parser.add_argument('--output_name', type=str, required=True, help='Output file name (Just name with no extension!)')
 parser.add_argument('--save_df', action='store_true', help='Whether to save the metadata dataframe')
 parser.add_argument('--verbose', type=int, default=0, help='Verbosity level')
+parser.add_argument('--resume', action='store_true', help='Resume an interrupted run from its generation journal')
+parser.add_argument('--trace', type=str, default=None, help='Record per-stage spans and save them as a Chrome trace JSON to this path')
+parser.add_argument('--trace_cuda', action='store_true', help='Also record GPU time and peak CUDA memory per span (adds synchronisation)')
 args = parser.parse_args()
+if args.trace:
+    tracing.enable(cuda=args.trace_cuda)
 
 AA_vocab = "ACDEFGHIKLMNPQRSTVWY"
 tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(os.path.dirname(os.path.realpath(__file__)), "tranception/utils/tokenizers/Basic_tokenizer"),
@@ -53,29 +61,41 @@ tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(os.path.dirname(
 
 # Load model
 model_name = args.model_name
-if model_name == 'Tranception':
-    assert args.model or args.Tmodel, "Either model size or model path must be specified"
-    model_type = args.model.capitalize() if args.model else None
-    try:
-        model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path=args.Tmodel, local_files_only=True)
-        print("Model successfully loaded from local")
-    except:
-        print("Model not found locally, downloading from HuggingFace")
-        if model_type=="Small":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Small")
-        elif model_type=="Medium":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Medium")
-        elif model_type=="Large":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Large")
-elif model_name == 'RITA':
-    assert args.Tmodel, "Model path must be specified"
-    tokenizer = AutoTokenizer.from_pretrained(args.Tmodel)
-    model = AutoModelForCausalLM.from_pretrained(args.Tmodel, local_files_only=True, trust_remote_code=True)
-elif model_name == 'ProtXLNet':
-    tokenizer = XLNetTokenizer.from_pretrained(args.Tmodel)
-    model = XLNetLMHeadModel.from_pretrained(args.Tmodel, mem_len=512)
-else:
-    raise ValueError(f"Model {model_name} not supported")
+with tracing.span('load_model', 'load', model=model_name):
+    if model_name == 'Tranception':
+        assert args.model or args.Tmodel, "Either model size or model path must be specified"
+        model_type = args.model.capitalize() if args.model else None
+        if checkpoints.is_converted(args.Tmodel):
+            # Outside the fallback below: a corrupt or outdated converted checkpoint must fail loudly
+            model = checkpoints.load_converted(args.Tmodel)
+            print("Model successfully loaded from local")
+        else:
+            try:
+                model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path=args.Tmodel, local_files_only=True)
+                print("Model successfully loaded from local")
+            except:
+                print("Model not found locally, downloading from HuggingFace")
+                if model_type=="Small":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Small")
+                elif model_type=="Medium":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Medium")
+                elif model_type=="Large":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Large")
+    elif model_name == 'RITA':
+        assert args.Tmodel, "Model path must be specified"
+        tokenizer = AutoTokenizer.from_pretrained(args.Tmodel)
+        if checkpoints.is_converted(args.Tmodel):
+            model = checkpoints.load_converted(args.Tmodel)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(args.Tmodel, local_files_only=True, trust_remote_code=True)
+    elif model_name == 'ProtXLNet':
+        tokenizer = XLNetTokenizer.from_pretrained(args.Tmodel)
+        if checkpoints.is_converted(args.Tmodel):
+            model = checkpoints.load_converted(args.Tmodel, mem_len=512)
+        else:
+            model = XLNetLMHeadModel.from_pretrained(args.Tmodel, mem_len=512)
+    else:
+        raise ValueError(f"Model {model_name} not supported")
 
 if args.sampling_method == 'beam_search' or args.sampling_method == 'mcts':
     assert args.max_length is not None, "Maximum length must be specified for beam_search or MCTS sampling method"
@@ -83,16 +103,9 @@ if args.sampling_method == 'beam_search' or args.sampling_method == 'mcts':
 sequence_num = args.sequence_num
 seq_length = args.seq_length
 AA_extension = args.extension_factor
-generated_sequence = []
-sequence_iteration = []
-generated_sequence_name = []
-mutation_list = []
-generation_duration = []
-samplings = []
-mutants = []
-subsamplings = []
-samplingtheshold = []
-subsamplingtheshold = []
+journal = GenerationJournal(os.path.join(os.path.dirname(os.path.realpath(__file__)), "ARgeneration_journal/{}.jsonl".format(args.output_name)), args, resume=args.resume)
+# journal.rows holds the metadata of the finished sequences (replayed ones included)
+generated_sequence = journal.rows
 past_key_values=None
 
 if args.sampling_method in ['top_k', 'top_p', 'typical', 'mirostat', 'beam_search']:
@@ -100,15 +113,25 @@ if args.sampling_method in ['top_k', 'top_p', 'typical', 'mirostat', 'beam_searc
 if args.sampling_method == 'beam_search' or args.sampling_method == 'mcts':
     assert args.max_length is not None, "Maximum length must be specified for beam_search or MCTS sampling method"
 
-pbar1 = tqdm(total=sequence_num, desc="Generating", position=0, leave=True)
+sampling_strat = args.sampling_method
+sampling_threshold = args.max_length if args.sampling_method == 'mcts' else args.sampling_threshold
+journal.restore_rng_state()
+pbar1 = tqdm(total=sequence_num, initial=len(generated_sequence), desc="Generating", position=0, leave=True)
 while len(generated_sequence) < sequence_num:
 
-    if not args.sequence: seq = random.choice(AA_vocab)
-    else: seq = args.sequence.upper()
-    sequence_length = len(seq)
     start_time = time.time()
-    mutation_history = []
-    iteration = 0
+    partial = journal.pop_partial()
+    if partial is not None:
+        # the restored RNG state was saved after the starting residue was drawn: drawing again would shift the RNG sequence
+        iteration, seq, mutation_history, elapsed = partial
+        mutated_sequence = seq
+        start_time -= elapsed
+    else:
+        if not args.sequence: seq = random.choice(AA_vocab)
+        else: seq = args.sequence.upper()
+        mutation_history = []
+        iteration = 0
+    sequence_length = len(seq)
     
     pbar1.set_description(f"Generating {len(generated_sequence) + 1}/{sequence_num}")
     while sequence_length < seq_length:
@@ -195,26 +218,20 @@ while len(generated_sequence) < sequence_num:
         seq = mutated_sequence
         sequence_length = len(seq)
         iteration += 1
+        journal.record_mutation(iteration, seq, mutation_history, start_time)
 
-    generated_sequence.append(mutated_sequence)
-    sequence_iteration.append(iteration)
-    samplings.append(sampling_strat)
-    samplingtheshold.append(sampling_threshold) 
-    seq_name = 'AR{}_{}AA_{}'.format(model_name, iteration+1, len(generated_sequence))
-    generated_sequence_name.append(seq_name)
-    mutants.append('1')
-    subsamplings.append('NA')
-    subsamplingtheshold.append('NA')
-    mutation_list.append(''.join(mutation_history))
+    seq_name = 'AR{}_{}AA_{}'.format(model_name, iteration+1, len(generated_sequence) + 1)
     generation_time = time.time() - start_time
-    generation_duration.append(generation_time)
+    journal.record_sequence({'name': seq_name, 'sequence': mutated_sequence, 'sampling': sampling_strat, 'threshold': sampling_threshold, 'subsampling': 'NA', 'subthreshold': 'NA', 'iterations': iteration, 'mutants': '1', 'mutations': ''.join(mutation_history), 'time': generation_time})
     pbar1.write(f"Sequence {len(generated_sequence)}/{sequence_num}: {generation_time} seconds")
     # print("=========================================") if args.verbose == 1 else None
     pbar1.update(1)
 
 pbar1.close()   
-print(f'===========Generated {len(generated_sequence)} sequences of length {seq_length} in {sum(generation_duration)} seconds============')
-generated_sequence_df = pd.DataFrame({'name': generated_sequence_name,'sequence': generated_sequence, 'sampling': samplings, 'threshold': samplingtheshold, 'subsampling':subsamplings, 'subthreshold': subsamplingtheshold, 'iterations': sequence_iteration, 'mutants': mutants, 'mutations': mutation_list, 'time': generation_duration})
+generation_duration = sum(row['time'] for row in generated_sequence)
+print(f'===========Generated {len(generated_sequence)} sequences of length {seq_length} in {generation_duration} seconds============')
+# Compact the journal into the metadata CSV / FASTA layout
+generated_sequence_df = journal.to_dataframe()
 
 if args.save_df:
     save_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ARgenerated_metadata/{}.csv".format(args.output_name))
@@ -228,4 +245,7 @@ if args.save_df:
 save_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ARgenerated_sequence/{}.fasta".format(args.output_name))
 os.makedirs(os.path.dirname(os.path.realpath(save_path))) if not os.path.exists(os.path.dirname(os.path.realpath(save_path))) else None
 util.save_as_fasta(generated_sequence_df, save_path)
+journal.close(remove=True)
+if args.trace:
+    tracing.finish(args.trace)
 print(f"Generated sequences saved to {save_path}")
\ No newline at end of file
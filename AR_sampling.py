@@ -10,11 +10,13 @@ from torch.distributions import Categorical
 import pandas as pd
 import math
 import app
+from tracing import traced
 from decimal import Decimal
 from statistics import mean
 import os
 
 AA_vocab = "ACDEFGHIKLMNPQRSTVWY"
+device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
 class ARtemperature_sampler:
   def __init__(self, temperature: float = 1.0):
@@ -26,13 +28,14 @@ class ARtemperature_sampler:
 # Modified version of sampling for DataFrame containing probabilities
 
 # Top-k sampling
+@traced(category='sampling')
 def ARtop_k_sampling(scores: pd.DataFrame, k: int, sampler = ARtemperature_sampler(temperature=1.0), multi=False):
   if multi:
     scores = scores.sort_values(by=['avg_score'], ascending=False)
     scores = scores.reset_index(drop=True)
     scores = scores.iloc[:k]
     return scores
-  raw_score = torch.tensor(scores['avg_score'].values, device='cuda:0')
+  raw_score = torch.tensor(scores['avg_score'].values, device=device)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
   zeros = raw_score.new_ones(raw_score.shape) * float('-inf')
   values, indices = torch.topk(raw_score, k=k, dim=-1)
@@ -42,6 +45,7 @@ def ARtop_k_sampling(scores: pd.DataFrame, k: int, sampler = ARtemperature_sampl
   return scores['mutated_sequence'][sampled_score]
 
 # Typical sampling
+@traced(category='sampling')
 def ARtypical_sampling(scores: pd.DataFrame, mass: float = 0.9, sampler = ARtemperature_sampler(temperature=1.0), multi=False):
   raw_score = torch.tensor(scores['avg_score'].values)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
@@ -77,6 +81,7 @@ def ARtypical_sampling(scores: pd.DataFrame, mass: float = 0.9, sampler = ARtemp
     return scores['mutated_sequence'][sampled_score]
 
 # Top-p sampling
+@traced(category='sampling')
 def ARtop_p_sampling(scores: pd.DataFrame, p: float, sampler = ARtemperature_sampler(temperature=1.0), multi=False):
   raw_score = torch.tensor(scores['avg_score'].values)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
@@ -130,6 +135,7 @@ def compute_k(n,s,tau):
   return round(k)
 
 # Mirostat Sampling
+@traced(category='sampling')
 def ARmirostat_sampling(scores: pd.DataFrame, tau:float = 3.0, sampler = ARtemperature_sampler(temperature=1.0), vocab=AA_vocab, multi=False):
   max_surprise = 2*tau
   n = len(vocab)
@@ -159,8 +165,9 @@ def ARmirostat_sampling(scores: pd.DataFrame, tau:float = 3.0, sampler = ARtempe
     return scores['mutated_sequence'][sampled_score]
 
 # Random Sampling
+@traced(category='sampling')
 def ARrandom_sampling(scores: pd.DataFrame, sampler = ARtemperature_sampler(temperature=1.0), multi=False):
-  raw_score = torch.tensor(scores['avg_score'].values, device='cuda:0')
+  raw_score = torch.tensor(scores['avg_score'].values, device=device)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
   sampled_score = sampler(raw_score).item()
   
@@ -169,6 +176,7 @@ def ARrandom_sampling(scores: pd.DataFrame, sampler = ARtemperature_sampler(temp
   else:
     return scores['mutated_sequence'][sampled_score]
 
+@traced(category='sampling')
 def ARbeam_search(scores: pd.DataFrame, beam_width: int, max_length:int, tokenizer, Tmodel, score_mirror=False, batch=20, max_pos=50, sampler=ARtemperature_sampler(temperature=1.0), multi=False, past_key_values=None, extension_factor=1, filter='hpf', IST=96, verbose=0, model_type='Tranception'):
   length = 1
   while length < max_length:
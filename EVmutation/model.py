@@ -694,22 +694,30 @@ class CouplingsModel:
         """
         Calculates FN and CN scores as defined in Ekeberg et al., Phys Rev E, 2013,
         as well as MI scores. Assumes parameters are in zero-sum gauge.
+
+        Scores are computed for one tile of pairs (i, i+1..L-1) at a time, which
+        are contiguous slices of J_ij / f_ij (so this also works when they are
+        memory-mapped arrays).
         """
-        # calculate Frobenius norm for each pair of sites (i, j)
-        # also calculate mutual information
         self._fn_scores = np.zeros((self.L, self.L))
         self._mi_scores_raw = np.zeros((self.L, self.L))
 
         for i in range(self.L - 1):
-            for j in range(i + 1, self.L):
-                self._fn_scores[i, j] = np.linalg.norm(self.J_ij[i, j], "fro")
-                self._fn_scores[j, i] = self._fn_scores[i, j]
-
-                # mutual information
-                p = self.f_ij[i, j]
-                m = np.dot(self.f_i[i, np.newaxis].T, self.f_i[j, np.newaxis])
-                self._mi_scores_raw[i, j] = np.sum(p[p > 0] * np.log(p[p > 0] / m[p > 0]))
-                self._mi_scores_raw[j, i] = self._mi_scores_raw[i, j]
+            # Frobenius norm of the coupling matrices of sites (i, j > i)
+            J = self.J_ij[i, i + 1:]
+            self._fn_scores[i, i + 1:] = np.sqrt(np.einsum("kab,kab->k", J, J))
+
+            # mutual information, summed over the symbol pairs with p > 0
+            p = self.f_ij[i, i + 1:]
+            m = self.f_i[i, np.newaxis, :, np.newaxis] * self.f_i[i + 1:, np.newaxis, :]
+            observed = p > 0
+            with np.errstate(divide="ignore"):
+                mi = np.where(observed, p * np.log(np.where(observed, p, 1) / np.where(observed, m, 1)), 0)
+            self._mi_scores_raw[i, i + 1:] = mi.sum(axis=(1, 2))
+
+        pair_i, pair_j = np.triu_indices(self.L, k=1)
+        self._fn_scores[pair_j, pair_i] = self._fn_scores[pair_i, pair_j]
+        self._mi_scores_raw[pair_j, pair_i] = self._mi_scores_raw[pair_i, pair_j]
 
         # apply Average Product Correction (Dunn et al., Bioinformatics, 2008)
         # subtract APC and blank diagonal entries
@@ -717,20 +725,15 @@ class CouplingsModel:
         self._mi_scores_apc = self.apc(self._mi_scores_raw)
 
         # create internal dataframe representation
-        ecs = []
-        for i in range(self.L - 1):
-            for j in range(i + 1, self.L):
-                ecs.append((
-                    self.index_list[i], self.target_seq[i],
-                    self.index_list[j], self.target_seq[j],
-                    abs(self.index_list[i] - self.index_list[j]),
-                    self._mi_scores_raw[i, j], self._mi_scores_apc[i, j],
-                    self._fn_scores[i, j], self._cn_scores[i, j]
-                ))
-
-        self._ecs = pd.DataFrame(
-            ecs, columns=["i", "A_i", "j", "A_j", "seqdist", "mi_raw", "mi_apc", "fn", "cn"]
-        ).sort_values(by="cn", ascending=False)
+        index_list = np.asarray(self.index_list)
+        target_seq = np.asarray(self.target_seq)
+        self._ecs = pd.DataFrame({
+            "i": index_list[pair_i], "A_i": target_seq[pair_i],
+            "j": index_list[pair_j], "A_j": target_seq[pair_j],
+            "seqdist": np.abs(index_list[pair_i] - index_list[pair_j]),
+            "mi_raw": self._mi_scores_raw[pair_i, pair_j], "mi_apc": self._mi_scores_apc[pair_i, pair_j],
+            "fn": self._fn_scores[pair_i, pair_j], "cn": self._cn_scores[pair_i, pair_j],
+        }).sort_values(by="cn", ascending=False)
 
     @property
     def cn_scores(self):
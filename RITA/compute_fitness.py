@@ -10,7 +10,8 @@ import numpy as np
 import torch
 from torch.nn import CrossEntropyLoss
 
-def calc_fitness(model, prots, tokenizer, device='cuda:0', model_type='RITA'):
+def calc_fitness(model, prots, tokenizer, device=None, model_type='RITA'):
+    device = next(model.parameters()).device if device is None else device # the model's device, so CPU-prepared models stay on the CPU
     loss_list = []
     loss_fn = CrossEntropyLoss()
     model_context_len = 512 if model_type == 'ProtXLNet' else 1023
@@ -1,24 +1,26 @@
+from backends import tf, keras, evmutation_tools, proteinbert_tokenization
 import torch
 import torch.nn as nn
 import transformers
 from transformers import PreTrainedTokenizerFast
 import tranception
-import datasets
 from tranception import config, model_pytorch
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import os
-from tensorflow import keras
 import itertools
+import contextlib
+import weakref
 import re
 import tqdm
 import time
 from scoring_metrics.util import identify_mutation, extract_mutations
-from EVmutation.model import CouplingsModel
-from EVmutation.tools import predict_mutation_table
+from functools import lru_cache
 from sampling import top_k_sampling
+import heatmaps
+import tracing
+import cpu_inference
+from tracing import traced
 from RITA import compute_fitness
 
 # Amino Acid Vocabulary
@@ -43,6 +45,7 @@ tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(os.path.dirname(
 #     all_single_mutants = [{'mutant': f"{sequence_list[i]}{i+1}{aa}", 'mutated_sequence': ''.join([aa if j == i else sequence_list[j] for j in range(len(sequence_list))])} for i, aa in combos if sequence_list[i] != aa]
 #     return pd.DataFrame(all_single_mutants)
 
+@traced(category='mutants')
 def create_all_single_mutants(sequence,AA_vocab,mutation_range_start=None,mutation_range_end=None,exclude_positions:list=None):
     sequence_list = list(sequence)
     if mutation_range_start is None: mutation_range_start = 1
@@ -79,66 +82,62 @@ def extend_sequence_by_n(sequence, n: int, reference_vocab, output_sequence=True
     df_ext = pd.DataFrame.from_dict({"extension": permut})
     return df_ext
 
+def contains_any(sequences, patterns):
+  """
+  Boolean mask of the sequences that contain at least one of the patterns as a substring
+  (same result as str.contains('|'.join(patterns)) for plain amino-acid strings).
+  Patterns are grouped by length; for each group either every window of the sequence is looked up in the
+  pattern set or every pattern is searched in the sequence, whichever takes fewer checks.
+  """
+  patterns_by_length = {}
+  for pattern in set(patterns):
+    patterns_by_length.setdefault(len(pattern), set()).add(pattern)
+  if len(patterns_by_length) == 0:
+    # An empty alternation matches every sequence
+    return np.ones(len(sequences), dtype=bool)
+  lengths = sorted(patterns_by_length, reverse=True)
+  keep = np.zeros(len(sequences), dtype=bool)
+  for i, sequence in enumerate(sequences):
+    sequence_length = len(sequence)
+    for length in lengths:
+      if length > sequence_length:
+        continue
+      group = patterns_by_length[length]
+      num_windows = sequence_length - length + 1
+      if num_windows <= len(group):
+        hit = any(sequence[j:j+length] in group for j in range(num_windows))
+      else:
+        hit = any(pattern in sequence for pattern in group)
+      if hit:
+        keep[i] = True
+        break
+  return keep
+
+@traced(category='filter')
 def trim_DMS(DMS_data:pd.DataFrame, sampled_mutants:pd.DataFrame, mutation_rounds:int):
   if mutation_rounds == 0:
     # get sequences in DMS that contains a substring of the sampled mutants
-    trimmed_variants = DMS_data[DMS_data["mutated_sequence"].str.contains('|'.join(sampled_mutants['mutated_sequence']))].reset_index(drop=True)
-    trimmed_variants = trimmed_variants.drop_duplicates(subset=['mutated_sequence']).reset_index(drop=True)
+    codes, unique_sequences = pd.factorize(DMS_data["mutated_sequence"])
+    _, first_occurrence = np.unique(codes, return_index=True)
+    keep = contains_any(unique_sequences, sampled_mutants['mutated_sequence'])
+    trimmed_variants = DMS_data.iloc[first_occurrence[keep]].reset_index(drop=True)
     return trimmed_variants[['mutated_sequence']]
   else:
-    for mutation in range(2):
-      if mutation == 0:
-        DMS_data[f'past_mutation'] = DMS_data["mutant"].map(lambda x: ":".join(x.split(":", mutation_rounds-1)[:mutation_rounds-1]))
-      else:
-        DMS_data[f'current_mutation'] = DMS_data["mutant"].map(lambda x: ":".join(x.split(":", mutation_rounds-1)[mutation_rounds-1:]))
-    trimmed_variants = DMS_data[DMS_data[f'past_mutation'].isin(sampled_mutants['mutant'])].reset_index(drop=True)
-    # print(f'Trimmed DMS: {len(trimmed_variants)}')
+    # keep variants whose first mutation_rounds-1 mutations are one of the sampled mutants (hash join on the prefix)
+    sampled = set(sampled_mutants['mutant'])
+    num_past = mutation_rounds - 1
+    past_in_sampled = np.array([":".join(mutant.split(":", num_past)[:num_past]) in sampled for mutant in DMS_data["mutant"].tolist()], dtype=bool)
+    trimmed_variants = DMS_data[past_in_sampled]
     trimmed_variants = trimmed_variants.drop_duplicates(subset=['mutant']).reset_index(drop=True)
     return trimmed_variants[['mutant','mutated_sequence']]
 
 def create_scoring_matrix_visual(scores,sequence,image_index=0,mutation_range_start=None,mutation_range_end=None,AA_vocab=AA_vocab,annotate=True,fontsize=20):
-  filtered_scores=scores.copy()
-  filtered_scores=filtered_scores[filtered_scores.position.isin(range(mutation_range_start,mutation_range_end+1))]
-  piv=filtered_scores.pivot(index='position',columns='target_AA',values='avg_score').round(4)
-  mutation_range_len = mutation_range_end - mutation_range_start + 1
-  fig, ax = plt.subplots(figsize=(50,mutation_range_len))
-  scores_dict = {}
-  valid_mutant_set=set(filtered_scores.mutant)  
-  ax.tick_params(bottom=True, top=True, left=True, right=True)
-  ax.tick_params(labelbottom=True, labeltop=True, labelleft=True, labelright=True)
-  if annotate:
-    for position in range(mutation_range_start,mutation_range_end+1):
-      for target_AA in list(AA_vocab):
-        mutant = sequence[position-1]+str(position)+target_AA
-        if mutant in valid_mutant_set:
-          scores_dict[mutant]= float(filtered_scores.loc[filtered_scores.mutant==mutant,'avg_score'])
-        else:
-          scores_dict[mutant]=0.0
-    labels = (np.asarray(["{} \n {:.4f}".format(symb,value) for symb, value in scores_dict.items() ])).reshape(mutation_range_len,len(AA_vocab))
-    heat = sns.heatmap(piv,annot=labels,fmt="",cmap='RdYlGn',linewidths=0.30,ax=ax,vmin=np.percentile(scores.avg_score,2),vmax=np.percentile(scores.avg_score,98),\
-                cbar_kws={'label': 'Log likelihood ratio (mutant / starting sequence)'},annot_kws={"size": fontsize})
-  else:
-    heat = sns.heatmap(piv,cmap='RdYlGn',linewidths=0.30,ax=ax,vmin=np.percentile(scores.avg_score,2),vmax=np.percentile(scores.avg_score,98),\
-                cbar_kws={'label': 'Log likelihood ratio (mutant / starting sequence)'},annot_kws={"size": fontsize})
-  heat.figure.axes[-1].yaxis.label.set_size(fontsize=int(fontsize*1.5))
-  heat.figure.axes[-1].yaxis.set_ticklabels(heat.figure.axes[-1].yaxis.get_ticklabels(), fontsize=fontsize)
-  heat.set_title("Higher predicted scores (green) imply higher protein fitness",fontsize=fontsize*2, pad=40)
-  heat.set_ylabel("Sequence position", fontsize = fontsize*2)
-  heat.set_xlabel("Amino Acid mutation", fontsize = fontsize*2)
-  yticklabels = [str(pos)+' ('+sequence[pos-1]+')' for pos in range(mutation_range_start,mutation_range_end+1)]
-  heat.set_yticklabels(yticklabels)
-  heat.set_xticklabels(heat.get_xmajorticklabels(), fontsize = fontsize)
-  heat.set_yticklabels(heat.get_ymajorticklabels(), fontsize = fontsize, rotation=0)
-  plt.tight_layout()
-
-  # Save output
-  save_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scoring_matrix/')
-  os.mkdir(save_path) if not os.path.exists(save_path) else None
-  image_path = os.path.join(save_path, 'fitness_scoring_substitution_matrix_{}.png'.format(image_index))
-  plt.savefig(image_path,dpi=100)
-  # plt.show()
-
-  return image_path
+  """Renders the heatmap of one window of single-mutant scores synchronously (see heatmaps.HeatmapRenderer for the background renderer)."""
+  matrix = heatmaps.score_matrix(scores, sequence, mutation_range_start, mutation_range_end, AA_vocab)
+  image_path = heatmaps.heatmap_path(image_index)
+  return heatmaps.render_heatmap(matrix, sequence[mutation_range_start-1:mutation_range_end], mutation_range_start, AA_vocab,
+                                 vmin=np.percentile(scores.avg_score,2), vmax=np.percentile(scores.avg_score,98), image_path=image_path,
+                                 mode='annotated' if annotate else 'raster', fontsize=fontsize)
 
 def suggest_mutations(scores, multi=False):
   intro_message = "The following mutations may be sensible options to improve fitness: \n\n"
@@ -200,6 +199,7 @@ def check_valid_mutant(sequence,mutant,AA_vocab=AA_vocab, multi_mutant=False):
     assert to_AA in AA_vocab, f"to_AA {to_AA} is not in AA_vocab"
   return valid
 
+@traced(category='mutants')
 def get_mutated_protein(sequence,mutant):
   mutated_sequence = list(sequence)
   multi_mutant=True if len(mutant.split(':'))>1 else False
@@ -217,13 +217,14 @@ def get_mutated_protein(sequence,mutant):
     mutated_sequence[position-1]=to_AA
   return ''.join(mutated_sequence)
 
-def score_and_create_matrix_all_singles(sequence, Tranception_model, mutation_range_start=None,mutation_range_end=None,scoring_mirror=False,batch_size_inference=20,max_number_positions_per_heatmap=50,num_workers=0,AA_vocab=AA_vocab, tokenizer=tokenizer, with_heatmap=True, past_key_values=None, model_type='Tranception', exclude_positions=None):
+@traced(category='scoring')
+def score_and_create_matrix_all_singles(sequence, Tranception_model, mutation_range_start=None,mutation_range_end=None,scoring_mirror=False,batch_size_inference=20,max_number_positions_per_heatmap=50,num_workers=0,AA_vocab=AA_vocab, tokenizer=tokenizer, with_heatmap=True, past_key_values=None, model_type='Tranception', exclude_positions=None, heatmap_mode='annotated'):
   if mutation_range_start is None: mutation_range_start=1
   if mutation_range_end is None: mutation_range_end=len(sequence)
   assert len(sequence) > 0, "no sequence entered"
   assert mutation_range_start <= mutation_range_end, "mutation range is invalid"
   model = Tranception_model
-  if torch.cuda.is_available():
+  if torch.cuda.is_available() and not cpu_inference.is_cpu_model(model):
     model.cuda()
     # print("Inference will take place on GPU")
   else:
@@ -232,19 +233,22 @@ def score_and_create_matrix_all_singles(sequence, Tranception_model, mutation_ra
   all_single_mutants = create_all_single_mutants(sequence,AA_vocab,mutation_range_start,mutation_range_end,exclude_positions=exclude_positions)
   # print("Single variants generated")
   if model_type == 'Tranception':
-    scores, past_key_values = model.score_mutants(DMS_data=all_single_mutants, 
-                                      target_seq=sequence, 
-                                      scoring_mirror=scoring_mirror, 
-                                      batch_size_inference=batch_size_inference,  
-                                      num_workers=num_workers, 
-                                      indel_mode=False,
-                                      past_key_values=past_key_values
-                                      )
+    with tracing.span('Tranception.score_mutants', 'model', variants=len(all_single_mutants)):
+      scores, past_key_values = model.score_mutants(DMS_data=all_single_mutants, 
+                                        target_seq=sequence, 
+                                        scoring_mirror=scoring_mirror, 
+                                        batch_size_inference=batch_size_inference,  
+                                        num_workers=num_workers, 
+                                        indel_mode=False,
+                                        past_key_values=past_key_values
+                                        )
     # print("Single scores computed")
-    scores = pd.merge(scores,all_single_mutants,on="mutated_sequence",how="left")
+    with tracing.span('merge_scores', 'pandas'):
+      scores = pd.merge(scores,all_single_mutants,on="mutated_sequence",how="left")
   elif model_type == 'RITA' or model_type == 'ProtXLNet':
     all_single_mutants['mutated_sequence'] = all_single_mutants['mutated_sequence'].apply(lambda x: process_prompt_protxlnet(x)) if model_type == 'ProtXLNet' else all_single_mutants['mutated_sequence']
-    model_scores = compute_fitness.calc_fitness(model=model, prots=np.array(all_single_mutants['mutated_sequence']), tokenizer=tokenizer, model_type=model_type)
+    with tracing.span(f'{model_type}.calc_fitness', 'model', variants=len(all_single_mutants)):
+      model_scores = compute_fitness.calc_fitness(model=model, prots=np.array(all_single_mutants['mutated_sequence']), tokenizer=tokenizer, model_type=model_type)
     all_single_mutants['avg_score'] = model_scores
     scores = all_single_mutants
     scores['mutated_sequence'] = scores['mutated_sequence'].apply(lambda x: post_process_protxlnet(x, AA_vocab)) if model_type == 'ProtXLNet' else scores['mutated_sequence']
@@ -262,13 +266,18 @@ def score_and_create_matrix_all_singles(sequence, Tranception_model, mutation_ra
     image_index = 0
     window_start = mutation_range_start
     window_end = min(mutation_range_end,mutation_range_start+max_number_positions_per_heatmap-1)
+    # Heatmaps are rendered in the background; the returned paths are written once rendering finishes, and a window
+    # the renderer was too busy to queue is None
+    renderer = heatmaps.get_heatmap_renderer(heatmap_mode)
+    vmin, vmax = np.percentile(scores.avg_score,2), np.percentile(scores.avg_score,98)
     for image_index in range(number_heatmaps):
-      score_heatmaps.append(create_scoring_matrix_visual(scores,sequence,image_index,window_start,window_end,AA_vocab))
+      score_heatmaps.append(renderer.submit(scores,sequence,image_index,window_start,window_end,AA_vocab,vmin,vmax))
       window_start += max_number_positions_per_heatmap
       window_end = min(mutation_range_end,window_start+max_number_positions_per_heatmap-1)
   # return score_heatmaps, suggest_mutations(scores), scores, all_single_mutants, past_key_values
   return score_heatmaps, None, scores, all_single_mutants, past_key_values
 
+@traced(category='scoring')
 def score_multi_mutations(sequence:str, extra_mutants:pd.DataFrame, Tranception_model, mutation_range_start=None,mutation_range_end=None,scoring_mirror=False,batch_size_inference=20,max_number_positions_per_heatmap=50,num_workers=0,AA_vocab=AA_vocab, tokenizer=tokenizer, AR_mode=False, past_key_values=None, verbose=0, model_type='Tranception'):
   if sequence is not None:
     if mutation_range_start is None: mutation_range_start=1
@@ -278,26 +287,29 @@ def score_multi_mutations(sequence:str, extra_mutants:pd.DataFrame, Tranception_
   model = Tranception_model
   # print(f'model: {model}')
   model.config.tokenizer = tokenizer
-  if torch.cuda.is_available():
+  if torch.cuda.is_available() and not cpu_inference.is_cpu_model(model):
     model.cuda()
     print("Inference will take place on GPU") if verbose == 1 else None
   else:
     print("Inference will take place on CPU") if verbose == 1 else None
   if model_type == 'Tranception':
-    scores, past_key_values = model.score_mutants(DMS_data=extra_mutants, 
-                                      target_seq=sequence, 
-                                      scoring_mirror=scoring_mirror, 
-                                      batch_size_inference=batch_size_inference,  
-                                      num_workers=num_workers, 
-                                      indel_mode=False,
-                                      past_key_values=past_key_values,
-                                      verbose=verbose
-                                      )
+    with tracing.span('Tranception.score_mutants', 'model', variants=len(extra_mutants)):
+      scores, past_key_values = model.score_mutants(DMS_data=extra_mutants, 
+                                        target_seq=sequence, 
+                                        scoring_mirror=scoring_mirror, 
+                                        batch_size_inference=batch_size_inference,  
+                                        num_workers=num_workers, 
+                                        indel_mode=False,
+                                        past_key_values=past_key_values,
+                                        verbose=verbose
+                                        )
     print("Scoring done") if verbose == 1 else None
-    scores = pd.merge(scores,extra_mutants,on="mutated_sequence",how="left")
+    with tracing.span('merge_scores', 'pandas'):
+      scores = pd.merge(scores,extra_mutants,on="mutated_sequence",how="left")
   elif model_type == 'RITA' or model_type == 'ProtXLNet':
     extra_mutants['mutated_sequence'] = extra_mutants['mutated_sequence'].apply(lambda x: process_prompt_protxlnet(x)) if model_type == 'ProtXLNet' else extra_mutants['mutated_sequence']
-    model_scores = compute_fitness.calc_fitness(model=model, prots=np.array(extra_mutants['mutated_sequence']), tokenizer=tokenizer, model_type=model_type)
+    with tracing.span(f'{model_type}.calc_fitness', 'model', variants=len(extra_mutants)):
+      model_scores = compute_fitness.calc_fitness(model=model, prots=np.array(extra_mutants['mutated_sequence']), tokenizer=tokenizer, model_type=model_type)
     extra_mutants['avg_score'] = model_scores
     scores = extra_mutants
     scores['mutated_sequence'] = scores['mutated_sequence'].apply(lambda x: post_process_protxlnet(x, AA_vocab)) if model_type == 'ProtXLNet' else scores['mutated_sequence']
@@ -322,10 +334,73 @@ def clear_inputs(protein_sequence_input,mutation_range_start,mutation_range_end)
   mutation_range_end = None
   return protein_sequence_input,mutation_range_start,mutation_range_end, extra_mutants
 
+@traced(category='load')
 def load_savedmodel(model_path):
   model = keras.models.load_model(model_path)
   return model
 
+@lru_cache(maxsize=None)
+def proteinBERT_token_lut():
+  """ProteinBERT token of every byte value (amino acids are case-sensitive, anything else is <OTHER>)."""
+  token_lut = np.full(256, proteinbert_tokenization.additional_token_to_index['<OTHER>'], dtype=np.int32)
+  for aa, token_index in proteinbert_tokenization.aa_to_token_index.items():
+    token_lut[ord(aa)] = token_index
+  return token_lut
+
+# Traced predict steps per ProteinBERT model (and number of annotations), dropped with the model
+_proteinBERT_predict_steps = weakref.WeakKeyDictionary()
+
+def encode_proteinBERT(sequences, seq_len):
+  """
+  Vectorized equivalent of proteinbert.tokenize_seqs: <START> + tokens + <END>, padded with <PAD> to seq_len,
+  as an int32 array of shape (len(sequences), seq_len).
+  """
+  additional_token_to_index = proteinbert_tokenization.additional_token_to_index
+  lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+  max_length = int(lengths.max()) if len(sequences) > 0 else 0
+  assert max_length + proteinbert_tokenization.ADDED_TOKENS_PER_SEQ <= seq_len, f"Sequences of length {max_length} do not fit the model input length {seq_len}"
+  chars = np.array(sequences, dtype=f'S{max(max_length, 1)}').view(np.uint8).reshape(len(sequences), -1)
+  tokens = np.full((len(sequences), seq_len), additional_token_to_index['<PAD>'], dtype=np.int32)
+  tokens[:, 0] = additional_token_to_index['<START>']
+  tokens[:, 1:1 + chars.shape[1]] = np.where(np.arange(chars.shape[1])[None, :] < lengths[:, None], proteinBERT_token_lut()[chars], additional_token_to_index['<PAD>'])
+  tokens[np.arange(len(sequences)), lengths + 1] = additional_token_to_index['<END>']
+  return tokens
+
+def _proteinBERT_predict_step(model, n_annotations):
+  """tf.function running the model on a batch of tokens with empty annotations, traced once per model."""
+  steps = _proteinBERT_predict_steps.setdefault(model, {})
+  if n_annotations not in steps:
+    # the step only holds a weak reference, otherwise the cache entry would keep its own key alive
+    model_ref = weakref.ref(model)
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, model.inputs[0].shape[1]), dtype=tf.int32)])
+    def predict_step(tokens):
+      annotations = tf.zeros((tf.shape(tokens)[0], n_annotations), dtype=tf.float32)
+      return tf.reshape(model_ref()([tokens, annotations], training=False), (tf.shape(tokens)[0], -1))
+    steps[n_annotations] = predict_step
+  return steps[n_annotations]
+
+@traced(category='filter')
+def predict_proteinBERT(model, DMS, input_encoder, top_n, batch_size=128, return_score=False, device=None):
+  """
+  Quantitative-Function Filter with a fine-tuned ProteinBERT regression model: scores every variant of DMS and keeps the
+  top_n, ranked by decreasing score (ties keep the DMS order). Runs on the default TensorFlow device unless device is given
+  (e.g. '/CPU:0').
+  """
+  seq_len = model.inputs[0].shape[1]
+  tokens = encode_proteinBERT(DMS['mutated_sequence'].tolist(), seq_len)
+  dataset = tf.data.Dataset.from_tensor_slices(tokens).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+  predict_step = _proteinBERT_predict_step(model, input_encoder.n_annotations)
+  with tf.device(device) if device is not None else contextlib.nullcontext():
+    scores = np.concatenate([predict_step(batch).numpy()[:, 0] for batch in dataset]) if len(tokens) > 0 else np.zeros(0)
+  DMS = DMS.copy()
+  DMS['ProteinBERT'] = scores
+  DMS = DMS.iloc[np.argsort(-scores, kind='stable')].reset_index(drop=True)
+  if return_score:
+    return DMS[['mutated_sequence', 'mutant', 'ProteinBERT']].head(top_n)
+  else:
+    return DMS[['mutated_sequence', 'mutant']].head(top_n)
+
+@traced(category='filter')
 def predict_evmutation(DMS, top_n, ev_model, return_evscore=False):
   # Load Model
   # c = CouplingsModel(model_params)
@@ -334,7 +409,7 @@ def predict_evmutation(DMS, top_n, ev_model, return_evscore=False):
   # print("===Predicting EVmutation===")
   DMS['mutant'] = DMS['mutant'].str.replace(':', ',')
   # print(f'ev predict table: {DMS}')
-  DMS = predict_mutation_table(c, DMS, output_column="EVmutation")
+  DMS = evmutation_tools.predict_mutation_table(c, DMS, output_column="EVmutation")
   DMS = DMS.sort_values(by = 'EVmutation', ascending = False, ignore_index = True)
   # print(f'ev result table: {DMS}')
   # print("===Predicting EVmutation Done===")
@@ -361,46 +436,93 @@ def get_all_possible_mutations_at_pos(sequence: str, position: int, or_mutant=No
     else:
       return pd.DataFrame(mutations)
 
-def get_attention_mutants(DMS, AMSmodel, focus='highest', top_n = 5, AA_vocab=AA_vocab, tokenizer=tokenizer, model_type='Tranception'):
+def _last_layer_attention_scores(AMSmodel, input_ids, query_mask):
+  """
+  Mean attention received by each key position in the last Tranception block, averaged over heads and real
+  (non-padding) query positions. The last block's _attn is wrapped for the duration of the forward pass, so
+  only a (batch, length) summary is kept instead of every layer's heads x length x length attention.
+  """
+  last_attention = AMSmodel.transformer.h[-1].attn
+  attn = last_attention._attn
+  captured = {}
+  def _attn(query, key, value, attention_mask=None, head_mask=None, alibi_bias=None):
+    attn_output, attn_weights = attn(query, key, value, attention_mask, head_mask, alibi_bias=alibi_bias)
+    mask = query_mask.to(attn_weights.dtype)
+    captured['scores'] = torch.einsum('bhqk,bq->bk', attn_weights, mask) / (attn_weights.shape[1] * mask.sum(dim=-1, keepdim=True))
+    return attn_output, attn_weights
+  last_attention._attn = _attn
+  try:
+    AMSmodel(input_ids=input_ids, return_dict=True)
+  finally:
+    del last_attention._attn
+  return captured['scores']
+
+@traced(category='filter')
+def get_attention_mutants(DMS, AMSmodel, focus='highest', top_n = 5, AA_vocab=AA_vocab, tokenizer=tokenizer, model_type='Tranception', batch_size=32):
+  """
+  Attention-Matrix Sampling: for every row of DMS, all single mutants (on top of its mutant) at the top_n positions
+  receiving the highest (or lowest) last-layer attention. Rows are scored in padded batches on the model's device.
+  """
   os.environ["TOKENIZERS_PARALLELISM"] = "false"
-  new_mutations = []
-  for idx, row in tqdm.tqdm(DMS.iterrows(), total=len(DMS), desc=f'Getting attention mutants'):
-    sequence = row['mutated_sequence']
-    sequence = process_prompt_protxlnet(sequence) if model_type == 'ProtXLNet' else sequence
-    mutant = row['mutant']
-
-    # Get attention scores
-    inputs = torch.tensor([tokenizer.encode(sequence)]).to("cuda")
-    if model_type == 'Tranception':
-      attention_weights = AMSmodel(input_ids=inputs, return_dict=True, output_attentions=True).attentions
-      attention_scores = attention_weights[-1][0].mean(dim=(0, 1))[1:-1].tolist()
-    elif model_type == 'RITA':
-      attention_weights = AMSmodel(input_ids=inputs).hidden_states
-      attention_scores = attention_weights[-1].mean(dim=1)[:-1].tolist()
-    elif model_type == 'ProtXLNet':
-      inputs = tokenizer.batch_encode_plus([sequence], add_special_tokens=True, pad_to_max_length=False)
-      input_ids, attention_mask = torch.tensor(inputs['input_ids']).to("cuda"), torch.tensor(inputs['attention_mask']).to("cuda")
-      attention_weights = AMSmodel(input_ids=input_ids, attention_mask=attention_mask, mems=None, return_dict=True, output_attentions=True).attentions
-      attention_scores = attention_weights[-1][0].mean(dim=(0, 1))[1:-1].tolist()
-      sequence = post_process_protxlnet(sequence)
-    else: 
-      raise ValueError('Invalid model type')
-    # print(f'as: {attention_scores}')
-    
-
-    if focus == 'highest':
-      ind = np.argpartition(attention_scores, -top_n)[-top_n:]
-    elif focus == 'lowest':
-      ind = np.argpartition(attention_scores, top_n)[:top_n]
-    else:
-      raise ValueError('Invalid focus value')
-    
-    # Mutate sequence at positions with highest attention scores
-    for pos in ind:
-      dict_pos = get_all_possible_mutations_at_pos(sequence, pos, or_mutant=mutant, return_dict=True)
-      new_mutations.extend(dict_pos)
-  
-  new_mutations = pd.DataFrame(new_mutations)
+  if focus not in ['highest', 'lowest']:
+    raise ValueError('Invalid focus value')
+  if model_type not in ['Tranception', 'RITA', 'ProtXLNet']:
+    raise ValueError('Invalid model type')
+  device = next(AMSmodel.parameters()).device
+  sequences = DMS['mutated_sequence'].tolist()
+  or_mutants = DMS['mutant'].tolist()
+  top_positions = []
+  with torch.no_grad():
+    for batch_start in tqdm.tqdm(range(0, len(sequences), batch_size), desc=f'Getting attention mutants'):
+      batch_sequences = sequences[batch_start:batch_start + batch_size]
+      prompts = [process_prompt_protxlnet(sequence) for sequence in batch_sequences] if model_type == 'ProtXLNet' else batch_sequences
+      tokens = [tokenizer.encode(prompt) for prompt in prompts]
+      lengths = torch.tensor([len(t) for t in tokens], device=device)
+      max_length = int(lengths.max())
+      pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+      input_ids = torch.tensor([t + [pad_id] * (max_length - len(t)) for t in tokens], device=device)
+      token_mask = torch.arange(max_length, device=device)[None, :] < lengths[:, None]
+
+      # Per-token scores, then the same token window as the single-sequence version: [1:-1] for Tranception and ProtXLNet, [:-1] for RITA
+      if model_type == 'Tranception':
+        token_scores = _last_layer_attention_scores(AMSmodel, input_ids, token_mask)
+        offset = 1
+      elif model_type == 'RITA':
+        token_scores = AMSmodel(input_ids=input_ids).hidden_states.mean(dim=-1)
+        offset = 0
+      else:
+        attention = AMSmodel(input_ids=input_ids, attention_mask=token_mask.long(), mems=None, return_dict=True, output_attentions=True).attentions[-1]
+        mask = token_mask.to(attention.dtype)
+        token_scores = torch.einsum('bhqk,bq->bk', attention, mask) / (attention.shape[1] * mask.sum(dim=-1, keepdim=True))
+        offset = 1
+      # Position p of a sequence is token p+offset; only positions that exist in the (unprocessed) sequence can be mutated
+      sequence_lengths = torch.tensor([len(sequence) for sequence in batch_sequences], device=device)
+      num_scores = torch.minimum(lengths - offset - 1, sequence_lengths)
+      scores = token_scores[:, offset:].float()
+      valid = torch.arange(scores.shape[1], device=device)[None, :] < num_scores[:, None]
+      scores = scores.masked_fill(~valid, float('-inf') if focus == 'highest' else float('inf'))
+      # Every row gets top_n columns: a row with fewer positions than that keeps all of them and is padded with -1
+      k = min(top_n, scores.shape[1])
+      batch_positions = torch.topk(scores, k=k, dim=-1, largest=(focus == 'highest')).indices
+      batch_positions = batch_positions.masked_fill(torch.arange(k, device=device)[None, :] >= num_scores[:, None], -1)
+      top_positions.append(torch.nn.functional.pad(batch_positions, (0, top_n - k), value=-1).cpu())
+  top_positions = torch.cat(top_positions).numpy()
+
+  # Expand (row, position) pairs into all 19 substitutions as index arrays
+  vocab = np.frombuffer(AA_vocab.encode(), dtype=np.uint8)
+  row_index = np.repeat(np.arange(len(sequences)), top_positions.shape[1])
+  position_index = top_positions.reshape(-1)
+  row_index, position_index = row_index[position_index >= 0], position_index[position_index >= 0]
+  row_index = np.repeat(row_index, len(vocab))
+  position_index = np.repeat(position_index, len(vocab))
+  substitution = np.tile(vocab, len(row_index) // len(vocab))
+  wild_type = np.array([ord(sequences[r][p]) for r, p in zip(row_index[::len(vocab)], position_index[::len(vocab)])], dtype=np.uint8).repeat(len(vocab))
+  keep = substitution != wild_type
+  row_index, position_index, substitution, wild_type = row_index[keep], position_index[keep], substitution[keep], wild_type[keep]
+
+  mutated_sequences = [sequences[r][:p] + chr(aa) + sequences[r][p+1:] for r, p, aa in zip(row_index, position_index, substitution)]
+  mutant_codes = [f"{or_mutants[r]}:{chr(wt)}{p+1}{chr(aa)}" if or_mutants[r] else f"{chr(wt)}{p+1}{chr(aa)}" for r, p, wt, aa in zip(row_index, position_index, wild_type, substitution)]
+  new_mutations = pd.DataFrame({'mutant': mutant_codes, 'mutated_sequence': mutated_sequences})
   new_mutations = new_mutations.drop_duplicates(subset=['mutant']).reset_index(drop=True)
   return new_mutations[['mutant','mutated_sequence']]
 
@@ -436,17 +558,18 @@ def post_process_protxlnet(s, AA_vocab=AA_vocab):
   seq = ''.join(cleaned_seq).replace(' ', '').replace("\n", "")
   return seq
 
-def stratified_filtering(DMS, threshold, column_name='EVmutation'):
+@traced(category='filter')
+def stratified_filtering(DMS, threshold, column_name='EVmutation', random_state=None):
   try:
     DMS['strata'] = pd.qcut(DMS[column_name], q=4, labels=['very low', 'low', 'high', 'very high'])
   except IndexError:
     print(f'Indexing Error: {column_name} may not be scored properly')
-    return DMS[['mutant', 'mutated_sequence']].reset_index(drop=True).sample(n=threshold)
+    return DMS[['mutant', 'mutated_sequence']].reset_index(drop=True).sample(n=threshold, random_state=random_state)
   if threshold >= 4:
     threshold = threshold // 4
   elif threshold < 4:
     threshold = 1
-  filtered = DMS.groupby('strata', group_keys=False).apply(lambda x: x.sample(min(len(x), threshold)))
+  filtered = DMS.groupby('strata', group_keys=False).apply(lambda x: x.sample(min(len(x), threshold), random_state=random_state))
   return filtered[['mutant', 'mutated_sequence']].reset_index(drop=True)
 ############################################################################################################
 def list_of_dicts_to_df(lst):
@@ -512,6 +635,7 @@ def generate_1extra_mutation(
 #   df = pd.concat(df.to_list(), ignore_index=True)
 #   return df
 
+@traced(category='mutants')
 def apply_gen_1extra(
     DMS,
     AA_vocab=AA_vocab,
@@ -0,0 +1,49 @@
+import os
+import importlib
+import threading
+
+# transformers imports TensorFlow whenever it is installed, even though every model it loads here is
+# PyTorch; the ProteinBERT filter imports TensorFlow itself when it is used
+os.environ.setdefault("USE_TF", "0")
+os.environ.setdefault("USE_TORCH", "1")
+
+class LazyModule:
+    """
+    Stand-in for a heavy module that is only imported on first attribute access, e.g.
+    tf = LazyModule("tensorflow") costs nothing until tf.function or tf.data is used.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+def is_loaded(module):
+    return not isinstance(module, LazyModule) or module._module is not None
+
+# ProteinBERT Quantitative-Function Filter
+tf = LazyModule("tensorflow")
+keras = LazyModule("tensorflow.keras")
+proteinbert_tokenization = LazyModule("proteinbert.tokenization")
+# EVmutation filters (numba-compiled)
+evmutation_model = LazyModule("EVmutation.model")
+evmutation_tools = LazyModule("EVmutation.tools")
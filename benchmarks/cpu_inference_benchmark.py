@@ -0,0 +1,91 @@
+# Accuracy and throughput of the CPU inference modes (cpu_inference.prepare_model: int8 dynamic quantization of the linear
+# layers, bfloat16 autocast, or both) against the fp32 model, scoring all single mutants of a sequence through
+# app.score_and_create_matrix_all_singles as generator.py does. Ranked avg_score outputs are compared with fp32 (Spearman
+# correlation, overlap of the top-k mutants, agreement of the best mutant) on tiny synthetic models (benchmarks/synthetic.py)
+# or on a real checkpoint (--checkpoint, a regular or a converted checkpoint as in generator.py --Tmodel).
+# Exits 1 if a mode falls below --min_spearman.
+# Usage: python benchmarks/cpu_inference_benchmark.py [--model_type Tranception RITA] [--n_embd 256 --n_layer 4] [--length 200]
+#        python benchmarks/cpu_inference_benchmark.py --model_type RITA --checkpoint ~/RITA_s --threads 8
+import os
+import sys
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+from scipy.stats import spearmanr
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+import app
+import checkpoints
+import cpu_inference
+
+def load_checkpoint(model_type, path):
+  from transformers import AutoModelForCausalLM, AutoTokenizer
+  from tranception.model_pytorch import TranceptionLMHeadModel
+  if model_type == 'Tranception':
+    tokenizer = app.tokenizer
+    model = checkpoints.load_converted(path) if checkpoints.is_converted(path) else TranceptionLMHeadModel.from_pretrained(path, local_files_only=True)
+  else:
+    tokenizer = AutoTokenizer.from_pretrained(path)
+    model = checkpoints.load_converted(path) if checkpoints.is_converted(path) else AutoModelForCausalLM.from_pretrained(path, local_files_only=True, trust_remote_code=True)
+  return model.eval(), tokenizer
+
+def score(model, tokenizer, model_type, sequence, batch_size):
+  model.throughput.reset()
+  start = time.perf_counter()
+  _, _, scores, _, _ = app.score_and_create_matrix_all_singles(sequence, model, scoring_mirror=False, batch_size_inference=batch_size, num_workers=0,
+                                                               AA_vocab=app.AA_vocab, tokenizer=tokenizer, with_heatmap=False, model_type=model_type)
+  elapsed = time.perf_counter() - start
+  return scores.set_index('mutant')['avg_score'], elapsed, model.throughput.rows_per_second
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model_type', nargs='+', choices=['Tranception', 'RITA'], default=['Tranception', 'RITA'])
+  parser.add_argument('--checkpoint', type=str, default=None, help='Real checkpoint to evaluate (one --model_type)')
+  parser.add_argument('--modes', nargs='+', choices=['int8', 'bf16', 'int8+bf16'], default=['int8', 'bf16', 'int8+bf16'])
+  parser.add_argument('--length', type=int, default=200, help='Length of the scored sequence (all its single mutants are scored)')
+  parser.add_argument('--sequence', type=str, default=None, help='Sequence to mutate (default: a random one of --length)')
+  parser.add_argument('--n_embd', type=int, default=256, help='Width of the synthetic models')
+  parser.add_argument('--n_layer', type=int, default=4, help='Depth of the synthetic models')
+  parser.add_argument('--batch_size', type=int, default=64)
+  parser.add_argument('--threads', type=int, default=4, help='CPU threads (fixed for comparable numbers)')
+  parser.add_argument('--top_k', type=int, default=20, help='Size of the top-ranked mutant sets compared with fp32')
+  parser.add_argument('--min_spearman', type=float, default=0.9)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  if args.checkpoint and len(args.model_type) != 1:
+    parser.error("--checkpoint needs a single --model_type")
+
+  sequence = args.sequence or synthetic.random_sequence(args.length, args.seed)
+  builders = {'Tranception': synthetic.tiny_tranception, 'RITA': synthetic.tiny_rita}
+  failed = []
+  print(f"{len(sequence) * 19} single mutants of a length {len(sequence)} sequence, {args.threads} threads")
+  print(f"{'model':<12} {'mode':<10} {'seconds':>8} {'seq/s':>8} {'speed-up':>9} {'spearman':>9} {f'top-{args.top_k}':>7} {'best':>5} {'max |diff|':>11}")
+  for model_type in args.model_type:
+    if args.checkpoint:
+      model, tokenizer = load_checkpoint(model_type, args.checkpoint)
+    else:
+      model, tokenizer = builders[model_type](n_embd=args.n_embd, n_layer=args.n_layer, seed=args.seed)
+    reference = cpu_inference.prepare_model(copy.deepcopy(model), int8=False, bf16=False, num_threads=args.threads)
+    with torch.no_grad():
+      score(reference, tokenizer, model_type, sequence, args.batch_size) # warm-up
+      fp32_scores, fp32_time, fp32_rate = score(reference, tokenizer, model_type, sequence, args.batch_size)
+    print(f"{model_type:<12} {'fp32':<10} {fp32_time:>8.2f} {fp32_rate:>8.1f} {'':>9} {'':>9} {'':>7} {'':>5} {'':>11}")
+    fp32_top = set(fp32_scores.nlargest(args.top_k).index)
+    for mode in args.modes:
+      prepared = cpu_inference.prepare_model(copy.deepcopy(model), int8='int8' in mode, bf16='bf16' in mode, num_threads=args.threads)
+      with torch.no_grad():
+        score(prepared, tokenizer, model_type, sequence, args.batch_size)
+        mode_scores, mode_time, mode_rate = score(prepared, tokenizer, model_type, sequence, args.batch_size)
+      mode_scores = mode_scores.reindex(fp32_scores.index)
+      rho = spearmanr(fp32_scores.values, mode_scores.values).correlation
+      overlap = len(fp32_top & set(mode_scores.nlargest(args.top_k).index)) / args.top_k
+      same_best = fp32_scores.idxmax() == mode_scores.idxmax()
+      max_diff = np.abs(fp32_scores.values - mode_scores.values).max()
+      print(f"{model_type:<12} {mode:<10} {mode_time:>8.2f} {mode_rate:>8.1f} {fp32_time / mode_time:>8.2f}x {rho:>9.4f} {overlap:>7.0%} {'yes' if same_best else 'no':>5} {max_diff:>11.2e}")
+      if not rho >= args.min_spearman:
+        failed.append(f"{model_type} {mode}")
+  if failed:
+    sys.exit(f"Spearman correlation with fp32 below {args.min_spearman}: {', '.join(failed)}")
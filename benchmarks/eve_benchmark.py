@@ -0,0 +1,90 @@
+# EVE evolutionary-index benchmark: the per-sample loop ('full' aggregation) vs the batched engine ('batched') of
+# VAE_model.compute_evol_indices_chunk, on a tiny randomly initialised VAE and a synthetic MSA (see benchmarks/synthetic.py).
+# Both runs start from the same seed; the batched engine makes the same random draws in the same order, so the mean /
+# std of the ELBO samples and the evolutionary indices are checked to agree before timing.
+# On CPU the random draws bound both runs; the batched engine saves the per-sample encoder passes and small kernels, which
+# shows with the EVE model sizes (--model_params scoring_metrics/ProteinGym/proteingym/baselines/EVE/EVE/default_model_params.json).
+# Usage: python benchmarks/eve_benchmark.py [--length 100] [--num_mutants 500] [--num_samples 200] [--samples_memory_budget 0.25]
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "scoring_metrics", "ProteinGym", "proteingym", "baselines", "EVE"))
+from EVE import VAE_model
+from utils import data_utils
+
+MODEL_PARAMS = {
+  "encoder_parameters": {"hidden_layers_sizes": [128, 64], "z_dim": 8, "convolve_input": False, "convolution_input_depth": 8,
+                         "nonlinear_activation": "relu", "dropout_proba": 0.0},
+  "decoder_parameters": {"hidden_layers_sizes": [64, 128], "z_dim": 8, "bayesian_decoder": True, "first_hidden_nonlinearity": "relu",
+                         "last_hidden_nonlinearity": "relu", "dropout_proba": 0.1, "convolve_output": True, "convolution_output_depth": 8,
+                         "include_temperature_scaler": True, "include_sparsity": False, "num_tiles_sparsity": 0, "logit_sparsity_p": 0},
+}
+
+def tiny_vae(msa_data, sparsity=False, seed=0, model_params=MODEL_PARAMS):
+  params = copy.deepcopy(model_params)
+  if sparsity:
+    params["decoder_parameters"].update(include_sparsity=True, num_tiles_sparsity=2, logit_sparsity_p=0.1)
+  return VAE_model.VAE_model(model_name="tiny", data=msa_data, encoder_parameters=params["encoder_parameters"],
+                             decoder_parameters=params["decoder_parameters"], random_seed=seed)
+
+def synthetic_data(workdir, length, depth, num_mutants, seed):
+  target = synthetic.random_sequence(length, seed)
+  names, sequences = synthetic.synthetic_msa(target, depth=depth, seed=seed)
+  names[0] = f"TARGET/1-{length}"
+  msa_data = data_utils.MSA_processing(MSA_location=synthetic.write_fasta(os.path.join(workdir, "msa.a2m"), names, sequences),
+                                       preprocess_MSA=False, use_weights=False)
+  rng = np.random.default_rng(seed)
+  singles = msa_data.all_single_mutations
+  mutants = [":".join(sorted(rng.choice(singles, size=rng.integers(1, 3), replace=False), key=lambda mutant: int(mutant[1:-1])))
+             for _ in range(num_mutants)]
+  mutants = [mutant for mutant in dict.fromkeys(mutants) if len({m[1:-1] for m in mutant.split(":")}) == mutant.count(":") + 1]
+  return msa_data, pd.DataFrame({"mutations": mutants})
+
+def evol_indices(model, msa_data, mutants, num_samples, batch_size, method, memory_budget, seed):
+  torch.manual_seed(seed)
+  start = time.perf_counter()
+  _, indices, _, std = model.compute_evol_indices_chunk(msa_data=msa_data, list_mutations_location=mutants, num_samples=num_samples,
+                                                        batch_size=batch_size, aggregation_method=method, samples_memory_budget=memory_budget)
+  return time.perf_counter() - start, np.asarray(indices), np.asarray(std)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--length', type=int, default=100, help='Length of the synthetic protein')
+  parser.add_argument('--depth', type=int, default=200, help='Sequences in the synthetic MSA')
+  parser.add_argument('--num_mutants', type=int, default=500)
+  parser.add_argument('--num_samples', type=int, default=200, help='ELBO samples per mutant')
+  parser.add_argument('--batch_size', type=int, default=256)
+  parser.add_argument('--model_params', type=str, default=None, help='JSON with encoder_parameters / decoder_parameters (default: a tiny VAE)')
+  parser.add_argument('--samples_memory_budget', type=float, default=0.25, help='GB for the samples of the batched engine')
+  parser.add_argument('--threads', type=int, default=1, help='torch CPU threads (fixed for comparable numbers)')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  torch.set_num_threads(args.threads)
+  memory_budget = int(args.samples_memory_budget * 2**30)
+  model_params = MODEL_PARAMS
+  if args.model_params:
+    with open(args.model_params) as fh:
+      model_params = json.load(fh)
+  with tempfile.TemporaryDirectory(prefix="sampling_proteins_eve_") as workdir:
+    msa_data, mutants = synthetic_data(workdir, args.length, args.depth, args.num_mutants, args.seed)
+  print(f"{'decoder':<10} {'mutants':>8} {'samples':>8} {'loop s':>8} {'batched s':>10} {'speed-up':>9} {'max |diff| index':>17} {'max |diff| std':>15}")
+  for sparsity in (False, True):
+    model = tiny_vae(msa_data, sparsity=sparsity, seed=args.seed, model_params=model_params)
+    loop_time, loop_indices, loop_std = evol_indices(model, msa_data, mutants, args.num_samples, args.batch_size, "full", memory_budget, args.seed)
+    batched_time, batched_indices, batched_std = evol_indices(model, msa_data, mutants, args.num_samples, args.batch_size, "batched", memory_budget, args.seed)
+    index_diff, std_diff = np.abs(loop_indices - batched_indices).max(), np.abs(loop_std - batched_std).max()
+    print(f"{'sparsity' if sparsity else 'default':<10} {len(loop_indices):>8} {args.num_samples:>8} {loop_time:>8.2f} {batched_time:>10.2f} "
+          f"{loop_time / batched_time:>8.1f}x {index_diff:>17.2e} {std_diff:>15.2e}")
+    if not (np.allclose(loop_indices, batched_indices, rtol=1e-4, atol=1e-3) and np.allclose(loop_std, batched_std, rtol=1e-3, atol=1e-3)):
+      sys.exit("The batched engine does not reproduce the statistics of the sample loop")
@@ -0,0 +1,59 @@
+# Batched Gibbs chains for ESM-MSA (ESM_MSA_sampler.generate_chains) vs one generate_single call per chain, on a tiny
+# randomly initialised MSA Transformer and a synthetic MSA (see benchmarks/synthetic.py). Outputs are random, so they are only
+# checked for length and alphabet; greedy chains (burn_in=0, k=1) started from the same bins are checked to agree.
+# Usage: python benchmarks/gibbs_benchmark.py [--length 100] [--depth 16] [--chains 64] [--batch_size 16] [--steps 10] [--passes 3]
+import os
+import sys
+import time
+import argparse
+import torch
+import esm
+from esm.model.msa_transformer import MSATransformer
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "scoring_metrics", "protein_gibbs_sampler", "src"))
+from pgen.esm_msa_sampler import ESM_MSA_sampler, ESM_MSA_ALLOWED_AMINO_ACIDS
+
+class TinyESM_MSA():
+  def __init__(self, seed=0):
+    self.alphabet = esm.Alphabet.from_architecture("MSA Transformer")
+    torch.manual_seed(seed)
+    args = argparse.Namespace(layers=2, embed_dim=32, logit_bias=True, ffn_embed_dim=64, attention_heads=4, dropout=0.0, attention_dropout=0.0,
+                              activation_dropout=0.0, max_tokens=2**14, max_positions=1024, embed_positions_msa=True)
+    self.model = MSATransformer(args, self.alphabet).eval()
+    self.batch_converter = self.alphabet.get_batch_converter()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--length', type=int, default=100, help='Alignment length')
+  parser.add_argument('--depth', type=int, default=16, help='Sequences in the seed MSA (the last one is sampled)')
+  parser.add_argument('--chains', type=int, default=64, help='Sequences to generate')
+  parser.add_argument('--batch_size', type=int, default=16, help='Chains per forward call')
+  parser.add_argument('--steps', type=int, default=10)
+  parser.add_argument('--passes', type=int, default=3)
+  parser.add_argument('--threads', type=int, default=1, help='torch CPU threads (fixed for comparable numbers)')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  torch.set_num_threads(args.threads)
+  sampler = ESM_MSA_sampler(TinyESM_MSA(args.seed), device="cpu")
+  _, seed_msa = synthetic.synthetic_msa(synthetic.random_sequence(args.length, args.seed), depth=args.depth, seed=args.seed)
+  settings = dict(steps=args.steps, passes=args.passes, burn_in=1)
+
+  start = time.perf_counter()
+  serial = [sampler.generate_single(seed_msa, **settings) for _ in range(args.chains)]
+  serial_time = time.perf_counter() - start
+  start = time.perf_counter()
+  batched = sampler.generate_chains([seed_msa] * args.chains, batch_size=args.batch_size, **settings)
+  batched_time = time.perf_counter() - start
+  for sequence in serial + batched:
+    if len(sequence) != args.length or not set(sequence) <= set(ESM_MSA_ALLOWED_AMINO_ACIDS):
+      sys.exit(f"Generated sequence of length {len(sequence)} with characters {sorted(set(sequence))}")
+  greedy = sampler.generate_chains([seed_msa] * 4, steps=1, passes=2, burn_in=0, k=1, batch_size=4)
+  if len(set(greedy)) != 1:
+    sys.exit("Greedy chains on the same MSA diverged")
+
+  print(f"\n{args.chains} chains, {args.depth} x {args.length} seed MSA, {args.passes} passes of {args.steps} steps")
+  print(f"{'generate_single loop':<28} {serial_time:>8.2f}s")
+  print(f"{'generate_chains (batch ' + str(args.batch_size) + ')':<28} {batched_time:>8.2f}s ({serial_time / batched_time:.1f}x)")
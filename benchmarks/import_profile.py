@@ -0,0 +1,66 @@
+# Import-time profile of a module or entry point script, aggregated per top-level package.
+# Runs the target under `python -X importtime` in a fresh interpreter (scripts are run with --help, which
+# stops right after their imports) and reports the self import time of every package, slowest first.
+# Usage: python benchmarks/import_profile.py [app | generator.py | ...] [--top 20] [--modules] [--json out.json]
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+def target_command(target):
+  """Interpreter arguments that import target: a module name, or a script run with --help."""
+  if target.endswith(".py"):
+    return [os.path.join(REPO_DIR, target), "--help"]
+  return ["-c", f"import {target}"]
+
+def profile_imports(target):
+  """(module, self seconds, cumulative seconds, depth) of every module imported by target, in import order."""
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+  result = subprocess.run([sys.executable, "-X", "importtime", *target_command(target)], cwd=REPO_DIR, env=env, capture_output=True, text=True)
+  records = []
+  for line in result.stderr.splitlines():
+    match = IMPORTTIME_LINE.match(line)
+    if match:
+      self_us, cumulative_us, indent, module = match.groups()
+      records.append((module, int(self_us) / 1e6, int(cumulative_us) / 1e6, (len(indent) - 1) // 2))
+  if result.returncode != 0 and not records:
+    raise RuntimeError(f"Importing {target} failed:\n{result.stderr[-2000:]}")
+  return records
+
+def per_package(records):
+  """Self import time summed per top-level package, slowest first."""
+  totals = {}
+  for module, self_time, _, _ in records:
+    package = module.split(".")[0]
+    totals[package] = totals.get(package, 0.0) + self_time
+  return sorted(totals.items(), key=lambda item: -item[1])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('target', nargs='?', default='app', help='Module to import, or entry point script (e.g. generator.py)')
+  parser.add_argument('--top', type=int, default=20, help='Number of rows to show')
+  parser.add_argument('--modules', action='store_true', help='Rank individual modules by cumulative time instead of packages by self time')
+  parser.add_argument('--json', type=str, default=None, help='Also write the full per-package and per-module profile to this file')
+  args = parser.parse_args()
+
+  records = profile_imports(args.target)
+  total = sum(self_time for _, self_time, _, _ in records)
+  packages = per_package(records)
+  print(f"{args.target}: {total:.2f}s spent importing {len(records)} modules")
+  if args.modules:
+    rows = sorted(((module, cumulative) for module, _, cumulative, _ in records), key=lambda row: -row[1])
+    print(f"{'module':<60} {'cumulative':>10}")
+  else:
+    rows = packages
+    print(f"{'package':<60} {'self':>10}")
+  for name, seconds in rows[:args.top]:
+    print(f"{name:<60} {seconds:>9.3f}s")
+  if args.json:
+    with open(args.json, "w") as fh:
+      json.dump({'target': args.target, 'total': total, 'packages': dict(packages),
+                 'modules': [{'module': m, 'self': s, 'cumulative': c, 'depth': d} for m, s, c, d in records]}, fh, indent=2)
@@ -0,0 +1,94 @@
+# Model load-time benchmark: regular from_pretrained checkpoints vs converted, memory-mapped checkpoints (checkpoints.py)
+# for Tranception, RITA and ProtXLNet built from the tiny synthetic configs (see benchmarks/synthetic.py).
+# Each load runs in a fresh interpreter, like a generator invocation; the best of --repeats runs is reported together
+# with the RSS growth of the load. Outputs of both loads are checked to be identical before timing.
+# Usage: python benchmarks/load_benchmark.py [--n_embd 256 --n_layer 8] [--repeats 3] [--output load.json]
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+import checkpoints
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BUILDERS = {'Tranception': synthetic.tiny_tranception, 'RITA': synthetic.tiny_rita, 'ProtXLNet': synthetic.tiny_xlnet}
+
+PROBE = """
+import sys, json, time
+import torch, checkpoints, tracing
+import tranception.model_pytorch, transformers
+rss = tracing.current_rss()
+start = time.perf_counter()
+if {converted!r}:
+  model = checkpoints.load_converted({path!r})
+else:
+  model = checkpoints.load_pretrained({model_name!r}, {path!r}).eval()
+print(json.dumps({{'time': time.perf_counter() - start, 'rss_mb': (tracing.current_rss() - rss) / 2**20}}))
+"""
+
+def write_checkpoints(model_name, workdir, n_embd, n_layer, n_head):
+  """Saves the tiny model as a regular checkpoint and converts it; returns both directories."""
+  size = {'d_model' if model_name == 'ProtXLNet' else 'n_embd': n_embd}
+  model, tokenizer = BUILDERS[model_name](n_layer=n_layer, n_head=n_head, **size)
+  if model_name == 'Tranception':
+    del model.config.tokenizer
+  regular_dir = os.path.join(workdir, model_name)
+  model.save_pretrained(regular_dir, safe_serialization=False)
+  if model_name != 'Tranception':
+    tokenizer.save_pretrained(regular_dir)
+  converted_dir = checkpoints.convert_checkpoint(regular_dir, regular_dir + '_converted', model_name)
+  return regular_dir, converted_dir
+
+def check_outputs(model_name, regular_dir, converted_dir):
+  regular = checkpoints.load_pretrained(model_name, regular_dir).eval()
+  converted = checkpoints.load_converted(converted_dir)
+  input_ids = torch.randint(5, 20, (2, 32))
+  with torch.no_grad():
+    return torch.equal(regular(input_ids=input_ids).logits, converted(input_ids=input_ids).logits)
+
+def measure_load(model_name, path, converted, repeats):
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+  runs = []
+  for _ in range(repeats):
+    result = subprocess.run([sys.executable, "-c", PROBE.format(model_name=model_name, path=path, converted=converted)], cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+      raise RuntimeError(f"Loading {path} failed:\n{result.stderr[-2000:]}")
+    runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+  return min(run['time'] for run in runs), min(run['rss_mb'] for run in runs)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--models', type=str, nargs='+', choices=list(BUILDERS), default=list(BUILDERS), help='Models to benchmark')
+  parser.add_argument('--n_embd', type=int, default=32, help='Hidden size of the synthetic models')
+  parser.add_argument('--n_layer', type=int, default=2, help='Number of layers of the synthetic models')
+  parser.add_argument('--n_head', type=int, default=4, help='Number of attention heads of the synthetic models')
+  parser.add_argument('--repeats', type=int, default=3, help='Fresh interpreters per load (best is reported)')
+  parser.add_argument('--output', type=str, default=None, help='Write the results as JSON to this file')
+  args = parser.parse_args()
+
+  workdir = tempfile.mkdtemp(prefix="sampling_proteins_load_")
+  results = []
+  print(f"{'model':<12} {'size MB':>8} {'from_pretrained':>16} {'converted':>10} {'speed-up':>9} {'RSS MB (regular / converted)':>30}")
+  try:
+    for model_name in args.models:
+      regular_dir, converted_dir = write_checkpoints(model_name, workdir, args.n_embd, args.n_layer, args.n_head)
+      if not check_outputs(model_name, regular_dir, converted_dir):
+        sys.exit(f"{model_name}: the converted checkpoint does not reproduce the outputs of the regular one")
+      size_mb = os.path.getsize(os.path.join(converted_dir, checkpoints.WEIGHTS_FILE)) / 2**20
+      regular_time, regular_rss = measure_load(model_name, regular_dir, False, args.repeats)
+      converted_time, converted_rss = measure_load(model_name, converted_dir, True, args.repeats)
+      results.append({'model': model_name, 'size_mb': size_mb, 'from_pretrained': regular_time, 'converted': converted_time,
+                      'from_pretrained_rss_mb': regular_rss, 'converted_rss_mb': converted_rss})
+      print(f"{model_name:<12} {size_mb:>8.1f} {regular_time:>15.3f}s {converted_time:>9.3f}s {regular_time / converted_time:>8.1f}x {regular_rss:>14.1f} / {converted_rss:<14.1f}")
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+  if args.output:
+    with open(args.output, "w") as fh:
+      json.dump({'n_embd': args.n_embd, 'n_layer': args.n_layer, 'n_head': args.n_head, 'results': results}, fh, indent=2)
+    print(f"Results saved to {args.output}")
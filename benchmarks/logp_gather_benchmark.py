@@ -0,0 +1,65 @@
+# Per-sequence mean log-probability as computed by the resident CARP / MIF-ST scorers (scoring_metrics/util.py:
+# length_batches + mean_token_log_probability on padded logits) vs the per-sequence full log-softmax of tmp/extract.py and
+# tmp/extract_mif.py, on random logits for sequences of mixed lengths. sequence_models is not needed: the models are
+# replaced by random logits, so this checks the batching and gathering and times them, not the model forward passes.
+# Usage: python benchmarks/logp_gather_benchmark.py [--num_sequences 500] [--min_length 50] [--max_length 400] [--alphabet 30]
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "scoring_metrics"))
+from util import length_batches, mean_token_log_probability
+
+def extract_logp(logits, tokens):
+  """tmp/extract.py: r.log_softmax(dim=-1)[:ell][torch.arange(len(src)), src].mean() with a batch size of 1."""
+  return logits.log_softmax(dim=-1)[torch.arange(len(tokens)), tokens].mean().item()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_sequences', type=int, default=500)
+  parser.add_argument('--min_length', type=int, default=50)
+  parser.add_argument('--max_length', type=int, default=400)
+  parser.add_argument('--alphabet', type=int, default=30, help='Logits per position')
+  parser.add_argument('--max_tokens', type=int, default=8192)
+  parser.add_argument('--max_batch_size', type=int, default=64)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(args.seed)
+  torch.manual_seed(args.seed)
+  lengths = rng.integers(args.min_length, args.max_length + 1, args.num_sequences).tolist()
+  logits = [torch.randn(length, args.alphabet) for length in lengths]
+  tokens = [torch.randint(args.alphabet, (length,)) for length in lengths]
+
+  start = time.perf_counter()
+  expected = np.array([extract_logp(l, t) for l, t in zip(logits, tokens)])
+  loop_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  batches = length_batches(lengths, args.max_tokens, args.max_batch_size)
+  scores = np.zeros(len(lengths))
+  padded_positions = 0
+  for batch_index in batches:
+    width = max(lengths[i] for i in batch_index)
+    padded_positions += width * len(batch_index)
+    batch_logits = torch.zeros(len(batch_index), width, args.alphabet)
+    batch_tokens = torch.zeros(len(batch_index), width, dtype=torch.long)
+    for b, i in enumerate(batch_index):
+      batch_logits[b, :lengths[i]] = logits[i]
+      batch_tokens[b, :lengths[i]] = tokens[i]
+    scores[batch_index] = mean_token_log_probability(batch_logits, batch_tokens, [lengths[i] for i in batch_index])
+  batched_time = time.perf_counter() - start
+
+  if sorted(i for batch_index in batches for i in batch_index) != list(range(len(lengths))):
+    sys.exit("length_batches does not cover every sequence exactly once")
+  if any(len(batch_index) > 1 and len(batch_index) * max(lengths[i] for i in batch_index) > args.max_tokens for batch_index in batches):
+    sys.exit("length_batches exceeds max_tokens")
+  if not np.allclose(scores, expected, atol=1e-5):
+    sys.exit(f"Batched log-probabilities differ from the per-sequence log-softmax by {np.abs(scores - expected).max():.2e}")
+  print(f"\n{len(lengths)} sequences of length {args.min_length}-{args.max_length}, {len(batches)} batches, "
+        f"{padded_positions / sum(lengths) - 1:.1%} padding, max |diff| {np.abs(scores - expected).max():.2e}")
+  print(f"{'per-sequence log_softmax':<26} {loop_time:>8.3f}s")
+  print(f"{'batched gather':<26} {batched_time:>8.3f}s (includes padding the random logits)")
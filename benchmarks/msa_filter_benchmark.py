@@ -0,0 +1,91 @@
+# In-process MSA filter (ProteinGym utils/msa_filter.py, used by esm/compute_fitness.read_msa) on a synthetic MSA with
+# near-duplicate clusters (see benchmarks/synthetic.py). The numba kernels are checked against a plain numpy greedy filter
+# with the same criteria (coverage and identity with the query, greedy maximum pairwise identity from the longest sequences
+# down), then timed cold (first call), from the in-memory cache and from the on-disk index cache of a new process.
+# Usage: python benchmarks/msa_filter_benchmark.py [--length 300] [--depth 5000] [--min_cov 75] [--max_seq_id 90] [--min_seq_id 0]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "scoring_metrics", "ProteinGym", "proteingym"))
+from utils import msa_filter
+
+def clustered_msa(length, depth, seed):
+  """Synthetic MSA whose rows are mutated copies of a few cluster centres, with a2m insert columns ('.' and lower case) in some rows."""
+  rng = np.random.default_rng(seed)
+  target = synthetic.random_sequence(length, seed)
+  _, centres = synthetic.synthetic_msa(target, depth=max(depth // 20, 2), substitution_rate=0.4, gap_rate=0.1, seed=seed)
+  sequences = [target]
+  for i in range(1, depth):
+    centre = np.array(list(centres[rng.integers(len(centres))]))
+    mutated = rng.random(length) < 0.05
+    centre[mutated] = rng.choice(list(synthetic.AA_vocab), mutated.sum())
+    truncated = rng.integers(0, length // 2) if rng.random() < 0.2 else 0
+    centre[:truncated] = "-"
+    sequences.append("".join(centre))
+  return [f"seq{i}" for i in range(depth)], [sequence.replace("-", ".", 1).lower() if i % 7 == 3 else sequence for i, sequence in enumerate(sequences)]
+
+def reference_filter(msa, min_cov, max_seq_id, min_seq_id):
+  residues = msa != msa_filter.GAP
+  query = msa[0]
+  num_residues = residues.sum(1)
+  covered = (residues & (query != msa_filter.GAP)).sum(1)
+  identical = (residues & (msa == query)).sum(1)
+  passing = (100 * covered >= min_cov * num_residues[0]) & (100 * identical >= min_seq_id * np.maximum(np.minimum(num_residues, num_residues[0]), 1))
+  passing[0] = True
+  candidates = np.flatnonzero(passing[1:]) + 1
+  kept = [0]
+  for i in candidates[np.argsort(-num_residues[candidates], kind="stable")]:
+    if max_seq_id >= 100:
+      kept.append(i)
+      continue
+    identities = (residues[kept] & (msa[kept] == msa[i])).sum(1)
+    if np.all(100 * identities <= max_seq_id * np.minimum(num_residues[kept], num_residues[i])):
+      kept.append(i)
+  return np.sort(kept)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--length', type=int, default=300, help='Alignment length')
+  parser.add_argument('--depth', type=int, default=5000, help='Sequences in the synthetic MSA')
+  parser.add_argument('--min_cov', type=int, default=75)
+  parser.add_argument('--max_seq_id', type=int, default=90)
+  parser.add_argument('--min_seq_id', type=int, default=0)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix="sampling_proteins_msa_filter_") as workdir:
+    names, sequences = clustered_msa(args.length, args.depth, args.seed)
+    msa_file = synthetic.write_fasta(os.path.join(workdir, "msa.a2m"), names, sequences)
+    encoded = msa_filter.encode_msa([sequence for _, sequence in msa_filter.parse_a2m(open(msa_file).read())])
+    start = time.perf_counter()
+    expected = reference_filter(encoded, args.min_cov, args.max_seq_id, args.min_seq_id)
+    reference_time = time.perf_counter() - start
+    msa_filter.filter_msa(encoded[:10], args.min_cov, args.max_seq_id, args.min_seq_id) # compile (or load the compiled kernels)
+    start = time.perf_counter()
+    kept = msa_filter.filter_msa(encoded, args.min_cov, args.max_seq_id, args.min_seq_id)
+    kernel_time = time.perf_counter() - start
+    if not np.array_equal(kept, expected):
+      sys.exit(f"The numba filter keeps {len(kept)} sequences, the reference filter {len(expected)}")
+
+    cache_dir = os.path.join(workdir, "hhfiltered")
+    thresholds = dict(min_cov=args.min_cov, max_seq_id=args.max_seq_id, min_seq_id=args.min_seq_id, cache_dir=cache_dir)
+    timings = []
+    for label in ("cold", "memory cache", "disk cache"):
+      if label == "disk cache":
+        msa_filter._filter_cache.clear() # as a new process would start
+      start = time.perf_counter()
+      records = msa_filter.filter_msa_file(msa_file, **thresholds)
+      timings.append((label, time.perf_counter() - start))
+      if [name for name, _ in records] != [names[i] for i in expected]:
+        sys.exit(f"filter_msa_file ({label}) does not return the filtered records in file order")
+  print(f"\n{args.depth} x {args.length} MSA, kept {len(kept)} sequences (cov {args.min_cov}, max id {args.max_seq_id}, min id {args.min_seq_id})")
+  print(f"{'numpy greedy':<18} {reference_time:>8.3f}s")
+  print(f"{'numba kernels':<18} {kernel_time:>8.3f}s ({reference_time / kernel_time:.1f}x)")
+  for label, elapsed in timings:
+    print(f"{'file, ' + label:<18} {elapsed:>8.3f}s")
@@ -0,0 +1,68 @@
+# ESM-MSA subsampling from a parsed-once MSA store (pgen.msa_store.MSAStore) vs re-parsing the alignment, subsetting the strings
+# and tokenizing them with the ESM batch converter on every draw, on a synthetic MSA (see benchmarks/synthetic.py).
+# Both paths are checked to give the same tokens for the same rows; weighted and max_diverse subsets are timed from the store.
+# Usage: python benchmarks/msa_store_benchmark.py [--length 300] [--depth 5000] [--alignment_size 256] [--draws 50]
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import torch
+import esm
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "scoring_metrics", "protein_gibbs_sampler", "src"))
+from pgen.utils import parse_fasta
+from pgen.msa_store import MSAStore
+
+def timed(function, repeats):
+  start = time.perf_counter()
+  for i in range(repeats):
+    result = function(i)
+  return (time.perf_counter() - start) / repeats, result
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--length', type=int, default=300, help='Alignment length')
+  parser.add_argument('--depth', type=int, default=5000, help='Sequences in the synthetic MSA')
+  parser.add_argument('--alignment_size', type=int, default=256, help='Sequences per subset')
+  parser.add_argument('--draws', type=int, default=50, help='Subsets drawn per strategy')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  alphabet = esm.Alphabet.from_architecture("MSA Transformer")
+  batch_converter = alphabet.get_batch_converter()
+  with tempfile.TemporaryDirectory(prefix="sampling_proteins_msa_store_") as workdir:
+    names, sequences = synthetic.synthetic_msa(synthetic.random_sequence(args.length, args.seed), depth=args.depth, seed=args.seed)
+    msa_file = synthetic.write_fasta(os.path.join(workdir, "msa.a2m"), names, sequences)
+
+    def text_draw(i):
+      msa = parse_fasta(msa_file, clean="upper")
+      rows = random.Random(i).sample(range(len(msa)), args.alignment_size)
+      return rows, batch_converter([[(str(j), msa[row]) for j, row in enumerate(rows)]])[2][0, :, 1:]
+    text_time, (rows, text_tokens) = timed(text_draw, args.draws)
+
+    start = time.perf_counter()
+    store = MSAStore.from_fasta(msa_file)
+    build_time = time.perf_counter() - start
+    if not torch.equal(store.tokens(rows, alphabet), text_tokens):
+      sys.exit("MSAStore tokens differ from the batch converter tokens")
+    timings = [("parse + subset + tokenize", text_time)]
+    for strategy in ("random", "weighted", "top_hits", "max_diverse"):
+      if strategy == "weighted":
+        start = time.perf_counter()
+        store.weights
+        timings.append(("weights (once)", time.perf_counter() - start))
+      elapsed, _ = timed(lambda i: store.tokens(store.subset(args.alignment_size, strategy, keep_first=True, random_seed=i), alphabet), args.draws)
+      timings.append((f"store {strategy}", elapsed))
+    start = time.perf_counter()
+    MSAStore.from_fasta(msa_file)
+    cached_time = time.perf_counter() - start
+
+  print(f"\n{args.depth} x {args.length} MSA, subsets of {args.alignment_size} sequences, ms per draw")
+  print(f"{'store build (once)':<28} {1000 * build_time:>9.1f}")
+  print(f"{'store from cache':<28} {1000 * cached_time:>9.1f}")
+  for label, elapsed in timings:
+    print(f"{label:<28} {1000 * elapsed:>9.2f}")
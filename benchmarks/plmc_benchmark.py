@@ -0,0 +1,101 @@
+# plmc training scheduler check and benchmark (plmc_scheduler.py) on synthetic alignments (see benchmarks/synthetic.py).
+# Trains a manifest of small families, checks that every parameter file loads in CouplingsModel with the expected
+# focus sequence, that a second run skips everything by content hash and that changing one alignment retrains only that
+# family, and compares the estimated with the measured time and peak RSS of each job. With --compare_sequential, the
+# same families are also trained one after the other with every core, the way they were launched by hand.
+# Needs a built plmc: make -C EVmutation/plmc all-openmp32
+# Usage: python benchmarks/plmc_benchmark.py [--lengths 40 60 80 100] [--depth 300] [--num_cores 4] [--compare_sequential]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+import plmc_scheduler
+
+def write_families(workdir, lengths, depth, seed):
+  """Writes one synthetic alignment per length and a manifest of them; returns the manifest path and target sequences."""
+  rows, targets = [], {}
+  for i, length in enumerate(lengths):
+    name = f"family{i}_L{length}"
+    target = synthetic.random_sequence(length, seed + i)
+    names, sequences = synthetic.synthetic_msa(target, depth=depth, seed=seed + i)
+    names[0] = f"{name}/1-{length}"
+    synthetic.write_fasta(os.path.join(workdir, name + ".a2m"), names, sequences)
+    rows.append({'msa': name + ".a2m", 'name': name, 'max_iter': 50})
+    targets[name] = target
+  manifest = os.path.join(workdir, "manifest.csv")
+  pd.DataFrame(rows).to_csv(manifest, index=False)
+  return manifest, targets
+
+def run(manifest, output_dir, num_cores, plmc_binary):
+  jobs = plmc_scheduler.load_manifest(manifest, output_dir)
+  start = time.perf_counter()
+  plmc_scheduler.PlmcScheduler(jobs, num_cores=num_cores, plmc_binary=plmc_binary, progress_every=0).run()
+  return jobs, time.perf_counter() - start
+
+def check(condition, message):
+  if not condition:
+    sys.exit(f"FAILED: {message}")
+  print(f"ok: {message}")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--lengths', type=int, nargs='+', default=[40, 60, 80, 100], help='Lengths of the synthetic families')
+  parser.add_argument('--depth', type=int, default=300, help='Sequences per alignment')
+  parser.add_argument('--num_cores', type=int, default=None, help='Cores for the scheduler (default: all)')
+  parser.add_argument('--plmc', type=str, default=plmc_scheduler.PLMC_BINARY, help='plmc binary (single precision build)')
+  parser.add_argument('--compare_sequential', action='store_true', help='Also train the families one at a time with every core')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', type=str, default=None, help='Write the results as JSON to this file')
+  args = parser.parse_args()
+
+  if not os.path.isfile(args.plmc):
+    sys.exit(f"plmc binary {args.plmc} not found, build it with: make -C EVmutation/plmc all-openmp32")
+  workdir = tempfile.mkdtemp(prefix="sampling_proteins_plmc_")
+  try:
+    manifest, targets = write_families(workdir, args.lengths, args.depth, args.seed)
+    output_dir = os.path.join(workdir, "models")
+    jobs, elapsed = run(manifest, output_dir, args.num_cores, args.plmc)
+    check(all(job.status == 'complete' for job in jobs), f"{len(jobs)} families trained in {elapsed:.1f}s")
+    for job in jobs:
+      model = synthetic.backends.evmutation_model.CouplingsModel(job.path('.model_params'))
+      check(model.L == job.num_sites and "".join(model.target_seq) == targets[job.name], f"{job.name} loads with its {job.num_sites} focus sites")
+      with open(job.path('.metadata.json')) as fh:
+        metadata = json.load(fh)
+      check(metadata['hash'] == job.hash and metadata['iterations'] > 0, f"{job.name} metadata records the hash and {metadata['iterations']} iterations")
+
+    rerun, rerun_elapsed = run(manifest, output_dir, args.num_cores, args.plmc)
+    check(all(job.status == 'cached' for job in rerun), f"second run skips every family ({rerun_elapsed:.2f}s)")
+    with open(jobs[0].msa, "a") as fh:
+      fh.write(f">extra\n{targets[jobs[0].name]}\n")
+    changed, _ = run(manifest, output_dir, args.num_cores, args.plmc)
+    check([job.status for job in changed] == ['complete'] + ['cached'] * (len(changed) - 1), f"changing {jobs[0].name} retrains only that family")
+
+    print(f"\n{'job':<16} {'threads':>7} {'time s':>8} {'estimated':>10} {'peak RSS MB':>12} {'estimated':>10}")
+    for job in jobs:
+      print(f"{job.name:<16} {job.threads:>7} {job.elapsed:>8.2f} {job.estimated_time(job.threads):>10.2f} {job.peak_rss / 2**20:>12.1f} {job.memory / 2**20:>10.1f}")
+    results = {'lengths': args.lengths, 'depth': args.depth, 'scheduled': elapsed, 'cached_rerun': rerun_elapsed,
+               'jobs': [{'name': job.name, 'threads': job.threads, 'elapsed': job.elapsed, 'estimated_time': job.estimated_time(job.threads),
+                         'peak_rss': job.peak_rss, 'estimated_memory': job.memory} for job in jobs]}
+    if args.compare_sequential:
+      num_cores = args.num_cores or os.cpu_count()
+      start = time.perf_counter()
+      for job in plmc_scheduler.load_manifest(manifest, os.path.join(workdir, "sequential")):
+        os.makedirs(job.output_dir, exist_ok=True)
+        subprocess.run(job.command(args.plmc, num_cores), capture_output=True, check=True)
+      sequential_elapsed = time.perf_counter() - start
+      results['sequential'] = sequential_elapsed
+      print(f"\nscheduled {elapsed:.1f}s vs one family at a time with {num_cores} threads {sequential_elapsed:.1f}s ({sequential_elapsed / elapsed:.2f}x)")
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+  if args.output:
+    with open(args.output, "w") as fh:
+      json.dump(results, fh, indent=2)
+    print(f"Results saved to {args.output}")
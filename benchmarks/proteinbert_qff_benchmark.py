@@ -0,0 +1,82 @@
+# Benchmark of app.predict_proteinBERT against the list-based encode_X + keras predict path, on a small randomly
+# initialised conv_and_global_attention_model with a numeric head (no weights are downloaded). Runs on CPU.
+# Usage: python benchmarks/proteinbert_qff_benchmark.py [--num_variants 4096] [--length 250] [--batch_size 128]
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import app
+from tensorflow import keras
+from proteinbert import conv_and_global_attention_model
+from proteinbert.model_generation import InputEncoder
+from proteinbert.tokenization import n_tokens
+
+def create_qff_model(seq_len, n_annotations, seed=0):
+  """Pretraining architecture (reduced size) with the numeric global head added by FinetuningModelGenerator."""
+  keras.utils.set_random_seed(seed)
+  model = conv_and_global_attention_model.create_model(seq_len, n_tokens, n_annotations, d_hidden_seq=64, d_hidden_global=128, n_blocks=2, n_heads=2, d_key=32)
+  _, output_annotations = model.output
+  output = keras.layers.Dense(1, activation=None)(keras.layers.Dropout(0.5)(output_annotations))
+  return keras.models.Model(inputs=model.input, outputs=output)
+
+def baseline_predict(model, DMS, input_encoder, top_n, batch_size):
+  seq_len = model.inputs[0].shape[1]
+  X = input_encoder.encode_X(DMS['mutated_sequence'].tolist(), seq_len)
+  DMS = DMS.copy()
+  DMS['ProteinBERT'] = model.predict(X, batch_size=batch_size, verbose=0)[:, 0]
+  DMS = DMS.sort_values(by='ProteinBERT', ascending=False, kind='stable', ignore_index=True)
+  return DMS[['mutated_sequence', 'mutant', 'ProteinBERT']].head(top_n)
+
+def random_DMS(rng, num_variants, length):
+  wild_type = rng.choice(list(app.AA_vocab), length)
+  positions = rng.integers(length, size=num_variants)
+  substitutions = rng.choice(list(app.AA_vocab), num_variants)
+  rows = []
+  for position, aa in zip(positions, substitutions):
+    sequence = wild_type.copy()
+    sequence[position] = aa
+    rows.append((f"{wild_type[position]}{position+1}{aa}", "".join(sequence)))
+  return pd.DataFrame(rows, columns=['mutant', 'mutated_sequence'])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_variants', type=int, default=4096)
+  parser.add_argument('--length', type=int, default=250)
+  parser.add_argument('--seq_len', type=int, default=512, help='Model input length')
+  parser.add_argument('--n_annotations', type=int, default=8943)
+  parser.add_argument('--batch_size', type=int, default=128)
+  parser.add_argument('--top_n', type=int, default=96)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(args.seed)
+  DMS = random_DMS(rng, args.num_variants, args.length)
+  model = create_qff_model(args.seq_len, args.n_annotations, seed=args.seed)
+  input_encoder = InputEncoder(n_annotations=args.n_annotations)
+
+  start = time.perf_counter()
+  reference_tokens = input_encoder.encode_X(DMS['mutated_sequence'].tolist(), args.seq_len)[0]
+  list_encode_time = time.perf_counter() - start
+  start = time.perf_counter()
+  tokens = app.encode_proteinBERT(DMS['mutated_sequence'].tolist(), args.seq_len)
+  lut_encode_time = time.perf_counter() - start
+  assert np.array_equal(reference_tokens, tokens), "Token arrays differ"
+  print(f"encoding {args.num_variants} x {args.seq_len}: tokenize_seqs {list_encode_time*1000:.1f} ms, lookup table {lut_encode_time*1000:.1f} ms")
+
+  # Warm-up (graph tracing) is excluded from both timings
+  baseline_predict(model, DMS.head(args.batch_size), input_encoder, args.top_n, args.batch_size)
+  app.predict_proteinBERT(model, DMS.head(args.batch_size), input_encoder, args.top_n, batch_size=args.batch_size, device='/CPU:0')
+  start = time.perf_counter()
+  expected = baseline_predict(model, DMS, input_encoder, args.top_n, args.batch_size)
+  baseline_time = time.perf_counter() - start
+  start = time.perf_counter()
+  result = app.predict_proteinBERT(model, DMS, input_encoder, args.top_n, batch_size=args.batch_size, return_score=True, device='/CPU:0')
+  qff_time = time.perf_counter() - start
+  assert np.allclose(expected['ProteinBERT'], result['ProteinBERT'], atol=1e-4), "Scores differ"
+  print(f"top-{args.top_n} overlap with keras predict: {len(set(expected['mutant']) & set(result['mutant']))}/{args.top_n}")
+  print(f"scoring {args.num_variants} variants: encode_X + predict {baseline_time:.2f} s, predict_proteinBERT {qff_time:.2f} s ({baseline_time/qff_time:.2f}x)")
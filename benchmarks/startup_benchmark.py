@@ -0,0 +1,72 @@
+# Startup-budget regression benchmark for app.py and the generator entry points.
+# Each entry point is imported (scripts are run with --help, which stops right after their imports) in a fresh
+# interpreter; the best of --repeats runs is compared against the cost of importing torch and pandas alone,
+# which every path needs. The check fails if an entry point exceeds its budget over that floor, or if it
+# loads a backend that only some features need (TensorFlow/Keras, seaborn/matplotlib, datasets, biotite).
+# Usage: python benchmarks/startup_benchmark.py [--repeats 3] [--budget 1.0] [--output startup.json]
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+ENTRY_POINTS = ['app', 'generator.py', 'multi-generator.py', 'AR_generator.py']
+FLOOR = 'torch, pandas'
+LAZY_BACKENDS = ['tensorflow', 'keras', 'seaborn', 'matplotlib', 'datasets', 'biotite', 'proteinbert']
+
+PROBE = """
+import io, sys, json, time, runpy, contextlib
+target = {target!r}
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+  try:
+    if target.endswith('.py'):
+      sys.argv = [target, '--help']
+      runpy.run_path(target, run_name='__main__')
+    else:
+      exec('import ' + target)
+  except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'modules': sorted({{name.split('.')[0] for name in sys.modules}})}}))
+"""
+
+def measure_startup(target, repeats):
+  """Best import time of target over repeats fresh interpreters, and the top-level packages it loaded."""
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+  runs = []
+  for _ in range(repeats):
+    result = subprocess.run([sys.executable, "-c", PROBE.format(target=target)], cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+      raise RuntimeError(f"Importing {target} failed:\n{result.stderr[-2000:]}")
+    runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+  return min(run['time'] for run in runs), runs[0]['modules']
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--repeats', type=int, default=3, help='Fresh interpreters per entry point (best is reported)')
+  parser.add_argument('--budget', type=float, default=1.0, help='Allowed startup time in seconds on top of importing torch and pandas')
+  parser.add_argument('--entry_points', type=str, nargs='+', default=ENTRY_POINTS, help='Modules or scripts to check')
+  parser.add_argument('--output', type=str, default=None, help='Write the results as JSON to this file')
+  args = parser.parse_args()
+
+  floor, _ = measure_startup(FLOOR, args.repeats)
+  print(f"{'entry point':<20} {'startup':>8} {'over floor':>10}  lazy backends loaded")
+  print(f"{'(' + FLOOR + ')':<20} {floor:>7.2f}s")
+  results, failures = [], []
+  for target in args.entry_points:
+    startup, modules = measure_startup(target, args.repeats)
+    loaded = [backend for backend in LAZY_BACKENDS if backend in modules]
+    overhead = startup - floor
+    passed = overhead <= args.budget and not loaded
+    results.append({'entry_point': target, 'startup': startup, 'overhead': overhead, 'budget': args.budget, 'lazy_backends_loaded': loaded, 'passed': passed})
+    print(f"{target:<20} {startup:>7.2f}s {overhead:>9.2f}s  {', '.join(loaded) if loaded else '-'}{'' if passed else '  FAIL'}")
+    if not passed:
+      failures.append(target)
+  if args.output:
+    with open(args.output, "w") as fh:
+      json.dump({'floor': floor, 'results': results}, fh, indent=2)
+  if failures:
+    sys.exit(f"Startup budget exceeded by: {', '.join(failures)}")
+  print(f"All entry points start within {args.budget:.2f}s of the {FLOOR} floor")
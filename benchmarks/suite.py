@@ -0,0 +1,228 @@
+# CPU-only micro and macro benchmark suite on tiny synthetic models and data (see benchmarks/synthetic.py).
+# Times the hot paths of a generation run (mutant libraries, tokenization, scoring, samplers, filters, a full
+# evolution cycle) and the scoring metrics, writes the results as JSON and compares them against a stored baseline.
+# Usage:
+#   python benchmarks/suite.py --output results.json                 # run everything
+#   python benchmarks/suite.py --group micro --filter sampling       # a subset
+#   python benchmarks/suite.py --baseline baseline.json --tolerance 0.25   # exits 1 on regressions
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import synthetic
+import app
+import sampling
+from scoring_metrics import tm_score
+
+BENCHMARKS = []
+
+def benchmark(name, group):
+  """Registers setup(fixtures) -> zero-argument callable as a benchmark; setup time is not measured."""
+  def register(setup):
+    BENCHMARKS.append((name, group, setup))
+    return setup
+  return register
+
+# Micro benchmarks
+
+@benchmark('mutant_library_singles', 'micro')
+def _(fixtures):
+  return lambda: app.create_all_single_mutants(fixtures.sequence, app.AA_vocab)
+
+@benchmark('mutant_library_1extra', 'micro')
+def _(fixtures):
+  parents, _ = synthetic.multi_mutant_library(fixtures.single_scores)
+  return lambda: app.apply_gen_1extra(DMS=parents[['mutant', 'mutated_sequence']])
+
+@benchmark('tokenization_tranception', 'micro')
+def _(fixtures):
+  sequences = fixtures.single_scores['mutated_sequence'].tolist()
+  return lambda: app.tokenizer(sequences, add_special_tokens=True, truncation=True, padding=True, max_length=1024)
+
+@benchmark('trim_DMS', 'micro')
+def _(fixtures):
+  parents, library = synthetic.multi_mutant_library(fixtures.single_scores)
+  return lambda: app.trim_DMS(DMS_data=library, sampled_mutants=parents, mutation_rounds=2)
+
+@benchmark('sampling_top_k', 'micro')
+def _(fixtures):
+  scores = fixtures.single_scores
+  return lambda: [sampling.top_k_sampling(scores, k=10) for _ in range(20)]
+
+@benchmark('sampling_top_p', 'micro')
+def _(fixtures):
+  scores = fixtures.single_scores
+  return lambda: [sampling.top_p_sampling(scores, p=0.9) for _ in range(20)]
+
+@benchmark('sampling_typical', 'micro')
+def _(fixtures):
+  scores = fixtures.single_scores
+  return lambda: [sampling.typical_sampling(scores, mass=0.9) for _ in range(20)]
+
+@benchmark('sampling_mirostat', 'micro')
+def _(fixtures):
+  scores = fixtures.single_scores
+  return lambda: [sampling.mirostat_sampling(scores, tau=3.0) for _ in range(20)]
+
+@benchmark('sampling_random', 'micro')
+def _(fixtures):
+  scores = fixtures.single_scores
+  return lambda: [sampling.random_sampling(scores) for _ in range(20)]
+
+@benchmark('sampling_top_k_multi', 'micro')
+def _(fixtures):
+  _, library = synthetic.multi_mutant_library(fixtures.single_scores)
+  library = library.assign(avg_score=np.random.default_rng(0).normal(size=len(library)))
+  return lambda: sampling.top_k_sampling(library, k=100, multi=True)
+
+@benchmark('couplings_model_load', 'micro')
+def _(fixtures):
+  return lambda: synthetic.backends.evmutation_model.CouplingsModel(fixtures.plmc_params)
+
+@benchmark('couplings_ecs', 'micro')
+def _(fixtures):
+  model = synthetic.backends.evmutation_model.CouplingsModel(fixtures.plmc_params)
+  def ecs():
+    model._reset_precomputed()
+    return model.ecs
+  return ecs
+
+@benchmark('filter_qff_evmutation', 'micro')
+def _(fixtures):
+  _, library = synthetic.multi_mutant_library(fixtures.single_scores)
+  return lambda: app.predict_evmutation(DMS=library.copy(), top_n=96, ev_model=fixtures.ev_model)
+
+@benchmark('filter_rsf', 'micro')
+def _(fixtures):
+  _, library = synthetic.multi_mutant_library(fixtures.single_scores)
+  ev_scored = app.predict_evmutation(DMS=library.copy(), top_n=len(library), ev_model=fixtures.ev_model, return_evscore=True)
+  return lambda: app.stratified_filtering(ev_scored, threshold=96, column_name='EVmutation')
+
+@benchmark('filter_hpf', 'micro')
+def _(fixtures):
+  parents, library = synthetic.multi_mutant_library(fixtures.single_scores)
+  return lambda: app.trim_DMS(DMS_data=library, sampled_mutants=parents, mutation_rounds=2).sample(n=96, random_state=0)
+
+@benchmark('metric_tm_score', 'micro')
+def _(fixtures):
+  reference_pdb, model_pdbs = fixtures.structures
+  scorer = tm_score.TMScorer(reference_pdb)
+  scorer.score(model_pdbs[:1])
+  return lambda: scorer.score(model_pdbs)
+
+@benchmark('metric_longest_repeat', 'micro')
+def _(fixtures):
+  from scoring_metrics.single_sequence_metrics import find_longest_repeat
+  sequences = fixtures.single_scores['mutated_sequence'].tolist()
+  return lambda: [find_longest_repeat(sequence, k) for sequence in sequences for k in (1, 2, 3, 4)]
+
+# Macro benchmarks
+
+def score_singles(fixtures, model_type):
+  model, tokenizer = {'Tranception': fixtures.tranception, 'RITA': fixtures.rita, 'ProtXLNet': fixtures.xlnet}[model_type]
+  return lambda: app.score_and_create_matrix_all_singles(fixtures.sequence, model, scoring_mirror=False, batch_size_inference=64, num_workers=0,
+                                                         AA_vocab=app.AA_vocab, tokenizer=tokenizer, with_heatmap=False, model_type=model_type)
+
+@benchmark('score_singles_tranception', 'macro')
+def _(fixtures):
+  return score_singles(fixtures, 'Tranception')
+
+@benchmark('score_singles_rita', 'macro')
+def _(fixtures):
+  return score_singles(fixtures, 'RITA')
+
+@benchmark('score_singles_xlnet', 'macro')
+def _(fixtures):
+  return score_singles(fixtures, 'ProtXLNet')
+
+@benchmark('score_multi_tranception', 'macro')
+def _(fixtures):
+  model, tokenizer = fixtures.tranception
+  _, library = synthetic.multi_mutant_library(fixtures.single_scores)
+  extra_mutants = library.sample(n=96, random_state=0)
+  return lambda: app.score_multi_mutations(fixtures.sequence, extra_mutants=extra_mutants, Tranception_model=model, batch_size_inference=64,
+                                           num_workers=0, tokenizer=tokenizer, model_type='Tranception')
+
+@benchmark('evolution_cycle_hpf', 'macro')
+def _(fixtures):
+  """One multi-generator evolution cycle with 2 mutation rounds and the High-Probability Filter."""
+  model, tokenizer = fixtures.tranception
+  sampler = sampling.temperature_sampler(1.0)
+  def cycle():
+    _, _, scores, _, _ = app.score_and_create_matrix_all_singles(fixtures.sequence, model, batch_size_inference=64, num_workers=0,
+                                                                 tokenizer=tokenizer, with_heatmap=False, model_type='Tranception')
+    mutation = sampling.top_k_sampling(scores, k=100, sampler=sampler, multi=True)
+    all_extra_mutants = app.apply_gen_1extra(DMS=mutation)
+    extra_mutants = app.trim_DMS(DMS_data=all_extra_mutants, sampled_mutants=mutation, mutation_rounds=2).sample(n=96)
+    _, scores, _, _ = app.score_multi_mutations(fixtures.sequence, extra_mutants=extra_mutants, Tranception_model=model, batch_size_inference=64,
+                                                num_workers=0, tokenizer=tokenizer, model_type='Tranception')
+    return app.get_mutated_protein(fixtures.sequence, sampling.top_k_sampling(scores, k=3, sampler=sampler))
+  return cycle
+
+def time_benchmark(function, repeats, warmup=1):
+  for _ in range(warmup):
+    function()
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.fmean(times), 'repeats': repeats}
+
+def compare(results, baseline, tolerance):
+  """Rows of (name, baseline median, current median, ratio, regressed) for the benchmarks present in both runs."""
+  rows = []
+  for name, result in results.items():
+    if name in baseline:
+      ratio = result['median'] / baseline[name]['median']
+      rows.append((name, baseline[name]['median'], result['median'], ratio, ratio > 1 + tolerance))
+  return rows
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--group', type=str, choices=['micro', 'macro', 'all'], default='all', help='Benchmarks to run')
+  parser.add_argument('--filter', type=str, default=None, help='Only run benchmarks whose name contains this string')
+  parser.add_argument('--repeats', type=int, default=5, help='Timed repeats per benchmark (after one warm-up call)')
+  parser.add_argument('--length', type=int, default=100, help='Length of the synthetic protein')
+  parser.add_argument('--threads', type=int, default=1, help='torch CPU threads (fixed for comparable numbers)')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', type=str, default=None, help='Write the results as JSON to this file')
+  parser.add_argument('--baseline', type=str, default=None, help='JSON results of a previous run to compare against')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slow-down of the median over the baseline before failing')
+  args = parser.parse_args()
+
+  torch.set_num_threads(args.threads)
+  torch.manual_seed(args.seed)
+  np.random.seed(args.seed)
+  fixtures = synthetic.SyntheticFixtures(length=args.length, seed=args.seed)
+  results = {}
+  for name, group, setup in BENCHMARKS:
+    if (args.group != 'all' and group != args.group) or (args.filter and args.filter not in name):
+      continue
+    results[name] = dict(group=group, **time_benchmark(setup(fixtures), args.repeats))
+    print(f"{name:<28} {group:<6} median {1000 * results[name]['median']:>10.2f} ms  min {1000 * results[name]['min']:>10.2f} ms")
+
+  report = {'meta': {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                     'threads': args.threads, 'length': args.length, 'seed': args.seed, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+  if args.output:
+    with open(args.output, 'w') as fh:
+      json.dump(report, fh, indent=2)
+    print(f"Results saved to {args.output}")
+  if args.baseline:
+    with open(args.baseline) as fh:
+      baseline = json.load(fh)['results']
+    rows = compare(results, baseline, args.tolerance)
+    print(f"\n{'benchmark':<28} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, before, after, ratio, regressed in rows:
+      print(f"{name:<28} {1000 * before:>10.2f}ms {1000 * after:>10.2f}ms {ratio:>6.2f}x{'  REGRESSION' if regressed else ''}")
+    regressions = [row[0] for row in rows if row[4]]
+    if regressions:
+      sys.exit(f"{len(regressions)} benchmarks regressed by more than {100 * args.tolerance:.0f}%: {', '.join(regressions)}")
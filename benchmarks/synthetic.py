@@ -0,0 +1,182 @@
+# Tiny synthetic models and data for CPU benchmarks: randomly initialised Tranception, RITA-like (GPT-2) and
+# ProtXLNet-like (XLNet) models with character-level tokenizers, plmc v2 parameter files and MSAs.
+# Nothing is downloaded; everything is seeded, so two runs build identical fixtures.
+import os
+import sys
+import tempfile
+from functools import cached_property
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import backends
+from transformers import PreTrainedTokenizerFast, GPT2Config, GPT2LMHeadModel, XLNetConfig, XLNetLMHeadModel
+from tokenizers import Tokenizer, Regex, models, pre_tokenizers, processors
+from tranception.config import TranceptionConfig
+from tranception.model_pytorch import TranceptionLMHeadModel
+
+AA_vocab = "ACDEFGHIKLMNPQRSTVWY"
+PLMC_ALPHABET = "-ACDEFGHIKLMNPQRSTVWY"
+
+def random_sequence(length, seed=0):
+  rng = np.random.default_rng(seed)
+  return "".join(rng.choice(list(AA_vocab), length))
+
+def tiny_tranception(n_embd=32, n_layer=2, n_head=4, seed=0):
+  """Randomly initialised Tranception (grouped ALiBi, tranception attention) with the repo's tokenizer."""
+  import app
+  torch.manual_seed(seed)
+  config = TranceptionConfig(vocab_size=25, n_positions=1024, n_ctx=1024, n_embd=n_embd, n_layer=n_layer, n_head=n_head, n_inner=2 * n_embd,
+                             attention_mode="tranception", position_embedding="grouped_alibi", scoring_window="optimal")
+  model = TranceptionLMHeadModel(config).eval()
+  model.config.tokenizer = app.tokenizer
+  return model, app.tokenizer
+
+def character_tokenizer(special_tokens, unk_token):
+  vocab = {token: i for i, token in enumerate(special_tokens + list(AA_vocab))}
+  tokenizer = Tokenizer(models.WordLevel(vocab, unk_token=unk_token))
+  tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex(r"\S"), behavior="isolated")
+  return tokenizer
+
+def tiny_rita(n_embd=32, n_layer=2, n_head=4, seed=0):
+  """RITA-like causal LM: a GPT-2 with a character-level amino-acid tokenizer."""
+  tokenizer = character_tokenizer(["<PAD>", "<EOS>", "<unk>"], "<unk>")
+  tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<PAD>", eos_token="<EOS>", unk_token="<unk>")
+  torch.manual_seed(seed)
+  config = GPT2Config(vocab_size=len(tokenizer), n_positions=1024, n_embd=n_embd, n_layer=n_layer, n_head=n_head)
+  return GPT2LMHeadModel(config).eval(), tokenizer
+
+def tiny_xlnet(d_model=32, n_layer=2, n_head=4, seed=0):
+  """ProtXLNet-like XLNet with a whitespace-separated amino-acid tokenizer that appends <sep> <cls> like XLNetTokenizer."""
+  special_tokens = ["<pad>", "<unk>", "<sep>", "<cls>", "<mask>"]
+  tokenizer = character_tokenizer(special_tokens, "<unk>")
+  tokenizer.post_processor = processors.TemplateProcessing(single="$A <sep> <cls>", special_tokens=[("<sep>", 2), ("<cls>", 3)])
+  tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", unk_token="<unk>", sep_token="<sep>", cls_token="<cls>", mask_token="<mask>", padding_side="left")
+  torch.manual_seed(seed)
+  config = XLNetConfig(vocab_size=len(tokenizer), d_model=d_model, n_layer=n_layer, n_head=n_head, d_inner=2 * d_model, mem_len=512)
+  return XLNetLMHeadModel(config).eval(), tokenizer
+
+def write_plmc_params(path, target_seq, num_sequences=100, seed=0, precision="float32"):
+  """Writes a plmc v2 binary parameter file (as read by EVmutation's CouplingsModel) with random fields and couplings."""
+  rng = np.random.default_rng(seed)
+  L, q = len(target_seq), len(PLMC_ALPHABET)
+  f_i = rng.dirichlet(np.ones(q), size=L)
+  upper_i, upper_j = np.triu_indices(L, k=1)
+  with open(path, "wb") as f:
+    np.array([L, q, num_sequences, 0, 100], dtype=np.int32).tofile(f)
+    np.array([0.2, 0.01, 0.01 * (L - 1), 0.0, 0.8 * num_sequences], dtype=precision).tofile(f)
+    np.array(list(PLMC_ALPHABET), dtype="S1").tofile(f)
+    np.ones(num_sequences, dtype=precision).tofile(f)
+    np.array(list(target_seq), dtype="S1").tofile(f)
+    np.arange(1, L + 1, dtype=np.int32).tofile(f)
+    f_i.astype(precision).tofile(f)
+    rng.normal(0, 1, (L, q)).astype(precision).tofile(f)
+    (f_i[upper_i, :, None] * f_i[upper_j, None, :]).astype(precision).tofile(f)
+    rng.normal(0, 0.1, (len(upper_i), q, q)).astype(precision).tofile(f)
+  return path
+
+def synthetic_msa(target_seq, depth=256, substitution_rate=0.3, gap_rate=0.05, seed=0):
+  """(names, sequences) of an aligned MSA around target_seq: the target first, then random variants with gaps."""
+  rng = np.random.default_rng(seed)
+  target = np.array(list(target_seq))
+  sequences = [target_seq]
+  for _ in range(depth - 1):
+    variant = target.copy()
+    substituted = rng.random(len(target)) < substitution_rate
+    variant[substituted] = rng.choice(list(AA_vocab), substituted.sum())
+    variant[rng.random(len(target)) < gap_rate] = "-"
+    sequences.append("".join(variant))
+  return [f"seq{i}" for i in range(depth)], sequences
+
+def write_fasta(path, names, sequences):
+  with open(path, "w") as fh:
+    for name, sequence in zip(names, sequences):
+      fh.write(f">{name}\n{sequence}\n")
+  return path
+
+def random_ca_trace(length, seed=0, noise=0.0, reference=None):
+  """CA coordinates of a random chain with 3.8A steps, or of reference perturbed by Gaussian noise."""
+  rng = np.random.default_rng(seed)
+  if reference is not None:
+    return reference + rng.normal(0, noise, reference.shape)
+  steps = rng.normal(size=(length, 3))
+  steps = 3.8 * steps / np.linalg.norm(steps, axis=1, keepdims=True)
+  return np.cumsum(steps, axis=0)
+
+def write_ca_pdb(path, sequence, coords):
+  three_letter = {'A': 'ALA', 'C': 'CYS', 'D': 'ASP', 'E': 'GLU', 'F': 'PHE', 'G': 'GLY', 'H': 'HIS', 'I': 'ILE', 'K': 'LYS', 'L': 'LEU',
+                  'M': 'MET', 'N': 'ASN', 'P': 'PRO', 'Q': 'GLN', 'R': 'ARG', 'S': 'SER', 'T': 'THR', 'V': 'VAL', 'W': 'TRP', 'Y': 'TYR'}
+  with open(path, "w") as fh:
+    for i, (aa, (x, y, z)) in enumerate(zip(sequence, coords)):
+      fh.write(f"ATOM  {i+1:>5}  CA  {three_letter[aa]} A{i+1:>4}    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           C\n")
+    fh.write("END\n")
+  return path
+
+class SyntheticFixtures:
+  """Lazily built, cached fixtures shared by the benchmarks; files are written to a temporary directory."""
+  def __init__(self, length=100, msa_depth=256, seed=0):
+    self.length = length
+    self.msa_depth = msa_depth
+    self.seed = seed
+    self.workdir = tempfile.mkdtemp(prefix="sampling_proteins_bench_")
+
+  @cached_property
+  def sequence(self):
+    return random_sequence(self.length, self.seed)
+
+  @cached_property
+  def tranception(self):
+    return tiny_tranception(seed=self.seed)
+
+  @cached_property
+  def rita(self):
+    return tiny_rita(seed=self.seed)
+
+  @cached_property
+  def xlnet(self):
+    return tiny_xlnet(seed=self.seed)
+
+  @cached_property
+  def plmc_params(self):
+    return write_plmc_params(os.path.join(self.workdir, "synthetic.model_params"), self.sequence, seed=self.seed)
+
+  @cached_property
+  def ev_model(self):
+    return backends.evmutation_model.CouplingsModel(self.plmc_params)
+
+  @cached_property
+  def msa(self):
+    return synthetic_msa(self.sequence, depth=self.msa_depth, seed=self.seed)
+
+  @cached_property
+  def msa_file(self):
+    return write_fasta(os.path.join(self.workdir, "synthetic.a2m"), *self.msa)
+
+  @cached_property
+  def single_scores(self):
+    """Scored single-mutant library of the tiny Tranception, with position / target_AA columns."""
+    import app
+    model, tokenizer = self.tranception
+    _, _, scores, _, _ = app.score_and_create_matrix_all_singles(self.sequence, model, scoring_mirror=False, batch_size_inference=64, num_workers=0,
+                                                                  AA_vocab=AA_vocab, tokenizer=tokenizer, with_heatmap=False)
+    return scores
+
+  @cached_property
+  def structures(self):
+    """Reference PDB and 32 perturbed model PDBs (CA only)."""
+    reference = random_ca_trace(self.length, self.seed)
+    reference_pdb = write_ca_pdb(os.path.join(self.workdir, "reference.pdb"), self.sequence, reference)
+    models = [write_ca_pdb(os.path.join(self.workdir, f"model_{i}.pdb"), self.sequence, random_ca_trace(self.length, self.seed + i + 1, noise=1.0 + 0.1 * i, reference=reference))
+              for i in range(32)]
+    return reference_pdb, models
+
+def multi_mutant_library(scores, num_parents=100):
+  """Top-scoring singles as sampled parents, and every double mutant extending them (as apply_gen_1extra builds)."""
+  import app
+  parents = scores.sort_values(by=['avg_score'], ascending=False).head(num_parents).reset_index(drop=True)
+  return parents, app.apply_gen_1extra(DMS=parents[['mutant', 'mutated_sequence']])
+
+def random_scores(num_variants, seed=0):
+  rng = np.random.default_rng(seed)
+  return pd.DataFrame({'mutant': [f"A{i+1}C" for i in range(num_variants)], 'avg_score': rng.normal(size=num_variants)})
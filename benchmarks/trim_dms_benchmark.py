@@ -0,0 +1,76 @@
+# Micro-benchmark of app.trim_DMS against the regex / string-split implementation it replaced.
+# Usage: python benchmarks/trim_dms_benchmark.py [--length 100] [--sampled 100] [--repeats 3]
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import app
+
+def regex_trim_DMS(DMS_data, sampled_mutants, mutation_rounds):
+  DMS_data = DMS_data.copy()
+  if mutation_rounds == 0:
+    trimmed_variants = DMS_data[DMS_data["mutated_sequence"].str.contains('|'.join(sampled_mutants['mutated_sequence']))].reset_index(drop=True)
+    trimmed_variants = trimmed_variants.drop_duplicates(subset=['mutated_sequence']).reset_index(drop=True)
+    return trimmed_variants[['mutated_sequence']]
+  DMS_data['past_mutation'] = DMS_data["mutant"].map(lambda x: ":".join(x.split(":", mutation_rounds-1)[:mutation_rounds-1]))
+  trimmed_variants = DMS_data[DMS_data['past_mutation'].isin(sampled_mutants['mutant'])].reset_index(drop=True)
+  trimmed_variants = trimmed_variants.drop_duplicates(subset=['mutant']).reset_index(drop=True)
+  return trimmed_variants[['mutant','mutated_sequence']]
+
+def random_multi_mutant(rng, sequence, num_mutations):
+  positions = sorted(rng.choice(len(sequence), num_mutations, replace=False))
+  mutated, codes = list(sequence), []
+  for position in positions:
+    aa = rng.choice([a for a in app.AA_vocab if a != sequence[position]])
+    codes.append(f"{sequence[position]}{position+1}{aa}")
+    mutated[position] = aa
+  return ":".join(codes), "".join(mutated)
+
+def multi_mutant_library(rng, length, num_sampled, mutation_rounds):
+  """Sampled (mutation_rounds-1)-mutants and a library of mutation_rounds-mutants, half of which extend a sampled parent."""
+  wild_type = "".join(rng.choice(list(app.AA_vocab), length))
+  parents = [random_multi_mutant(rng, wild_type, mutation_rounds - 1) for _ in range(2 * num_sampled)]
+  sampled = pd.DataFrame(parents[:num_sampled], columns=['mutant', 'mutated_sequence'])
+  rows = []
+  for mutant, sequence in parents:
+    for position in rng.choice(length, length // 4, replace=False):
+      for aa in app.AA_vocab:
+        if aa != sequence[position]:
+          rows.append((f"{mutant}:{sequence[position]}{position+1}{aa}", sequence[:position] + aa + sequence[position+1:]))
+  return pd.DataFrame(rows, columns=['mutant', 'mutated_sequence']), sampled
+
+def extension_library(rng, length, num_sampled, extension=2):
+  """Sampled prefixes and a library of extended sequences (AR mode), half of which extend a sampled prefix."""
+  prefixes = ["".join(rng.choice(list(app.AA_vocab), length)) for _ in range(2 * num_sampled)]
+  sampled = pd.DataFrame({'mutated_sequence': prefixes[:num_sampled]})
+  rows = [prefix + "".join(rng.choice(list(app.AA_vocab), extension)) for prefix in prefixes for _ in range(20)]
+  return pd.DataFrame({'mutated_sequence': rows}), sampled
+
+def timed(function, repeats, *args):
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    result = function(*args)
+    times.append(time.perf_counter() - start)
+  return result, min(times)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--length', type=int, default=100, help='Sequence length')
+  parser.add_argument('--sampled', type=int, default=100, help='Number of sampled parent mutants')
+  parser.add_argument('--repeats', type=int, default=3, help='Timing repeats (best is reported)')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+
+  cases = [('extension (rounds=0)', *extension_library(rng, args.length, args.sampled), 0),
+           ('multi-mutant (rounds=3)', *multi_mutant_library(rng, args.length, args.sampled, 3), 3)]
+  for name, library, sampled, mutation_rounds in cases:
+    expected, regex_time = timed(regex_trim_DMS, args.repeats, library, sampled, mutation_rounds)
+    result, set_time = timed(app.trim_DMS, args.repeats, library, sampled, mutation_rounds)
+    assert expected.equals(result), f"{name}: trimmed variants differ"
+    print(f"{name}: {len(library)} rows -> {len(result)} kept; regex {regex_time*1000:.1f} ms, set-based {set_time*1000:.1f} ms ({regex_time/set_time:.1f}x)")
@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+import argparse
+import contextlib
+import numpy as np
+import torch
+
+# Converted checkpoints are a directory with the model config / tokenizer files, a flat weights file in which every
+# tensor starts on an ALIGNMENT boundary, and an index of the tensors in it. Loading builds the model with its
+# parameters on the meta device and binds tensors that view a memory map of the weights file: nothing is deserialized
+# or copied, pages are read on first use, and processes loading the same checkpoint share the page cache.
+INDEX_FILE = 'mmap_index.json'
+WEIGHTS_FILE = 'mmap_weights.bin'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+MODEL_NAMES = ['Tranception', 'RITA', 'ProtXLNet']
+# Files of the source checkpoint that the converted directory does not need
+WEIGHT_FILE_SUFFIXES = ('.bin', '.pt', '.pth', '.ckpt', '.safetensors', '.h5', '.msgpack', '.index.json')
+
+# dtype name -> (numpy dtype of the stored bytes, torch dtype); numpy has no bfloat16, so it is stored as int16
+DTYPES = {
+    'float32': (np.float32, torch.float32),
+    'float16': (np.float16, torch.float16),
+    'bfloat16': (np.int16, torch.bfloat16),
+    'float64': (np.float64, torch.float64),
+    'int64': (np.int64, torch.int64),
+    'int32': (np.int32, torch.int32),
+    'int16': (np.int16, torch.int16),
+    'int8': (np.int8, torch.int8),
+    'uint8': (np.uint8, torch.uint8),
+    'bool': (np.bool_, torch.bool),
+}
+
+def is_converted(path):
+    return path is not None and os.path.isfile(os.path.join(path, INDEX_FILE))
+
+def load_pretrained(model_name, model_path, **config_kwargs):
+    """Model loaded the way the generators load it from a regular checkpoint."""
+    if model_name == 'Tranception':
+        from tranception.model_pytorch import TranceptionLMHeadModel
+        return TranceptionLMHeadModel.from_pretrained(model_path, **config_kwargs)
+    elif model_name == 'RITA':
+        from transformers import AutoModelForCausalLM
+        return AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True, **config_kwargs)
+    elif model_name == 'ProtXLNet':
+        from transformers import XLNetLMHeadModel
+        return XLNetLMHeadModel.from_pretrained(model_path, **config_kwargs)
+    raise ValueError(f"Model {model_name} not supported, use one of {MODEL_NAMES}")
+
+def _storage_array(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+def save_converted(model, output_dir, model_name, tokenizer=None, source_dir=None):
+    """
+    Writes model (an already loaded Tranception, RITA or ProtXLNet) as a converted checkpoint. Tensors that share
+    storage, e.g. tied input / output embeddings, are written once and bound to the same parameter when loaded.
+    """
+    if model_name not in MODEL_NAMES:
+        raise ValueError(f"Model {model_name} not supported, use one of {MODEL_NAMES}")
+    os.makedirs(output_dir, exist_ok=True)
+    if source_dir is not None and os.path.isdir(source_dir):
+        # Keep the config, tokenizer and remote-code files (RITA) exactly as they were
+        for file_name in os.listdir(source_dir):
+            source_file = os.path.join(source_dir, file_name)
+            if os.path.isfile(source_file) and not file_name.endswith(WEIGHT_FILE_SUFFIXES):
+                shutil.copy2(source_file, os.path.join(output_dir, file_name))
+    if not os.path.exists(os.path.join(output_dir, 'config.json')):
+        model.config.save_pretrained(output_dir)
+    if tokenizer is not None:
+        tokenizer.save_pretrained(output_dir)
+    tensors, written = {}, {}
+    tmp_path = os.path.join(output_dir, WEIGHTS_FILE + '.tmp')
+    with open(tmp_path, 'wb') as fh:
+        for name, tensor in model.state_dict(keep_vars=True).items():
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+            if key in written:
+                tensors[name] = {'alias': written[key]}
+                continue
+            written[key] = name
+            array = _storage_array(tensor)
+            offset = fh.tell() + (-fh.tell() % ALIGNMENT)
+            fh.seek(offset)
+            fh.write(array.tobytes())
+            tensors[name] = {'dtype': str(tensor.dtype).replace('torch.', ''), 'shape': list(tensor.shape), 'offset': offset, 'nbytes': array.nbytes,
+                             'parameter': isinstance(tensor, torch.nn.Parameter)}
+    os.replace(tmp_path, os.path.join(output_dir, WEIGHTS_FILE))
+    # The index is written last: a directory without it is not a converted checkpoint
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as fh:
+        json.dump({'format_version': FORMAT_VERSION, 'model_name': model_name, 'tensors': tensors}, fh)
+    return output_dir
+
+def convert_checkpoint(model_path, output_dir, model_name):
+    """Loads a regular (pickle or safetensors) checkpoint once and writes it as a converted checkpoint."""
+    model = load_pretrained(model_name, model_path)
+    tokenizer = None
+    if not os.path.isdir(model_path) and model_name != 'Tranception':
+        # The tokenizer files of a local checkpoint are copied; those of a HuggingFace model id are saved
+        from transformers import AutoTokenizer, XLNetTokenizer
+        tokenizer = (XLNetTokenizer if model_name == 'ProtXLNet' else AutoTokenizer).from_pretrained(model_path)
+    return save_converted(model, output_dir, model_name, tokenizer=tokenizer, source_dir=model_path)
+
+# torch.nn.init functions that the module constructors call to initialise their parameters
+INIT_FUNCTIONS = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'xavier_uniform_', 'xavier_normal_',
+                  'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_']
+
+@contextlib.contextmanager
+def meta_parameters():
+    """
+    Modules created in this context get their parameters on the meta device, and their weight initialisation
+    (torch.nn.init and the transformers _init_weights) is skipped; buffers are real.
+    """
+    from transformers.modeling_utils import no_init_weights
+    register_parameter = torch.nn.Module.register_parameter
+    def register_meta_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = torch.nn.Parameter(param.to('meta'), requires_grad=param.requires_grad)
+    init_functions = {name: getattr(torch.nn.init, name) for name in INIT_FUNCTIONS if hasattr(torch.nn.init, name)}
+    torch.nn.Module.register_parameter = register_meta_parameter
+    for name in init_functions:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        with no_init_weights():
+            yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter
+        for name, function in init_functions.items():
+            setattr(torch.nn.init, name, function)
+
+def _build_model(model_name, path, config_kwargs):
+    if model_name == 'Tranception':
+        from tranception.config import TranceptionConfig
+        from tranception.model_pytorch import TranceptionLMHeadModel
+        return TranceptionLMHeadModel(TranceptionConfig.from_pretrained(path, **config_kwargs))
+    elif model_name == 'RITA':
+        from transformers import AutoConfig, AutoModelForCausalLM
+        config = AutoConfig.from_pretrained(path, trust_remote_code=True, **config_kwargs)
+        return AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+    elif model_name == 'ProtXLNet':
+        from transformers import XLNetConfig, XLNetLMHeadModel
+        return XLNetLMHeadModel(XLNetConfig.from_pretrained(path, **config_kwargs))
+    raise ValueError(f"Model {model_name} not supported, use one of {MODEL_NAMES}")
+
+def load_converted(path, **config_kwargs):
+    """
+    Loads a converted checkpoint in eval mode. config_kwargs override config attributes like from_pretrained does
+    (e.g. mem_len=512 for ProtXLNet). Parameters do not require gradients. The memory map is copy-on-write, so
+    in-place changes to the weights stay private to the process; .to(device) / .half() copy as usual.
+    """
+    with open(os.path.join(path, INDEX_FILE)) as fh:
+        index = json.load(fh)
+    if index['format_version'] != FORMAT_VERSION:
+        raise ValueError(f"Converted checkpoint {path} has format version {index['format_version']}, expected {FORMAT_VERSION}; convert it again")
+    with meta_parameters():
+        model = _build_model(index['model_name'], path, config_kwargs)
+    weights = np.memmap(os.path.join(path, WEIGHTS_FILE), dtype=np.uint8, mode='c')
+    bound = {}
+    for name, entry in index['tensors'].items():
+        if 'alias' in entry:
+            continue
+        numpy_dtype, torch_dtype = DTYPES[entry['dtype']]
+        array = weights[entry['offset']:entry['offset'] + entry['nbytes']].view(numpy_dtype).reshape(entry['shape'])
+        tensor = torch.from_numpy(array)
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        bound[name] = torch.nn.Parameter(tensor, requires_grad=False) if entry['parameter'] else tensor
+    for name, entry in index['tensors'].items():
+        tensor = bound[entry.get('alias', name)]
+        module_name, _, attribute = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if attribute in module._parameters:
+            module._parameters[attribute] = tensor
+        elif attribute in module._buffers:
+            module._buffers[attribute] = tensor
+        else:
+            raise ValueError(f"Converted checkpoint {path} has weights for {name}, which is not part of the {index['model_name']} model")
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"Converted checkpoint {path} has no weights for {', '.join(missing)}")
+    return model.eval()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a Tranception, RITA or ProtXLNet checkpoint into a memory-mapped checkpoint; pass the output directory as --Tmodel to the generators')
+    parser.add_argument('--model_name', type=str, choices=MODEL_NAMES, required=True, help='Model name')
+    parser.add_argument('--model_path', type=str, required=True, help='Local checkpoint directory or HuggingFace model id')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory to write the converted checkpoint to')
+    args = parser.parse_args()
+    convert_checkpoint(args.model_path, args.output_dir, args.model_name)
+    print(f"Converted {args.model_name} checkpoint saved to {args.output_dir}")
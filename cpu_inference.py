@@ -0,0 +1,119 @@
+import time
+import functools
+import warnings
+import contextlib
+import torch
+import torch.nn as nn
+from transformers.pytorch_utils import Conv1D
+
+# CPU inference mode for the scoring models (Tranception, RITA, ProtXLNet): the linear layers are quantized to int8 with
+# dynamic (per-batch) activation scales, the forward pass can run under bfloat16 autocast, the number of threads is fixed
+# and every forward call is metered so scoring throughput can be reported. The model stays on the CPU: code that moves
+# models to CUDA checks is_cpu_model first.
+
+def configure_threads(num_threads=None):
+    """Fixes the intra-op thread count (all cores by default) and returns it. Inter-op threads can only be set once per process."""
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+    return torch.get_num_threads()
+
+def conv1d_to_linear(model):
+    """
+    Replaces the GPT-2 style Conv1D layers (Tranception, GPT-2) by equivalent nn.Linear layers, so dynamic quantization,
+    which only handles nn.Linear, covers them too. Conv1D stores the weight as (in, out), nn.Linear as (out, in).
+    """
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = nn.Linear(child.weight.shape[0], child.weight.shape[1], device=child.weight.device, dtype=child.weight.dtype)
+                with torch.no_grad():
+                    linear.weight.copy_(child.weight.t())
+                    linear.bias.copy_(child.bias)
+                setattr(module, child_name, linear)
+    return model
+
+def _float_input(module, args):
+    # quantized::linear_dynamic only takes float32 activations, which bfloat16 autocast upstream does not produce
+    return tuple(arg.float() if torch.is_tensor(arg) and arg.is_floating_point() else arg for arg in args)
+
+class ThroughputMeter:
+    """Rows (sequences) and seconds spent in the forward calls of a model; a nested forward call is not counted twice."""
+    def __init__(self):
+        self.rows = 0
+        self.seconds = 0.0
+        self.calls = 0
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def measure(self, rows):
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.seconds += time.perf_counter() - start
+                self.rows += rows
+                self.calls += 1
+
+    def reset(self):
+        self.rows = 0
+        self.seconds = 0.0
+        self.calls = 0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def report(self, label="Scoring"):
+        return f"{label}: {self.rows} sequences in {self.calls} forward calls, {self.seconds:.2f}s ({self.rows_per_second:.1f} sequences/s, {torch.get_num_threads()} threads)"
+
+def _batch_rows(args, kwargs):
+    input_ids = kwargs.get('input_ids', args[0] if len(args) > 0 else None)
+    return int(input_ids.shape[0]) if torch.is_tensor(input_ids) and input_ids.dim() > 1 else 1
+
+def prepare_model(model, int8=True, bf16=False, num_threads=None):
+    """
+    Returns model set up for CPU scoring (in place): eval mode on the CPU, Conv1D layers turned into nn.Linear, linear
+    layers dynamically quantized to int8 (int8=True) and forward calls run under bfloat16 autocast (bf16=True).
+    model.cpu_inference holds the settings and model.throughput the ThroughputMeter of its forward calls.
+    """
+    num_threads = configure_threads(num_threads)
+    model = model.cpu().eval()
+    if int8:
+        conv1d_to_linear(model)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # torch.ao.quantization deprecation notices
+            torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        if bf16:
+            for module in model.modules():
+                if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+                    module.register_forward_pre_hook(_float_input)
+    meter = ThroughputMeter()
+    forward = model.forward
+
+    @functools.wraps(forward)
+    def cpu_forward(*args, **kwargs):
+        with meter.measure(_batch_rows(args, kwargs)), torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+            outputs = forward(*args, **kwargs)
+        if bf16:
+            # downstream scoring (log-softmax, losses) runs in float32, as with the fp32 model
+            if hasattr(outputs, 'logits') and outputs.logits is not None:
+                outputs.logits = outputs.logits.float()
+            elif isinstance(outputs, tuple) and torch.is_tensor(outputs[0]) and outputs[0].is_floating_point():
+                outputs = (outputs[0].float(),) + outputs[1:]
+        return outputs
+
+    model.forward = cpu_forward
+    model.cpu_inference = {'int8': int8, 'bf16': bf16, 'threads': num_threads}
+    model.throughput = meter
+    return model
+
+def is_cpu_model(model):
+    """True for models prepared by prepare_model, which must not be moved to CUDA (quantized layers only run on the CPU)."""
+    return getattr(model, 'cpu_inference', None) is not None
@@ -1,4 +1,9 @@
+from backends import evmutation_model
 import app
+import heatmaps
+import tracing
+import checkpoints
+import cpu_inference
 import argparse
 from transformers import PreTrainedTokenizerFast, AutoModelForCausalLM, AutoTokenizer, XLNetLMHeadModel, XLNetTokenizer
 from tranception import config, model_pytorch
@@ -6,10 +11,10 @@ import tranception
 import pandas as pd
 import os
 import util
+from journal import GenerationJournal
 from sampling import top_k_sampling, temperature_sampler, top_p_sampling, typical_sampling, mirostat_sampling, random_sampling, beam_search
 import time
 import MCTS
-from EVmutation.model import CouplingsModel
 from app import process_prompt_protxlnet
 
 parser = argparse.ArgumentParser()
@@ -18,13 +23,16 @@ parser.add_argument('--seq_id', type=str, help='Sequence ID for mutation', requi
 parser.add_argument('--mutation_start', type=int, default=None, help='Mutation start position')
 parser.add_argument('--mutation_end', type=int, default=None, help='Mutation end position')
 parser.add_argument('--model', type=str, choices=['small', 'medium', 'large'], help='Tranception model size')
-parser.add_argument('--Tmodel', type=str, help='Tranception model path')
+parser.add_argument('--Tmodel', type=str, help='Tranception model path (a regular or a converted checkpoint, see checkpoints.py)')
 parser.add_argument('--model_name', type=str, choices=['Tranception', 'RITA', 'ProtXLNet'], help='Model name', required=True)
 parser.add_argument('--use_scoring_mirror', action='store_true', help='Whether to score the sequence from both ends')
 parser.add_argument('--batch', type=int, default=20, help='Batch size for scoring')
 parser.add_argument('--max_pos', type=int, default=50, help='Maximum number of positions per heatmap')
 parser.add_argument('--num_workers', type=int, default=8, help='Number of workers for dataloader')
+parser.add_argument('--cpu_inference', type=str, choices=['int8', 'bf16', 'int8+bf16'], default=None, help='Score on the CPU with int8 dynamically quantized linear layers and/or bfloat16 autocast (see cpu_inference.py)')
+parser.add_argument('--threads', type=int, default=None, help='Number of CPU threads for scoring (default: all cores)')
 parser.add_argument('--with_heatmap', action='store_true', help='Whether to generate heatmap')
+parser.add_argument('--heatmap_mode', type=str, choices=['annotated', 'raster'], default='annotated', help='Heatmap style: annotated cells or a fast raster without per-cell text')
 parser.add_argument('--save_scores', action='store_true', help='Whether to save scores')
 
 parser.add_argument('--sampling_method', type=str, choices=['top_k', 'top_p', 'typical', 'mirostat', 'random', 'greedy', 'beam_search', 'mcts'], required=True, help='Sampling method')
@@ -40,7 +48,17 @@ parser.add_argument('--output_name', type=str, required=True, help='Output file
 parser.add_argument('--save_df', action='store_true', help='Whether to save the dataframe')
 parser.add_argument('--verbose', action='store_true', help='Whether to print verbose output')
 parser.add_argument('--conserved_positions', nargs='+', type=int, help='List of conserved positions to exclude from mutation (1-indexed)')
+parser.add_argument('--resume', action='store_true', help='Resume an interrupted run from its generation journal')
+parser.add_argument('--trace', type=str, default=None, help='Record per-stage spans and save them as a Chrome trace JSON to this path')
+parser.add_argument('--trace_cuda', action='store_true', help='Also record GPU time and peak CUDA memory per span (adds synchronisation)')
 args = parser.parse_args()
+if args.trace:
+    tracing.enable(cuda=args.trace_cuda)
+
+if args.with_heatmap:
+    # Start the background renderer first: its workers are forked, which is only safe before the tokenizers are used and
+    # the model is loaded (and CUDA initialised)
+    heatmaps.get_heatmap_renderer(args.heatmap_mode)
 
 AA_vocab = "ACDEFGHIKLMNPQRSTVWY"
 tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(os.path.dirname(os.path.realpath(__file__)), "tranception/utils/tokenizers/Basic_tokenizer"),
@@ -53,44 +71,54 @@ tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(os.path.dirname(
 
 # Load model
 model_name = args.model_name
-if model_name == 'Tranception':
-    assert args.model or args.Tmodel, "Either model size or model path must be specified"
-    model_type = args.model.capitalize() if args.model else None
-    try:
-        model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path=args.Tmodel, local_files_only=True)
-        print("Model successfully loaded from local")
-    except:
-        print("Model not found locally, downloading from HuggingFace")
-        if model_type=="Small":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Small")
-        elif model_type=="Medium":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Medium")
-        elif model_type=="Large":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Large")
-elif model_name == 'RITA':
-    assert args.Tmodel, "Model path must be specified"
-    tokenizer = AutoTokenizer.from_pretrained(args.Tmodel)
-    model = AutoModelForCausalLM.from_pretrained(args.Tmodel, local_files_only=True, trust_remote_code=True)
-elif model_name == 'ProtXLNet':
-    tokenizer = XLNetTokenizer.from_pretrained(args.Tmodel)
-    model = XLNetLMHeadModel.from_pretrained(args.Tmodel, mem_len=512)
-else:
-    raise ValueError(f"Model {model_name} not supported")
+with tracing.span('load_model', 'load', model=model_name):
+    if model_name == 'Tranception':
+        assert args.model or args.Tmodel, "Either model size or model path must be specified"
+        model_type = args.model.capitalize() if args.model else None
+        if checkpoints.is_converted(args.Tmodel):
+            # Outside the fallback below: a corrupt or outdated converted checkpoint must fail loudly
+            model = checkpoints.load_converted(args.Tmodel)
+            print("Model successfully loaded from local")
+        else:
+            try:
+                model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path=args.Tmodel, local_files_only=True)
+                print("Model successfully loaded from local")
+            except:
+                print("Model not found locally, downloading from HuggingFace")
+                if model_type=="Small":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Small")
+                elif model_type=="Medium":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Medium")
+                elif model_type=="Large":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Large")
+    elif model_name == 'RITA':
+        assert args.Tmodel, "Model path must be specified"
+        tokenizer = AutoTokenizer.from_pretrained(args.Tmodel)
+        if checkpoints.is_converted(args.Tmodel):
+            model = checkpoints.load_converted(args.Tmodel)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(args.Tmodel, local_files_only=True, trust_remote_code=True)
+    elif model_name == 'ProtXLNet':
+        tokenizer = XLNetTokenizer.from_pretrained(args.Tmodel)
+        if checkpoints.is_converted(args.Tmodel):
+            model = checkpoints.load_converted(args.Tmodel, mem_len=512)
+        else:
+            model = XLNetLMHeadModel.from_pretrained(args.Tmodel, mem_len=512)
+    else:
+        raise ValueError(f"Model {model_name} not supported")
+    if args.cpu_inference:
+        model = cpu_inference.prepare_model(model, int8='int8' in args.cpu_inference, bf16='bf16' in args.cpu_inference, num_threads=args.threads)
+        print(f"CPU inference: {args.cpu_inference} on {model.cpu_inference['threads']} threads")
+    elif args.threads:
+        cpu_inference.configure_threads(args.threads)
     
 mutation_start = args.mutation_start
 mutation_end = args.mutation_end
 sequence_num = args.sequence_num
 evolution_cycles = args.evolution_cycles
-generated_sequence = []
-sequence_iteration = []
-generated_sequence_name = []
-mutation_list = []
-generation_duration = []
-samplings = []
-mutants = []
-subsamplings = []
-samplingtheshold = []
-subsamplingtheshold = []
+journal = GenerationJournal(os.path.join(os.path.dirname(os.path.realpath(__file__)), "generation_journal/{}.jsonl".format(args.output_name)), args, resume=args.resume)
+# journal.rows holds the metadata of the finished sequences (replayed ones included)
+generated_sequence = journal.rows
 past_key_values=None
 
 if args.sampling_method in ['top_k', 'top_p', 'typical', 'mirostat', 'beam_search']:
@@ -100,10 +128,13 @@ if args.sampling_method == 'beam_search' or args.sampling_method == 'mcts':
     if args.filter == 'qff' or args.filter == 'ams':
         ev_dir = os.path.join(f"{args.evmutation_model_dir}")
         assert os.path.exists(ev_dir), f"Model directory {ev_dir} does not exist"
-        ev_model = CouplingsModel(ev_dir)
+        ev_model = evmutation_model.CouplingsModel(ev_dir)
     else:
         ev_model = None
 
+sampling_strat = args.sampling_method
+sampling_threshold = args.max_length if args.sampling_method == 'mcts' else args.sampling_threshold
+journal.restore_rng_state()
 while len(generated_sequence) < sequence_num:
 
     iteration = 0
@@ -111,6 +142,11 @@ while len(generated_sequence) < sequence_num:
     sequence_id = args.seq_id
     start_time = time.time()
     mutation_history = []
+    partial = journal.pop_partial()
+    if partial is not None:
+        iteration, seq, mutation_history, elapsed = partial
+        mutated_sequence = seq
+        start_time -= elapsed
 
     while iteration < evolution_cycles:
         if args.verbose:
@@ -134,6 +170,7 @@ while len(generated_sequence) < sequence_num:
                                                                                         AA_vocab=AA_vocab, 
                                                                                         tokenizer=tokenizer,
                                                                                         with_heatmap=args.with_heatmap,
+                                                                                        heatmap_mode=args.heatmap_mode,
                                                                                         past_key_values=past_key_values,
                                                                                         model_type=model_name,
                                                                                         exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None
@@ -191,24 +228,20 @@ while len(generated_sequence) < sequence_num:
         seq = mutated_sequence
 
         iteration += 1
+        journal.record_mutation(iteration, seq, mutation_history, start_time)
 
-    generated_sequence.append(mutated_sequence)
-    sequence_iteration.append(iteration)
-    samplings.append(sampling_strat)
-    samplingtheshold.append(sampling_threshold) 
-    seq_name = '{}_{}_{}x_{}'.format(model_name, sequence_id, iteration, len(generated_sequence))
-    generated_sequence_name.append(seq_name)
-    mutants.append('1')
-    subsamplings.append('NA')
-    subsamplingtheshold.append('NA')
-    mutation_list.append(';'.join(mutation_history))
+    seq_name = '{}_{}_{}x_{}'.format(model_name, sequence_id, iteration, len(generated_sequence) + 1)
     generation_time = time.time() - start_time
-    generation_duration.append(generation_time)
+    journal.record_sequence({'name': seq_name, 'sequence': mutated_sequence, 'sampling': sampling_strat, 'threshold': sampling_threshold, 'subsampling': 'NA', 'subthreshold': 'NA', 'iterations': iteration, 'mutants': '1', 'mutations': ';'.join(mutation_history), 'time': generation_time})
     print(f"Sequence {len(generated_sequence)}/{sequence_num}: {generation_time} seconds with {iteration} evolution cycles")
     print("=========================================") if args.verbose else None
     
-print(f'===========Mutated {len(generated_sequence)} sequences in {sum(generation_duration)} seconds============')
-generated_sequence_df = pd.DataFrame({'name': generated_sequence_name,'sequence': generated_sequence, 'sampling': samplings, 'threshold': samplingtheshold, 'subsampling':subsamplings, 'subthreshold': subsamplingtheshold, 'iterations': sequence_iteration, 'mutants': mutants, 'mutations': mutation_list, 'time': generation_duration})
+generation_duration = sum(row['time'] for row in generated_sequence)
+print(f'===========Mutated {len(generated_sequence)} sequences in {generation_duration} seconds============')
+if args.cpu_inference:
+    print(model.throughput.report())
+# Compact the journal into the metadata CSV / FASTA layout
+generated_sequence_df = journal.to_dataframe()
 
 if args.save_df:
     save_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "generated_metadata/{}.csv".format(args.output_name))
@@ -223,3 +256,6 @@ save_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "generated
 os.makedirs(os.path.dirname(os.path.realpath(save_path))) if not os.path.exists(os.path.dirname(os.path.realpath(save_path))) else None
 util.save_as_fasta(generated_sequence_df, save_path)
 print(f"Generated sequences saved to {save_path}")
+journal.close(remove=True)
+if args.trace:
+    tracing.finish(args.trace)
@@ -0,0 +1,166 @@
+import os
+import sys
+import atexit
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+HEATMAP_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scoring_matrix/')
+HEATMAP_MODES = ['annotated', 'raster']
+
+def heatmap_path(image_index):
+    return os.path.join(HEATMAP_DIR, 'fitness_scoring_substitution_matrix_{}.png'.format(image_index))
+
+def score_matrix(scores, sequence, mutation_range_start, mutation_range_end, AA_vocab):
+    """
+    Compact (positions x AA_vocab) float32 matrix of avg_score for the positions mutation_range_start..mutation_range_end;
+    the wild type and excluded mutants are NaN.
+    """
+    matrix = np.full((mutation_range_end - mutation_range_start + 1, len(AA_vocab)), np.nan, dtype=np.float32)
+    positions = scores['position'].to_numpy()
+    in_window = (positions >= mutation_range_start) & (positions <= mutation_range_end)
+    aa_index = {aa: i for i, aa in enumerate(AA_vocab)}
+    columns = np.array([aa_index.get(aa, -1) for aa in scores['target_AA'].to_numpy()[in_window]], dtype=np.int64)
+    known = columns >= 0
+    matrix[positions[in_window][known] - mutation_range_start, columns[known]] = scores['avg_score'].to_numpy()[in_window][known]
+    return matrix
+
+def render_heatmap(matrix, wild_type, mutation_range_start, AA_vocab, vmin, vmax, image_path, mode='annotated', fontsize=20):
+    """
+    Renders a score matrix to image_path with the non-interactive Agg backend. 'annotated' draws the seaborn heatmap
+    with the mutant and its score in every cell; 'raster' draws the colour map only, which is much faster on long windows.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    mutation_range_len = matrix.shape[0]
+    positions = range(mutation_range_start, mutation_range_start + mutation_range_len)
+    yticklabels = [str(pos)+' ('+wild_type[i]+')' for i, pos in enumerate(positions)]
+    cbar_label = 'Log likelihood ratio (mutant / starting sequence)'
+    title = "Higher predicted scores (green) imply higher protein fitness"
+    if mode == 'annotated':
+        import seaborn as sns
+        fig, ax = plt.subplots(figsize=(50,mutation_range_len))
+        ax.tick_params(bottom=True, top=True, left=True, right=True)
+        ax.tick_params(labelbottom=True, labeltop=True, labelleft=True, labelright=True)
+        labels = np.array(["{} \n {:.4f}".format(wild_type[i]+str(pos)+aa, 0.0 if np.isnan(matrix[i, j]) else matrix[i, j])
+                           for i, pos in enumerate(positions) for j, aa in enumerate(AA_vocab)]).reshape(matrix.shape)
+        piv = pd.DataFrame(matrix.round(4), index=list(positions), columns=list(AA_vocab))
+        heat = sns.heatmap(piv,annot=labels,fmt="",cmap='RdYlGn',linewidths=0.30,ax=ax,vmin=vmin,vmax=vmax,
+                    cbar_kws={'label': cbar_label},annot_kws={"size": fontsize})
+        heat.figure.axes[-1].yaxis.label.set_size(fontsize=int(fontsize*1.5))
+        heat.figure.axes[-1].tick_params(labelsize=fontsize)
+        heat.set_title(title,fontsize=fontsize*2, pad=40)
+        heat.set_ylabel("Sequence position", fontsize = fontsize*2)
+        heat.set_xlabel("Amino Acid mutation", fontsize = fontsize*2)
+        heat.set_yticks(np.arange(mutation_range_len) + 0.5)
+        heat.set_yticklabels(yticklabels, fontsize = fontsize, rotation=0)
+        heat.tick_params(axis='x', labelsize=fontsize)
+        dpi = 100
+    elif mode == 'raster':
+        fig, ax = plt.subplots(figsize=(8, max(3, 0.18 * mutation_range_len)))
+        image = ax.imshow(np.ma.masked_invalid(matrix), cmap='RdYlGn', vmin=vmin, vmax=vmax, aspect='auto', interpolation='nearest')
+        fig.colorbar(image, ax=ax, label=cbar_label)
+        ax.set_xticks(range(len(AA_vocab)))
+        ax.set_xticklabels(list(AA_vocab))
+        ax.set_yticks(range(mutation_range_len))
+        ax.set_yticklabels(yticklabels, fontsize=6)
+        ax.set_title(title)
+        ax.set_ylabel("Sequence position")
+        ax.set_xlabel("Amino Acid mutation")
+        dpi = 80
+    else:
+        raise ValueError(f"Heatmap mode {mode} not supported, use one of {HEATMAP_MODES}")
+    fig.tight_layout()
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    # Write then rename, so that a reader never sees a half-written image
+    tmp_path = image_path + '.tmp.png'
+    fig.savefig(tmp_path, dpi=dpi)
+    plt.close(fig)
+    os.replace(tmp_path, image_path)
+    return image_path
+
+def _cuda_initialized():
+    # torch is not imported here: if it has not been imported, CUDA cannot be initialised
+    torch = sys.modules.get('torch')
+    return torch is not None and torch.cuda.is_initialized()
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    import seaborn
+
+class HeatmapRenderer:
+    """
+    Renders score matrices in a background process pool so that the caller never waits on matplotlib.
+    submit() only builds the compact score matrix and returns the image path the heatmap will be written to.
+    Images keep one fixed path per window; a render of a path that is still in flight is waited on before the path
+    is resubmitted. If more than max_pending renders are queued, new heatmaps are skipped rather than blocking and
+    submit() returns None for them.
+    Workers are forked (the generator scripts are not import-safe, which spawn would require) when the renderer is
+    created, so the scripts create it before loading the model. Once CUDA is initialised forking is unsafe, and a
+    renderer created after that (e.g. lazily from app.py) spawns its workers instead; they only import this module.
+    """
+    def __init__(self, processes=1, mode='annotated', max_pending=8):
+        if mode not in HEATMAP_MODES:
+            raise ValueError(f"Heatmap mode {mode} not supported, use one of {HEATMAP_MODES}")
+        self.mode = mode
+        self.max_pending = max_pending
+        self.pending = {}
+        self.skipped = 0
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() and not _cuda_initialized() else 'spawn')
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker)
+        self.executor.submit(int).result()
+        atexit.register(self.close)
+
+    def _collect(self):
+        still_pending = {}
+        for image_path, future in self.pending.items():
+            if not future.done():
+                still_pending[image_path] = future
+            elif future.exception() is not None:
+                print(f"Heatmap rendering failed: {future.exception()}")
+        self.pending = still_pending
+
+    def submit(self, scores, sequence, image_index, mutation_range_start, mutation_range_end, AA_vocab, vmin=None, vmax=None):
+        image_path = heatmap_path(image_index)
+        if image_path in self.pending:
+            # The previous render of this window must not finish after (and overwrite) the new one
+            self.pending[image_path].exception()
+        self._collect()
+        if len(self.pending) >= self.max_pending:
+            self.skipped += 1
+            if self.skipped == 1:
+                print(f"Heatmap renderer has {len(self.pending)} heatmaps queued, skipping new ones until it catches up")
+            return None
+        if vmin is None: vmin = np.percentile(scores.avg_score,2)
+        if vmax is None: vmax = np.percentile(scores.avg_score,98)
+        matrix = score_matrix(scores, sequence, mutation_range_start, mutation_range_end, AA_vocab)
+        wild_type = sequence[mutation_range_start-1:mutation_range_end]
+        self.pending[image_path] = self.executor.submit(render_heatmap, matrix, wild_type, mutation_range_start, AA_vocab, float(vmin), float(vmax), image_path, self.mode)
+        return image_path
+
+    def wait(self):
+        """Blocks until every queued heatmap is written."""
+        for future in self.pending.values():
+            future.exception()
+        self._collect()
+
+    def close(self):
+        if self.executor is None:
+            return
+        self.wait()
+        self.executor.shutdown()
+        self.executor = None
+        if self.skipped:
+            print(f"Skipped {self.skipped} heatmaps while the renderer was busy")
+
+_renderers = {}
+
+def get_heatmap_renderer(mode='annotated', processes=1):
+    """Module-level renderer per mode, shared by every caller in the process."""
+    if mode not in _renderers:
+        _renderers[mode] = HeatmapRenderer(processes=processes, mode=mode)
+    return _renderers[mode]
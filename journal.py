@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import pickle
+import base64
+import hashlib
+import random
+import numpy as np
+import pandas as pd
+import torch
+
+METADATA_COLUMNS = ['name', 'sequence', 'sampling', 'threshold', 'subsampling', 'subthreshold', 'iterations', 'mutants', 'mutations', 'time']
+# Arguments that do not change the generated trajectories
+NON_TRAJECTORY_ARGS = ['resume', 'verbose', 'save_df', 'save_scores', 'num_workers', 'threads', 'heatmap_mode', 'trace', 'trace_cuda']
+
+def args_fingerprint(args):
+    arguments = {k: v for k, v in sorted(vars(args).items()) if k not in NON_TRAJECTORY_ARGS}
+    return hashlib.sha1(json.dumps(arguments, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_rng_state():
+    state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return base64.b64encode(pickle.dumps(state)).decode('ascii')
+
+def set_rng_state(encoded_state):
+    state = pickle.loads(base64.b64decode(encoded_state))
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class GenerationJournal:
+    """
+    Append-only JSON-lines journal of a generation run.
+    Each committed mutation and each finished sequence is appended together with the RNG state, so that
+    a run started with --resume replays the finished sequences and continues the interrupted trajectory
+    from the same cycle. Records are flushed on write and fsynced every fsync_every records and at
+    every finished sequence.
+    """
+    def __init__(self, path, args, resume=False, fsync_every=16):
+        self.path = path
+        self.fingerprint = args_fingerprint(args)
+        self.fsync_every = fsync_every
+        self.pending = 0
+        self.rows = []
+        self.numbers = []
+        self.partial = None
+        self.rng_state = None
+        os.makedirs(os.path.dirname(os.path.realpath(path)), exist_ok=True)
+        if resume and os.path.exists(path):
+            self._replay()
+            self.fh = open(path, 'a')
+            print(f"Resuming from {path}: {len(self.rows)} sequences done" + (f", sequence {len(self.rows) + 1} at cycle {self.partial['iteration']}" if self.partial is not None else ""))
+        else:
+            if os.path.exists(path):
+                print(f"Overwriting existing journal {path} (use --resume to continue it)")
+            self.fh = open(path, 'w')
+            self._write({'type': 'header', 'fingerprint': self.fingerprint, 'args': vars(args)}, sync=True)
+
+    def _replay(self):
+        with open(self.path) as fh:
+            lines = fh.readlines()
+        for line_number, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last line is what an interrupted write looks like; anything else is corruption
+                if line_number != len(lines) - 1:
+                    raise
+                # Drop the torn line so that new records start on a fresh line
+                with open(self.path, 'w') as fh:
+                    fh.writelines(lines[:-1])
+                break
+            if record['type'] == 'header':
+                if record['fingerprint'] != self.fingerprint:
+                    raise ValueError(f"Journal {self.path} was written with different arguments and cannot be resumed")
+            elif record['type'] == 'mutation':
+                self.partial = {'iteration': record['iteration'], 'sequence': record['sequence'], 'mutations': record['mutations'], 'elapsed': record['elapsed']}
+                self.rng_state = record['rng']
+            elif record['type'] == 'sequence':
+                self.rows.append(record['row'])
+                self.numbers.append(record.get('number', len(self.rows)))
+                self.partial = None
+                self.rng_state = record['rng']
+
+    def _write(self, record, sync=False):
+        self.fh.write(json.dumps(record, default=str) + '\n')
+        self.fh.flush()
+        self.pending += 1
+        if sync or self.pending >= self.fsync_every:
+            os.fsync(self.fh.fileno())
+            self.pending = 0
+
+    def restore_rng_state(self):
+        if self.rng_state is not None:
+            set_rng_state(self.rng_state)
+
+    def pop_partial(self):
+        """Returns (iteration, sequence, mutation history, elapsed seconds) of the interrupted trajectory, or None."""
+        partial, self.partial = self.partial, None
+        if partial is None:
+            return None
+        return partial['iteration'], partial['sequence'], partial['mutations'], partial['elapsed']
+
+    def record_mutation(self, iteration, sequence, mutations, start_time):
+        self._write({'type': 'mutation', 'iteration': iteration, 'sequence': sequence, 'mutations': list(mutations), 'elapsed': time.time() - start_time, 'rng': get_rng_state()})
+
+    def record_sequence(self, row, number=None):
+        """Appends a finished sequence; number identifies its trajectory when they can finish out of order (default: the next one)."""
+        self.rows.append(row)
+        self.numbers.append(len(self.rows) if number is None else number)
+        self._write({'type': 'sequence', 'row': row, 'number': self.numbers[-1], 'rng': get_rng_state()}, sync=True)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.rows, columns=METADATA_COLUMNS)
+
+    def close(self, remove=False):
+        self.fh.close()
+        if remove:
+            os.remove(self.path)
@@ -1,16 +1,23 @@
+from backends import tf, evmutation_model
 import app
+import heatmaps
+import tracing
+import checkpoints
 import argparse
 from transformers import PreTrainedTokenizerFast, AutoModelForCausalLM, AutoTokenizer, XLNetLMHeadModel, XLNetTokenizer
 from tranception import config, model_pytorch
 import tranception
+import numpy as np
 import pandas as pd
+import torch
 import os
 import util
-import tensorflow as tf
+from journal import GenerationJournal
+from pipeline import StagedPipeline
+import sampling
 from sampling import top_k_sampling, temperature_sampler, top_p_sampling, typical_sampling, mirostat_sampling, random_sampling
-from proteinbert.model_generation import InputEncoder
 import time
-from EVmutation.model import CouplingsModel
+import threading
 from app import process_prompt_protxlnet
 
 parser = argparse.ArgumentParser()
@@ -19,7 +26,7 @@ parser.add_argument('--seq_id', type=str, help='Sequence ID for mutation', requi
 parser.add_argument('--mutation_start', type=int, default=None, help='Mutation start position')
 parser.add_argument('--mutation_end', type=int, default=None, help='Mutation end position')
 parser.add_argument('--model', type=str, choices=['small', 'medium', 'large'], help='Tranception model size')
-parser.add_argument('--Tmodel', type=str, help='Tranception model path')
+parser.add_argument('--Tmodel', type=str, help='Tranception model path (a regular or a converted checkpoint, see checkpoints.py)')
 # parser.add_argument('--AMSmodel', type=str, help='Tranception model path for Attention-Matrix Sampling')
 parser.add_argument('--model_name', type=str, choices=['Tranception', 'RITA', 'ProtXLNet'], help='Model name', required=True)
 parser.add_argument('--use_scoring_mirror', action='store_true', help='Whether to score the sequence from both ends')
@@ -27,6 +34,7 @@ parser.add_argument('--batch', type=int, default=20, help='Batch size for scorin
 parser.add_argument('--max_pos', type=int, default=50, help='Maximum number of positions per heatmap')
 parser.add_argument('--num_workers', type=int, default=8, help='Number of workers for dataloader')
 parser.add_argument('--with_heatmap', action='store_true', help='Whether to generate heatmap')
+parser.add_argument('--heatmap_mode', type=str, choices=['annotated', 'raster'], default='annotated', help='Heatmap style: annotated cells or a fast raster without per-cell text')
 parser.add_argument('--mutations', type=int, default=2, help='Number of mutations to generate')
 parser.add_argument('--save_scores', action='store_true', help='Whether to save scores')
 
@@ -48,7 +56,18 @@ parser.add_argument('--output_name', type=str, required=True, help='Output file
 parser.add_argument('--save_df', action='store_true', help='Whether to save the dataframe')
 parser.add_argument('--verbose', action='store_true', help='Verbose mode')
 parser.add_argument('--conserved_positions', type=int, nargs='+', help='List of conserved positions to exclude from mutation (1-indexed)')
+parser.add_argument('--resume', action='store_true', help='Resume an interrupted run from its generation journal')
+parser.add_argument('--pipeline_depth', type=int, default=1, help='Number of sequences generated concurrently, so that filtering of one overlaps with model scoring of another (1 = sequential)')
+parser.add_argument('--trace', type=str, default=None, help='Record per-stage spans and save them as a Chrome trace JSON to this path')
+parser.add_argument('--trace_cuda', action='store_true', help='Also record GPU time and peak CUDA memory per span (adds synchronisation)')
 args = parser.parse_args()
+if args.trace:
+    tracing.enable(cuda=args.trace_cuda)
+
+if args.with_heatmap:
+    # Start the background renderer first: its workers are forked, which is only safe before the tokenizers are used and
+    # the model is loaded (and CUDA initialised)
+    heatmaps.get_heatmap_renderer(args.heatmap_mode)
 
 AA_vocab = "ACDEFGHIKLMNPQRSTVWY"
 tranception_tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(os.path.dirname(os.path.realpath(__file__)), "tranception/utils/tokenizers/Basic_tokenizer"),
@@ -61,30 +80,42 @@ tranception_tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(os.p
 
 # Load model
 model_name = args.model_name
-if model_name == 'Tranception':
-    assert args.model or args.Tmodel, "Either model size or model path must be specified"
-    model_type = args.model.capitalize() if args.model else None
-    try:
-        model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path=args.Tmodel, local_files_only=True)
-        print("Model successfully loaded from local")
-    except:
-        print("Model not found locally, downloading from HuggingFace")
-        if model_type=="Small":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Small")
-        elif model_type=="Medium":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Medium")
-        elif model_type=="Large":
-            model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Large")
-    tokenizer = tranception_tokenizer
-elif model_name == 'RITA':
-    assert args.Tmodel, "Model path must be specified"
-    tokenizer = AutoTokenizer.from_pretrained(args.Tmodel)
-    model = AutoModelForCausalLM.from_pretrained(args.Tmodel, local_files_only=True, trust_remote_code=True)
-elif model_name == 'ProtXLNet':
-    tokenizer = XLNetTokenizer.from_pretrained(args.Tmodel)
-    model = XLNetLMHeadModel.from_pretrained(args.Tmodel, mem_len=512)
-else:
-    raise ValueError(f"Model {model_name} not supported")
+with tracing.span('load_model', 'load', model=model_name):
+    if model_name == 'Tranception':
+        assert args.model or args.Tmodel, "Either model size or model path must be specified"
+        model_type = args.model.capitalize() if args.model else None
+        if checkpoints.is_converted(args.Tmodel):
+            # Outside the fallback below: a corrupt or outdated converted checkpoint must fail loudly
+            model = checkpoints.load_converted(args.Tmodel)
+            print("Model successfully loaded from local")
+        else:
+            try:
+                model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path=args.Tmodel, local_files_only=True)
+                print("Model successfully loaded from local")
+            except:
+                print("Model not found locally, downloading from HuggingFace")
+                if model_type=="Small":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Small")
+                elif model_type=="Medium":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Medium")
+                elif model_type=="Large":
+                    model = tranception.model_pytorch.TranceptionLMHeadModel.from_pretrained(pretrained_model_name_or_path="PascalNotin/Tranception_Large")
+        tokenizer = tranception_tokenizer
+    elif model_name == 'RITA':
+        assert args.Tmodel, "Model path must be specified"
+        tokenizer = AutoTokenizer.from_pretrained(args.Tmodel)
+        if checkpoints.is_converted(args.Tmodel):
+            model = checkpoints.load_converted(args.Tmodel)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(args.Tmodel, local_files_only=True, trust_remote_code=True)
+    elif model_name == 'ProtXLNet':
+        tokenizer = XLNetTokenizer.from_pretrained(args.Tmodel)
+        if checkpoints.is_converted(args.Tmodel):
+            model = checkpoints.load_converted(args.Tmodel, mem_len=512)
+        else:
+            model = XLNetLMHeadModel.from_pretrained(args.Tmodel, mem_len=512)
+    else:
+        raise ValueError(f"Model {model_name} not supported")
 
 
 # example_sequence = {'MDH_A0A075B5H0': 'MTQRKKISLIGAGNIGGTLAHLIAQKELGDVVLFDIVEGMPQGKALDISHSSPIMGSNVKITGTNNYEDIKGSDVVIITAGIPRKPGKSDKEWSRDDLLSVNAKIMKDVAENIKKYCPNAFVIVVTNPLDVMVYVLHKYSGLPHNKVCGMAGVLDSSRFRYFLAEKLNVSPNDVQAMVIGGHGDTMVPLTRYCTVGGIPLTEFIKQGWITQEEIDEIVERTRNAGGEIVNLLKTGSAYFAPAASAIEMAESYLKDKKRILPCSAYLEGQYGVKDLFVGVPVIIGKNGVEKIIELELTEEEQEMFDKSVESVRELVETVKKLNALEHHHHHH',
@@ -95,17 +126,9 @@ mutation_start = args.mutation_start
 mutation_end = args.mutation_end
 sequence_num = args.sequence_num
 evolution_cycles = args.evolution_cycles
-generated_sequence = []
-sequence_iteration = []
-generated_sequence_name = []
-mutation_list = []
-generation_duration = []
-samplings = []
-subsamplings = []
-mutants = []
-samplingthreshold = []
-subsamplingthreshold = []
-past_key_values=None
+journal = GenerationJournal(os.path.join(os.path.dirname(os.path.realpath(__file__)), "generation_journal/{}.jsonl".format(args.output_name)), args, resume=args.resume)
+# journal.rows holds the metadata of the finished sequences (replayed ones included)
+generated_sequence = journal.rows
 
 if args.sampling_method in ['top_k', 'top_p', 'typical', 'mirostat']:
     assert args.sampling_threshold is not None, "Sampling threshold must be specified for top_k, top_p, and mirostat sampling methods"
@@ -116,11 +139,14 @@ if args.use_qff:
     if args.proteinbert:
         assert args.saved_model_dir is not None, "Please specify the saved model directory for Quantitative Filter!"
         physical_devices = tf.config.experimental.list_physical_devices('GPU')
-        assert len(physical_devices) > 0, "Not enough GPU hardware devices available"
-        config = tf.config.experimental.set_memory_growth(physical_devices[0], True)
+        if len(physical_devices) > 0:
+            config = tf.config.experimental.set_memory_growth(physical_devices[0], True)
+        else:
+            print("No GPU found, ProteinBERT will run on CPU")
 
         model_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), f"{args.saved_model_dir}")
         
+        from proteinbert.model_generation import InputEncoder
         input_encoder = InputEncoder(n_annotations=8943) # Check this number
         proteinbert_model = app.load_savedmodel(model_path=model_path)
         strat = "ProteinBERT"
@@ -128,7 +154,7 @@ if args.use_qff:
     if args.evmutation:
         ev_dir = os.path.join(f"{args.evmutation_model_dir}")
         assert os.path.exists(ev_dir), f"Model directory {ev_dir} does not exist"
-        ev_model = CouplingsModel(ev_dir)
+        ev_model = evmutation_model.CouplingsModel(ev_dir)
         strat = "EVmutation"
 
     print(f"{strat} Quantitative-Function Filter will be used!")
@@ -138,7 +164,7 @@ if args.use_hpf:
 if args.use_ams:
     ev_dir = os.path.join(f"{args.evmutation_model_dir}")
     assert os.path.exists(ev_dir), f"Model directory {ev_dir} does not exist"
-    ev_model = CouplingsModel(ev_dir)
+    ev_model = evmutation_model.CouplingsModel(ev_dir)
     strat = "Attention-Matrix Sampling"
     print("Attention-Matrix Sampling will be used!")
     # if args.model_name == 'RITA':
@@ -148,224 +174,209 @@ if args.use_ams:
 if args.use_rsf:
     ev_dir = os.path.join(f"{args.evmutation_model_dir}")
     assert os.path.exists(ev_dir), f"Model directory {ev_dir} does not exist"
-    ev_model = CouplingsModel(ev_dir)
+    ev_model = evmutation_model.CouplingsModel(ev_dir)
     strat = "Random-Stratified Filter"
     print("Random-Stratified Filter will be used!")
 
-while len(generated_sequence) < sequence_num:
-
-    iteration = 0
-    seq = args.sequence
-    sequence_id = args.seq_id
-    start_time = time.time()
-    mutation_history = []
-
-    while iteration < evolution_cycles:
-        if args.verbose:
-            print(f"Sequence {len(generated_sequence) + 1} of {sequence_num}, Iteration {iteration + 1} of {evolution_cycles}")
-            print("=========================================")
-
-        mutation_count = 0
-        while mutation_count < args.mutations:
-            mutation_count += 1
-            print(f"Mutation {mutation_count} of {args.mutations}") if args.verbose else None
-            # First Mutation
-            if mutation_count == 1:
-                # 1. Generate and score suggested mutation
-                score_heatmap, suggested_mutation, scores, _, past_key_values = app.score_and_create_matrix_all_singles(seq, Tranception_model=model, 
-                                                                                            mutation_range_start=mutation_start, mutation_range_end=mutation_end, 
-                                                                                            scoring_mirror=args.use_scoring_mirror, 
-                                                                                            batch_size_inference=args.batch, 
-                                                                                            max_number_positions_per_heatmap=args.max_pos, 
-                                                                                            num_workers=args.num_workers, 
-                                                                                            AA_vocab=AA_vocab, 
-                                                                                            tokenizer=tokenizer,
-                                                                                            with_heatmap=args.with_heatmap,
-                                                                                            past_key_values=past_key_values,
-                                                                                            model_type=model_name,
-                                                                                            exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None
-                                                                                            )
-
-                # 2. Define intermediate sampling threshold
-                final_sampler = temperature_sampler(args.temperature)
-                intermediate_sampling_threshold = args.intermediate_threshold
-                assert intermediate_sampling_threshold > 0, "Intermediate sampling threshold must be greater than 0!"
-            
-            # Subsequent Mutations
-            if mutation_count > 1 and mutation_count < args.mutations:
-                # 1. Generate extra mutations
-                last_mutation_round_DMS = scores
-                print(f"Generating 1 extra mutations after {len(last_mutation_round_DMS['mutant'][0].split(':'))} rounds to make {mutation_count} rounds in total") if args.verbose else None
-                assert len(last_mutation_round_DMS['mutant'][0].split(':')) == mutation_count-1, "Mutation step not consistent with previous mutation round"
-                
-                # 2. Sample from extra mutations
-                if args.use_qff:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None)
-                    if args.proteinbert:
-                        extra_mutants = app.predict_proteinBERT(model=proteinbert_model, DMS=all_extra_mutants,input_encoder=input_encoder, top_n=intermediate_sampling_threshold, batch_size=128)
-                    if args.evmutation:
-                        extra_mutants = app.predict_evmutation(DMS=all_extra_mutants, top_n=intermediate_sampling_threshold, ev_model=ev_model)
-                
-                if args.use_hpf:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None)
-                    trimmed = app.trim_DMS(DMS_data=all_extra_mutants, sampled_mutants=mutation, mutation_rounds=mutation_count)
-                    # _, scored_trimmed, trimmed, past_key_values = app.score_multi_mutations(seq,extra_mutants=all_extra_mutants,mutation_range_start=mutation_start, mutation_range_end=mutation_end, 
-                    #                                         scoring_mirror=args.use_scoring_mirror, batch_size_inference=args.batch, 
-                    #                                         max_number_positions_per_heatmap=args.max_pos, num_workers=args.num_workers, 
-                    #                                         AA_vocab=AA_vocab, tokenizer=tokenizer, Tranception_model=model, past_key_values=past_key_values)
-                    # extra_mutants = top_k_sampling(scored_trimmed, k=intermediate_sampling_threshold, sampler=final_sampler, multi=True)[['mutant', 'mutated_sequence']]
-                    extra_mutants = trimmed.sample(n=intermediate_sampling_threshold)
-
-                if args.use_rsf:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None)
-                    ev_scored = app.predict_evmutation(DMS=all_extra_mutants, top_n=len(all_extra_mutants), ev_model=ev_model, return_evscore=True)
-                    extra_mutants = app.stratified_filtering(ev_scored, threshold=intermediate_sampling_threshold, column_name='EVmutation')
-
-
-                if args.use_ams:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    att_mutations = app.get_attention_mutants(DMS=mutation, AMSmodel=model, focus='highest', top_n=5, tokenizer=tokenizer, model_type=model_name) #top_n is the number of attention positions to focus on
-                    extra_mutants = app.predict_evmutation(DMS=att_mutations, top_n=intermediate_sampling_threshold, ev_model=ev_model)
-                
-                print(f"Using {len(extra_mutants)} variants for scoring") if args.verbose else None
-
-                # 3. Get scores of sampled mutation
-                suggested_mutation, scores, _, past_key_values = app.score_multi_mutations(seq,
-                                                                        extra_mutants=extra_mutants,
-                                                                        mutation_range_start=mutation_start, 
-                                                                        mutation_range_end=mutation_end, 
-                                                                        scoring_mirror=args.use_scoring_mirror, 
-                                                                        batch_size_inference=args.batch, 
-                                                                        max_number_positions_per_heatmap=args.max_pos, 
-                                                                        num_workers=args.num_workers, 
-                                                                        AA_vocab=AA_vocab, 
-                                                                        tokenizer=tokenizer,
-                                                                        Tranception_model=model,
-                                                                        past_key_values=past_key_values,
-                                                                        model_type=model_name,)
-
-                # 4. Define intermediate sampling threshold
-                final_sampler = temperature_sampler(args.temperature)
-                intermediate_sampling_threshold = args.intermediate_threshold
-                assert intermediate_sampling_threshold > 0, "Intermediate sampling threshold must be greater than 0!"
-
-            # Last Mutation
-            if mutation_count == args.mutations:
-                # 1. Generate extra mutations
-                last_mutation_round_DMS = scores
-                print(f"Generating 1 extra mutations after {len(last_mutation_round_DMS['mutant'][0].split(':'))} rounds to make {mutation_count} rounds in total") if args.verbose else None
-                assert len(last_mutation_round_DMS['mutant'][0].split(':')) == mutation_count-1, "Mutation step not consistent with previous mutation round"
-                # 2. Sample from extra mutations
-                if args.use_qff:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None)
-                    if args.proteinbert:
-                        extra_mutants = app.predict_proteinBERT(model=proteinbert_model, DMS=all_extra_mutants,input_encoder=input_encoder, top_n=intermediate_sampling_threshold, batch_size=128)
-                    if args.evmutation:
-                        extra_mutants = app.predict_evmutation(DMS=all_extra_mutants, top_n=intermediate_sampling_threshold, ev_model=ev_model)
-                
-                if args.use_hpf:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None)
-                    trimmed = app.trim_DMS(DMS_data=all_extra_mutants, sampled_mutants=mutation, mutation_rounds=mutation_count)
-                    # _, scored_trimmed, trimmed, past_key_values = app.score_multi_mutations(seq,extra_mutants=all_extra_mutants,mutation_range_start=mutation_start, mutation_range_end=mutation_end, 
-                    #                                         scoring_mirror=args.use_scoring_mirror, batch_size_inference=args.batch, 
-                    #                                         max_number_positions_per_heatmap=args.max_pos, num_workers=args.num_workers, 
-                    #                                         AA_vocab=AA_vocab, tokenizer=tokenizer, Tranception_model=model, past_key_values=past_key_values)
-                    # extra_mutants = top_k_sampling(scored_trimmed, k=intermediate_sampling_threshold, sampler=final_sampler, multi=True)[['mutant', 'mutated_sequence']]
-                    extra_mutants = trimmed.sample(n=intermediate_sampling_threshold)
-
-                if args.use_rsf:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=args.conserved_positions if hasattr(args, 'conserved_positions') else None)
-                    ev_scored = app.predict_evmutation(DMS=all_extra_mutants, top_n=len(all_extra_mutants), ev_model=ev_model, return_evscore=True)
-                    extra_mutants = app.stratified_filtering(ev_scored, threshold=intermediate_sampling_threshold, column_name='EVmutation')
-
-                if args.use_ams:
-                    mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=final_sampler, multi=True)
-                    att_mutations = app.get_attention_mutants(DMS=mutation, AMSmodel=model, focus='highest', top_n=5, tokenizer=tokenizer, model_type=model_name) #top_n is the number of attention positions to focus on
-                    extra_mutants = app.predict_evmutation(DMS=att_mutations, top_n=intermediate_sampling_threshold, ev_model=ev_model)
-                
-                print(f"Using {len(extra_mutants)} variants for scoring") if args.verbose else None
-
-                # 3. Get scores of sampled mutation
-                suggested_mutation, scores, _, past_key_values = app.score_multi_mutations(seq,
-                                                                        extra_mutants=extra_mutants,
-                                                                        mutation_range_start=mutation_start, 
-                                                                        mutation_range_end=mutation_end, 
-                                                                        scoring_mirror=args.use_scoring_mirror, 
-                                                                        batch_size_inference=args.batch, 
-                                                                        max_number_positions_per_heatmap=args.max_pos, 
-                                                                        num_workers=args.num_workers, 
-                                                                        AA_vocab=AA_vocab, 
-                                                                        tokenizer=tokenizer,
-                                                                        Tranception_model=model,
-                                                                        past_key_values=past_key_values,
-                                                                        model_type=model_name,)
-
-                # 4. Final Sampling mutation from suggested mutation scores
-                final_sampler = temperature_sampler(args.temperature)
-                sampling_strat = args.sampling_method
-                sampling_threshold = args.sampling_threshold
-
-                if sampling_strat == 'top_k':
-                    mutation = top_k_sampling(scores, k=int(sampling_threshold), sampler=final_sampler)
-                elif sampling_strat == 'top_p':
-                    assert float(sampling_threshold) <= 1.0 and float(sampling_threshold) > 0, "Top-p sampling threshold must be between 0 and 1"
-                    mutation = top_p_sampling(scores, p=float(sampling_threshold), sampler=final_sampler)
-                elif sampling_strat == 'typical':
-                    assert float(sampling_threshold) < 1.0 and float(sampling_threshold) > 0, "Typical sampling threshold must be between 0 and 1"
-                    mutation = typical_sampling(scores, mass=float(sampling_threshold), sampler=final_sampler)
-                elif sampling_strat == 'mirostat':
-                    mutation = mirostat_sampling(scores, tau=float(sampling_threshold), sampler=final_sampler)
-                elif sampling_strat == 'random':
-                    mutation = random_sampling(scores, sampler=final_sampler)
-                elif sampling_strat == 'greedy':
-                    mutation = top_k_sampling(scores, k=1, sampler=final_sampler)
-                else:
-                    raise ValueError(f"Sampling strategy {sampling_strat} not supported")
-                print(f"Using {sampling_strat} as final sampling strategy with threshold {sampling_threshold}") if args.verbose else None
-
-        # Get Mutated Sequence
-        mutated_sequence = app.get_mutated_protein(seq, mutation)
-        mutation_history += [mutation]
-        if args.verbose:
-            print("Original Sequence: ", seq)
-            print("Mutation: ", mutation)
-            print("Mutated Sequence: ", mutated_sequence)
-            print("=========================================")
+sampling_strat = args.sampling_method
+sampling_threshold = args.sampling_threshold
+intermediate_sampling_threshold = args.intermediate_threshold
+assert intermediate_sampling_threshold > 0, "Intermediate sampling threshold must be greater than 0!"
+final_sampler = temperature_sampler(args.temperature)
+exclude_positions = args.conserved_positions if hasattr(args, 'conserved_positions') else None
+# The model is only ever run by one thread at a time (AMS proposals also run it)
+model_lock = threading.Lock()
+journal.restore_rng_state()
+# A sequential run samples from the global RNGs, whose state the journal records. Pipelined trajectories run their
+# stages on different threads in an order that depends on timing, so each one samples from its own generators instead,
+# seeded from the run's RNG state (read without advancing it, so a resumed run derives the same seed) and its number
+trajectory_seed = None
+if args.pipeline_depth > 1:
+    numpy_state = np.random.get_state()
+    trajectory_seed = int(np.random.randint(2**31))
+    np.random.set_state(numpy_state)
+
+class Trajectory:
+    """State of one generated sequence as it moves through the propose / score / sample stages."""
+    def __init__(self, number, partial=None):
+        self.number = number
+        self.iteration = 0
+        self.seq = args.sequence
+        self.mutation_history = []
+        self.start_time = time.time()
+        if partial is not None:
+            self.iteration, self.seq, self.mutation_history, elapsed = partial
+            self.start_time -= elapsed
+        self.mutation_count = 1
+        self.scores = None
+        self.extra_mutants = None
+        self.past_key_values = None
+        self.mutation = None
+        self.random_state = None
+        self.sampler = final_sampler
+        if trajectory_seed is not None:
+            self.random_state = np.random.default_rng([trajectory_seed, number])
+            generator = torch.Generator(device=sampling.device).manual_seed(int(self.random_state.integers(2**63)))
+            self.sampler = temperature_sampler(args.temperature, generator=generator)
+
+def propose_stage(trajectory):
+    # Sample from the previous round's scores and filter the extra mutations down to the variants to score
+    last_mutation_round_DMS = trajectory.scores
+    mutation_count = trajectory.mutation_count
+    print(f"Generating 1 extra mutations after {len(last_mutation_round_DMS['mutant'][0].split(':'))} rounds to make {mutation_count} rounds in total") if args.verbose else None
+    assert len(last_mutation_round_DMS['mutant'][0].split(':')) == mutation_count-1, "Mutation step not consistent with previous mutation round"
+    if args.use_qff:
+        mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=trajectory.sampler, multi=True)
+        all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=exclude_positions)
+        if args.proteinbert:
+            extra_mutants = app.predict_proteinBERT(model=proteinbert_model, DMS=all_extra_mutants,input_encoder=input_encoder, top_n=intermediate_sampling_threshold, batch_size=128)
+        if args.evmutation:
+            extra_mutants = app.predict_evmutation(DMS=all_extra_mutants, top_n=intermediate_sampling_threshold, ev_model=ev_model)
 
-        seq = mutated_sequence
+    if args.use_hpf:
+        mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=trajectory.sampler, multi=True)
+        all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=exclude_positions)
+        trimmed = app.trim_DMS(DMS_data=all_extra_mutants, sampled_mutants=mutation, mutation_rounds=mutation_count)
+        extra_mutants = trimmed.sample(n=intermediate_sampling_threshold, random_state=trajectory.random_state)
 
-        iteration += 1
+    if args.use_rsf:
+        mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=trajectory.sampler, multi=True)
+        all_extra_mutants = app.apply_gen_1extra(DMS=mutation, exclude_positions=exclude_positions)
+        ev_scored = app.predict_evmutation(DMS=all_extra_mutants, top_n=len(all_extra_mutants), ev_model=ev_model, return_evscore=True)
+        extra_mutants = app.stratified_filtering(ev_scored, threshold=intermediate_sampling_threshold, column_name='EVmutation', random_state=trajectory.random_state)
 
-    generated_sequence.append(mutated_sequence)
-    sequence_iteration.append(iteration)
-    samplings.append(sampling_strat)
-    samplingthreshold.append(sampling_threshold)
+    if args.use_ams:
+        mutation = top_k_sampling(last_mutation_round_DMS, k=int(100), sampler=trajectory.sampler, multi=True)
+        with model_lock:
+            att_mutations = app.get_attention_mutants(DMS=mutation, AMSmodel=model, focus='highest', top_n=5, tokenizer=tokenizer, model_type=model_name) #top_n is the number of attention positions to focus on
+        extra_mutants = app.predict_evmutation(DMS=att_mutations, top_n=intermediate_sampling_threshold, ev_model=ev_model)
+
+    print(f"Using {len(extra_mutants)} variants for scoring") if args.verbose else None
+    trajectory.extra_mutants = extra_mutants
+    return 'score'
+
+def score_stage(trajectory):
+    if trajectory.iteration >= evolution_cycles:
+        return None
+    if trajectory.mutation_count == 1 and args.verbose:
+        print(f"Sequence {trajectory.number} of {sequence_num}, Iteration {trajectory.iteration + 1} of {evolution_cycles}")
+        print("=========================================")
+    print(f"Mutation {trajectory.mutation_count} of {args.mutations}") if args.verbose else None
+    with model_lock:
+        if trajectory.mutation_count == 1:
+            # Generate and score all single mutations
+            score_heatmap, suggested_mutation, trajectory.scores, _, trajectory.past_key_values = app.score_and_create_matrix_all_singles(trajectory.seq, Tranception_model=model,
+                                                                                        mutation_range_start=mutation_start, mutation_range_end=mutation_end,
+                                                                                        scoring_mirror=args.use_scoring_mirror,
+                                                                                        batch_size_inference=args.batch,
+                                                                                        max_number_positions_per_heatmap=args.max_pos,
+                                                                                        num_workers=args.num_workers,
+                                                                                        AA_vocab=AA_vocab,
+                                                                                        tokenizer=tokenizer,
+                                                                                        with_heatmap=args.with_heatmap,
+                                                                                        heatmap_mode=args.heatmap_mode,
+                                                                                        past_key_values=trajectory.past_key_values,
+                                                                                        model_type=model_name,
+                                                                                        exclude_positions=exclude_positions
+                                                                                        )
+        else:
+            # Get scores of the sampled extra mutations
+            suggested_mutation, trajectory.scores, _, trajectory.past_key_values = app.score_multi_mutations(trajectory.seq,
+                                                                    extra_mutants=trajectory.extra_mutants,
+                                                                    mutation_range_start=mutation_start,
+                                                                    mutation_range_end=mutation_end,
+                                                                    scoring_mirror=args.use_scoring_mirror,
+                                                                    batch_size_inference=args.batch,
+                                                                    max_number_positions_per_heatmap=args.max_pos,
+                                                                    num_workers=args.num_workers,
+                                                                    AA_vocab=AA_vocab,
+                                                                    tokenizer=tokenizer,
+                                                                    Tranception_model=model,
+                                                                    past_key_values=trajectory.past_key_values,
+                                                                    model_type=model_name,)
+    if trajectory.mutation_count < args.mutations:
+        trajectory.mutation_count += 1
+        return 'propose'
+    return 'sample'
+
+def sample_stage(trajectory):
+    # Final sampling of the mutation from the last round's scores
+    scores = trajectory.scores
+    final_sampler = trajectory.sampler
+    if sampling_strat == 'top_k':
+        mutation = top_k_sampling(scores, k=int(sampling_threshold), sampler=final_sampler)
+    elif sampling_strat == 'top_p':
+        assert float(sampling_threshold) <= 1.0 and float(sampling_threshold) > 0, "Top-p sampling threshold must be between 0 and 1"
+        mutation = top_p_sampling(scores, p=float(sampling_threshold), sampler=final_sampler)
+    elif sampling_strat == 'typical':
+        assert float(sampling_threshold) < 1.0 and float(sampling_threshold) > 0, "Typical sampling threshold must be between 0 and 1"
+        mutation = typical_sampling(scores, mass=float(sampling_threshold), sampler=final_sampler)
+    elif sampling_strat == 'mirostat':
+        mutation = mirostat_sampling(scores, tau=float(sampling_threshold), sampler=final_sampler)
+    elif sampling_strat == 'random':
+        mutation = random_sampling(scores, sampler=final_sampler)
+    elif sampling_strat == 'greedy':
+        mutation = top_k_sampling(scores, k=1, sampler=final_sampler)
+    else:
+        raise ValueError(f"Sampling strategy {sampling_strat} not supported")
+    print(f"Using {sampling_strat} as final sampling strategy with threshold {sampling_threshold}") if args.verbose else None
+
+    # Get Mutated Sequence
+    mutated_sequence = app.get_mutated_protein(trajectory.seq, mutation)
+    trajectory.mutation_history += [mutation]
+    if args.verbose:
+        print("Original Sequence: ", trajectory.seq)
+        print("Mutation: ", mutation)
+        print("Mutated Sequence: ", mutated_sequence)
+        print("=========================================")
+
+    trajectory.seq = mutated_sequence
+    trajectory.iteration += 1
+    trajectory.mutation_count = 1
+    # Interleaved trajectories cannot be replayed from a single partial record, so only a
+    # sequential run journals its mutations; a pipelined run resumes from its finished sequences
+    if args.pipeline_depth == 1:
+        journal.record_mutation(trajectory.iteration, trajectory.seq, trajectory.mutation_history, start_time=trajectory.start_time)
+    if trajectory.iteration < evolution_cycles:
+        return 'score'
+    return None
+
+def trajectories():
+    partial = journal.pop_partial()
+    # pipelined trajectories can finish out of order: the journal records which numbers are done
+    finished = set(journal.numbers)
+    numbers = [number for number in range(1, sequence_num + 1) if number not in finished][:sequence_num - len(generated_sequence)]
+    for number in numbers:
+        yield Trajectory(number, partial)
+        partial = None
+
+# Proposal / filtering of one trajectory overlaps with model scoring of another when pipeline_depth > 1
+pipeline = StagedPipeline([('score', score_stage), ('propose', propose_stage), ('sample', sample_stage)], max_in_flight=args.pipeline_depth)
+for trajectory in pipeline.run(trajectories(), first_stage='score'):
+    iteration = trajectory.iteration
+    mutation_count = args.mutations
+    mutation_history = trajectory.mutation_history
+    mutated_sequence = trajectory.seq
+    # The last enabled filter names the subsampling
     if args.use_qff:
-        subsamplings.append(f'QFF {strat}')
+        subsampling = f'QFF {strat}'
     if args.use_hpf:
-        subsamplings.append('HPF')
+        subsampling = 'HPF'
     if args.use_ams:
-        subsamplings.append('AMS')
+        subsampling = 'AMS'
     if args.use_rsf:
-        subsamplings.append('RSF')
-    subsamplingthreshold.append(intermediate_sampling_threshold)
-    mutants.append(mutation_count)
-    seq_name = f'{model_name}_{sequence_id}_{iteration}x_{len(generated_sequence)}'
-    generated_sequence_name.append(seq_name)
-    mutation_list.append(';'.join(mutation_history))
-    generation_time = time.time() - start_time
-    generation_duration.append(generation_time)
+        subsampling = 'RSF'
+    seq_name = f'{model_name}_{args.seq_id}_{iteration}x_{trajectory.number}'
+    generation_time = time.time() - trajectory.start_time
+    journal.record_sequence({'name': seq_name, 'sequence': mutated_sequence, 'sampling': sampling_strat, 'threshold': sampling_threshold, 'subsampling': subsampling, 'subthreshold': intermediate_sampling_threshold, 'iterations': iteration, 'mutants': mutation_count, 'mutations': ';'.join(mutation_history), 'time': generation_time}, number=trajectory.number)
     print(f"Sequence {len(generated_sequence)}/{sequence_num}: {generation_time} seconds using {strat} on {mutation_count} multi-mutants and {iteration} evolution cycles")
     print("=========================================") if args.verbose else None
-    
-print(f'===========Mutated {len(generated_sequence)} sequences in {sum(generation_duration)} seconds============')
-generated_sequence_df = pd.DataFrame({'name': generated_sequence_name,'sequence': generated_sequence, 'sampling': samplings, 'threshold': samplingthreshold, 'subsampling':subsamplings, 'subthreshold': subsamplingthreshold, 'iterations': sequence_iteration, 'mutants': mutants, 'mutations': mutation_list, 'time': generation_duration})
+if args.verbose or args.pipeline_depth > 1:
+    pipeline.summary()
+generation_duration = sum(row['time'] for row in generated_sequence)
+print(f'===========Mutated {len(generated_sequence)} sequences in {generation_duration} seconds============')
+# Compact the journal into the metadata CSV / FASTA layout
+generated_sequence_df = journal.to_dataframe()
 
 if args.save_df:
     save_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "generated_metadata/{}.csv".format(args.output_name))
@@ -379,4 +390,7 @@ if args.save_df:
 save_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "generated_sequence/{}.fasta".format(args.output_name))
 os.makedirs(os.path.dirname(os.path.realpath(save_path))) if not os.path.exists(os.path.dirname(os.path.realpath(save_path))) else None
 util.save_as_fasta(generated_sequence_df, save_path)
+journal.close(remove=True)
+if args.trace:
+    tracing.finish(args.trace)
 print(f"Generated sequences saved to {save_path}")
\ No newline at end of file
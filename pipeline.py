@@ -0,0 +1,119 @@
+import time
+import queue
+import threading
+import tracing
+
+_STOP = object()
+
+class StageStats:
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.wait = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, busy, wait):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.wait += wait
+
+class StagedPipeline:
+    """
+    Runs items through named stages, each served by its own worker threads and fed by a bounded queue.
+    A stage function takes an item, updates it in place and returns the name of the next stage, or None
+    when the item is finished. Items may revisit stages, so a generation trajectory can loop
+    propose -> score -> propose ... while other trajectories occupy the remaining stages.
+    At most max_in_flight items are admitted at a time; every queue has room for all of them, so a put
+    never blocks and the cyclic routing cannot deadlock.
+    With max_in_flight=1 only one stage runs at any time and items go through stages in the same order as
+    a plain sequential loop.
+    """
+    def __init__(self, stages, max_in_flight=2, workers=None):
+        self.stages = dict(stages)
+        self.max_in_flight = max(1, max_in_flight)
+        workers = workers or {}
+        self.workers = {name: max(1, workers.get(name, 1)) for name in self.stages}
+        self.stats = {name: StageStats(name, self.workers[name]) for name in self.stages}
+        self.wall_time = 0.0
+        self.finished = 0
+
+    def _worker(self, name, inbox):
+        function, stats = self.stages[name], self.stats[name]
+        while True:
+            wait_start = time.perf_counter()
+            item = inbox.get()
+            busy_start = time.perf_counter()
+            if item is _STOP:
+                return
+            if self.aborted.is_set():
+                continue
+            try:
+                with tracing.span(f'stage.{name}', 'pipeline'):
+                    next_stage = function(item)
+            except BaseException as error:
+                self.done.put((item, error))
+                continue
+            stats.add(time.perf_counter() - busy_start, busy_start - wait_start)
+            if next_stage is None:
+                self.done.put((item, None))
+            else:
+                self.queues[next_stage].put(item)
+
+    def run(self, items, first_stage=None):
+        """Yields the finished items in completion order; items is consumed lazily as capacity frees up."""
+        first_stage = first_stage or next(iter(self.stages))
+        self.queues = {name: queue.Queue(maxsize=self.max_in_flight + self.workers[name]) for name in self.stages}
+        self.done = queue.Queue()
+        self.aborted = threading.Event()
+        threads = [threading.Thread(target=self._worker, args=(name, self.queues[name]), name=f"pipeline-{name}-{i}", daemon=True)
+                   for name in self.stages for i in range(self.workers[name])]
+        for thread in threads:
+            thread.start()
+        items = iter(items)
+        in_flight, exhausted = 0, False
+        start = time.perf_counter()
+        try:
+            while True:
+                while not exhausted and in_flight < self.max_in_flight:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self.queues[first_stage].put(item)
+                    in_flight += 1
+                if in_flight == 0:
+                    break
+                item, error = self.done.get()
+                in_flight -= 1
+                if error is not None:
+                    raise error
+                self.finished += 1
+                yield item
+        finally:
+            self.aborted.set()
+            self.wall_time += time.perf_counter() - start
+            for name in self.stages:
+                for _ in range(self.workers[name]):
+                    self.queues[name].put(_STOP)
+            for thread in threads:
+                thread.join(timeout=0 if in_flight else None)
+
+    def occupancy(self):
+        """Fraction of the wall time each stage's workers spent working."""
+        if self.wall_time == 0:
+            return {name: 0.0 for name in self.stages}
+        return {name: stats.busy / (self.wall_time * stats.workers) for name, stats in self.stats.items()}
+
+    def summary(self):
+        occupancy = self.occupancy()
+        total_busy = sum(stats.busy for stats in self.stats.values())
+        print(f"Pipeline: {self.finished} items in {self.wall_time:.2f}s wall, {total_busy:.2f}s summed stage time (max {self.max_in_flight} in flight)")
+        for name, stats in self.stats.items():
+            print(f"  {name:<10} workers={stats.workers} calls={stats.items:<6} busy={stats.busy:.2f}s wait={stats.wait:.2f}s occupancy={100 * occupancy[name]:.1f}%")
+        if self.stats:
+            bottleneck = max(self.stats.values(), key=lambda stats: stats.busy / stats.workers)
+            print(f"  bottleneck: {bottleneck.name}")
@@ -0,0 +1,373 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import subprocess
+import pandas as pd
+
+# Trains one plmc model per alignment of a manifest, running several plmc processes side by side. Every job gets a
+# memory and time estimate from its alignment size (N sequences, L focus sites, q states); jobs are started largest
+# first, each with a share of the free cores, as long as their estimated memory fits in what is left of the RAM budget.
+# Each job writes <name>.model_params, <name>.txt (coupling scores), <name>.log (plmc output) and <name>.metadata.json;
+# the metadata is written last and records a hash of the alignment and plmc options, so finished jobs are skipped.
+PLMC_BINARY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'EVmutation', 'plmc', 'bin', 'plmc')
+PLMC_ALPHABET = '-ACDEFGHIKLMNPQRSTVWY'
+METADATA_VERSION = 1
+# Peak RSS of plmc is about 19x the parameter vector (x, gradient, L-BFGS history, full coupling blocks and pair
+# frequencies) in both precisions; BASE_MEMORY covers the binary and alignment buffers
+MEMORY_PER_PARAMETER = 19
+BASE_MEMORY = 32 * 2**20
+# Seconds per L-BFGS iteration per N * L^2 * q on one core (measured on synthetic alignments, plmc -g)
+TIME_PER_UNIT = {'float32': 2.6e-9, 'float64': 4e-9}
+# plmc parallelises over sites; fewer than this many sites per thread does not pay off
+MIN_SITES_PER_THREAD = 8
+PRECISION_BYTES = {'float64': 8, 'float32': 4}
+MANIFEST_OPTIONS = ['focus', 'lambda_e', 'lambda_h', 'theta', 'max_iter']
+ITERATION_LINE = re.compile(r'^(\d+)\t([\d.]+)\t[^\t]+\t[^\t]+\t([^\t]+)\t')
+
+def available_memory():
+    """MemAvailable in bytes, or None where /proc/meminfo does not exist."""
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def read_alignment_stats(msa_path, focus=None):
+    """
+    (number of sequences, number of sites plmc keeps, focus id) of a FASTA / a2m alignment. With a focus sequence, plmc
+    keeps its uppercase, non-gap columns; the focus defaults to the first sequence, named up to the '/' of its region.
+    """
+    num_sequences, sequences, focus_index, current = 0, {}, None, None
+    with open(msa_path) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:].split()[0] if len(line) > 1 else ''
+                if num_sequences == 0 and focus is None:
+                    focus = name.split('/')[0]
+                # plmc focuses on the first sequence whose name starts with the focus id
+                is_focus = focus_index is None and name.startswith(focus)
+                if is_focus:
+                    focus_index = num_sequences
+                current = sequences.setdefault(num_sequences, []) if num_sequences == 0 or is_focus else None
+                num_sequences += 1
+            elif current is not None:
+                current.append(line)
+    if num_sequences == 0:
+        raise ValueError(f"No sequences found in {msa_path}")
+    if focus_index is None:
+        # plmc proceeds without a focus sequence and keeps every column
+        return num_sequences, len(''.join(sequences[0])), None
+    return num_sequences, sum(1 for character in ''.join(sequences[focus_index]) if character in PLMC_ALPHABET[1:]), focus
+
+def exit_code(wait_status):
+    """Return code of a wait status as subprocess reports it: the exit code, or minus the signal that killed the process."""
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status) if os.WIFEXITED(wait_status) else wait_status
+
+def file_sha1(path, chunk_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class PlmcJob:
+    """One plmc run: its options, alignment statistics, resource estimates and, once run, its outcome."""
+    def __init__(self, msa, name, output_dir, focus=None, lambda_e=None, lambda_h=0.01, theta=0.2, max_iter=200, gap_ignore=True, precision='float32'):
+        self.msa = msa
+        self.name = name
+        self.output_dir = output_dir
+        self.num_sequences, self.num_sites, self.focus = read_alignment_stats(msa, focus)
+        # README default: lambda_e = 0.2 * (L - 1)
+        self.lambda_e = 0.2 * (self.num_sites - 1) if lambda_e is None else lambda_e
+        self.lambda_h = lambda_h
+        self.theta = theta
+        self.max_iter = max_iter
+        self.gap_ignore = gap_ignore
+        self.num_states = len(PLMC_ALPHABET) - (1 if gap_ignore else 0)
+        L, q = self.num_sites, self.num_states
+        self.num_parameters = L * q + L * (L - 1) // 2 * q * q
+        self.memory = MEMORY_PER_PARAMETER * PRECISION_BYTES[precision] * self.num_parameters + self.num_sequences * L + BASE_MEMORY
+        self.work = TIME_PER_UNIT[precision] * self.num_sequences * L ** 2 * q * max_iter
+        self.max_threads = max(1, L // MIN_SITES_PER_THREAD)
+        self.hash = None
+        self.threads = None
+        self.iteration = 0
+        self.status = 'pending'
+
+    def path(self, suffix):
+        return os.path.join(self.output_dir, self.name + suffix)
+
+    def options(self):
+        """plmc options that determine the model (the thread count and output paths do not)."""
+        options = ['-le', str(self.lambda_e), '-lh', str(self.lambda_h), '-m', str(self.max_iter), '-t', str(self.theta)]
+        if self.focus is not None:
+            options += ['-f', self.focus]
+        if self.gap_ignore:
+            options.append('-g')
+        return options
+
+    def compute_hash(self):
+        sha1 = hashlib.sha1(file_sha1(self.msa).encode())
+        sha1.update(json.dumps(self.options()).encode())
+        self.hash = sha1.hexdigest()
+        return self.hash
+
+    def is_complete(self):
+        """Whether the outputs exist and were trained from the same alignment content and options."""
+        try:
+            with open(self.path('.metadata.json')) as fh:
+                metadata = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        return (metadata.get('hash') == (self.hash or self.compute_hash()) and metadata.get('status') == 'complete'
+                and os.path.isfile(self.path('.model_params')) and os.path.getsize(self.path('.model_params')) == metadata.get('model_params_bytes'))
+
+    def estimated_time(self, threads=1):
+        return self.work / threads
+
+    def command(self, plmc_binary, threads):
+        return [plmc_binary, '-o', self.path('.model_params.tmp'), '-c', self.path('.txt.tmp'), '-n', str(threads)] + self.options() + [self.msa]
+
+def load_manifest(manifest_path, output_dir, **defaults):
+    """
+    Jobs of a CSV manifest with an 'msa' column and optional 'name' (defaults to the alignment file name without its
+    extension), 'focus', 'lambda_e', 'lambda_h', 'theta' and 'max_iter' columns; empty cells take the defaults.
+    """
+    manifest = pd.read_csv(manifest_path)
+    if 'msa' not in manifest.columns:
+        raise ValueError(f"Manifest {manifest_path} has no 'msa' column")
+    manifest_dir = os.path.dirname(os.path.realpath(manifest_path))
+    jobs = []
+    for _, row in manifest.iterrows():
+        msa = row['msa'] if os.path.isabs(row['msa']) else os.path.join(manifest_dir, row['msa'])
+        name = row['name'] if 'name' in manifest.columns and not pd.isna(row['name']) else os.path.splitext(os.path.basename(msa))[0]
+        options = dict(defaults)
+        options.update({option: row[option] for option in MANIFEST_OPTIONS if option in manifest.columns and not pd.isna(row[option])})
+        if 'max_iter' in options:
+            options['max_iter'] = int(options['max_iter'])
+        jobs.append(PlmcJob(msa, str(name), output_dir, **options))
+    names = [job.name for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Manifest {manifest_path} has duplicate job names: {', '.join(duplicates)}")
+    return jobs
+
+def format_bytes(num_bytes):
+    return f"{num_bytes / 2**30:.2f} GB" if num_bytes >= 2**30 else f"{num_bytes / 2**20:.0f} MB"
+
+class PlmcScheduler:
+    """
+    Runs jobs on num_cores cores within memory_budget bytes. Pending jobs are ordered by estimated work; whenever cores
+    are free, the largest jobs whose memory estimates fit in the remaining budget start together and split the free
+    cores by estimated work, so a large family gets many threads while small families run side by side.
+    """
+    def __init__(self, jobs, num_cores=None, memory_budget=None, plmc_binary=PLMC_BINARY, progress_every=25, poll_interval=0.2):
+        self.jobs = jobs
+        self.num_cores = num_cores or os.cpu_count() or 1
+        self.memory_budget = memory_budget if memory_budget is not None else int(0.8 * (available_memory() or 8 * 2**30))
+        self.plmc_binary = plmc_binary
+        self.progress_every = progress_every
+        self.poll_interval = poll_interval
+        self.print_lock = threading.Lock()
+
+    def log(self, message):
+        with self.print_lock:
+            print(message, flush=True)
+
+    def plan(self):
+        """Marks finished and oversized jobs; returns the jobs to run, largest first."""
+        pending = []
+        for job in self.jobs:
+            job.compute_hash()
+            if job.is_complete():
+                job.status = 'cached'
+            elif job.memory > self.memory_budget:
+                job.status = 'too_large'
+            else:
+                pending.append(job)
+        return sorted(pending, key=lambda job: -job.work)
+
+    def print_plan(self):
+        self.log(f"{'job':<24} {'N':>8} {'L':>6} {'q':>3} {'memory':>10} {'time (1 core)':>14}  status")
+        for job in self.jobs:
+            self.log(f"{job.name:<24} {job.num_sequences:>8} {job.num_sites:>6} {job.num_states:>3} {format_bytes(job.memory):>10} {job.estimated_time():>13.1f}s  {job.status}")
+        self.log(f"Budget: {self.num_cores} cores, {format_bytes(self.memory_budget)}")
+
+    def allocate_threads(self, batch, free_cores):
+        """
+        Threads of each job of batch (at most free_cores jobs): one each, and the other cores by largest remainder of
+        the jobs' shares of the estimated work. A job never gets more than max_threads; the cores it cannot use go to
+        the others, so a job never gets fewer threads than a job with less work unless its sites limit it.
+        """
+        threads = [1] * len(batch)
+        open_jobs = [i for i, job in enumerate(batch) if job.max_threads > 1]
+        extra = free_cores - len(batch)
+        while extra > 0 and open_jobs:
+            total_work = sum(batch[i].work for i in open_jobs)
+            shares = {i: extra * batch[i].work / total_work for i in open_jobs}
+            grants = {i: int(shares[i]) for i in open_jobs}
+            by_remainder = sorted(open_jobs, key=lambda i: (shares[i] - grants[i], batch[i].work), reverse=True)
+            for i in by_remainder[:extra - sum(grants.values())]:
+                grants[i] += 1
+            for i in open_jobs:
+                grants[i] = min(grants[i], batch[i].max_threads - threads[i])
+                threads[i] += grants[i]
+            extra -= sum(grants.values())
+            open_jobs = [i for i in open_jobs if threads[i] < batch[i].max_threads]
+        return threads
+
+    def follow(self, job, process, log_file):
+        """Copies plmc output to the job log and reports progress every progress_every iterations."""
+        for line in process.stdout:
+            log_file.write(line)
+            match = ITERATION_LINE.match(line)
+            if match:
+                job.iteration = int(match.group(1))
+                if self.progress_every and job.iteration % self.progress_every == 0:
+                    self.log(f"{job.name}: iteration {job.iteration}/{job.max_iter or '?'} ({float(match.group(2)):.1f}s, -loglk {match.group(3)})")
+            elif line.startswith('Effective number of samples:'):
+                job.effective_sequences = float(line.split(':')[1].split()[0])
+            elif line.startswith('Gradient optimization:'):
+                job.optimization = line.split(':', 1)[1].strip()
+
+    def sample_peak_rss(self, job):
+        # The rusage of wait4 also counts the pages of this interpreter touched between fork and exec, so the peak RSS
+        # of plmc is the high-water mark of /proc/<pid>/status, sampled while it runs
+        try:
+            with open(f'/proc/{job.process.pid}/status') as fh:
+                for line in fh:
+                    if line.startswith('VmHWM:'):
+                        job.peak_rss = max(job.peak_rss or 0, int(line.split()[1]) * 1024)
+                        job.peak_rss_source = 'proc'
+        except OSError:
+            pass
+
+    def start(self, job, threads):
+        job.threads = threads
+        job.effective_sequences = job.optimization = job.peak_rss = None
+        job.peak_rss_source = None
+        job.log_file = open(job.path('.log'), 'w')
+        job.process = subprocess.Popen(job.command(self.plmc_binary, threads), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        job.reader = threading.Thread(target=self.follow, args=(job, job.process, job.log_file), daemon=True)
+        job.reader.start()
+        job.start_time = time.perf_counter()
+        job.status = 'running'
+        self.log(f"{job.name}: started with {threads} threads (estimated {format_bytes(job.memory)}, {job.estimated_time(threads):.1f}s)")
+
+    def finish(self, job, exit_status, rusage):
+        job.elapsed = time.perf_counter() - job.start_time
+        job.process.returncode = exit_code(exit_status)
+        job.reader.join()
+        job.process.stdout.close()
+        job.log_file.close()
+        if job.peak_rss is None:
+            # Without /proc, the wait4 rusage is all there is: its max RSS counts the pages of this interpreter the child
+            # touched before exec, so it is only an upper bound on plmc's. ru_maxrss is in kilobytes on Linux, bytes on macOS
+            job.peak_rss = rusage.ru_maxrss if os.uname().sysname == 'Darwin' else rusage.ru_maxrss * 1024
+            job.peak_rss_source = 'rusage_upper_bound'
+        if job.process.returncode != 0 or not os.path.isfile(job.path('.model_params.tmp')):
+            job.status = 'failed'
+            self.log(f"{job.name}: plmc failed with exit code {job.process.returncode}, see {job.path('.log')}")
+            return
+        os.replace(job.path('.model_params.tmp'), job.path('.model_params'))
+        os.replace(job.path('.txt.tmp'), job.path('.txt'))
+        job.status = 'complete'
+        self.write_metadata(job)
+        self.log(f"{job.name}: done in {job.elapsed:.1f}s (estimated {job.estimated_time(job.threads):.1f}s), "
+                 f"peak RSS {'at most ' if job.peak_rss_source == 'rusage_upper_bound' else ''}{format_bytes(job.peak_rss)} (estimated {format_bytes(job.memory)})")
+
+    def write_metadata(self, job):
+        metadata = {'metadata_version': METADATA_VERSION, 'hash': job.hash, 'status': job.status, 'msa': os.path.realpath(job.msa),
+                    'msa_sha1': file_sha1(job.msa), 'plmc_options': job.options(), 'focus': job.focus, 'num_sequences': job.num_sequences,
+                    'effective_sequences': job.effective_sequences, 'num_sites': job.num_sites, 'num_states': job.num_states,
+                    'num_parameters': job.num_parameters, 'iterations': job.iteration, 'optimization': job.optimization, 'threads': job.threads,
+                    'elapsed': job.elapsed, 'estimated_time': job.estimated_time(job.threads), 'peak_rss': job.peak_rss, 'peak_rss_source': job.peak_rss_source,
+                    'estimated_memory': job.memory, 'model_params_bytes': os.path.getsize(job.path('.model_params')),
+                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(job.path('.metadata.json'), 'w') as fh:
+            json.dump(metadata, fh, indent=2)
+
+    def run(self):
+        if not os.path.isfile(self.plmc_binary):
+            raise FileNotFoundError(f"plmc binary {self.plmc_binary} not found, build it with: make -C EVmutation/plmc all-openmp32")
+        pending = self.plan()
+        self.print_plan()
+        for job in self.jobs:
+            os.makedirs(job.output_dir, exist_ok=True)
+            if job.status == 'too_large':
+                self.log(f"{job.name}: estimated {format_bytes(job.memory)} exceeds the memory budget, skipped")
+        running = []
+        try:
+            while pending or running:
+                free_cores = self.num_cores - sum(job.threads for job in running)
+                free_memory = self.memory_budget - sum(job.memory for job in running)
+                # The largest jobs that fit start together, one core each at least, sharing the free cores
+                batch = []
+                for job in pending:
+                    if len(batch) == free_cores:
+                        break
+                    if job.memory <= free_memory:
+                        batch.append(job)
+                        free_memory -= job.memory
+                for job, threads in zip(batch, self.allocate_threads(batch, free_cores)):
+                    pending.remove(job)
+                    self.start(job, threads)
+                    running.append(job)
+                time.sleep(self.poll_interval)
+                for job in list(running):
+                    self.sample_peak_rss(job)
+                    pid, exit_status, rusage = os.wait4(job.process.pid, os.WNOHANG)
+                    if pid != 0:
+                        running.remove(job)
+                        self.finish(job, exit_status, rusage)
+        finally:
+            for job in running:
+                job.process.kill()
+                job.process.wait()
+                job.log_file.close()
+                for suffix in ('.model_params.tmp', '.txt.tmp'):
+                    if os.path.exists(job.path(suffix)):
+                        os.remove(job.path(suffix))
+        return self.jobs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train plmc models (.model_params for EVmutation) for every alignment of a manifest in parallel')
+    parser.add_argument('--manifest', type=str, required=True, help="CSV with an 'msa' column and optional 'name', 'focus', 'lambda_e', 'lambda_h', 'theta' and 'max_iter' columns")
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory to write the model parameters, coupling scores, logs and metadata to')
+    parser.add_argument('--num_cores', type=int, default=None, help='Cores to use (default: all)')
+    parser.add_argument('--memory_budget', type=float, default=None, help='RAM budget in GB (default: 80%% of the available memory)')
+    parser.add_argument('--plmc', type=str, default=PLMC_BINARY, help='plmc binary')
+    parser.add_argument('--precision', type=str, choices=list(PRECISION_BYTES), default='float32', help='Precision plmc was built with: float32 (make all-openmp32) writes the parameter files CouplingsModel reads by default')
+    parser.add_argument('--lambda_e', type=float, default=None, help='Default coupling regularization (default: 0.2 * (L - 1))')
+    parser.add_argument('--lambda_h', type=float, default=0.01, help='Default field regularization')
+    parser.add_argument('--theta', type=float, default=0.2, help='Default sequence reweighting threshold')
+    parser.add_argument('--max_iter', type=int, default=200, help='Default maximum number of iterations')
+    parser.add_argument('--progress_every', type=int, default=25, help='Report progress every this many iterations (0 to disable)')
+    parser.add_argument('--dry_run', action='store_true', help='Only print the estimates and which jobs would run')
+    args = parser.parse_args()
+
+    jobs = load_manifest(args.manifest, args.output_dir, lambda_e=args.lambda_e, lambda_h=args.lambda_h, theta=args.theta, max_iter=args.max_iter, precision=args.precision)
+    memory_budget = int(args.memory_budget * 2**30) if args.memory_budget is not None else None
+    scheduler = PlmcScheduler(jobs, num_cores=args.num_cores, memory_budget=memory_budget, plmc_binary=args.plmc, progress_every=args.progress_every)
+    if args.dry_run:
+        scheduler.plan()
+        scheduler.print_plan()
+        sys.exit(0)
+    start = time.perf_counter()
+    scheduler.run()
+    statuses = [job.status for job in jobs]
+    print(f"{statuses.count('complete')} trained, {statuses.count('cached')} already complete, {statuses.count('failed')} failed, "
+          f"{statuses.count('too_large')} over the memory budget in {time.perf_counter() - start:.1f}s")
+    if 'failed' in statuses or 'too_large' in statuses:
+        sys.exit(1)
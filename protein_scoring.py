@@ -16,6 +16,7 @@ from scoring_metrics import fid_score as fid
 from scoring_metrics import esmfold
 from scoring_metrics import alphafold
 import time
+import tracing
 
 #Reset calculated metrics (creates a new datastructure to store results, clearing any existing results)
 results = dict()
@@ -55,8 +56,18 @@ parser.add_argument("--skip_FID", action="store_true", help="Whether to not calc
 parser.add_argument("--model_params", type=str, help="Model params to use for EVmutation")
 parser.add_argument("--orig_seq", required=False, type=str, help="Original sequence to use for Tranception or EVmutation")
 parser.add_argument('--output_name', type=str, required=True, help='Output file name (Just name with no extension!)')
+parser.add_argument('--trace', type=str, default=None, help='Record a span per metric and save them as a Chrome trace JSON to this path')
+parser.add_argument('--trace_cuda', action='store_true', help='Also record GPU time and peak CUDA memory per metric')
 parser.add_argument('--binder_sequence', type=str, required=False, help='Binder sequence to use for AlphaFold2 complex prediction (if not specified, will predict monomeric structure with ESMFold)')
 args = parser.parse_args()
+if args.trace:
+  tracing.enable(cuda=args.trace_cuda)
+  tracing.instrument(st_metrics, ['TM_score', 'ESM_IF', 'ProteinMPNN', 'MIF_ST', 'AlphaFold2_pLDDT'], 'metric')
+  tracing.instrument(ab_metrics, ['ESM_MSA', 'substitution_score', 'EVmutation'], 'metric')
+  tracing.instrument(ss_metrics, ['CARP_640m_logp', 'ESM_1v_unmask', 'Progen2', 'ESM_1v_mask6', 'Repeat', 'Tranception'], 'metric')
+  tracing.instrument(esmfold, ['predict_structure'], 'metric')
+  tracing.instrument(alphafold, ['predict_AFstructure'], 'metric')
+  tracing.instrument(fid, ['calculate_fid_given_paths'], 'metric')
 
 # Checks
 if args.use_tranception or args.use_evmutation:
@@ -264,6 +275,8 @@ os.makedirs(os.path.dirname(os.path.realpath(save_path))) if not os.path.exists(
 
 df.to_csv(save_path)
 
+if args.trace:
+  tracing.finish(args.trace)
 print("===========================================")
 print(f"SCORING COMPLETED SUCCESSFULLY | SAVED: {save_path} | TIME: {time.time() - start_time} seconds")
 print("===========================================")
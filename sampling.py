@@ -3,27 +3,35 @@ from torch.distributions import Categorical
 import pandas as pd
 import math
 import app
+from tracing import traced
 from decimal import Decimal
 
 AA_vocab = "ACDEFGHIKLMNPQRSTVWY"
+device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
 class temperature_sampler:
-  def __init__(self, temperature: float = 1.0):
+  def __init__(self, temperature: float = 1.0, generator: torch.Generator = None):
     self.temperature = temperature
+    self.generator = generator
   def __call__(self, logits: torch.Tensor):
+    if self.generator is not None:
+      # Categorical.sample always draws from the global generator
+      probs = torch.softmax(logits / self.temperature, dim=-1)
+      return torch.multinomial(probs, 1, generator=self.generator).squeeze(-1)
     dist = Categorical(logits=logits / self.temperature)
     return dist.sample()
 
 # Modified version of sampling for DataFrame containing probabilities
 
 # Top-k sampling
+@traced(category='sampling')
 def top_k_sampling(scores: pd.DataFrame, k: int, sampler = temperature_sampler(temperature=1.0), multi=False):
   if multi:
     scores = scores.sort_values(by=['avg_score'], ascending=False)
     scores = scores.reset_index(drop=True)
     scores = scores.iloc[:k]
     return scores
-  raw_score = torch.tensor(scores['avg_score'].values, device='cuda:0')
+  raw_score = torch.tensor(scores['avg_score'].values, device=device)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
   zeros = raw_score.new_ones(raw_score.shape) * float('-inf')
   values, indices = torch.topk(raw_score, k=k, dim=-1)
@@ -33,6 +41,7 @@ def top_k_sampling(scores: pd.DataFrame, k: int, sampler = temperature_sampler(t
   return scores['mutant'][sampled_score]
 
 # Typical sampling
+@traced(category='sampling')
 def typical_sampling(scores: pd.DataFrame, mass: float = 0.9, sampler = temperature_sampler(temperature=1.0), multi=False):
   raw_score = torch.tensor(scores['avg_score'].values)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
@@ -68,6 +77,7 @@ def typical_sampling(scores: pd.DataFrame, mass: float = 0.9, sampler = temperat
     return scores['mutant'][sampled_score]
 
 # Top-p sampling
+@traced(category='sampling')
 def top_p_sampling(scores: pd.DataFrame, p: float, sampler = temperature_sampler(temperature=1.0), multi=False):
   raw_score = torch.tensor(scores['avg_score'].values)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
@@ -119,6 +129,7 @@ def compute_k(n,s,tau):
   return round(k)
 
 # Mirostat Sampling
+@traced(category='sampling')
 def mirostat_sampling(scores: pd.DataFrame, tau:float = 3.0, sampler = temperature_sampler(temperature=1.0), vocab=AA_vocab, multi=False):
   max_surprise = 2*tau
   n = len(vocab)
@@ -148,8 +159,9 @@ def mirostat_sampling(scores: pd.DataFrame, tau:float = 3.0, sampler = temperatu
     return scores['mutant'][sampled_score]
 
 # Random Sampling
+@traced(category='sampling')
 def random_sampling(scores: pd.DataFrame, sampler = temperature_sampler(temperature=1.0), multi=False):
-  raw_score = torch.tensor(scores['avg_score'].values, device='cuda:0')
+  raw_score = torch.tensor(scores['avg_score'].values, device=device)
   raw_score = torch.nan_to_num(raw_score, float("-inf"))
   sampled_score = sampler(raw_score).item()
   
@@ -159,6 +171,7 @@ def random_sampling(scores: pd.DataFrame, sampler = temperature_sampler(temperat
     return scores['mutant'][sampled_score]
 
 
+@traced(category='sampling')
 def beam_search(scores: pd.DataFrame, beam_width: int, max_length:int, tokenizer, Tmodel, score_mirror=False, batch=20, max_pos=50, sampler=temperature_sampler(temperature=1.0), multi=False, past_key_values=None, filter='hpf', ev_model=None, IST=96, model_type='Tranception', exclude_positions=None):
   length = 1
   while length < max_length:
@@ -166,6 +166,98 @@ class VAE_Bayesian_MLP_decoder(nn.Module):
 
         return x_recon_log
 
+    def noise_buffers(self, batch_size, num_samples):
+        """
+        Empty buffers for the random draws of num_samples forward passes on batch_size latent vectors (dropout masks and
+        weight noise), in the order forward draws them; fill sample i with draw_noise(buffers, i).
+        """
+        dropout = self.dropout_proba > 0.0 and self.training
+        shapes = [(batch_size, self.z_dim)] if dropout else []
+        for layer_index in range(len(self.hidden_layers_sizes)):
+            shapes.append(self.hidden_layers_mean[str(layer_index)].weight.shape)
+            shapes.append(self.hidden_layers_mean[str(layer_index)].bias.shape)
+            if dropout:
+                shapes.append((batch_size, self.hidden_layers_sizes[layer_index]))
+        shapes += [self.last_hidden_layer_weight_mean.shape, self.last_hidden_layer_bias_mean.shape]
+        if self.convolve_output:
+            shapes.append(self.output_convolution_mean.weight.shape)
+        if self.include_sparsity:
+            shapes.append(self.sparsity_weight_mean.shape)
+        if self.include_temperature_scaler:
+            shapes.append(self.temperature_scaler_mean.shape)
+        mean = self.last_hidden_layer_bias_mean
+        return [torch.empty((num_samples,) + tuple(shape), dtype=mean.dtype, device=mean.device) for shape in shapes]
+
+    def draw_noise(self, buffers, sample_index):
+        """Fills sample sample_index of noise_buffers with the same random draws, in the same order, as a call to forward."""
+        dropout = self.dropout_proba > 0.0 and self.training
+        buffers = iter(buffers)
+        def dropout_mask():
+            next(buffers)[sample_index].bernoulli_(1 - self.dropout_proba).div_(1 - self.dropout_proba)
+        if dropout:
+            dropout_mask()
+        for layer_index in range(len(self.hidden_layers_sizes)):
+            next(buffers)[sample_index].normal_()
+            next(buffers)[sample_index].normal_()
+            if dropout:
+                dropout_mask()
+        for buffer in buffers:
+            buffer[sample_index].normal_()
+
+    def sample_memory(self, batch_size):
+        """Approximate bytes that forward_samples needs per sample (weight noise, sampled weights and activations)."""
+        num_weights = sum(param.numel() for name, param in self.named_parameters() if 'log_var' not in name)
+        output_size = self.seq_len * self.alphabet_size
+        activations = batch_size * (self.z_dim + sum(self.hidden_layers_sizes) + 3 * output_size)
+        return self.last_hidden_layer_bias_mean.element_size() * (2 * num_weights + output_size * self.hidden_layers_sizes[-1] + activations)
+
+    def forward_samples(self, z, noise):
+        """
+        forward for num_samples weight samples at once: z is (num_samples, batch_size, z_dim) and noise the filled
+        noise_buffers, which are overwritten with the sampled weights. Returns log-probabilities of shape
+        (num_samples, batch_size, seq_len, alphabet).
+        """
+        num_samples, batch_size = z.shape[:2]
+        noise = iter(noise)
+        def sample(mean, log_var):
+            # In place, with the rounding of the sampler: exp(0.5*log_var) * eps + mean
+            return next(noise).mul_(torch.exp(0.5*log_var)).add_(mean)
+        dropout = self.dropout_proba > 0.0 and self.training
+        x = z.mul_(next(noise)) if dropout else z
+
+        for layer_index in range(len(self.hidden_layers_sizes)):
+            layer_weight = sample(self.hidden_layers_mean[str(layer_index)].weight, self.hidden_layers_log_var[str(layer_index)].weight)
+            layer_bias = sample(self.hidden_layers_mean[str(layer_index)].bias, self.hidden_layers_log_var[str(layer_index)].bias)
+            x = torch.baddbmm(layer_bias.unsqueeze(1), x, layer_weight.transpose(1, 2))
+            last_layer = layer_index == len(self.hidden_layers_sizes)-1
+            x = self.last_hidden_nonlinearity(x) if last_layer else self.first_hidden_nonlinearity(x)
+            if dropout:
+                x = x.mul_(next(noise))
+
+        W_out = sample(self.last_hidden_layer_weight_mean, self.last_hidden_layer_weight_log_var)
+        b_out = sample(self.last_hidden_layer_bias_mean, self.last_hidden_layer_bias_log_var)
+
+        if self.convolve_output:
+            output_convolution_weight = sample(self.output_convolution_mean.weight, self.output_convolution_log_var.weight)
+            W_out = torch.bmm(W_out.view(num_samples, self.seq_len * self.hidden_layers_sizes[-1], self.channel_size),
+                              output_convolution_weight.view(num_samples, self.channel_size, self.alphabet_size))
+
+        if self.include_sparsity:
+            sparsity_weights = sample(self.sparsity_weight_mean, self.sparsity_weight_log_var)
+            sparsity_tiled = nn.Sigmoid()(sparsity_weights.repeat(1, self.num_tiles_sparsity, 1)).unsqueeze(3)
+            W_out = W_out.view(num_samples, self.hidden_layers_sizes[-1], self.seq_len, self.alphabet_size) * sparsity_tiled
+
+        W_out = W_out.view(num_samples, self.seq_len * self.alphabet_size, self.hidden_layers_sizes[-1])
+
+        x = torch.baddbmm(b_out.unsqueeze(1), x, W_out.transpose(1, 2))
+
+        if self.include_temperature_scaler:
+            temperature_scaler = sample(self.temperature_scaler_mean, self.temperature_scaler_log_var)
+            x = torch.log(1.0+torch.exp(temperature_scaler)).view(num_samples, 1, 1) * x
+
+        x = x.view(num_samples, batch_size, self.seq_len, self.alphabet_size)
+        return F.log_softmax(x, dim=-1)
+
 class VAE_Standard_MLP_decoder(nn.Module):
     """
     Standard MLP decoder class for the VAE model.
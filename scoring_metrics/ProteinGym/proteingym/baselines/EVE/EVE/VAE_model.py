@@ -196,6 +196,27 @@ class VAE_model(nn.Module):
 
         return ELBO_batch_tensor, BCE_batch_tensor, KLD_batch_tensor
 
+    def all_likelihood_components_samples(self, x, mu, log_var, num_samples):
+        """
+        ELBOs of num_samples calls to all_likelihood_components_z in one batched pass, as a (num_samples, batch) tensor.
+        The random draws are made in the same order as the calls would make them (Bayesian decoder only).
+        """
+        eps = torch.empty((num_samples,) + mu.shape, dtype=mu.dtype, device=mu.device)
+        noise = self.decoder.noise_buffers(len(x), num_samples)
+        for sample_index in range(num_samples):
+            eps[sample_index].normal_()
+            self.decoder.draw_noise(noise, sample_index)
+        z = eps.mul_(torch.exp(0.5 * log_var)).add_(mu)
+        recon_x_log = self.decoder.forward_samples(z, noise)
+
+        recon_x_log = recon_x_log.view(num_samples, -1, self.alphabet_size * self.seq_len)
+        x = x.view(1, -1, self.alphabet_size * self.seq_len).expand_as(recon_x_log)
+
+        BCE_batch_tensor = torch.sum(F.binary_cross_entropy_with_logits(recon_x_log, x, reduction='none'), dim=2)
+        KLD_batch_tensor = (-0.5 * torch.sum(1 + log_var - mu.pow(2) - log_var.exp(), dim=1))
+
+        return -(BCE_batch_tensor + KLD_batch_tensor)
+
     def train_model(self, data, training_parameters, use_dataloader=False):
         """
         Training procedure for the VAE model.
@@ -364,7 +385,7 @@ class VAE_model(nn.Module):
         }, model_checkpoint)
 
     def compute_evol_indices(self, msa_data, list_mutations_location, num_samples, batch_size=256,
-                             mutant_column="mutations", num_chunks=1, aggregation_method="full"):
+                             mutant_column="mutations", num_chunks=1, aggregation_method="full", samples_memory_budget=2 ** 30):
         list_valid_mutations = []
         evol_indices = []
 
@@ -381,15 +402,17 @@ class VAE_model(nn.Module):
                                                                                                    num_samples=num_samples,
                                                                                                    batch_size=batch_size,
                                                                                                    mutant_column=mutant_column,
-                                                                                                   aggregation_method=aggregation_method)
+                                                                                                   aggregation_method=aggregation_method,
+                                                                                                   samples_memory_budget=samples_memory_budget)
             list_valid_mutations.extend(list(list_valid_mutations_chunk))
             evol_indices.extend(list(evol_indices_chunk))
         return list_valid_mutations, evol_indices, '', ''
 
     def compute_evol_indices_chunk(self, msa_data, list_mutations_location, num_samples, batch_size=256,
-                                   mutant_column="mutations", aggregation_method="full"):
+                                   mutant_column="mutations", aggregation_method="full", samples_memory_budget=2 ** 30):
         """
         The column in the list_mutations dataframe that contains the mutant(s) for a given variant should be called "mutations"
+        aggregation_method "batched" evaluates as many samples at once as fit in samples_memory_budget bytes (Bayesian decoder only)
         """
 
         # Note: wt is added inside this function, so no need to add a row in csv/dataframe input with wt
@@ -402,7 +425,7 @@ class VAE_model(nn.Module):
         list_valid_mutated_sequences = {}
         list_valid_mutated_sequences['wt'] = msa_data.focus_seq_trimmed  # first sequence in the list is the wild_type
 
-        if aggregation_method not in ["full", "batch", "online"]:
+        if aggregation_method not in ["full", "batch", "online", "batched"]:
             raise ValueError("Invalid aggregation method: {}".format(aggregation_method))
 
         for mutation in list_mutations[mutant_column]:
@@ -542,10 +565,42 @@ class VAE_model(nn.Module):
                     std_predictions[i * batch_size:i * batch_size + len(x)] = std.detach().cpu()
                     tqdm.tqdm.write('\n')
 
+                delta_elbos = mean_predictions - mean_predictions[0]
+                evol_indices = - delta_elbos.detach().cpu().numpy()
+        elif aggregation_method == "batched":
+            # Samples are an extra batch dimension: each block of samples is one batched decoder pass, and the mean and
+            # variance are merged block by block on the device (Chan et al. pairwise update)
+            if not self.decoder.bayesian_decoder:
+                raise ValueError("Aggregation method 'batched' requires a Bayesian decoder")
+            mean_predictions = torch.zeros(len(list_valid_mutations))
+            std_predictions = torch.zeros(len(list_valid_mutations))
+            with torch.no_grad():
+                for i, batch in enumerate(tqdm(dataloader, 'Looping through mutation batches')):
+                    x = batch.type(self.dtype).to(self.device)
+                    samples_per_block = int(max(1, min(num_samples, samples_memory_budget // self.decoder.sample_memory(len(x)))))
+                    mu, log_var = self.encoder(x)
+                    count = 0
+                    online_mean = torch.zeros(len(x), dtype=self.dtype, device=self.device)
+                    online_s = torch.zeros(len(x), dtype=self.dtype, device=self.device)
+                    for start in range(0, num_samples, samples_per_block):
+                        seq_predictions = self.all_likelihood_components_samples(x, mu, log_var, min(samples_per_block, num_samples - start))
+                        block_count = len(seq_predictions)
+                        block_mean = seq_predictions.mean(dim=0)
+                        block_s = ((seq_predictions - block_mean) ** 2).sum(dim=0)
+                        delta = block_mean - online_mean
+                        total = count + block_count
+                        online_mean = online_mean + delta * block_count / total
+                        online_s = online_s + block_s + delta ** 2 * count * block_count / total
+                        count = total
+
+                    std = (online_s / (num_samples - 1)).sqrt()
+                    mean_predictions[i * batch_size:i * batch_size + len(x)] = online_mean.detach().cpu()
+                    std_predictions[i * batch_size:i * batch_size + len(x)] = std.detach().cpu()
+
                 delta_elbos = mean_predictions - mean_predictions[0]
                 evol_indices = - delta_elbos.detach().cpu().numpy()
         else:
-            raise ValueError("Invalid aggregation method. Must be one of 'full', 'batch' or 'online'.")
+            raise ValueError("Invalid aggregation method. Must be one of 'full', 'batch', 'online' or 'batched'.")
 
         return list_valid_mutations, evol_indices, mean_predictions[
             0].detach().cpu().numpy(), std_predictions.detach().cpu().numpy()
@@ -26,7 +26,8 @@ if __name__=='__main__':
     parser.add_argument('--num_samples_compute_evol_indices', type=int, help='Num of samples to approximate delta elbo when computing evol indices')
     parser.add_argument('--batch_size', default=256, type=int, help='Batch size when computing evol indices')
     parser.add_argument("--skip_existing", action="store_true", help="Skip scoring if output file already exists")
-    parser.add_argument("--aggregation_method", choices=["full", "batch", "online"], default="full", help="Method to aggregate evol indices")
+    parser.add_argument("--aggregation_method", choices=["full", "batch", "online", "batched"], default="batched", help="Method to aggregate evol indices")
+    parser.add_argument("--samples_memory_budget", type=float, default=1.0, help="Memory in GB for the samples evaluated at once by the batched aggregation method")
     parser.add_argument("--threshold_focus_cols_frac_gaps", type=float,
                         help="Maximum fraction of gaps allowed in focus columns - see data_utils.MSA_processing")
     args = parser.parse_args()
@@ -119,7 +120,8 @@ if __name__=='__main__':
             mutant_column=DMS_mutant_column,
             num_samples=args.num_samples_compute_evol_indices,
             batch_size=args.batch_size,
-            aggregation_method=args.aggregation_method
+            aggregation_method=args.aggregation_method,
+            samples_memory_budget=int(args.samples_memory_budget * 2 ** 30)
         )
 
         df = {}
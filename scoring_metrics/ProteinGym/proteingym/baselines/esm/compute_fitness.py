@@ -10,7 +10,6 @@ from Bio import SeqIO
 import itertools
 from typing import List, Tuple
 import torch
-import subprocess
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from baselines.esm import esm
@@ -19,48 +18,25 @@ from esm import Alphabet, FastaBatchedDataset, ProteinBertModel, pretrained, MSA
 from utils.scoring_utils import get_optimal_window, set_mutant_offset, undo_mutant_offset
 from utils.data_utils import DMS_file_cleanup
 from utils.msa_utils import MSA_processing
-
-if not os.path.isdir(os.path.expanduser('~/hh-suite-3.3.0')):
-    subprocess.run(['wget', 'https://github.com/soedinglab/hh-suite/releases/download/v3.3.0/hhsuite-3.3.0-AVX2-Linux.tar.gz', '-P', os.path.expanduser('~/')], check=True)
-    os.mkdir(os.path.expanduser('~/hh-suite-3.3.0'), exist_ok=True)
-    subprocess.run(['tar', '-xzf', os.path.expanduser('~/hhsuite-3.3.0-AVX2-Linux.tar.gz'), '-C', os.path.expanduser('~/hh-suite-3.3.0')], check=True)
-    subprocess.run(['rm', os.path.expanduser('~/hhsuite-3.3.0-AVX2-Linux.tar.gz')], check=True)
+from utils.msa_filter import filter_msa_file
 
 def standardization(x):
     """Assumes input is numpy array or pandas series"""
     return (x - x.mean()) / x.std()
 
-def read_msa(filename: str, nseq: int, sampling_strategy: str, random_seed: int, weight_filename: str, filter_msa: bool, path_to_hhfilter: str, hhfilter_min_cov=75, hhfilter_max_seq_id=100, hhfilter_min_seq_id=0) -> List[Tuple[str, str]]:
-    """ Reads the first nseq sequences from an MSA file, automatically removes insertions."""
-    print("Sampling sequences from MSA with strategy: "+str(sampling_strategy))
-    random.seed(random_seed)
-    if filter_msa:
-        filename = str(filename) if not isinstance(filename, str) else filename # In case it is a pathlib object
-        input_folder = '/'.join(filename.split('/')[:-1])
-        msa_name = filename.split('/')[-1].split('.')[0]
-        if not os.path.isdir(input_folder+os.sep+'preprocessed'):
-            os.mkdir(input_folder+os.sep+'preprocessed')
-        if not os.path.isdir(input_folder+os.sep+'hhfiltered'):
-            os.mkdir(input_folder+os.sep+'hhfiltered')
-        preprocessed_filename = input_folder+os.sep+'preprocessed'+os.sep+msa_name
-        os.system('cat '+filename+' | tr  "."  "-" >> '+preprocessed_filename+'.a2m')
-        os.system('dd if='+preprocessed_filename+'.a2m of='+preprocessed_filename+'_UC.a2m conv=ucase')
-        output_filename = input_folder+os.sep+'hhfiltered'+os.sep+msa_name+'_hhfiltered_cov_'+str(hhfilter_min_cov)+'_maxid_'+str(hhfilter_max_seq_id)+'_minid_'+str(hhfilter_min_seq_id)+'.a2m'
-        os.system(path_to_hhfilter+os.sep+'bin/hhfilter -cov '+str(hhfilter_min_cov)+' -id '+str(hhfilter_max_seq_id)+' -qid '+str(hhfilter_min_seq_id)+' -i '+preprocessed_filename+'_UC.a2m -o '+output_filename)
-        filename = output_filename
+_msa_cache = {}
 
-    if sampling_strategy=='first_x_rows':
-        msa = [
-            (record.description, str(record.seq))
-            for record in itertools.islice(SeqIO.parse(filename, "fasta"), nseq)
-        ]
-    elif sampling_strategy=='random':
-        msa = [
-            (record.description, str(record.seq)) for record in SeqIO.parse(filename, "fasta")
-        ]
-        nseq = min(len(msa),nseq)
-        msa = random.sample(msa, nseq)
-    elif sampling_strategy=='sequence-reweighting':
+def _msa_records(filename):
+    """All (description, sequence) records of an MSA file, parsed once per process (keyed by path and modification time)."""
+    key = ('records', str(filename), os.path.getmtime(filename))
+    if key not in _msa_cache:
+        _msa_cache[key] = [(record.description, str(record.seq)) for record in SeqIO.parse(filename, "fasta")]
+    return _msa_cache[key]
+
+def _reweighting_pool(filename, weight_filename):
+    """Focus sequence, other sequences and their normalized weights for sequence-reweighting, computed once per process."""
+    key = ('reweighting', str(filename), os.path.getmtime(filename), weight_filename)
+    if key not in _msa_cache:
         MSA = MSA_processing(
             MSA_location=filename,
             use_weights=True,
@@ -70,10 +46,10 @@ def read_msa(filename: str, nseq: int, sampling_strategy: str, random_seed: int,
         print("Name of focus_seq: "+str(MSA.focus_seq_name))
         all_sequences_msa=[]
         weights=[]
-        msa=[]
+        focus=[]
         for seq_name in MSA.raw_seq_name_to_sequence.keys():
             if seq_name == MSA.focus_seq_name:
-                msa.append((seq_name,MSA.raw_seq_name_to_sequence[seq_name]))
+                focus.append((seq_name,MSA.raw_seq_name_to_sequence[seq_name]))
                 del MSA.seq_name_to_weight[seq_name]
             else:
                 if seq_name in MSA.seq_name_to_weight:
@@ -82,6 +58,42 @@ def read_msa(filename: str, nseq: int, sampling_strategy: str, random_seed: int,
         if len(all_sequences_msa)>0:
             weights = np.array(weights) / np.array(list(MSA.seq_name_to_weight.values())).sum()
             print("Check sum weights MSA: "+str(weights.sum()))
+        _msa_cache[key] = (focus, all_sequences_msa, weights)
+    return _msa_cache[key]
+
+def read_msa(filename: str, nseq: int, sampling_strategy: str, random_seed: int, weight_filename: str, filter_msa: bool, path_to_hhfilter: str, hhfilter_min_cov=75, hhfilter_max_seq_id=100, hhfilter_min_seq_id=0) -> List[Tuple[str, str]]:
+    """ Reads the first nseq sequences from an MSA file, automatically removes insertions."""
+    print("Sampling sequences from MSA with strategy: "+str(sampling_strategy))
+    random.seed(random_seed)
+    records = None
+    if filter_msa:
+        filename = str(filename) if not isinstance(filename, str) else filename # In case it is a pathlib object
+        input_folder = os.path.dirname(filename)
+        msa_name = os.path.basename(filename).split('.')[0]
+        records = filter_msa_file(filename, min_cov=hhfilter_min_cov, max_seq_id=hhfilter_max_seq_id, min_seq_id=hhfilter_min_seq_id, cache_dir=os.path.join(input_folder, 'hhfiltered'))
+        if sampling_strategy=='sequence-reweighting': # MSA_processing reads the alignment from disk
+            output_filename = os.path.join(input_folder, 'hhfiltered', msa_name+'_hhfiltered_cov_'+str(hhfilter_min_cov)+'_maxid_'+str(hhfilter_max_seq_id)+'_minid_'+str(hhfilter_min_seq_id)+'.a2m')
+            if not os.path.isfile(output_filename):
+                with open(output_filename, "w") as output:
+                    output.write("".join(">"+desc+"\n"+seq+"\n" for desc, seq in records))
+            filename = output_filename
+
+    if sampling_strategy=='first_x_rows':
+        if records is not None:
+            msa = records[:nseq]
+        else:
+            msa = [
+                (record.description, str(record.seq))
+                for record in itertools.islice(SeqIO.parse(filename, "fasta"), nseq)
+            ]
+    elif sampling_strategy=='random':
+        msa = records if records is not None else _msa_records(filename)
+        nseq = min(len(msa),nseq)
+        msa = random.sample(msa, nseq)
+    elif sampling_strategy=='sequence-reweighting':
+        focus, all_sequences_msa, weights = _reweighting_pool(filename, weight_filename)
+        msa = list(focus)
+        if len(all_sequences_msa)>0:
             msa.extend(random.choices(all_sequences_msa, weights=weights, k=nseq-1))
     msa = [(desc, seq.upper()) for desc, seq in msa]
     print("First 10 elements of sampled MSA: ")
@@ -183,7 +195,7 @@ def create_parser():
     parser.add_argument(
         '--filter-msa',
         action='store_true',
-        help='Whether to use hhfilter to filter input MSA before sampling'
+        help='Whether to filter the input MSA (coverage and identity, as hhfilter) before sampling'
     )
     parser.add_argument(
         '--hhfilter-min-cov',
@@ -207,7 +219,7 @@ def create_parser():
         '--path-to-hhfilter',
         type=str,
         default='~/hh-suite-3.3.0',
-        help='Path to hhfilter binaries'
+        help='Unused: the MSA is filtered in-process (kept for backward compatibility)'
     )
     parser.add_argument(
         '--scoring-window',
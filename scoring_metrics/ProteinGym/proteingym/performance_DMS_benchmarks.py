@@ -6,8 +6,14 @@ from scipy.stats import spearmanr
 from sklearn.metrics import roc_auc_score, matthews_corrcoef
 import warnings
 import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from proteingym.utils.performance_utils import bootstrap_means, compute_metrics
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+METRICS = ['Spearman','AUC','MCC','NDCG','Top_recall']
+DEPTHS = ['1','2','3','4','5+']
+
 def minmax(x):
     return ( (x - np.min(x)) / (np.max(x) - np.min(x)) ) 
 
@@ -81,35 +87,78 @@ def standardization(x):
     """Assumes input is numpy array or pandas series"""
     return (x - x.mean()) / x.std()
 
-def compute_bootstrap_standard_error(df, number_assay_reshuffle=10000):
+def compute_bootstrap_standard_error(df, number_assay_reshuffle=10000, seed=None):
     """
     Computes the non-parametric bootstrap standard error for the mean estimate of a given performance metric (eg., Spearman, AUC) across DMS assays (ie., the sample standard deviation of the mean across bootstrap samples)
     """
-    model_names = df.columns
-    mean_performance_across_samples = []
-    for sample in range(number_assay_reshuffle):
-        mean_performance_across_samples.append(df.sample(frac=1.0, replace=True).mean(axis=0)) #Resample a dataset of the same size (with replacement) then take the sample mean
-    mean_performance_across_samples=pd.DataFrame(data=mean_performance_across_samples,columns=model_names)
-    return mean_performance_across_samples.std(ddof=1)
+    df = df.select_dtypes(include='number')
+    mean_performance_across_samples = bootstrap_means(df.values, number_assay_reshuffle, seed=seed) #Resample datasets of the same size (with replacement) then take the sample means
+    return pd.Series(mean_performance_across_samples.std(axis=0, ddof=1), index=df.columns)
 
-def compute_bootstrap_standard_error_functional_categories(df, number_assay_reshuffle=10000):
+def compute_bootstrap_standard_error_functional_categories(df, number_assay_reshuffle=10000, seed=None):
     """
     Computes the non-parametric bootstrap standard error for the mean estimate of a given performance metric (eg., Spearman, AUC) across DMS assays (ie., the sample standard deviation of the mean across bootstrap samples)
     """
-    model_names = df.columns
-    mean_performance_across_samples = {}
-    for category, group in df.groupby("Selection Type"):
-        mean_performance_across_samples[category] = []
-        for sample in range(number_assay_reshuffle):
-            mean_performance_across_samples[category].append(group.sample(frac=1.0, replace=True).mean(axis=0)) #Resample a dataset of the same size (with replacement) then take the sample mean
-        mean_performance_across_samples[category]=pd.DataFrame(data=mean_performance_across_samples[category])
-    categories = list(mean_performance_across_samples.keys())
-    combined_averages = mean_performance_across_samples[categories[0]].copy()
-    for category in categories[1:]:
-        combined_averages += mean_performance_across_samples[category]
-    combined_averages /= len(categories)
-    return combined_averages.std(ddof=1)
+    rng = np.random.default_rng(seed)
+    df = df.select_dtypes(include='number')
+    mean_performance_across_samples = [bootstrap_means(group.values, number_assay_reshuffle, seed=rng) for category, group in df.groupby("Selection Type")]
+    combined_averages = np.mean(mean_performance_across_samples, axis=0)
+    return pd.Series(combined_averages.std(axis=0, ddof=1), index=df.columns)
 
+def compute_DMS_performance(DMS_id, mapping_protein_seq_DMS, score_variables, args):
+    """
+    Computes all metrics of all models for one DMS assay, returns a dict metric -> {score: value} plus number_mutants (None if its scoring file is missing)
+    """
+    try:
+        print(DMS_id)    
+        DMS_filename = mapping_protein_seq_DMS["DMS_filename"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
+        DMS_file = pd.read_csv(args.DMS_data_folder+os.sep+DMS_filename)
+        print("Length DMS: {}".format(len(DMS_file)))
+        merged_scores = pd.read_csv(args.input_scoring_files_folder + os.sep + DMS_id + ".csv") #We assume no missing value (all models were enforced to score all mutants)
+        if 'mutant' not in merged_scores: merged_scores['mutant'] = merged_scores['mutated_sequence'] #if mutant not in DMS file we default to mutated_sequence (eg., for indels)
+    except:
+        print(f"Scoring file for {DMS_id} missing")
+        return None
+
+    by_depth = not args.indel_mode and args.performance_by_depth
+    if by_depth:
+        merged_scores['mutation_depth']=merged_scores['mutant'].apply(lambda x: len(x.split(":")))
+        merged_scores['mutation_depth_grouped']=merged_scores['mutation_depth'].apply(lambda x: '5+' if x >=5 else str(x))
+    performance_DMS = {metric: {} for metric in METRICS}
+    present_scores = []
+    for score in score_variables:
+        if score not in merged_scores:
+            print("Model scores for {} not in merged scores for DMS {}".format(score,DMS_id))
+            for metric in METRICS:
+                performance_DMS[metric][score] = np.nan
+                if by_depth:
+                    for depth in DEPTHS:
+                        performance_DMS[metric][score+'_'+depth] = np.nan
+        else:
+            present_scores.append(score)
+    if present_scores:
+        # All models of the assay are scored at once; MCC binarizes scores at their median over the full assay, including for the depth subsets
+        DMS_score = merged_scores['DMS_score'].values
+        DMS_score_bin = merged_scores['DMS_score_bin'].values if 'DMS_score_bin' in merged_scores else np.full(len(merged_scores), np.nan)
+        model_scores = merged_scores[present_scores].values.astype(float)
+        model_scores_bin = (merged_scores[present_scores] >= merged_scores[present_scores].median()).values
+        metrics = compute_metrics(DMS_score, DMS_score_bin, model_scores, model_scores_bin)
+        for metric in METRICS:
+            for j, score in enumerate(present_scores):
+                performance_DMS[metric][score] = metrics[metric][j]
+        for score in np.array(present_scores)[np.isnan(metrics['AUC'])]:
+            print("AUC issue with: {} for model: {}".format(DMS_id,score))
+        if by_depth:
+            for depth in DEPTHS:
+                in_depth = (merged_scores.mutation_depth_grouped==depth).values
+                if in_depth.any():
+                    metrics = compute_metrics(DMS_score[in_depth], DMS_score_bin[in_depth], model_scores[in_depth], model_scores_bin[in_depth])
+                for metric in METRICS:
+                    for j, score in enumerate(present_scores):
+                        performance_DMS[metric][score+'_'+depth] = metrics[metric][j] if in_depth.any() else np.nan
+    print("Number of mutants: {}".format(len(merged_scores['DMS_score'].values)))
+    performance_DMS['number_mutants'] = len(merged_scores['DMS_score'].values)
+    return performance_DMS
 
 proteingym_folder_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -121,6 +170,7 @@ def main():
     parser.add_argument('--DMS_data_folder', type=str, help='Path to folder that contains all DMS datasets')
     parser.add_argument('--indel_mode', action='store_true', help='Whether to score sequences with insertions and deletions')
     parser.add_argument('--performance_by_depth', action='store_true', help='Whether to compute performance by mutation depth')
+    parser.add_argument('--num_workers', default=os.cpu_count(), type=int, help='Number of processes scoring DMS assays in parallel')
     parser.add_argument('--config_file', default=f'{os.path.dirname(proteingym_folder_path)}/config.json', type=str, help='Path to config file containing model information')
     args = parser.parse_args()
     
@@ -176,89 +226,22 @@ def main():
         performance_all_DMS[metric].columns=['score','score_index']
 
     list_DMS = mapping_protein_seq_DMS["DMS_id"]
-    i = 0
-    for DMS_id in list_DMS:
-        try:
-            print(DMS_id)    
-            UniProt_ID = mapping_protein_seq_DMS["UniProt_ID"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
-            DMS_filename = mapping_protein_seq_DMS["DMS_filename"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
-            selection_type = mapping_protein_seq_DMS["coarse_selection_type"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
-            MSA_Neff_L_category	= mapping_protein_seq_DMS["MSA_Neff_L_category"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
-            Taxon = mapping_protein_seq_DMS["taxon"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
-
-            DMS_file = pd.read_csv(args.DMS_data_folder+os.sep+DMS_filename)
-            print("Length DMS: {}".format(len(DMS_file)))
-            merged_scores = pd.read_csv(args.input_scoring_files_folder + os.sep + DMS_id + ".csv") #We assume no missing value (all models were enforced to score all mutants)
-            if 'mutant' not in merged_scores: merged_scores['mutant'] = merged_scores['mutated_sequence'] #if mutant not in DMS file we default to mutated_sequence (eg., for indels)
-        except:
-            print(f"Scoring file for {DMS_id} missing")
+    score_DMS = partial(compute_DMS_performance, mapping_protein_seq_DMS=mapping_protein_seq_DMS, score_variables=score_variables, args=args)
+    if args.num_workers > 1:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            performance_per_DMS = list(executor.map(score_DMS, list_DMS))
+    else:
+        performance_per_DMS = [score_DMS(DMS_id) for DMS_id in list_DMS]
+    for DMS_id, performance_DMS in zip(list_DMS, performance_per_DMS):
+        if performance_DMS is None:
             continue
-
-        if not args.indel_mode and args.performance_by_depth:
-            merged_scores['mutation_depth']=merged_scores['mutant'].apply(lambda x: len(x.split(":")))
-            merged_scores['mutation_depth_grouped']=merged_scores['mutation_depth'].apply(lambda x: '5+' if x >=5 else str(x))
-        performance_DMS = {}
-        for metric in ['Spearman','AUC','MCC','NDCG','Top_recall']:
-            performance_DMS[metric]={}
-        for score in score_variables:
-            if score not in merged_scores:
-                print("Model scores for {} not in merged scores for DMS {}".format(score,DMS_id))
-                performance_DMS["Spearman"][score] = np.nan
-                performance_DMS["AUC"][score] = np.nan
-                performance_DMS["MCC"][score] = np.nan
-                performance_DMS["NDCG"][score] = np.nan 
-                performance_DMS["Top_recall"][score] = np.nan
-                continue
-            performance_DMS['Spearman'][score] = spearmanr(merged_scores['DMS_score'], merged_scores[score])[0]
-            performance_DMS["NDCG"][score] = calc_ndcg(merged_scores['DMS_score'], merged_scores[score])
-            performance_DMS["Top_recall"][score] = calc_toprecall(merged_scores['DMS_score'], merged_scores[score])
-            try:
-                performance_DMS['AUC'][score] = roc_auc_score(y_true=merged_scores['DMS_score_bin'], y_score=merged_scores[score])
-            except:
-                print("AUC issue with: {} for model: {}".format(DMS_id,score))
-                performance_DMS['AUC'][score] = np.nan
-            try:
-                median_cutoff=merged_scores[score].median()
-                merged_scores[score+"_bin"]=merged_scores[score].map(lambda x: 1 if x >= median_cutoff else 0)
-                performance_DMS['MCC'][score] = matthews_corrcoef(y_true=merged_scores['DMS_score_bin'], y_pred=merged_scores[score+"_bin"])
-            except:
-                print("MCC issue with: {} for model: {}".format(DMS_id,score))
-                performance_DMS['MCC'][score] = np.nan
-
-        if not args.indel_mode and args.performance_by_depth:
-            for score in score_variables:
-                if score not in merged_scores:
-                    print("Model scores for {} not in merged scores for DMS {}".format(score,DMS_id))
-                    for depth in ['1','2','3','4','5+']:
-                        performance_DMS["Spearman"][score+'_'+depth] = np.nan
-                        performance_DMS["AUC"][score+'_'+depth] = np.nan
-                        performance_DMS["MCC"][score+'_'+depth] = np.nan 
-                        performance_DMS["NDCG"][score+'_'+depth] = np.nan
-                        performance_DMS["Top_recall"][score+'_'+depth] = np.nan
-                    continue
-                for depth in ['1','2','3','4','5+']:
-                    merged_scores_depth = merged_scores[merged_scores.mutation_depth_grouped==depth]
-                    if len(merged_scores_depth) > 0:
-                        performance_DMS['Spearman'][score+'_'+depth] = spearmanr(merged_scores_depth['DMS_score'], merged_scores_depth[score])[0]
-                        performance_DMS["NDCG"][score+'_'+depth] = calc_ndcg(merged_scores_depth['DMS_score'], merged_scores_depth[score])
-                        performance_DMS["Top_recall"][score+'_'+depth] = calc_toprecall(merged_scores_depth['DMS_score'], merged_scores_depth[score])
-                        try:
-                            performance_DMS['AUC'][score+'_'+depth] = roc_auc_score(y_true=merged_scores_depth['DMS_score_bin'], y_score=merged_scores_depth[score])
-                        except:
-                            performance_DMS['AUC'][score+'_'+depth] = np.nan
-                        try:
-                            performance_DMS['MCC'][score+'_'+depth] = matthews_corrcoef(y_true=merged_scores_depth['DMS_score_bin'], y_pred=merged_scores_depth[score+"_bin"])
-                        except:
-                            performance_DMS['MCC'][score+'_'+depth] = np.nan
-                    else:
-                        performance_DMS['Spearman'][score+'_'+depth] = np.nan
-                        performance_DMS['AUC'][score+'_'+depth] = np.nan
-                        performance_DMS['MCC'][score+'_'+depth] = np.nan
-                        performance_DMS["NDCG"][score+'_'+depth] = np.nan
-                        performance_DMS["Top_recall"][score+'_'+depth] = np.nan
-        print("Number of mutants: {}".format(len(merged_scores['DMS_score'].values)))
+        UniProt_ID = mapping_protein_seq_DMS["UniProt_ID"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
+        selection_type = mapping_protein_seq_DMS["coarse_selection_type"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
+        MSA_Neff_L_category	= mapping_protein_seq_DMS["MSA_Neff_L_category"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
+        Taxon = mapping_protein_seq_DMS["taxon"][mapping_protein_seq_DMS["DMS_id"]==DMS_id].values[0]
+        number_mutants = performance_DMS.pop('number_mutants')
         for metric in ['Spearman','AUC','MCC','NDCG','Top_recall']:
-            performance_DMS[metric]['number_mutants']=len(merged_scores['DMS_score'].values)
+            performance_DMS[metric]['number_mutants']=number_mutants
             performance_DMS[metric]['UniProt_ID'] = UniProt_ID
             performance_DMS[metric]["Selection Type"] = selection_type
             performance_DMS[metric]['MSA_Neff_L_category'] = MSA_Neff_L_category
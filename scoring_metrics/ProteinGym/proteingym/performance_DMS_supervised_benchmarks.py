@@ -3,6 +3,7 @@ import os
 import argparse
 from tqdm import tqdm
 import json 
+from proteingym.utils.performance_utils import bootstrap_means
 
 """
 This is the script used to compute statistics for the supervised scoring models. 
@@ -20,10 +21,9 @@ def compute_bootstrap_standard_error_functional_categories(df, number_assay_resh
         group_centered = group.subtract(df.loc[top_model],axis=0)
         mean_performance_across_samples = {}
         for category, group2 in group_centered.groupby("coarse_selection_type"):
-            mean_performance_across_samples[category] = []
-            for sample in range(number_assay_reshuffle):
-                mean_performance_across_samples[category].append(group2.sample(frac=1.0, replace=True).mean(axis=0)) #Resample a dataset of the same size (with replacement) then take the sample mean
-            mean_performance_across_samples[category]=pd.DataFrame(data=mean_performance_across_samples[category])
+            group2 = group2.select_dtypes(include='number')
+            #Resample datasets of the same size (with replacement) then take the sample means
+            mean_performance_across_samples[category]=pd.DataFrame(data=bootstrap_means(group2.values, number_assay_reshuffle),columns=group2.columns)
         categories = list(mean_performance_across_samples.keys())
         combined_averages = mean_performance_across_samples[categories[0]].copy()
         for category in categories[1:]:
@@ -0,0 +1,136 @@
+import os
+import hashlib
+import numpy as np
+from numba import njit, prange
+
+GAP = 0
+_filter_cache = {}
+
+def _encoding_table():
+    """Byte -> uint8 code: '-' and '.' are gaps (0), letters are case-insensitive residues."""
+    table = np.zeros(256, dtype=np.uint8)
+    for code, letter in enumerate("ABCDEFGHIJKLMNOPQRSTUVWXYZ*", start=1):
+        table[ord(letter)] = code
+        table[ord(letter.lower())] = code
+    return table
+
+ENCODING_TABLE = _encoding_table()
+
+def parse_a2m(content):
+    """Records (description, sequence) of an a2m/fasta alignment, with '.' turned into '-' and residues upper-cased as hhfilter input."""
+    records = []
+    for entry in content.split(">")[1:]:
+        header, _, sequence = entry.partition("\n")
+        sequence = "".join(sequence.split()).replace(".", "-").upper()
+        records.append((header.strip(), sequence))
+    return records
+
+def encode_msa(sequences):
+    """uint8 matrix (N, L) of an aligned set of sequences, gaps encoded as 0."""
+    length = len(sequences[0])
+    if any(len(sequence) != length for sequence in sequences):
+        raise ValueError("Sequences of the MSA are not aligned (rows of different lengths)")
+    raw = np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8).reshape(len(sequences), length)
+    return ENCODING_TABLE[raw]
+
+@njit(cache=True)
+def _identical_residues(a, b):
+    count = 0
+    for j in range(a.shape[0]):
+        if a[j] != GAP and a[j] == b[j]:
+            count += 1
+    return count
+
+@njit(parallel=True, cache=True)
+def _query_statistics(msa):
+    """Residues of each sequence, residues in query columns (coverage) and residues identical to the query."""
+    query = msa[0]
+    num_residues = np.zeros(msa.shape[0], dtype=np.int64)
+    covered = np.zeros(msa.shape[0], dtype=np.int64)
+    identical = np.zeros(msa.shape[0], dtype=np.int64)
+    for i in prange(msa.shape[0]):
+        for j in range(msa.shape[1]):
+            if msa[i, j] != GAP:
+                num_residues[i] += 1
+                if query[j] != GAP:
+                    covered[i] += 1
+                    if msa[i, j] == query[j]:
+                        identical[i] += 1
+    return num_residues, covered, identical
+
+@njit(parallel=True, cache=True)
+def _greedy_max_identity(msa, num_residues, order, max_identity, block_size):
+    """
+    Greedy redundancy reduction: candidates are visited in `order` and kept if their identity with every sequence kept so far
+    is at most max_identity, identity being identical residues over the residues of the shorter sequence.
+    Candidates are checked in blocks against the sequences kept before the block in parallel, then against each other in order.
+    """
+    kept = np.empty(order.shape[0], dtype=np.int64)
+    num_kept = 0
+    for start in range(0, order.shape[0], block_size):
+        block = order[start:start + block_size]
+        redundant = np.zeros(block.shape[0], dtype=np.bool_)
+        for b in prange(block.shape[0]):
+            i = block[b]
+            for k in range(num_kept):
+                other = kept[k]
+                shorter = min(num_residues[i], num_residues[other])
+                if _identical_residues(msa[i], msa[other]) > max_identity * shorter:
+                    redundant[b] = True
+                    break
+        for b in range(block.shape[0]):
+            if redundant[b]:
+                continue
+            i = block[b]
+            for b2 in range(b):
+                if redundant[b2]:
+                    continue
+                other = block[b2]
+                shorter = min(num_residues[i], num_residues[other])
+                if _identical_residues(msa[i], msa[other]) > max_identity * shorter:
+                    redundant[b] = True
+                    break
+            if not redundant[b]:
+                kept[num_kept] = i
+                num_kept += 1
+    return np.sort(kept[:num_kept])
+
+def filter_msa(msa, min_cov=75, max_seq_id=100, min_seq_id=0, block_size=256):
+    """
+    Indices of the rows of an encoded MSA (first row = query) kept by hhfilter-like criteria, all in %:
+    min_cov: residues in query columns over query residues; min_seq_id: identity with the query;
+    max_seq_id: maximum pairwise identity, applied greedily from the longest sequences down (the query is always kept).
+    """
+    num_residues, covered, identical = _query_statistics(msa)
+    shorter = np.maximum(np.minimum(num_residues, num_residues[0]), 1)
+    passing = (100 * covered >= min_cov * max(num_residues[0], 1)) & (100 * identical >= min_seq_id * shorter)
+    passing[0] = True
+    candidates = np.flatnonzero(passing[1:]) + 1
+    order = np.concatenate([[0], candidates[np.argsort(-num_residues[candidates], kind="stable")]]).astype(np.int64)
+    if max_seq_id >= 100:
+        return np.sort(order)
+    return _greedy_max_identity(msa, num_residues, order, max_seq_id / 100.0, block_size)
+
+def filter_msa_file(filename, min_cov=75, max_seq_id=100, min_seq_id=0, cache_dir=None):
+    """
+    Filtered records (description, sequence) of an a2m file, in file order, upper-cased and with '.' as '-'.
+    Results are cached in memory by the sha1 of the file content and the thresholds, and, with cache_dir, the kept indices
+    are saved there too so later processes only parse the MSA.
+    """
+    with open(filename, "r") as msa_file:
+        content = msa_file.read()
+    key = hashlib.sha1(content.encode()).hexdigest() + "_cov_{}_maxid_{}_minid_{}".format(min_cov, max_seq_id, min_seq_id)
+    if key in _filter_cache:
+        return _filter_cache[key]
+    records = parse_a2m(content)
+    cache_file = os.path.join(cache_dir, key + ".npy") if cache_dir is not None else None
+    if cache_file is not None and os.path.isfile(cache_file):
+        kept = np.load(cache_file)
+    else:
+        kept = filter_msa(encode_msa([sequence for _, sequence in records]), min_cov, max_seq_id, min_seq_id)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_file, kept)
+    _filter_cache[key] = [records[i] for i in kept]
+    print("Filtered MSA: kept {} of {} sequences (cov {}, max id {}, min id {})".format(len(kept), len(records), min_cov, max_seq_id, min_seq_id))
+    return _filter_cache[key]
@@ -0,0 +1,85 @@
+import numpy as np
+from scipy.stats import rankdata
+
+def bootstrap_means(values, number_assay_reshuffle=10000, seed=None, chunk_size=1000):
+    """
+    Means of number_assay_reshuffle bootstrap resamples of the rows of values (assays x models), skipping NaNs like DataFrame.mean.
+    Each chunk of resamples is drawn as one multinomial count matrix (resamples x assays), so that the resampled means are two matrix products.
+    """
+    rng = np.random.default_rng(seed)
+    values = np.asarray(values, dtype=float)
+    num_assays = values.shape[0]
+    observed = ~np.isnan(values)
+    filled = np.where(observed, values, 0.0)
+    means = np.empty((number_assay_reshuffle, values.shape[1]))
+    for start in range(0, number_assay_reshuffle, chunk_size):
+        counts = rng.multinomial(num_assays, np.full(num_assays, 1.0 / num_assays), size=min(chunk_size, number_assay_reshuffle - start)).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[start:start + len(counts)] = (counts @ filled) / (counts @ observed)
+    return means
+
+def _column_correlation(x, Y):
+    """Pearson correlation of the vector x with every column of Y."""
+    xc = x - x.mean()
+    Yc = Y - Y.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (xc @ Yc) / np.sqrt((xc @ xc) * (Yc * Yc).sum(axis=0))
+
+def compute_metrics(DMS_score, DMS_score_bin, model_scores, model_scores_bin=None, top=10):
+    """
+    Spearman, AUC, MCC, NDCG and Top_recall of every model (columns of model_scores, mutants x models) in one vectorized pass.
+    Matches spearmanr, roc_auc_score, matthews_corrcoef, calc_ndcg and calc_toprecall column by column, with NaN wherever
+    those raise (a single DMS_score_bin class, NaN scores). DMS_score_bin is 0/1. model_scores_bin defaults to the
+    scores binarized at their median; pass it to reuse the cutoffs of the full assay on a subset of its mutants.
+    """
+    y = np.asarray(DMS_score, dtype=float)
+    y_bin = np.asarray(DMS_score_bin, dtype=float)
+    S = np.asarray(model_scores, dtype=float).reshape(len(y), -1)
+    num_mutants, num_models = S.shape
+    has_nan = np.isnan(S).any(axis=0)
+    # Average ranks (ties share their mean rank), as used by spearmanr and the rank form of the AUC
+    ranks = rankdata(S, axis=0)
+    ranks[:, has_nan] = np.nan
+    metrics = {'Spearman': _column_correlation(rankdata(y), ranks) if not np.isnan(y).any() else np.full(num_models, np.nan)}
+
+    positives = y_bin == 1
+    num_positives, num_negatives = positives.sum(), (y_bin == 0).sum()
+    if np.isnan(y_bin).any() or num_positives == 0 or num_negatives == 0:
+        metrics['AUC'] = np.full(num_models, np.nan)
+    else:
+        metrics['AUC'] = (ranks[positives].sum(axis=0) - num_positives * (num_positives + 1) / 2) / (num_positives * num_negatives)
+
+    if model_scores_bin is None:
+        with np.errstate(invalid='ignore'):
+            model_scores_bin = S >= np.nanmedian(S, axis=0) if num_mutants else S.astype(bool)
+    predicted = np.asarray(model_scores_bin, dtype=bool).reshape(num_mutants, -1)
+    if np.isnan(y_bin).any():
+        metrics['MCC'] = np.full(num_models, np.nan)
+    else:
+        # sklearn's multiclass formulation, which is 0 whenever a prediction or the truth has a single class
+        true_sum = np.array([num_mutants - num_positives, num_positives], dtype=float)
+        predicted_positives = predicted.sum(axis=0).astype(float)
+        true_positives = (predicted & positives[:, None]).sum(axis=0)
+        true_negatives = (~predicted & ~positives[:, None]).sum(axis=0)
+        cov_ytyp = (true_positives + true_negatives) * num_mutants - (true_sum[0] * (num_mutants - predicted_positives) + true_sum[1] * predicted_positives)
+        cov_ypyp = num_mutants ** 2 - ((num_mutants - predicted_positives) ** 2 + predicted_positives ** 2)
+        cov_ytyt = num_mutants ** 2 - (true_sum ** 2).sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            metrics['MCC'] = np.where(cov_ypyp * cov_ytyt == 0, 0.0, cov_ytyp / np.sqrt(cov_ytyt * cov_ypyp))
+
+    k = int(np.floor(num_mutants * (top / 100)))
+    gains = (y - np.min(y)) / (np.max(y) - np.min(y)) if num_mutants else y
+    model_ranks = np.argsort(np.argsort(-S, axis=0), axis=0) + 1
+    in_top_k = (model_ranks <= k) & (gains != 0)[:, None]
+    dcg = np.where(in_top_k, gains[:, None] / np.log2(model_ranks + 1), 0.0).sum(axis=0)
+    ideal_ranks = np.argsort(np.argsort(-gains)) + 1
+    ideal_in_top_k = (ideal_ranks <= k) & (gains != 0)
+    idcg = (gains[ideal_in_top_k] / np.log2(ideal_ranks[ideal_in_top_k] + 1)).sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['NDCG'] = np.where(in_top_k.any(axis=0), dcg / idcg, 0.0)
+
+    top_true = y >= np.percentile(y, 100 - top)
+    top_model = S >= np.percentile(S, 100 - top, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['Top_recall'] = (top_true[:, None] & top_model).sum(axis=0) / top_true.sum()
+    return metrics
@@ -22,7 +22,7 @@ python ../../proteingym/baselines/EVE/compute_evol_indices_DMS.py \
     --output_evol_indices_location ${output_score_folder} \
     --num_samples_compute_evol_indices ${num_samples_compute_evol_indices} \
     --batch_size ${batch_size} \
-    --aggregation_method "full" \
+    --aggregation_method "batched" \
     --threshold_focus_cols_frac_gaps 1 \
     --skip_existing \
     --MSA_weights_location ${DMS_MSA_weights_folder} \
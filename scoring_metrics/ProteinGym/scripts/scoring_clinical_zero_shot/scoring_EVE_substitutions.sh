@@ -24,7 +24,7 @@ python ../../proteingym/baselines/EVE/compute_evol_indices_DMS.py \
     --output_scores_folder ${output_scores_folder} \
     --num_samples_compute_evol_indices ${num_samples_compute_evol_indices} \
     --batch_size ${batch_size} \
-    --aggregation_method "full" \
+    --aggregation_method "batched" \
     --threshold_focus_cols_frac_gaps 1 \
     --MSA_weights_location ${clinical_MSA_weights_folder_subs} \
     --random_seeds ${random_seeds} 
@@ -7,7 +7,7 @@ import json
 import time
 import shutil
 import tempfile
-import tmscoring
+from .tm_score import get_tm
 import pandas as pd
 from pgen.utils import parse_fasta
 from .util import add_metric
@@ -180,7 +180,7 @@ def predict_AFstructure(target_dir, reference_pdb, binder_sequence=None, save_di
         mean_ptm = np.mean(ptm)
         mean_iptm = np.mean(iptm)
 
-        tmscore = tmscoring.get_tm(reference_pdb, pdbname)
+        tmscore = get_tm(reference_pdb, pdbname)
 
         print(f'pae: {mean_pae:.3f} ptm: {mean_ptm:.3f} plddt: {mean_plddt:.3f} tmscore: {tmscore:.3f} time: {end_time:.3f}') if verbose == 1 else None
         
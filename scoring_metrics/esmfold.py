@@ -1,5 +1,5 @@
 from string import ascii_uppercase, ascii_lowercase
-import hashlib, re, os
+import hashlib, re, os, json
 import numpy as np
 import torch
 from jax.tree_util import tree_map
@@ -7,7 +7,7 @@ import matplotlib.pyplot as plt
 from scipy.special import softmax
 import gc
 import tqdm
-import tmscoring
+from .tm_score import get_tm_batch
 from glob import glob
 import pandas as pd
 from pgen.utils import parse_fasta
@@ -37,15 +37,17 @@ if not os.path.isfile(f'{model_name}'):
   print(f"Downloading {model_weights}...")
   os.system(f"aria2c -q -x 16 https://colabfold.steineggerlab.workers.dev/esm/{model_weights} -d {os.path.dirname(os.path.realpath(__file__))}")
 
-def parse_output(output):
-  pae = (output["aligned_confidence_probs"][0] * np.arange(64)).mean(-1) * 31
-  plddt = output["plddt"][0,:,1]
+ESMFOLD_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "tmp/esmfold_cache")
+
+def parse_output(output, index=0):
+  pae = (output["aligned_confidence_probs"][index] * np.arange(64)).mean(-1) * 31
+  plddt = output["plddt"][index,:,1]
 
   bins = np.append(0,np.linspace(2.3125,21.6875,63))
-  sm_contacts = softmax(output["distogram_logits"],-1)[0]
+  sm_contacts = softmax(output["distogram_logits"],-1)[index]
   sm_contacts = sm_contacts[...,bins<8].sum(-1)
-  xyz = output["positions"][-1,0,:,1]
-  mask = output["atom37_atom_exists"][0,:,1] == 1
+  xyz = output["positions"][-1,index,:,1]
+  mask = output["atom37_atom_exists"][index,:,1] == 1
   o = {"pae":pae[mask,:][:,mask],
        "plddt":plddt[mask],
        "sm_contacts":sm_contacts[mask,:][:,mask],
@@ -57,7 +59,83 @@ alphabet_list = list(ascii_uppercase+ascii_lowercase)
 
 id_list, plddt_list, tm_list = [], [], []
 
-def predict_structure(target_dir, reference_pdb, save_dir=None, copies=1, num_recycles=3, keep_pdb=False, verbose=0, collect_output=True, results=None):
+def clean_sequence(sequence, copies=1):
+  sequence = re.sub("[^A-Z:]", "", sequence.replace("/",":").upper())
+  sequence = re.sub(":+",":",sequence)
+  sequence = re.sub("^[:]+","",sequence)
+  sequence = re.sub("[:]+$","",sequence)
+  if copies == "" or copies <= 0: copies = 1
+  return ":".join([sequence] * copies)
+
+def weights_identity(path=model_name):
+  """Name, size and modification time of the weights file: a new or re-downloaded model does not reuse cached structures."""
+  if not os.path.isfile(path):
+    return os.path.basename(path)
+  stat = os.stat(path)
+  return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def structure_cache_path(sequence, num_recycles, chain_linker=25, cache_dir=ESMFOLD_CACHE_DIR):
+  """Content-addressed location of the folding outputs of a (cleaned) sequence with the given model and settings."""
+  return os.path.join(cache_dir, get_hash(f"{weights_identity()}_{sequence}_r{num_recycles}_l{chain_linker}"))
+
+def load_cached_structure(cache_path):
+  if not os.path.isfile(os.path.join(cache_path, "metrics.json")):
+    return None
+  with open(os.path.join(cache_path, "metrics.json")) as fh:
+    return json.load(fh)
+
+def chunk_size_for_batch(batch_len, max_len, max_pair_tokens=700**2):
+  # optimized for Tesla T4: smaller chunks once the pair representation of the batch exceeds a 700-residue monomer
+  return 64 if batch_len * max_len**2 > max_pair_tokens else 128
+
+def length_buckets(sequences, max_tokens_per_batch=1024):
+  """Groups sequences into length-sorted batches whose padded size (batch_len x max_len) fits max_tokens_per_batch."""
+  batches, batch, batch_max_len = [], [], 0
+  for sequence in sorted(sequences, key=len):
+    seq_len = len(sequence.replace(":", ""))
+    if len(batch) > 0 and (len(batch) + 1) * max(batch_max_len, seq_len) > max_tokens_per_batch:
+      batches.append(batch)
+      batch, batch_max_len = [], 0
+    batch.append(sequence)
+    batch_max_len = max(batch_max_len, seq_len)
+  if len(batch) > 0:
+    batches.append(batch)
+  return batches
+
+def fold_batch(model, sequences, num_recycles=3, chain_linker=25, cache_dir=ESMFOLD_CACHE_DIR):
+  """Folds a padded batch of sequences and writes the PDB, PAE and pLDDT/pTM of each one to the structure cache."""
+  max_len = max(len(sequence.replace(":", "")) for sequence in sequences)
+  model.set_chunk_size(chunk_size_for_batch(len(sequences), max_len))
+  try:
+    output = model.infer(sequences,
+                        num_recycles=num_recycles,
+                        chain_linker="X"*chain_linker,
+                        residue_index_offset=512)
+  except torch.cuda.OutOfMemoryError:
+    if len(sequences) == 1:
+      raise
+    # Split the batch and retry both halves
+    torch.cuda.empty_cache()
+    half = len(sequences) // 2
+    fold_batch(model, sequences[:half], num_recycles, chain_linker, cache_dir)
+    fold_batch(model, sequences[half:], num_recycles, chain_linker, cache_dir)
+    return
+
+  pdb_strs = model.output_to_pdb(output)
+  output = tree_map(lambda x: x.cpu().numpy(), output)
+  for index, sequence in enumerate(sequences):
+    O = parse_output(output, index)
+    ptm = float(output["ptm"][index])
+    plddt = float(O["plddt"].mean())
+    cache_path = structure_cache_path(sequence, num_recycles, chain_linker=chain_linker, cache_dir=cache_dir)
+    os.makedirs(cache_path, exist_ok=True)
+    np.savetxt(os.path.join(cache_path, "structure.pae.txt"),O["pae"],"%.3f")
+    with open(os.path.join(cache_path, "structure.pdb"),"w") as out:
+      out.write(pdb_strs[index])
+    with open(os.path.join(cache_path, "metrics.json"),"w") as out:
+      json.dump({"ptm": ptm, "plddt": plddt}, out)
+
+def predict_structure(target_dir, reference_pdb, save_dir=None, copies=1, num_recycles=3, keep_pdb=False, verbose=0, collect_output=True, results=None, cache_dir=ESMFOLD_CACHE_DIR, max_tokens_per_batch=1024, chain_linker=25):
 
   save_to_drive = save_dir
   if save_to_drive is not None:
@@ -68,104 +146,67 @@ def predict_structure(target_dir, reference_pdb, save_dir=None, copies=1, num_re
   # target_dir = args.target_dir
   fasta_dir = glob(target_dir+"/*.fasta")
   assert len(fasta_dir) > 0, f"No fasta files found in {target_dir}"
-  data_df = pd.DataFrame()
+  names, seqs = [], []
   for fasta_path in fasta_dir:
     batch = fasta_path.split('/')[-3]
     sampling = fasta_path.split('/')[-2]
     # print(f'Batch: {batch}/{sampling}')
     name, seq = parse_fasta(fasta_path, return_names=True, clean="unalign")
-    df = pd.DataFrame(list(zip(name, seq)), columns = ["name", "seq"])
-    data_df = pd.concat([data_df, df], ignore_index=True)
-    # data_df = data_df.head()
+    names += list(name)
+    seqs += list(seq)
+  data_df = pd.DataFrame({"name": names, "seq": seqs})
   print(f'Total sequences: {len(data_df)}')
 
-  model = torch.load(f'{model_name}')
-  model.eval().cuda().requires_grad_(False)
-  model_name_ = model_name
-
-  for _, row in tqdm.tqdm(data_df.iterrows(), total=len(data_df), desc=f"Predicting {batch}/{sampling}"):
-    start_time = time.time()
-    jobname = row['name']
-    jobname = re.sub(r'\W+', '', jobname)[:50]
-
-    sequence = row['seq']
-    sequence = re.sub("[^A-Z:]", "", sequence.replace("/",":").upper())
-    sequence = re.sub(":+",":",sequence)
-    sequence = re.sub("^[:]+","",sequence)
-    sequence = re.sub("[:]+$","",sequence)
-    copies = 1 
-    if copies == "" or copies <= 0: copies = 1
-    sequence = ":".join([sequence] * copies)
-    num_recycles = 3
-    chain_linker = 25
-
-    if save_to_drive is not None:
-      ID = path_prefix+'/'+batch+'/'+sampling+'/'+jobname
-    else:
-      tmpfolder = tempfile.mkdtemp()
-      ID = tmpfolder+'/'+batch+'/'+sampling+'/'+jobname
-    destination_path = '/'.join(ID.split('/')[:-1])
-    # print(f'Destination path: {destination_path}')
-
-    seqs = sequence.split(":")
-    lengths = [len(s) for s in seqs]
-    length = sum(lengths)
-    # print("length",length)
-
-    u_seqs = list(set(seqs))
-    if len(seqs) == 1: mode = "mono"
-    elif len(u_seqs) == 1: mode = "homo"
-    else: mode = "hetero"
-
-    if "model" not in dir() or model_name != model_name_:
-      if "model" in dir():
-        # delete old model from memory
-        del model
-        gc.collect()
-        if torch.cuda.is_available():
-          torch.cuda.empty_cache()
-
-    # optimized for Tesla T4
-    if length > 700:
-      model.set_chunk_size(64)
-    else:
-      model.set_chunk_size(128)
-
-    torch.cuda.empty_cache()
-    output = model.infer(sequence,
-                        num_recycles=num_recycles,
-                        chain_linker="X"*chain_linker,
-                        residue_index_offset=512)
-
-    pdb_str = model.output_to_pdb(output)[0]
-    output = tree_map(lambda x: x.cpu().numpy(), output)
-    ptm = output["ptm"][0]
-    plddt = output["plddt"][0,...,1].mean()
-
-    id_list.append(ID.split('/')[-1]) if not collect_output else None
-    plddt_list.append(plddt) if not collect_output else add_metric(results, ID.split('/')[-1], "pLDDT", plddt)
-    end_time = time.time() - start_time
-
-    O = parse_output(output)
+  copies = 1
+  num_recycles = 3
+  data_df["jobname"] = data_df["name"].map(lambda x: re.sub(r'\W+', '', x)[:50])
+  data_df["sequence"] = data_df["seq"].map(lambda x: clean_sequence(x, copies))
+
+  # Fold only the unique sequences that are not in the structure cache yet
+  unique_sequences = list(dict.fromkeys(data_df["sequence"]))
+  to_fold = [sequence for sequence in unique_sequences if load_cached_structure(structure_cache_path(sequence, num_recycles, chain_linker=chain_linker, cache_dir=cache_dir)) is None]
+  print(f'Unique sequences: {len(unique_sequences)} ({len(unique_sequences) - len(to_fold)} cached)')
+
+  if len(to_fold) > 0:
+    model = torch.load(f'{model_name}')
+    model.eval().requires_grad_(False)
+    if torch.cuda.is_available():
+      model.cuda()
+    for sequences in tqdm.tqdm(length_buckets(to_fold, max_tokens_per_batch), desc=f"Predicting {batch}/{sampling}"):
+      start_time = time.time()
+      fold_batch(model, sequences, num_recycles=num_recycles, chain_linker=chain_linker, cache_dir=cache_dir)
+      print(f'Folded {len(sequences)} sequences (max length {max(len(s) for s in sequences)}) in {time.time() - start_time:.3f}s') if verbose == 1 else None
+    del model
+    gc.collect()
+    if torch.cuda.is_available():
+      torch.cuda.empty_cache()
+
+  # TM Score of every unique structure against the reference in one batched call
+  tm_cache = dict(zip(unique_sequences, get_tm_batch(reference_pdb, [os.path.join(structure_cache_path(sequence, num_recycles, chain_linker=chain_linker, cache_dir=cache_dir), "structure.pdb") for sequence in unique_sequences])))
+
+  for _, row in data_df.iterrows():
+    jobname = row['jobname']
+    sequence = row['sequence']
+    cache_path = structure_cache_path(sequence, num_recycles, chain_linker=chain_linker, cache_dir=cache_dir)
+    metrics = load_cached_structure(cache_path)
+    ptm, plddt = metrics["ptm"], metrics["plddt"]
+    pdb_file = os.path.join(cache_path, "structure.pdb")
+
+    id_list.append(jobname) if not collect_output else None
+    plddt_list.append(plddt) if not collect_output else add_metric(results, jobname, "pLDDT", plddt)
+
+    tmscore = tm_cache[sequence]
+    tm_list.append(tmscore) if not collect_output else add_metric(results, jobname, "TM-score", tmscore)
 
     # Saving pdbs
-    os.system(f"mkdir -p {ID}")
-    prefix = f"{ID}/ptm{ptm:.3f}_r{num_recycles}_default"
-    np.savetxt(f"{prefix}.pae.txt",O["pae"],"%.3f")
-    with open(f"{prefix}.pdb","w") as out:
-      out.write(pdb_str)
-
-    # TM Score
-    # reference_pdb = args.reference_pdb
-    pdb_file = f"{prefix}.pdb"
-    tmscore = tmscoring.get_tm(reference_pdb, pdb_file)
-    tm_list.append(tmscore) if not collect_output else add_metric(results, ID.split('/')[-1], "TM-score", tmscore)
-
-    # delete pdb folder
-    if not keep_pdb:
-      shutil.rmtree(tmpfolder) if save_dir is None else shutil.rmtree(destination_path)
-
-    print(f'ptm: {ptm:.3f} plddt: {plddt:.3f} tmscore: {tmscore:.3f} time: {end_time:.3f}') if verbose == 1 else None
+    if keep_pdb:
+      ID = path_prefix+'/'+batch+'/'+sampling+'/'+jobname if save_to_drive is not None else tempfile.mkdtemp()+'/'+batch+'/'+sampling+'/'+jobname
+      os.makedirs(ID, exist_ok=True)
+      prefix = f"{ID}/ptm{ptm:.3f}_r{num_recycles}_default"
+      shutil.copyfile(os.path.join(cache_path, "structure.pae.txt"), f"{prefix}.pae.txt")
+      shutil.copyfile(pdb_file, f"{prefix}.pdb")
+
+    print(f'ptm: {ptm:.3f} plddt: {plddt:.3f} tmscore: {tmscore:.3f}') if verbose == 1 else None
 
   if not collect_output:
     results_df = pd.DataFrame(list(zip(id_list, plddt_list, tm_list)), columns = ["seq_name", "plddt", "tm_score"])
@@ -28,15 +28,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import os
-import pathlib
-import subprocess
-import pandas as pd
+import hashlib
 from .util import add_metric, identify_mutation
 from pgen.utils import parse_fasta
 
 import numpy as np
 import torch
-import tempfile
 from scipy import linalg
 
 try:
@@ -46,28 +43,103 @@ except ImportError:
     def tqdm(x):
         return x
 
-def get_ESM1v_predictions(targets_fasta, device = 'cuda:0'):
-    pred_arr = []
+FID_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "tmp/FID_reference_cache")
+FID_FEATURE_NAME = "esm1v_repr"
+
+_esm1v_sampler = None
+
+def get_ESM1v_sampler(device='cuda:0'):
+    """Loads ESM-1v once per process and keeps it resident for subsequent FID passes."""
+    global _esm1v_sampler
+    if _esm1v_sampler is None:
+        from pgen.esm_sampler import ESM_sampler
+        from pgen import models
+        _esm1v_sampler = ESM_sampler(models.ESM1v(), device="gpu" if str(device).startswith("cuda") else "cpu")
+    return _esm1v_sampler
+
+
+def iter_ESM1v_activations(targets_fasta, device='cuda:0', batch_size=16):
+    """Yields (batch_size x 1) activation blocks for the sequences of a fasta file.
+
+    Activations are the same per-sequence ESM-1v representation scores as
+    `likelihood_esm.py --masking_off --use_repr`, computed in-process.
+    Sequences are length-sorted before batching to limit padding.
+    """
     if device=='cuda:0':
         torch.cuda.empty_cache()
-    with tempfile.TemporaryDirectory() as output_dir:
-        outfile = output_dir + "/esm_results.tsv"
-        try:
-            proc = subprocess.run(['python', os.path.join(os.path.dirname(os.path.realpath(__file__)), "protein_gibbs_sampler/src/pgen/likelihood_esm.py"), "-i", targets_fasta, "-o", outfile, "--model", "esm1v", "--masking_off", "--score_name", "score", "--device", "gpu", "--use_repr"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-            # print(proc.stdout)
-            # print(proc.stderr)
-        except subprocess.CalledProcessError as e:
-            print(e.stdout.decode('utf-8'))
-            print(e.stderr.decode('utf-8'))
-            raise e
-            
-        df = pd.read_table(outfile)
-        print("done")
-        for i, row in df.iterrows():
-            p = row['score']
-            pred_arr.append(p)
-    # print(pred_arr)
-    return pred_arr
+    sampler = get_ESM1v_sampler(device)
+    seqs = sorted(parse_fasta(targets_fasta, return_names=False, clean="unalign"), key=len)
+    for start in tqdm(range(0, len(seqs), batch_size)):
+        batch = seqs[start:start+batch_size]
+        scores = sampler.log_likelihood_batch(batch, with_masking=False, batch_size=len(batch), use_repr=True)
+        yield np.array([[score] for score, _ in scores], dtype=np.float64)
+
+
+def get_ESM1v_predictions(targets_fasta, device = 'cuda:0'):
+    return [float(act) for block in iter_ESM1v_activations(targets_fasta, device) for act in block[:,0]]
+
+
+class ActivationStatistics:
+    """Running mean and covariance of activation vectors.
+
+    Batches are folded in with Chan et al.'s pairwise update (a blocked
+    Welford), so the full activation matrix is never held in memory and
+    statistics from several passes can be merged.
+    """
+    def __init__(self, dims=None, block_size=4096):
+        self.n = 0
+        self.block_size = block_size
+        self.mean = None if dims is None else np.zeros(dims)
+        self.m2 = None if dims is None else np.zeros((dims, dims))
+
+    def _merge(self, n_b, mean_b, m2_b):
+        if self.n == 0:
+            self.n, self.mean, self.m2 = n_b, mean_b, m2_b
+            return
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * (n_b / n)
+        self.m2 = self.m2 + m2_b + np.outer(delta, delta) * (self.n * n_b / n)
+        self.n = n
+
+    def update(self, activations):
+        activations = np.asarray(activations, dtype=np.float64)
+        activations = activations.reshape(len(activations), -1)
+        for start in range(0, len(activations), self.block_size):
+            block = activations[start:start+self.block_size]
+            mean_b = block.mean(axis=0)
+            centered = block - mean_b
+            self._merge(len(block), mean_b, centered.T @ centered)
+        return self
+
+    def merge(self, other):
+        if other.n > 0:
+            self._merge(other.n, other.mean.copy(), other.m2.copy())
+        return self
+
+    @property
+    def covariance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else np.full_like(self.m2, np.nan)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, n=self.n, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        stats = cls()
+        stats.n, stats.mean, stats.m2 = int(data["n"]), data["mean"], data["m2"]
+        return stats
+
+
+def fasta_content_hash(fasta_file, feature_name=FID_FEATURE_NAME):
+    """Hash of the (unaligned) sequences of a fasta file, independent of sequence names."""
+    h = hashlib.sha1(feature_name.encode())
+    for seq in parse_fasta(fasta_file, return_names=False, clean="unalign"):
+        h.update(seq.encode())
+        h.update(b"\n")
+    return h.hexdigest()
 
 
 def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
@@ -76,7 +148,8 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     and X_2 ~ N(mu_2, C_2) is
             d^2 = ||mu_1 - mu_2||^2 + Tr(C_1 + C_2 - 2*sqrt(C_1*C_2)).
 
-    Stable version by Dougal J. Sutherland.
+    Tr(sqrt(C_1*C_2)) is computed as Tr(sqrt(A*C_2*A)) with A = sqrt(C_1),
+    which only needs symmetric eigendecompositions.
 
     Params:
     -- mu1   : Numpy array containing the activations of a layer of the
@@ -98,9 +171,6 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     sigma1 = np.atleast_2d(sigma1)
     sigma2 = np.atleast_2d(sigma2)
 
-    # sigma1 = np.nan_to_num(sigma1)
-    # sigma2 = np.nan_to_num(sigma2)
-
     assert mu1.shape == mu2.shape, \
         'Training and test mean vectors have different lengths'
     assert sigma1.shape == sigma2.shape, \
@@ -108,41 +178,45 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
 
     diff = mu1 - mu2
 
-    # Product might be almost singular
-    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
-    if not np.isfinite(covmean).all():
+    if not (np.isfinite(sigma1).all() and np.isfinite(sigma2).all()):
         msg = ('fid calculation produces singular product; '
                'adding %s to diagonal of cov estimates') % eps
         print(msg)
-        offset = np.eye(sigma1.shape[0]) * eps
-        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
+        sigma1 = np.nan_to_num(sigma1) + np.eye(sigma1.shape[0]) * eps
+        sigma2 = np.nan_to_num(sigma2) + np.eye(sigma2.shape[0]) * eps
 
-    # Numerical error might give slight imaginary component
-    if np.iscomplexobj(covmean):
-        if not np.allclose(np.diagonal(covmean).imag, 0, atol=1e-3):
-            m = np.max(np.abs(covmean.imag))
-            raise ValueError('Imaginary component {}'.format(m))
-        covmean = covmean.real
-
-    tr_covmean = np.trace(covmean)
+    # Symmetrize to remove round-off asymmetry before the eigendecompositions
+    sigma1 = (sigma1 + sigma1.T) / 2
+    sigma2 = (sigma2 + sigma2.T) / 2
+    eigvals1, eigvecs1 = linalg.eigh(sigma1)
+    sqrt_sigma1 = (eigvecs1 * np.sqrt(np.clip(eigvals1, 0, None))) @ eigvecs1.T
+    product = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+    tr_covmean = np.sqrt(np.clip(linalg.eigvalsh((product + product.T) / 2), 0, None)).sum()
 
     return (diff.dot(diff) + np.trace(sigma1)
             + np.trace(sigma2) - 2 * tr_covmean)
 
 
-def calculate_activation_statistics(files, orig_seq, device='cuda:0', num_workers=8):
-    # act = get_activations(files, model, batch_size, dims, device, num_workers)
-    # act = get_ESM1v_predictions(files, orig_seq, device)
-    act = get_ESM1v_predictions(files, device)
-    mu = np.mean(act, axis=0)
-    sigma = np.cov(act, rowvar=False)
-    return mu, sigma
+def calculate_activation_statistics(files, orig_seq, device='cuda:0', num_workers=8, cache_dir=FID_CACHE_DIR):
+    """Streams ESM-1v activations of a fasta file into running statistics, cached by fasta content hash."""
+    cache_file = os.path.join(cache_dir, f"{fasta_content_hash(files)}.npz") if cache_dir is not None else None
+    if cache_file is not None and os.path.exists(cache_file):
+        print(f"Loading activation statistics from {cache_file}")
+        stats = ActivationStatistics.load(cache_file)
+    else:
+        stats = ActivationStatistics()
+        for block in iter_ESM1v_activations(files, device):
+            stats.update(block)
+        if cache_file is not None:
+            stats.save(cache_file)
+            print(f"Saved activation statistics to {cache_file}")
+    return stats.mean, stats.covariance
 
 
 def compute_statistics_of_path(path, orig_seq, device, num_workers=1):
     if type(path) is list and len(path) > 0:
-        m = np.mean(path, axis=0)
-        s = np.cov(path, rowvar=False)
+        stats = ActivationStatistics().update(path)
+        m, s = stats.mean, stats.covariance
     else:
         m, s = calculate_activation_statistics(path, orig_seq, device, num_workers)
 
@@ -151,38 +225,20 @@ def compute_statistics_of_path(path, orig_seq, device, num_workers=1):
 
 def calculate_fid_given_paths(target_files, reference_files, name, orig_seq, device='cuda:0', num_workers=8):
     """Calculates the FID of two paths"""
-    # print(f'target_files:{target_files}, reference_files:{reference_files}')
     # Target statistics
     if type(target_files) is list and len(target_files) > 0:
         print(f'Using precomputed target statistics for {name}')
-        m1, s1 = compute_statistics_of_path(target_files, device, num_workers)
+        m1, s1 = compute_statistics_of_path(target_files, orig_seq, device, num_workers)
     else:
         print(f'Calculating target statistics for {target_files} (Source: {target_files})')
-        m1, s1 = calculate_activation_statistics(target_files, orig_seq, device, num_workers)
-
-    # Reference statistics
-    reference_name = pathlib.Path(name).stem
-    cache_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), f"tmp/FID_reference_cache/{reference_name}.npy")
-    if os.path.exists(cache_file):
-        print(f"Loading reference statistics from {cache_file}")
-        m2, s2 = np.load(cache_file, allow_pickle=True)
-    else:
-        print(f"Calculating reference statistics for {reference_name} (Source: {reference_files})")
-        m2, s2 = compute_statistics_of_path(reference_files, orig_seq, device, num_workers)
-        
-        save_dir = os.path.dirname(cache_file)
-        os.makedirs(save_dir, exist_ok=True)
-        np.save(cache_file, (m2, s2))
-        print(f"Saved reference statistics to {cache_file}")
+        # Only reference statistics are reused, so targets are not written to the cache
+        m1, s1 = calculate_activation_statistics(target_files, orig_seq, device, num_workers, cache_dir=None)
+
+    # Reference statistics (cached by fasta content hash)
+    print(f"Reference statistics for {name} (Source: {reference_files})")
+    m2, s2 = compute_statistics_of_path(reference_files, orig_seq, device, num_workers)
+
     # Calculate FID
     fid_value = calculate_frechet_distance(m1, s1, m2, s2) * 1000
 
-    # result = {"fid": fid_value}
-    # df = pd.DataFrame.from_dict(result, orient="index")
-    # df.to_csv(os.path.join(os.path.dirname(os.path.realpath(__file__)),"fid.csv"))
-    # return 
-    # for _, row in df.iterrows():
-    #     results["FID"] = row["fid"]
-    # del df
-    # print("FID: ", fid_value)
     return fid_value
@@ -2,8 +2,8 @@ from typing import Iterator, List, Tuple
 import torch
 import math
 import random
-from tqdm import trange
-from pgen.esm_sampler import generate_step
+from tqdm import trange, tqdm
+from pgen.esm_sampler import generate_step, sample_tokens
 import sys
 
 ESM_MSA_ALLOWED_AMINO_ACIDS = "-ACDEFGHIKLMNPQRSTVWY"
@@ -70,7 +70,14 @@ class ESM_MSA_sampler():
 
 
     def get_init_msa(self, seed_msa, max_len, batch_size = 1):
-        """ Get initial msa by padding seed_seq with masks, and then tokenizing."""
+        """ Get initial msa by padding seed_seq with masks, and then tokenizing.
+            seed_msa can also be a LongTensor of tokens (sequences, sequence_len) without <cls>, such as MSAStore.tokens, which skips the text processing.
+        """
+        if torch.is_tensor(seed_msa):
+            tokens = torch.full((seed_msa.shape[0], max(max_len, seed_msa.shape[1]) + 1), self.model.alphabet.mask_idx, dtype=torch.long)
+            tokens[:, 0] = self.model.alphabet.cls_idx
+            tokens[:, 1:seed_msa.shape[1] + 1] = seed_msa
+            return tokens.unsqueeze(0).repeat(batch_size, 1, 1)
 
         padded_msa = list()
         for i, seq in enumerate(seed_msa):
@@ -151,37 +158,65 @@ class ESM_MSA_sampler():
             burn_in: sample from the complete distribution for this many passes, then only take the highest probability amino acid for the remaining passes.
             target_index: index of the sequence to mask and sample.
         """
-        with torch.no_grad():
-            sequence_length = len(seed_msa[0])
-            cuda = self.cuda
+        return self.generate_chains([seed_msa], steps=steps, passes=passes, burn_in=burn_in, target_index=target_index, k=k)[0]
 
-            positions = list(range(1,sequence_length+1)) #shift by 1 to account for cls token at beginning of sequence
-
-            batch = self.get_init_msa(seed_msa, len(seed_msa[0]), 1)
-            batch = batch.cuda() if cuda else batch
-
-            for pass_num in range(passes): # a pass is a complete pass over the sequence
-                random.shuffle(positions)
-                step_indices = partition(positions, steps)
-                for step_i in range(len(step_indices)): # a step is one forward call of the model, where a subset of the sequence has been masked
-                    #print(step_indices[step_i])
-                    self.mask_target_indexes_single(batch, step_indices[step_i], -1)
-                    #print(self.untokenize_batch(batch))
-                    # shape: (batch, sequences, sequence_len, alphabet_digits)
-                    forward_pass = self.model.model(batch)["logits"]
-                    batch_index = 0
-                    for aa_position in step_indices[step_i]: #position
-                        idx = generate_step(forward_pass[batch_index][target_index],
-                            gen_idx=aa_position, 
-                            top_k=k, 
-                            temperature=None,
-                            sample=(pass_num < burn_in),
-                            valid_idx=self.valid_aa_idx)
-                        batch[batch_index][target_index][aa_position] = idx
-                    
-        return self.untokenize_batch(batch)[target_index]
-        
-    
+    def generate_chains(self, seed_msas, steps=10, passes=3, burn_in=1, target_index=-1, k=1, temperature=None, batch_size=16, show_progress_bar=False, on_batch=None):
+        """
+            Batched generate_single: run one independent Gibbs chain per seed MSA, several chains per forward call.
+            seed_msas: a list of MSAs (lists of aligned sequences, or token tensors from MSAStore.tokens). Repeat an MSA to run several chains on it,
+                    its context is tokenized once and shared by its chains.
+            batch_size: how many chains to run at one time. Chains are grouped by MSA shape (number of sequences and length), so batches are not padded.
+            steps, passes, burn_in, target_index, k: as in generate_single.
+            temperature: as in generate.
+            on_batch: if given, called as on_batch(chain_indices, sequences) as soon as each batch is done, so results can be written out
+                    while later batches run. Batches follow the shape groups, not the order of seed_msas.
+
+            returns the generated target sequences, in the order of seed_msas.
+        """
+        with torch.no_grad():
+            contexts = dict() # id(msa) -> (index, tokens)
+            chain_context = list()
+            for msa in seed_msas:
+                if id(msa) not in contexts:
+                    contexts[id(msa)] = (len(contexts), self.get_init_msa(msa, len(msa[0]), 1)[0])
+                chain_context.append(contexts[id(msa)][0])
+            context_tokens = [tokens for _, tokens in contexts.values()]
+
+            by_shape = dict()
+            for chain, context in enumerate(chain_context):
+                by_shape.setdefault(tuple(context_tokens[context].shape), list()).append(chain)
+            batches = [group[start:start + batch_size] for group in by_shape.values() for start in range(0, len(group), batch_size)]
+
+            out = [None] * len(seed_msas)
+            for chains in tqdm(batches, disable=(not show_progress_bar)):
+                batch_contexts = sorted({chain_context[chain] for chain in chains})
+                shared = torch.stack([context_tokens[context] for context in batch_contexts])
+                # shape: (chains, sequences, sequence_len), each chain indexes its shared context
+                batch = shared[[batch_contexts.index(chain_context[chain]) for chain in chains]]
+                batch = batch.cuda() if self.cuda else batch
+                self.gibbs_chains(batch, steps, passes, burn_in, target_index, k, temperature)
+                sequences = self.untokenize_batch(batch[:, [target_index]].tolist())
+                for chain, sequence in zip(chains, sequences):
+                    out[chain] = sequence
+                if on_batch is not None:
+                    on_batch(chains, sequences)
+        return out
+
+    def gibbs_chains(self, batch, steps, passes, burn_in, target_index=-1, k=1, temperature=None):
+        """
+            Gibbs sampling of the target row of every MSA of batch (chains, sequences, sequence_len), in place.
+            In every pass, each chain splits its positions into steps random bins; every step masks one bin per chain and samples all of them in one draw.
+        """
+        sequence_length = batch.shape[2] - 1 # <cls> at the beginning of every sequence
+        target = batch[:, target_index] # a view, so updating it updates batch
+        for pass_num in range(passes): # a pass is a complete pass over the sequence
+            positions = torch.argsort(torch.rand(batch.shape[0], sequence_length, device=batch.device), dim=1) + 1 #shift by 1 to account for cls token at beginning of sequence
+            for step_indices in torch.tensor_split(positions, min(steps, sequence_length), dim=1): # a step is one forward call of the model
+                target.scatter_(1, step_indices, self.model.alphabet.mask_idx)
+                # shape: (chains, sequence_len, alphabet_digits)
+                logits = self.model.model(batch)["logits"][:, target_index]
+                logits = logits.gather(1, step_indices.unsqueeze(-1).expand(-1, -1, logits.shape[-1]))
+                target.scatter_(1, step_indices, sample_tokens(logits, temperature=temperature, top_k=k, sample=(pass_num < burn_in), valid_idx=self.valid_aa_idx))
 
     def generate(self, n_samples, seed_msa, batch_size=1, in_order=False, max_len=None, leader_length=0,
                  leader_length_percent=None, top_k=0, temperature=None, num_iters=10, burnin=float('inf'),
@@ -264,27 +299,19 @@ class ESM_MSA_sampler():
                                                                           num_sequences)
                     else:
                         target_indexes = self.get_target_indexes_all_positions(batch_size, indexes, num_sequences)
+                    # shape: (batch, sequences, positions)
+                    target_indexes = torch.tensor([[list(target) for target in msa] for msa in target_indexes], dtype=torch.long, device=batch.device)
                     if mask:
-                        self.mask_target_indexes(batch, target_indexes)
+                        batch.scatter_(2, target_indexes, self.model.alphabet.mask_idx)
 
                     # shape: (batch, sequences, sequence_len, alphabet_digits)
                     out = self.model.model(batch)["logits"]
-
-                    for batch_index in range(batch_size): #msa
-                        for sequence_index in range(num_sequences): #sequence
-                            for kk in target_indexes[batch_index][sequence_index]: #position
-                                
-                                idx = generate_step(out[batch_index][sequence_index],
-                                                    gen_idx=kk, # +1 is because of start token
-                                                    top_k=top_k,
-                                                    temperature=temperature,
-                                                    sample=(ii < burnin),
-                                                    valid_idx=self.valid_aa_idx)
-                                batch[batch_index][sequence_index][kk] = idx
+                    logits = out.gather(2, target_indexes.unsqueeze(-1).expand(-1, -1, -1, out.shape[-1]))
+                    batch.scatter_(2, target_indexes, sample_tokens(logits, temperature=temperature, top_k=top_k, sample=(ii < burnin), valid_idx=self.valid_aa_idx))
                 if generation_round == (n_generation_rounds - 1): #last batch, so don't take all of them, just take enough to get to n_samples
-                    sequences += self.untokenize_batch(batch)[0:n_samples - len(sequences)]
+                    sequences += self.untokenize_batch(batch.tolist())[0:n_samples - len(sequences)]
                 else:
-                    sequences += self.untokenize_batch(batch)
+                    sequences += self.untokenize_batch(batch.tolist())
             return sequences
 
     def mask_target_indexes(self, batch, target_indexes):
@@ -413,11 +440,9 @@ class ESM_MSA_sampler():
 
                     num_samples_for_this_msa = int(min(mask_distance, len(original_string)))
 
-                    # I think you can do this with a pytorch/numpy broadcast of a slice from tokens
-                    all_samples_for_this_msa = [original_msas.copy() for _ in range(num_samples_for_this_msa)]
-
                     masked_idx = set()
-                    _, _, all_samples_for_this_msa_tokens = self.model.batch_converter(all_samples_for_this_msa)
+                    # the tokens of this msa without the padding of the batch, repeated once per masking
+                    all_samples_for_this_msa_tokens = tokens[msa_idx:msa_idx + 1, :len(original_msas), :msa_range_end[msa_idx] - end_modifier].cpu().repeat(num_samples_for_this_msa, 1, 1)
                     # all_samples_for_this_msa_tokens = all_samples_for_this_msa_tokens.cuda() if self.cuda else all_samples_for_this_msa_tokens
 
                     for i_sample in range(num_samples_for_this_msa):
@@ -3,7 +3,7 @@ import torch
 import torch.nn.functional as F
 import math
 import random
-from tqdm import trange
+from tqdm import trange, tqdm
 
 def generate_step(out, gen_idx, temperature=None, top_k=0, sample=False, valid_idx=None):
     """ Generate a word from from out[gen_idx]
@@ -45,6 +45,30 @@ def generate_step(out, gen_idx, temperature=None, top_k=0, sample=False, valid_i
     return torch.tensor(valid_idx[idx])
 
 
+def sample_tokens(logits, temperature=None, top_k=0, sample=False, valid_idx=None):
+    """ Vectorized generate_step: draw one token for every row of logits in a single categorical draw.
+
+    args:
+        - logits (torch.Tensor): logits of size (..., vocab_size), e.g. (batch, masked positions, vocab_size)
+        - temperature, top_k, sample, valid_idx: as in generate_step
+    returns:
+        tensor of size (...) containing the selected token indexes
+    """
+    if valid_idx is not None:
+        valid_idx = torch.as_tensor(valid_idx, device=logits.device)
+        logits = logits.index_select(-1, valid_idx)
+    if temperature is not None:
+        logits = logits / temperature
+
+    if sample or (top_k <= 0) or (top_k > logits.shape[-1]):
+        top_k = logits.shape[-1]
+
+    kth_vals, kth_idx = logits.topk(top_k, dim=-1)
+    choice = torch.distributions.categorical.Categorical(logits=kth_vals).sample()
+    idx = kth_idx.gather(-1, choice.unsqueeze(-1)).squeeze(-1)
+    return valid_idx[idx] if valid_idx is not None else idx
+
+
 ESM_ALLOWED_AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
 
 class ESM_sampler():
@@ -97,15 +121,17 @@ class ESM_sampler():
             raise (Exception("Invalid input character: " + ",".join(input_chars-valid_chars) + f" in {input_chars}"))
         return cleaned_seq
 
-    def get_init_seq(self, seed_seq, max_len, batch_size = 1):
-        """ Get initial sequence by padding seed_seq with masks """
+    def get_init_seq(self, seed_seq, max_len, batch_size = 1, seeds_in_order = False):
+        """ Get initial sequence by padding seed_seq with masks.
+            If seed_seq is a list, seeds are drawn at random for each batch member, or taken in order if seeds_in_order is set.
+        """
         # In the BertGen paper they talk about padding with random sequence. I'm not sure that's a good idea. S.R.J.
         # Also, that code was commented out in the BertGen repo. So they probably didn't think was a good idea either.
 
 
 
         if isinstance(seed_seq, list): # input is an array, convert it to a string
-            batch = random.choices(seed_seq, k=batch_size)
+            batch = list(seed_seq[:batch_size]) if seeds_in_order else random.choices(seed_seq, k=batch_size)
             for i, seed in enumerate(batch):
                 remaining_len = max_len - len(seed)
                 batch[i] = (str(i), self.clean_seed_seq(seed) + "<mask>" * remaining_len)
@@ -122,7 +148,7 @@ class ESM_sampler():
         return tokens
 
     def generate(self, n_samples, seed_seq, batch_size=1, in_order=False, max_len=None, leader_length=0, leader_length_percent=None, top_k=0, temperature=None, num_iters=10,  burnin=float('inf'),
-                            mask=True, num_positions=0, num_positions_percent=None, indexes=None, rollover_from_start=False, show_progress_bar=True):
+                            mask=True, num_positions=0, num_positions_percent=None, indexes=None, rollover_from_start=False, show_progress_bar=True, seeds_in_order=False):
         """ generate sequences
 
             n_samples: number of sequences to output
@@ -142,6 +168,7 @@ class ESM_sampler():
             indexes: positions of the input sequence to modify. 1-indexed, if None then all positions after the leader.
 
             show_progress_bar: if True then show a progress bar corresponding to the number of batches that need to be processed. Default: True.
+            seeds_in_order: if seed_seq is a list, use its sequences in order for the members of each batch instead of drawing them at random (see generate_from_seeds).
 
             #### Examples #####
             seed = "MTSENPLLALREKISALDEKLLALLAERRELAVEVGKAKLLSHRPVRDIDRERDLLERLITLGKAHHLDAHYITRLFQLIIEDSVLTQQALLQQH"
@@ -194,7 +221,7 @@ class ESM_sampler():
 
             for batch_n in trange(n_batches, disable=(not show_progress_bar)):
 
-                batch = self.get_init_seq(seed_seq, max_len, batch_size)
+                batch = self.get_init_seq(seed_seq, max_len, batch_size, seeds_in_order)
                 batch = batch.cuda() if cuda else batch
 
                 indexes, last_i = self.calculate_indexes(indexes, leader_length, max_len, rollover_from_start)
@@ -213,28 +240,48 @@ class ESM_sampler():
                     else:
                         target_indexes = [indexes] * batch_size
 
-                    if mask:
-                        self.mask_target_indexes(batch, target_indexes)
-
-                    out = self.model.model(batch)["logits"]
-
-                    for batch_index in range(batch_size):
-                        for kk in target_indexes[batch_index]:
-                            idx = generate_step(out[batch_index],
-                                                gen_idx=kk,
-                                                top_k=top_k,
-                                                temperature=temperature,
-                                                sample=(ii < burnin),
-                                                valid_idx=self.valid_aa_idx)
-
-                            batch[batch_index][kk] = idx
+                    # shape: (batch, positions)
+                    target_indexes = torch.tensor([list(target) for target in target_indexes], dtype=torch.long, device=batch.device)
+                    self.gibbs_step(batch, target_indexes, mask, top_k, temperature, sample=(ii < burnin))
 
                 if batch_n == (n_batches - 1): #last batch, so maybe don't take all of them, just take enough to get to n_samples
-                    sequences += self.untokenize_batch(batch, self.model.alphabet.prepend_bos, self.model.alphabet.append_eos)[0:n_samples - len(sequences)]
+                    sequences += self.untokenize_batch(batch.tolist(), self.model.alphabet.prepend_bos, self.model.alphabet.append_eos)[0:n_samples - len(sequences)]
                 else:
-                    sequences += self.untokenize_batch(batch, self.model.alphabet.prepend_bos, self.model.alphabet.append_eos)
+                    sequences += self.untokenize_batch(batch.tolist(), self.model.alphabet.prepend_bos, self.model.alphabet.append_eos)
             return sequences
 
+    def gibbs_step(self, batch, target_indexes, mask=True, top_k=0, temperature=None, sample=True):
+        """ One forward call: mask (optionally) the target positions of every sequence, then sample all of them at once.
+
+            batch: tokens (batch, sequence_len), modified in place
+            target_indexes: LongTensor (batch, positions) of token positions to resample
+        """
+        if mask:
+            batch.scatter_(1, target_indexes, self.model.alphabet.mask_idx)
+        out = self.model.model(batch)["logits"]
+        logits = out.gather(1, target_indexes.unsqueeze(-1).expand(-1, -1, out.shape[-1]))
+        batch.scatter_(1, target_indexes, sample_tokens(logits, temperature=temperature, top_k=top_k, sample=sample, valid_idx=self.valid_aa_idx))
+
+    def generate_from_seeds(self, seeds, batch_size=1, show_progress_bar=True, **kwargs):
+        """ generate one sequence from each seed sequence.
+
+            seeds: a list of seed sequences (they can be repeated to generate several sequences from the same seed)
+            batch_size: how many sequences to run at one time. Seeds are grouped by length, so that a batch is not padded.
+            kwargs: as in generate (max_len and the percents are applied to each seed's length)
+
+            returns the generated sequences, in the order of seeds.
+        """
+        by_length = dict()
+        for i, seed in enumerate(seeds):
+            by_length.setdefault(len(seed), list()).append(i)
+        batches = [group[start:start + batch_size] for group in by_length.values() for start in range(0, len(group), batch_size)]
+        out = [None] * len(seeds)
+        for batch_ids in tqdm(batches, disable=(not show_progress_bar)):
+            generated = self.generate(len(batch_ids), [seeds[i] for i in batch_ids], batch_size=len(batch_ids), show_progress_bar=False, seeds_in_order=True, **kwargs)
+            for i, sequence in zip(batch_ids, generated):
+                out[i] = sequence
+        return out
+
     def get_random_target_index(self, batch_size, indexes, num_positions):
         target_indexes = list()
         for b in range(batch_size):
@@ -2,7 +2,8 @@ import argparse
 import textwrap
 from pgen.esm_msa_sampler import ESM_MSA_sampler
 from pgen import models
-from pgen.utils import parse_fasta, RawAndDefaultsFormatter, SequenceSubsetter, add_to_msa, write_sequential_fasta, generate_alignment, run_phmmer
+from pgen.msa_store import MSAStore
+from pgen.utils import parse_fasta, RawAndDefaultsFormatter, add_to_msa, write_sequential_fasta, generate_alignment, run_phmmer
 import sys
 import tqdm
 import tempfile
@@ -41,8 +42,9 @@ def main(input_h, output_h, masking_off, sampler, reference_msa_handle, delete_i
         for i in range(len(names)):
             renamed_reference_sequences[names[i]] = sequences[i]
 
-    else:
-        seq_msa = SequenceSubsetter.subset(reference_msa, alignment_size, strategy=subset_strategy, random_seed=subset_random_seed)
+    else: # parse and encode the reference once, subsets are drawn as row indexes
+        reference_store = MSAStore(reference_msa)
+        seq_msa = reference_store.sequences(reference_store.subset(alignment_size, strategy=subset_strategy, random_seed=subset_random_seed))
 
     # tmp_seq_list = list()
     tmp_name_list = list()
@@ -63,7 +65,7 @@ def main(input_h, output_h, masking_off, sampler, reference_msa_handle, delete_i
 
         else:
             if redraw:
-                seq_msa = SequenceSubsetter.subset(reference_msa, alignment_size, strategy=subset_strategy, random_seed=subset_random_seed)
+                seq_msa = reference_store.sequences(reference_store.subset(alignment_size, strategy=subset_strategy, random_seed=subset_random_seed))
                 if subset_random_seed is not None:
                     subset_random_seed += 1000000
 
@@ -117,9 +119,9 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, default="esm_msa1", choices={"esm_msa1"},
                         help="which model to use.")
     parser.add_argument("--batch_size", type=int, default=1, help="Batch size for sampling (msa instances per iteration).")
-    parser.add_argument("--subset_strategy", default="random", choices={"random","in_order","top_hits"}, help="How to subset the reference alignment to get it to the desired size. random: draw randombly, in_order: take the sequences listed first in the reference alignment, top_hits: run phmmer for each query against the reference sequences and use the top hits as the reference.")
+    parser.add_argument("--subset_strategy", default="random", choices={"random","in_order","weighted","max_diverse","top_hits"}, help="How to subset the reference alignment to get it to the desired size. random: draw randombly, in_order: take the sequences listed first in the reference alignment, weighted: draw randomly with probabilities proportional to the sequence weights, max_diverse: greedily take the sequences with the largest Hamming distance to those already taken, top_hits: run phmmer for each query against the reference sequences and use the top hits as the reference.")
     parser.add_argument("--subset_random_seed", default=None, type=int, help="Seed to start the random batch subsetter at. The seed will increment by 1000000 after each draw.")
-    parser.add_argument("--redraw", action='store_true', default=False, help="If subset_strategy is random, by default a single random draw will be used for all calculations. If redraw is set, then a new random draw of reference sequences will be done for each target sequence.")
+    parser.add_argument("--redraw", action='store_true', default=False, help="If subset_strategy is random or weighted, by default a single random draw will be used for all calculations. If redraw is set, then a new random draw of reference sequences will be done for each target sequence.")
     parser.add_argument("--unaligned_queries",  action='store_true', default=False, help="If the input sequences are unaligned or come from a different alignment than the reference msa, then use muscle profile to add each sequence to the reference alignment.")
     parser.add_argument("--count_gaps",  action='store_true', default=False, help="If true then average the log likelihoods over the coding positions as well as the gap positions. By default, gap positions are not considered in the sums and averages.")
     parser.add_argument("--mask_distance",  type=int, default=None, help="If set, then multiple positions will be masked at a time, with (mask_distance - 1) non-masked positions between each masked position. This will make the likelihood calculations faster. Default: mask positions one at a time.")
@@ -130,8 +132,8 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    if args.redraw and args.subset_strategy == 'in_order':
-        raise ValueError(f"redraw is set, but subset_strategy is 'in_order', so all the draws will be the same. That's probably not what you're trying to do.")
+    if args.redraw and args.subset_strategy in {'in_order', 'max_diverse'}:
+        raise ValueError(f"redraw is set, but subset_strategy is '{args.subset_strategy}', so all the draws will be the same. That's probably not what you're trying to do.")
 
     mask_distance = float("inf")
     if args.mask_distance is not None:
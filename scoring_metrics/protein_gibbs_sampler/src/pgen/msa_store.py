@@ -0,0 +1,194 @@
+import hashlib
+import numpy as np
+import torch
+from pgen.utils import parse_fasta
+from pgen.esm_msa_sampler import ESM_MSA_ALLOWED_AMINO_ACIDS
+
+GAP_CODE = 0 # ESM_MSA_ALLOWED_AMINO_ACIDS[0] == "-"
+
+def _encoding_table():
+    table = np.full(256, 255, dtype=np.uint8)
+    for code, c in enumerate(ESM_MSA_ALLOWED_AMINO_ACIDS):
+        table[ord(c)] = code
+        table[ord(c.lower())] = code
+    return table
+
+ENCODING_TABLE = _encoding_table()
+
+def encode_sequences(sequences):
+    """
+        sequences: a list of aligned protein sequence strings, each of the same length, containing characters from ESM_MSA_ALLOWED_AMINO_ACIDS (any case).
+
+        returns a uint8 matrix (len(sequences), sequence_len) of indexes into ESM_MSA_ALLOWED_AMINO_ACIDS (0 is a gap).
+    """
+    sequence_length = len(sequences[0]) if len(sequences) > 0 else 0
+    if any(len(seq) != sequence_length for seq in sequences):
+        raise ValueError("Sequences of the MSA are not all the same length")
+    raw = np.frombuffer("".join(sequences).encode("ascii", errors="replace"), dtype=np.uint8).reshape(len(sequences), sequence_length)
+    codes = ENCODING_TABLE[raw]
+    if (codes == 255).any():
+        invalid = {chr(c) for c in np.unique(raw[codes == 255])}
+        raise ValueError("Invalid input character: " + ",".join(sorted(invalid)))
+    return codes
+
+
+class MSAStore():
+    """
+        An alignment parsed and encoded once, with sequence weights and identities to the query (first sequence) computed on demand.
+        Subsets are returned as arrays of row indexes, which can be turned into ESM-MSA tokens (tokens) or strings (sequences) without text processing.
+
+        store = MSAStore.from_fasta("reference.a2m")
+        idx = store.subset(32, strategy="weighted", keep_first=True, random_seed=1)
+        seed_msa = store.tokens(idx, sampler.model.alphabet)  # can be passed to ESM_MSA_sampler.generate as seed_msa
+    """
+    subset_strategies = {"random", "in_order", "weighted", "top_hits", "max_diverse"}
+    _cache = dict()
+
+    def __init__(self, sequences, names=None, theta=0.2):
+        """
+            sequences: a list of aligned sequences of the same length, the first one being the query.
+            names: optional list of sequence names.
+            theta: sequences more than (1 - theta) identical are neighbours when computing weights (1 / number of neighbours).
+        """
+        self.matrix = encode_sequences(sequences)
+        self.names = list(names) if names is not None else [str(i) for i in range(len(sequences))]
+        self.theta = theta
+        self._weights = None
+        self._identity_to_query = None
+        self._token_tables = dict()
+        self._max_diverse_subsets = dict()
+
+    @classmethod
+    def from_fasta(cls, filename, clean="upper", theta=0.2):
+        """
+            Parses a fasta/a2m file (see utils.parse_fasta for clean), or returns the store of a previous call with the same file content and arguments.
+        """
+        with open(filename, "rb") as fasta_in:
+            content = fasta_in.read()
+        key = (hashlib.sha1(content).hexdigest(), clean, theta)
+        if key not in cls._cache:
+            names, sequences = parse_fasta(filename, return_names=True, clean=clean)
+            cls._cache[key] = cls(sequences, names, theta)
+        return cls._cache[key]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def sequence_length(self):
+        return self.matrix.shape[1]
+
+    @property
+    def weights(self):
+        """
+            EVE-style sequence weights: 1 / number of sequences whose identity over the non-gap positions of the sequence is above 1 - theta.
+            Sequences without residues get a weight of 0.
+        """
+        if self._weights is None:
+            one_hot = np.zeros((len(self), self.sequence_length, len(ESM_MSA_ALLOWED_AMINO_ACIDS) - 1), dtype=np.float32) # gaps are not counted as matches
+            rows, columns = np.nonzero(self.matrix != GAP_CODE)
+            one_hot[rows, columns, self.matrix[rows, columns] - 1] = 1.0
+            one_hot = one_hot.reshape(len(self), -1)
+            num_residues = one_hot.sum(axis=1)
+            neighbours = np.zeros(len(self), dtype=np.float64)
+            block_size = max(1, 2**25 // max(len(self), 1))
+            for start in range(0, len(self), block_size):
+                matches = one_hot[start:start + block_size] @ one_hot.T
+                identity = matches / np.maximum(num_residues[start:start + block_size, None], 1)
+                neighbours[start:start + block_size] = (identity > 1 - self.theta).sum(axis=1)
+            self._weights = np.where(num_residues > 0, 1.0 / np.maximum(neighbours, 1), 0.0)
+        return self._weights
+
+    @property
+    def neff(self):
+        return float(self.weights.sum())
+
+    def identity_to(self, query):
+        """
+            for every sequence of the store, the fraction of the non-gap positions of query (a uint8 encoded row, or an aligned sequence string) it matches.
+        """
+        if isinstance(query, str):
+            query = encode_sequences([query])[0]
+        residues = query != GAP_CODE
+        return ((self.matrix == query) & residues).sum(axis=1) / max(int(residues.sum()), 1)
+
+    @property
+    def identity_to_query(self):
+        if self._identity_to_query is None:
+            self._identity_to_query = self.identity_to(self.matrix[0])
+        return self._identity_to_query
+
+    def subset(self, n, strategy="random", keep_first=False, random_seed=None, query=None):
+        """
+            input:
+                n: how many sequences to draw. If n >= len(self), all sequences are returned (in the order of the strategy).
+                strategy:
+                    "random": draw uniformly without replacement
+                    "in_order": the first n sequences
+                    "weighted": draw without replacement with probabilities proportional to the sequence weights
+                    "top_hits": the n sequences most identical to query
+                    "max_diverse": greedily add the sequence with the largest summed Hamming distance to the sequences selected so far,
+                                   starting from the first sequence, as in the ESM-MSA paper.
+                keep_first: if set, then the first sequence is always the first index of the output and n-1 others are drawn.
+                random_seed: provided to the random number generator ("random" and "weighted").
+                query: aligned sequence string for "top_hits", by default the first sequence of the store.
+
+            output: an int64 array of row indexes.
+        """
+        if strategy not in self.subset_strategies:
+            raise ValueError(f"subset strategy {strategy} not recognized, must be one of {self.subset_strategies}")
+        if n <= 0:
+            return np.zeros(0, dtype=np.int64)
+        first = [0] if keep_first else []
+        candidates = np.arange(1 if keep_first else 0, len(self))
+        n = min(n - len(first), len(candidates))
+        rng = np.random.default_rng(random_seed)
+
+        if strategy == "in_order":
+            chosen = candidates[:n]
+        elif strategy == "random":
+            chosen = rng.permutation(candidates)[:n]
+        elif strategy == "weighted":
+            weights = self.weights[candidates]
+            n = min(n, int(np.count_nonzero(weights)))
+            chosen = rng.choice(candidates, size=n, replace=False, p=weights / weights.sum()) if n > 0 else candidates[:0]
+        elif strategy == "top_hits":
+            identity = self.identity_to(query) if query is not None else self.identity_to_query
+            chosen = candidates[np.argsort(-identity[candidates], kind="stable")[:n]]
+        elif strategy == "max_diverse": # deterministic, so computed once per size
+            if (n, keep_first) not in self._max_diverse_subsets:
+                self._max_diverse_subsets[(n, keep_first)] = self._max_diverse(candidates, n)
+            chosen = self._max_diverse_subsets[(n, keep_first)]
+        return np.concatenate([np.array(first, dtype=np.int64), chosen.astype(np.int64)])
+
+    def _max_diverse(self, candidates, n):
+        rows = self.matrix[candidates]
+        summed_distance = (rows != self.matrix[0]).sum(axis=1).astype(np.int64)
+        available = np.ones(len(candidates), dtype=bool)
+        chosen = np.zeros(n, dtype=np.int64)
+        for i in range(n):
+            best = int(np.argmax(np.where(available, summed_distance, -1)))
+            chosen[i] = candidates[best]
+            available[best] = False
+            summed_distance += (rows != self.matrix[chosen[i]]).sum(axis=1)
+        return chosen
+
+    def sequences(self, indexes):
+        """aligned sequence strings of the rows in indexes."""
+        letters = np.frombuffer(ESM_MSA_ALLOWED_AMINO_ACIDS.encode("ascii"), dtype=np.uint8)
+        return [row.tobytes().decode("ascii") for row in letters[self.matrix[indexes]]]
+
+    def tokens(self, indexes, alphabet, extra_sequences=()):
+        """
+            ESM-MSA tokens of the rows in indexes, followed by extra_sequences (aligned strings, e.g. the queries to score).
+
+            returns a LongTensor (sequences, sequence_len) without the <cls> column, which ESM_MSA_sampler.get_init_msa accepts as seed_msa.
+        """
+        table = self._token_tables.get(id(alphabet))
+        if table is None:
+            table = torch.tensor([alphabet.get_idx(c) for c in ESM_MSA_ALLOWED_AMINO_ACIDS], dtype=torch.long)
+            self._token_tables[id(alphabet)] = table
+        codes = self.matrix[indexes]
+        if len(extra_sequences) > 0:
+            codes = np.concatenate([codes, encode_sequences(list(extra_sequences))])
+        return table[torch.from_numpy(codes.astype(np.int64))]
@@ -5,7 +5,6 @@ from pgen import models
 from pgen.utils import write_sequential_fasta, parse_fasta, unalign, add_gaps_back, RawAndDefaultsFormatter
 from pathlib import Path
 import random
-from tqdm import trange
 
 model_map = {"esm1b":models.ESM1b, "esm6":models.ESM6, "esm12":models.ESM12, "esm34":models.ESM34}
 
@@ -23,14 +22,11 @@ def main(input_h, output_p, args):
                 name = line[0]
                 line_args = eval(line[1])
                 seeds = parse_fasta(line[2], clean=None)
-                sequences = list()
-                for out_seq_i in trange(args.num_output_sequences):
-                    seed = random.choice(seeds)
-                    seed, gap_mask = unalign(seed)
-                    generated_sequence = sampler.generate(n_samples=1, seed_seq=seed, batch_size=args.batch_size, show_progress_bar=False, **line_args)[0]
-                    if args.keep_gap_positions:
-                        generated_sequence = add_gaps_back(generated_sequence, gap_mask)
-                    sequences += [generated_sequence]
+                chosen_seeds = [unalign(random.choice(seeds)) for out_seq_i in range(args.num_output_sequences)]
+                # one batched run over all the requested sequences, seeds of the same length share a batch
+                sequences = sampler.generate_from_seeds([seed for seed, _ in chosen_seeds], batch_size=args.batch_size, **line_args)
+                if args.keep_gap_positions:
+                    sequences = [add_gaps_back(generated_sequence, gap_mask) for generated_sequence, (_, gap_mask) in zip(sequences, chosen_seeds)]
                 write_sequential_fasta( output_p / (name + ".fasta"), sequences )
 
 
@@ -60,7 +56,7 @@ if __name__ == "__main__":
             formatter_class=RawAndDefaultsFormatter)
     parser.add_argument("-o", default=".", help="a directory to save the outputs to.")
     parser.add_argument("-i", default=None, help="tab separated file where the columns are as follows: [sample name] \\t [dict of arguments for the sampler] \\t [path to fasta file].")
-    parser.add_argument("--batch_size", type=int, default=1, choices={1,}, help="batch size for sampling (sequences per iteration). Must be 1. This might change in the future.")
+    parser.add_argument("--batch_size", type=int, default=16, help="batch size for sampling (sequences per iteration). Seeds of the same length are generated together.")
     parser.add_argument("--num_output_sequences", type=int, default=1, help="total number of sequences to generate.")
     parser.add_argument("--device", type=str, default="cpu", choices={"cpu","gpu"}, help="cpu or gpu")
     parser.add_argument("--model", type=str, default="esm1b", choices={"esm1b", "esm6", "esm12", "esm34"}, help="which model to use")
@@ -1,7 +1,8 @@
 import argparse, textwrap
 from pgen.esm_msa_sampler import ESM_MSA_sampler
 from pgen import models
-from pgen.utils import write_sequential_fasta, parse_fasta, SequenceSubsetter, RawAndDefaultsFormatter
+from pgen.msa_store import MSAStore
+from pgen.utils import write_sequential_fasta, RawAndDefaultsFormatter
 from pathlib import Path
 import sys
 from tqdm import trange
@@ -32,7 +33,7 @@ def main(input_h, output_p, args):
                 name = line[0]
                 line_args = eval(line[1])
 
-                input_msa = parse_fasta(line[2], clean=clean_flag)
+                input_msa = MSAStore.from_fasta(line[2], clean=clean_flag) # parsed and encoded once per file content
                 alignment_size = args.alignment_size
                 if alignment_size == sys.maxsize:
                     alignment_size = len(input_msa)
@@ -40,7 +41,8 @@ def main(input_h, output_p, args):
                 batches = math.ceil(args.num_output_sequences / alignment_size )
                 sequences = list()
                 for i in trange(batches):
-                    batch_msa = SequenceSubsetter.subset(input_msa, alignment_size, args.keep_first_sequence, args.subset_strategy)
+                    batch_idx = input_msa.subset(alignment_size, args.subset_strategy, args.keep_first_sequence)
+                    batch_msa = input_msa.tokens(batch_idx, gibbs_sampler.model.alphabet)
                     sequences += gibbs_sampler.generate(n_samples=len(batch_msa), seed_msa=batch_msa, batch_size=args.batch_size, show_progress_bar=False, **line_args)
                 write_sequential_fasta( output_p / (name + ".fasta"), sequences[0:args.num_output_sequences] )
             else:
@@ -84,7 +86,7 @@ if __name__ == "__main__":
     parser.add_argument("--alignment_size", type=int, default=sys.maxsize, help="Sample this many sequences from the input alignment before doing gibbs sampling, recommended values are 32-256. Default: the entire input alignment.")
 
     parser.add_argument("--keep_first_sequence", action='store_true', default=False, help="If set, then keep the first sequence and sample the rest according to subset_strategy.")
-    parser.add_argument("--subset_strategy", default="random", choices=SequenceSubsetter.subset_strategies, help="How to subset the input alignment to get it to the desired size.")
+    parser.add_argument("--subset_strategy", default="random", choices=MSAStore.subset_strategies, help="How to subset the input alignment to get it to the desired size (see MSAStore.subset).")
 
     args = parser.parse_args()
 
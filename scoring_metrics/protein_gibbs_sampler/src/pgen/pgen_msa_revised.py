@@ -13,7 +13,7 @@ import warnings
 model_map = {"esm_msa1":models.ESM_MSA1}
 
 
-def pgen_msa(templates_path, references_path, output_path, seqs_per_template, keep_identical, steps, passes, burn_in, device, model, alignment_size, ep, op, top_k):
+def pgen_msa(templates_path, references_path, output_path, seqs_per_template, keep_identical, steps, passes, burn_in, device, model, alignment_size, ep, op, top_k, batch_size=16):
     clean_flag = 'unalign'
 
     template_seqs = list(zip(*parse_fasta(templates_path, clean=clean_flag, return_names=True)))
@@ -32,28 +32,34 @@ def pgen_msa(templates_path, references_path, output_path, seqs_per_template, ke
     del names
     del sequences
 
-    with tqdm(total=len(template_seqs) * seqs_per_template) as pbar:
-        with open(output_path,"w") as outfile:
-            for template_name, template_seq in template_seqs:
-                hits = run_phmmer(template_seq,reference_db_path)
-                unaligned_seqs = list()
-                for hit in hits:
-                    
-                    if reference_seqs[hit] != template_seq or keep_identical:
-                        unaligned_seqs.append(reference_seqs[hit])
-                    if len(unaligned_seqs) == alignment_size -1:
-                        break
-                unaligned_seqs.append(template_seq)
-                if len(unaligned_seqs) < alignment_size:
-                    warnings.warn(f"Warning: fewer than {alignment_size -1} hits found for template seq {template_name}")
-
-                _, new_alignment = generate_alignment({"1": unaligned_seqs}, ep=ep, op=op) #mafft should preserve the order of sequences
-                
-                for i in range(seqs_per_template):
-                    new_seq = gibbs_sampler.generate_single(new_alignment, steps=steps, passes=passes, burn_in=burn_in, k=top_k)
-                    new_seq = new_seq.replace("-","")
-                    print(f">{i}_{template_name}\n{new_seq}", file=outfile, flush=True)
-                    pbar.update(1)
+    alignments = list()
+    for template_name, template_seq in tqdm(template_seqs, desc="aligning"):
+        hits = run_phmmer(template_seq,reference_db_path)
+        unaligned_seqs = list()
+        for hit in hits:
+            
+            if reference_seqs[hit] != template_seq or keep_identical:
+                unaligned_seqs.append(reference_seqs[hit])
+            if len(unaligned_seqs) == alignment_size -1:
+                break
+        unaligned_seqs.append(template_seq)
+        if len(unaligned_seqs) < alignment_size:
+            warnings.warn(f"Warning: fewer than {alignment_size -1} hits found for template seq {template_name}")
+
+        _, new_alignment = generate_alignment({"1": unaligned_seqs}, ep=ep, op=op) #mafft should preserve the order of sequences
+        alignments.append(new_alignment)
+
+    # every sequence of every template is an independent chain, all of them are sampled in one batched run
+    chains = [alignment for alignment in alignments for i in range(seqs_per_template)]
+    with open(output_path,"w") as outfile:
+        # each batch is written as soon as it is done, so an interrupted run keeps what it has generated
+        def write_batch(chain_indices, new_seqs):
+            for chain_i, new_seq in zip(chain_indices, new_seqs):
+                template_name = template_seqs[chain_i // seqs_per_template][0]
+                new_seq = new_seq.replace("-","")
+                print(f">{chain_i % seqs_per_template}_{template_name}\n{new_seq}", file=outfile)
+            outfile.flush()
+        gibbs_sampler.generate_chains(chains, steps=steps, passes=passes, burn_in=burn_in, k=top_k, batch_size=batch_size, show_progress_bar=True, on_batch=write_batch)
 
     os.unlink(reference_db_path)
 
@@ -77,10 +83,11 @@ def main(argv):
     parser.add_argument("--device", type=str, default="cpu", choices={"cpu","gpu"}, help="cpu or gpu") #TODO: allow specification of particular CUDA devices.
     parser.add_argument("--model", type=str, default="esm_msa1", choices={"esm_msa1"}, help="which model to use")
     parser.add_argument("--alignment_size", type=int, default=32, help="how many sequences (template plus references) should be in the alignments used for sequence generation.")
+    parser.add_argument("--batch_size", type=int, default=16, help="how many sequences to generate at one time. Templates whose alignments have the same shape are sampled together.")
 
     args = parser.parse_args(argv)
 
-    pgen_msa(args.templates, args.references, args.o, args.seqs_per_template, args.keep_identical, args.steps, args.passes, args.burn_in, args.device, args.model, args.alignment_size, args.ep, args.op, args.top_k)
+    pgen_msa(args.templates, args.references, args.o, args.seqs_per_template, args.keep_identical, args.steps, args.passes, args.burn_in, args.device, args.model, args.alignment_size, args.ep, args.op, args.top_k, args.batch_size)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -1,5 +1,36 @@
+import argparse
 import pytest
+import torch
+import esm
+from esm.model.msa_transformer import MSATransformer
+from esm.model.esm2 import ESM2
 
 @pytest.fixture
 def mock_no_gpu(monkeypatch):
-    monkeypatch.setattr("torch.cuda.is_available", lambda: False)
\ No newline at end of file
+    monkeypatch.setattr("torch.cuda.is_available", lambda: False)
+
+class TinyESM_MSA():
+    """A randomly initialised 2-layer MSA Transformer with the ESM-MSA alphabet, shaped like models.ESM_MSA1 (no download)."""
+    def __init__(self, seed=0):
+        self.alphabet = esm.Alphabet.from_architecture("MSA Transformer")
+        args = argparse.Namespace(layers=2, embed_dim=32, logit_bias=True, ffn_embed_dim=64, attention_heads=4, dropout=0.0,
+                                  attention_dropout=0.0, activation_dropout=0.0, max_tokens=2**14, max_positions=1024, embed_positions_msa=True)
+        torch.manual_seed(seed)
+        self.model = MSATransformer(args, self.alphabet)
+        self.batch_converter = self.alphabet.get_batch_converter()
+
+@pytest.fixture(scope="session")
+def tiny_esm_msa():
+    return TinyESM_MSA()
+
+class TinyESM():
+    """A randomly initialised 2-layer ESM-2 with the ESM-1b alphabet, shaped like models.ESM6 (no download)."""
+    def __init__(self, seed=0):
+        self.alphabet = esm.Alphabet.from_architecture("ESM-1b")
+        torch.manual_seed(seed)
+        self.model = ESM2(num_layers=2, embed_dim=32, attention_heads=4, alphabet=self.alphabet)
+        self.batch_converter = self.alphabet.get_batch_converter()
+
+@pytest.fixture(scope="session")
+def tiny_esm():
+    return TinyESM()
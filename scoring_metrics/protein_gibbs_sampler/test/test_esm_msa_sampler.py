@@ -7,6 +7,7 @@ from io import StringIO
 from pgen.esm_msa_sampler import ESM_MSA_ALLOWED_AMINO_ACIDS
 import tempfile
 import pandas as pd
+import torch
 
 ####### Fixtures #######
 
@@ -21,6 +22,11 @@ def msa_sampler(esm_msa):
     return sampler
 
 
+@pytest.fixture(scope="module")
+def tiny_msa_sampler(tiny_esm_msa):
+    return esm_msa_sampler.ESM_MSA_sampler(tiny_esm_msa, device="cpu")
+
+
 ###### Tests #######
 
 def test_untokenize_batch(msa_sampler):
@@ -505,4 +511,50 @@ def test_generate_single(msa_sampler):
     # assert out[0][1:3] == "AA"
     # assert out[1][1:3] == "AC"
     # assert out[2][1:3] == "AA"
-    # assert out[3][1:3] == "AC"
\ No newline at end of file
+    # assert out[3][1:3] == "AC"
+
+
+def test_generate_chains_keeps_context_and_order(tiny_msa_sampler):
+    short_msa = ["ACDE", "AC-E", "ACDF"]
+    long_msa = ["ACDEFGHIKL", "ACDEFGHIKV", "WCDEFGHIKL"]
+    seed_msas = [short_msa, long_msa, short_msa, long_msa, short_msa]
+    out = tiny_msa_sampler.generate_chains(seed_msas, steps=3, passes=2, burn_in=1, batch_size=2)
+    assert [len(s) for s in out] == [4, 10, 4, 10, 4]
+    for s in out:
+        assert set(s) <= set(ESM_MSA_ALLOWED_AMINO_ACIDS)
+    assert short_msa == ["ACDE", "AC-E", "ACDF"]
+
+
+def test_generate_chains_reports_each_batch(tiny_msa_sampler):
+    short_msa = ["ACDE", "AC-E", "ACDF"]
+    long_msa = ["ACDEFGHIKL", "ACDEFGHIKV", "WCDEFGHIKL"]
+    reported = []
+    out = tiny_msa_sampler.generate_chains([short_msa, long_msa, short_msa, long_msa, short_msa], steps=3, passes=2, burn_in=1, batch_size=2,
+                                           on_batch=lambda chains, sequences: reported.append((list(chains), list(sequences))))
+    # batches follow the shape groups: the short MSAs (chains 0, 2, 4) in two batches, then the long ones
+    assert [chains for chains, _ in reported] == [[0, 2], [4], [1, 3]]
+    for chains, sequences in reported:
+        assert sequences == [out[chain] for chain in chains]
+
+
+def test_gibbs_chains_only_changes_the_target_row(tiny_msa_sampler):
+    batch = tiny_msa_sampler.get_init_msa(["ACDEFG", "ACDEFV", "WCDEFG"], 6, 4)
+    context = batch[:, :-1].clone()
+    tiny_msa_sampler.gibbs_chains(batch, steps=4, passes=2, burn_in=2)
+    assert torch.equal(batch[:, :-1], context)
+    assert (batch[:, -1, 0] == tiny_msa_sampler.model.alphabet.cls_idx).all()
+    assert not (batch[:, -1] == tiny_msa_sampler.model.alphabet.mask_idx).any()
+
+
+def test_generate_chains_greedy_is_deterministic(tiny_msa_sampler):
+    msa = ["ACDEFG", "ACDEFV", "WCDEFG"]
+    # with burn_in=0 and k=1 every step takes the most probable amino acid, so every chain of a pass follows the same path given the same bins
+    out = tiny_msa_sampler.generate_chains([msa] * 3, steps=1, passes=2, burn_in=0, k=1)
+    assert out[0] == out[1] == out[2]
+
+
+def test_generate_batch_vectorized(tiny_msa_sampler):
+    out = tiny_msa_sampler.generate(7, ["ACDE", "AC-E"], batch_size=2, num_iters=3, num_positions=2, show_progress_bar=False)
+    assert len(out) == 7
+    for s in out:
+        assert len(s) == 4 and set(s) <= set(ESM_MSA_ALLOWED_AMINO_ACIDS)
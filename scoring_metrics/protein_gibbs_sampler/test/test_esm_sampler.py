@@ -2,7 +2,7 @@ from statistics import mean
 import pytest
 import torch
 from pgen import models, esm_sampler
-from pgen.esm_sampler import generate_step, ESM_ALLOWED_AMINO_ACIDS
+from pgen.esm_sampler import generate_step, sample_tokens, ESM_ALLOWED_AMINO_ACIDS
 
 
 ####### Fixtures #######
@@ -18,6 +18,11 @@ def esm_sampler_fixture(esm6, scope="session"):
     return sampler
 
 
+@pytest.fixture(scope="module")
+def tiny_sampler(tiny_esm):
+    return esm_sampler.ESM_sampler(tiny_esm, device="cpu")
+
+
 
 ###### Tests #######
 
@@ -334,3 +339,43 @@ def test_likelihood_batch_handles_batch_sizes(esm_sampler_fixture, batch_size, m
     assert actual[0][0] == pytest.approx(mean(actual[0][1]))
     assert actual[1][0] == pytest.approx(expected[1])
     assert actual[1][0] == pytest.approx(mean(actual[1][1]))
+
+
+def test_sample_tokens_top_k_1_is_argmax():
+    logits = torch.tensor([[[0.0, 5.0, 1.0, 9.0], [3.0, 0.0, 2.0, 1.0]]])
+    assert sample_tokens(logits, top_k=1).tolist() == [[3, 0]]
+    assert sample_tokens(logits, top_k=1, valid_idx=[0, 1, 2]).tolist() == [[1, 0]]
+
+
+def test_sample_tokens_top_k_temperature():
+    torch.manual_seed(0)
+    logits = torch.tensor([0.0, 1.0, 2.0, -1.0, 0.5])
+    valid_idx = [1, 2, 4]
+    draws = sample_tokens(logits.expand(20000, 5), top_k=2, temperature=0.5, valid_idx=valid_idx)
+    assert set(draws.tolist()) == {1, 2} # the two most probable valid tokens
+    expected = torch.softmax(torch.tensor([2.0, 1.0]) / 0.5, 0)[0].item()
+    assert (draws == 2).float().mean().item() == pytest.approx(expected, abs=0.02)
+    assert set(sample_tokens(logits.expand(1000, 5), top_k=2, sample=True, valid_idx=valid_idx).tolist()) == set(valid_idx)
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(num_iters=2),
+    dict(num_iters=3, num_positions=2, in_order=True),
+    dict(num_iters=3, num_positions=2, mask=False, top_k=1, burnin=1),
+    dict(max_len=8, leader_length=5, num_positions=1, in_order=True, num_iters=3),
+])
+def test_generate_batched(tiny_sampler, kwargs):
+    out = tiny_sampler.generate(5, "ACDEF", batch_size=3, show_progress_bar=False, **kwargs)
+    assert len(out) == 5
+    for s in out:
+        assert len(s) == kwargs.get("max_len", 5)
+        assert set(s) <= set(ESM_ALLOWED_AMINO_ACIDS)
+    if "leader_length" in kwargs:
+        assert all(s.startswith("ACDEF") for s in out)
+
+
+def test_generate_from_seeds_groups_by_length(tiny_sampler):
+    seeds = ["ACDEF", "AC", "ACDEFGH", "ACDEF", "WW"]
+    out = tiny_sampler.generate_from_seeds(seeds, batch_size=2, num_iters=2, leader_length=1, show_progress_bar=False)
+    assert [len(s) for s in out] == [len(s) for s in seeds]
+    assert all(s[0] == seed[0] for s, seed in zip(out, seeds))
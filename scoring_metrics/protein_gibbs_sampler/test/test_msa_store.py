@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+import torch
+from pgen import esm_msa_sampler
+from pgen.msa_store import MSAStore, encode_sequences
+
+####### Fixtures #######
+
+@pytest.fixture(scope="function")
+def a2m_path(tmp_path):
+    path = tmp_path / "msa.a2m"
+    path.write_text(
+""">query
+ACDEFGHIKL
+>same
+ACDEFGHIKL
+>close
+ACDEFGHIKV
+>far
+WWWWWGHIKL
+>gappy
+--DEF...kl
+>other
+MNPQRSTVWY
+""")
+    return path
+
+@pytest.fixture(scope="module")
+def tiny_sampler(tiny_esm_msa):
+    return esm_msa_sampler.ESM_MSA_sampler(tiny_esm_msa, device="cpu")
+
+###### Tests #######
+
+def test_encode_sequences():
+    codes = encode_sequences(["A-c", "Y-A"])
+    assert codes.dtype == np.uint8
+    assert codes.tolist() == [[1, 0, 2], [20, 0, 1]]
+
+def test_encode_sequences_fails_if_non_standard_supplied():
+    with pytest.raises(ValueError, match="Invalid input character: X"):
+        encode_sequences(["AXA"])
+    with pytest.raises(ValueError):
+        encode_sequences(["AAA", "AA"])
+
+def test_from_fasta_is_cached_by_content(a2m_path):
+    store = MSAStore.from_fasta(a2m_path)
+    assert store.names[0] == "query"
+    assert store.sequences([4]) == ["--DEF---KL"]
+    assert MSAStore.from_fasta(a2m_path) is store
+    a2m_path.write_text(a2m_path.read_text() + ">extra\nACDEFGHIKL\n")
+    assert MSAStore.from_fasta(a2m_path) is not store
+
+def test_weights(a2m_path):
+    store = MSAStore.from_fasta(a2m_path)
+    # query, same and close are neighbours (> 80% identical); gappy matches all of its 5 residues in query and same, 4 in close
+    assert store.weights.tolist() == pytest.approx([1 / 3, 1 / 3, 1 / 3, 1.0, 1 / 3, 1.0])
+    assert store.neff == pytest.approx(sum(store.weights))
+
+def test_identity_to_query(a2m_path):
+    store = MSAStore.from_fasta(a2m_path)
+    assert store.identity_to_query.tolist() == pytest.approx([1.0, 1.0, 0.9, 0.5, 0.5, 0.0])
+    assert store.identity_to("WWWWWGHIKL").tolist() == pytest.approx([0.5, 0.5, 0.4, 1.0, 0.2, 0.0])
+
+@pytest.mark.parametrize("strategy,keep_first,expected", [
+    ("in_order", False, [0, 1, 2]),
+    ("in_order", True, [0, 1, 2]),
+    ("top_hits", True, [0, 1, 2]),
+    ("max_diverse", True, [0, 5, 3]),
+    ("max_diverse", False, [5, 3, 4]),
+    ])
+def test_subset_deterministic(a2m_path, strategy, keep_first, expected):
+    store = MSAStore.from_fasta(a2m_path)
+    assert store.subset(3, strategy, keep_first).tolist() == expected
+
+def test_subset_top_hits_query(a2m_path):
+    store = MSAStore.from_fasta(a2m_path)
+    assert store.subset(2, "top_hits", query="WWWWWGHIKL").tolist() == [3, 0]
+
+@pytest.mark.parametrize("strategy", ["random", "weighted"])
+def test_subset_random(a2m_path, strategy):
+    store = MSAStore.from_fasta(a2m_path)
+    subset = store.subset(4, strategy, keep_first=True, random_seed=1)
+    assert subset[0] == 0 and len(set(subset.tolist())) == 4
+    assert subset.tolist() == store.subset(4, strategy, keep_first=True, random_seed=1).tolist()
+    assert sorted(store.subset(100, strategy, random_seed=1).tolist()) == list(range(len(store)))
+
+def test_subset_sizes(a2m_path):
+    store = MSAStore.from_fasta(a2m_path)
+    assert store.subset(0, "random").tolist() == []
+    assert store.subset(1, "random", keep_first=True).tolist() == [0]
+    with pytest.raises(ValueError):
+        store.subset(2, "unknown")
+
+def test_tokens_match_batch_converter(a2m_path, tiny_esm_msa):
+    store = MSAStore.from_fasta(a2m_path)
+    idx = np.array([0, 4, 5])
+    tokens = store.tokens(idx, tiny_esm_msa.alphabet, extra_sequences=["ACDEF-HIKL"])
+    _, _, expected = tiny_esm_msa.batch_converter([[(str(i), s) for i, s in enumerate(store.sequences(idx) + ["ACDEF-HIKL"])]])
+    assert tokens.dtype == torch.long
+    assert torch.equal(tokens, expected[0, :, 1:])
+
+def test_get_init_msa_from_tokens(a2m_path, tiny_sampler):
+    store = MSAStore.from_fasta(a2m_path)
+    idx = store.subset(3, "in_order")
+    from_tokens = tiny_sampler.get_init_msa(store.tokens(idx, tiny_sampler.model.alphabet), 12, 2)
+    from_strings = tiny_sampler.get_init_msa(store.sequences(idx), 12, 2)
+    assert from_tokens.shape == (2, 3, 13)
+    assert torch.equal(from_tokens, from_strings[:, :, :13])
+
+def test_log_likelihood_batch_independent_of_batch_padding(tiny_sampler):
+    short_msa = ["ACDE", "AC-E", "ACDF", "WCDE"]
+    long_msa = ["ACDEFGHIKL", "ACDEFGHIKV", "AC-EFGHIKL", "WCDEFGHIKL"]
+    batched = list(tiny_sampler.log_likelihood_batch([short_msa, long_msa], mask_distance=2))
+    assert batched[0][0] == pytest.approx(tiny_sampler.log_likelihood(short_msa, mask_distance=2)[0], abs=1e-5)
+    assert batched[1][0] == pytest.approx(tiny_sampler.log_likelihood(long_msa, mask_distance=2)[0], abs=1e-5)
@@ -9,9 +9,10 @@
 # repeat_3 = True
 # repeat_4 = True
 
-from .util import add_metric, identify_mutation, add_sequence
+from .util import add_metric, identify_mutation, add_sequence, length_batches, mean_token_log_probability
 import tempfile
 import subprocess
+from functools import lru_cache
 import pandas as pd
 from glob import glob
 import torch
@@ -25,19 +26,41 @@ import tranception
 from tranception import model_pytorch
 
 #CARP
+class CARPScorer:
+  """
+  Resident CARP model scoring sequences in length-sorted padded batches.
+  The score is the mean log-probability of the residues of a sequence under the unmasked model, as written by
+  tmp/extract.py --repr_layers logits --include logp; only the log-probabilities of the observed residues are gathered.
+  """
+  def __init__(self, model_name="carp_640M", device=None, max_tokens=8192, max_batch_size=64):
+    from sequence_models.pretrained import load_model_and_alphabet
+    self.device = torch.device(device if device is not None else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    self.max_tokens = max_tokens
+    self.max_batch_size = max_batch_size
+    self.model, self.collater = load_model_and_alphabet(model_name)
+    self.model.to(self.device)
+    self.model.eval()
+
+  @torch.no_grad()
+  def score_sequences(self, sequences):
+    """Mean residue log-probability of each sequence. Padded positions are masked by the model and left out of the mean."""
+    scores = np.zeros(len(sequences))
+    lengths = [len(sequence) for sequence in sequences]
+    for batch_index in length_batches(lengths, self.max_tokens, self.max_batch_size):
+      x = self.collater([[sequences[i]] for i in batch_index])[0].to(self.device)
+      logits = self.model(x, repr_layers=[], logits=True)['logits']
+      scores[batch_index] = mean_token_log_probability(logits, x, [lengths[i] for i in batch_index])
+    return scores
+
+@lru_cache(maxsize=2)
+def get_CARP_scorer(model_name="carp_640M", device=None):
+  return CARPScorer(model_name=model_name, device=device)
+
 def CARP_640m_logp(target_seqs_file, results, device): 
-  with tempfile.TemporaryDirectory() as output_dir:
-    try:
-      proc = subprocess.run(['python', os.path.join(os.path.dirname(os.path.realpath(__file__)), "tmp/extract.py"), "carp_640M", target_seqs_file, output_dir + "/", "--repr_layers", "logits", "--include", "logp", "--device", device], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    except subprocess.CalledProcessError as e:
-      print(e.stderr.decode('utf-8'))
-      print(e.stdout.decode('utf-8'))
-      raise e
-    df = pd.read_table(output_dir + '/carp_640M_logp.tsv')
-    df = df.rename(columns={'name': 'id', 'logp': 'carp640m_logp'},)
-    for _, row in df.iterrows():
-      add_metric(results, row["id"], "CARP-640m", row["carp640m_logp"])
-    del df
+  names, sequences = parse_fasta(target_seqs_file, return_names=True, full_name=True)
+  scores = get_CARP_scorer("carp_640M", device).score_sequences(sequences)
+  for name, score in zip(names, scores):
+    add_metric(results, name, "CARP-640m", score)
 
 # ESM1v (ProteinGym Version)
 def ESM_1v(target_files, results, device, orig_seq): #TODO: allow other devices?
@@ -6,7 +6,7 @@
 # MIF_ST = True
 # AlphaFold2_pLDDT = True
 
-from .util import add_metric, get_pdb_sequence, residues_in_pdb
+from .util import add_metric, get_pdb_sequence, residues_in_pdb, length_batches, mean_token_log_probability
 import esm
 from glob import glob
 from pathlib import Path
@@ -15,71 +15,253 @@ import subprocess
 import pandas as pd
 from biotite.structure.io import pdb
 import os
-import tmscoring
+import sys
+import hashlib
+from functools import lru_cache
+import numpy as np
+import torch
+from .tm_score import get_tm_batch
+
+def file_hash(path):
+  with open(path, "rb") as fh:
+    return hashlib.sha1(fh.read()).hexdigest()
 
 # ESM-IF
-def ESM_IF(pdb_files, results): #TODO: move to GPU? Maybe spin off into a subprocess when moving to GPU, to avoid memory leaks?
-  esm_if_model, esm_if_alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
-  # esm_if_model = esm_if_model.to(device) # TODO: for some reason it crashes when I move it to the GPU
-  esm_if_model.eval()
-        # with open(output[0],'w') as f:
-        #     f.write('id,esm-if\n')
-  for pdb_file in pdb_files:
+class ESMIFScorer:
+  """
+  Resident ESM-IF model scoring (backbone, sequence) pairs in length-sorted padded batches through CoordBatchConverter.
+  Backbone coordinates are cached by file content, and sequences threaded onto one backbone share a single encoder pass.
+  Scores are the mean log-likelihood over the whole sequence and over the residues with coordinates, as
+  esm.inverse_folding.util.score_sequence.
+  """
+  def __init__(self, device=None, max_tokens=4096, max_batch_size=16, chain="A"):
+    import esm.inverse_folding
+    self.util = esm.inverse_folding.util
+    self.device = torch.device(device if device is not None else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    self.max_tokens = max_tokens
+    self.max_batch_size = max_batch_size
+    self.chain = chain
+    self.model, self.alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
+    self.model.to(self.device)
+    self.model.eval()
+    self.batch_converter = self.util.CoordBatchConverter(self.alphabet)
+    self.structure_cache = {}
+
+  def load(self, pdb_file):
+    """(coords, native sequence) of the chain of pdb_file, keyed by file content."""
+    key = file_hash(pdb_file)
+    if key not in self.structure_cache:
+      self.structure_cache[key] = self.util.load_coords(pdb_file, self.chain)
+    return self.structure_cache[key]
+
+  def log_likelihoods(self, logits, tokens, coords):
+    """Per-row (ll_fullseq, ll_withcoord) of padded decoder logits (batch, alphabet, positions) for the tokens after <cath>."""
+    target = tokens[:, 1:]
+    loss = torch.nn.functional.cross_entropy(logits, target, reduction='none').double()
+    sequence_mask = target != self.alphabet.padding_idx
+    # coords are padded with one position on each side, and with nan after the end of shorter backbones
+    coord_mask = torch.isfinite(coords[:, 1:1 + target.shape[1]]).all(-1).all(-1)
+    ll_fullseq = -torch.where(sequence_mask, loss, 0.0).sum(1) / sequence_mask.sum(1)
+    ll_withcoord = -torch.where(coord_mask, loss, 0.0).sum(1) / coord_mask.sum(1)
+    return ll_fullseq.cpu().numpy(), ll_withcoord.cpu().numpy()
+
+  @torch.no_grad()
+  def score_pairs(self, pairs):
+    """Scores a list of (coords, sequence) pairs, returning the arrays (ll_fullseq, ll_withcoord)."""
+    ll_fullseq = np.zeros(len(pairs))
+    ll_withcoord = np.zeros(len(pairs))
+    for batch_index in length_batches([len(pairs[i][1]) for i in range(len(pairs))], self.max_tokens, self.max_batch_size):
+      coords, confidence, _, tokens, padding_mask = self.batch_converter([(pairs[i][0], None, pairs[i][1]) for i in batch_index], device=self.device)
+      logits, _ = self.model.forward(coords, padding_mask, confidence, tokens[:, :-1])
+      ll_fullseq[batch_index], ll_withcoord[batch_index] = self.log_likelihoods(logits, tokens, coords)
+    return ll_fullseq, ll_withcoord
+
+  def score_structures(self, pdb_files):
+    """(ll_fullseq, ll_withcoord) of the native sequence of each PDB file."""
+    return self.score_pairs([self.load(pdb_file) for pdb_file in pdb_files])
+
+  @torch.no_grad()
+  def score_sequences(self, pdb_file, sequences):
+    """(ll_fullseq, ll_withcoord) of each sequence threaded onto the backbone of pdb_file; the encoder runs once."""
+    backbone, _ = self.load(pdb_file)
+    for i, sequence in enumerate(sequences):
+      assert len(sequence) == len(backbone), f"Sequence {i} does not match the length of chain {self.chain}"
+    coords, confidence, _, _, padding_mask = self.batch_converter([(backbone, None, None)], device=self.device)
+    encoder_out = self.model.encoder(coords, padding_mask, confidence, return_all_hiddens=False)
+    ll_fullseq = np.zeros(len(sequences))
+    ll_withcoord = np.zeros(len(sequences))
+    for start in range(0, len(sequences), self.max_batch_size):
+      batch = sequences[start:start + self.max_batch_size]
+      _, _, _, tokens, _ = self.batch_converter([(backbone, None, sequence) for sequence in batch], device=self.device)
+      # the decoder only reads encoder_out and encoder_padding_mask
+      shared_encoder_out = {
+        "encoder_out": [encoder_out["encoder_out"][0].repeat(1, len(batch), 1)], # T x B x C
+        "encoder_padding_mask": [encoder_out["encoder_padding_mask"][0].repeat(len(batch), 1)], # B x T
+      }
+      logits, _ = self.model.decoder(tokens[:, :-1], encoder_out=shared_encoder_out)
+      ll_fullseq[start:start + len(batch)], ll_withcoord[start:start + len(batch)] = self.log_likelihoods(logits, tokens, coords.expand(len(batch), -1, -1, -1))
+    return ll_fullseq, ll_withcoord
+
+@lru_cache(maxsize=2)
+def get_ESM_IF_scorer(device=None):
+  return ESMIFScorer(device=device)
+
+def ESM_IF(pdb_files, results, device=None):
+  """ESM-IF log-likelihood of each structure's own sequence; runs on the GPU when there is one unless device is given."""
+  ll_fullseq, _ = get_ESM_IF_scorer(device).score_structures(pdb_files)
+  for pdb_file, ll in zip(pdb_files, ll_fullseq):
     fstem = Path(pdb_file).stem
     name = fstem
-    coords, seq = esm.inverse_folding.util.load_coords(pdb_file, "A")
-    ll, _ = esm.inverse_folding.util.score_sequence(
-    esm_if_model, esm_if_alphabet, coords, str(seq))
     add_metric(results, name, "ESM-IF", ll)
-  del esm_if_model
-  del esm_if_alphabet
 
 # ProteinMPNN
-def ProteinMPNN(pdb_files, results):
-  with tempfile.TemporaryDirectory() as output_dir:
-    for i, pdb_file in enumerate(pdb_files):
-      command_line_arguments=[
-      "python",
-      os.path.join(os.path.dirname(os.path.realpath(__file__)), "ProteinMPNN/vanilla_proteinmpnn/protein_mpnn_run.py"),
-      "--pdb_path", pdb_file,
-      "--pdb_path_chains", "A",
-      "--score_only", "1",
-      "--save_score", "1",
-      "--out_folder", output_dir,
-      "--batch_size", "1"
-      ]
-      fstem = Path(pdb_file).stem
-      name = fstem
-      outfile = output_dir + f"outfile_{i}.txt"
-      with open(outfile,"w") as fh:
-        proc = subprocess.run(command_line_arguments, stdout=subprocess.PIPE, check=True)
-        print(proc.stdout.decode('utf-8'), file=fh)
-      with open(outfile,"r") as score_file_h:
-        score_file_lines = score_file_h.readlines()
-      score_line = score_file_lines[-2].split(",")
-      score_parts = score_line[1].strip().split(": ")
-      assert score_parts[0] == "mean" 
-      score = -1 * float(score_parts[1]) 
-      add_metric(results, name, "ProteinMPNN", score)
+PROTEINMPNN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ProteinMPNN/vanilla_proteinmpnn")
+
+class ProteinMPNNScorer:
+  """
+  Resident ProteinMPNN model scoring backbone/sequence pairs in padded batches.
+  Parsed structures are cached by file content, so repeated calls (or many sequences
+  threaded onto the same backbone) only parse each PDB once.
+  Scores are the mean negative log-likelihood over the designed chains, as written by
+  protein_mpnn_run.py --score_only 1.
+  """
+  def __init__(self, model_name="v_48_020", device=None, batch_size=8, backbone_noise=0.0, designed_chains=("A",)):
+    if PROTEINMPNN_DIR not in sys.path:
+      sys.path.append(PROTEINMPNN_DIR)
+    import protein_mpnn_utils
+    self.utils = protein_mpnn_utils
+    self.device = torch.device(device if device is not None else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    self.batch_size = batch_size
+    self.designed_chains = list(designed_chains)
+    checkpoint = torch.load(os.path.join(PROTEINMPNN_DIR, "vanilla_model_weights", f"{model_name}.pt"), map_location=self.device)
+    hidden_dim = 128
+    num_layers = 3
+    self.model = protein_mpnn_utils.ProteinMPNN(num_letters=21, node_features=hidden_dim, edge_features=hidden_dim, hidden_dim=hidden_dim, num_encoder_layers=num_layers, num_decoder_layers=num_layers, augment_eps=backbone_noise, k_neighbors=checkpoint['num_edges'])
+    self.model.to(self.device)
+    self.model.load_state_dict(checkpoint['model_state_dict'])
+    self.model.eval()
+    self.structure_cache = {}
+
+  def parse(self, pdb_file):
+    """Returns the parsed structure of pdb_file, keyed by file content. The entry name is the content hash."""
+    key = file_hash(pdb_file)
+    if key not in self.structure_cache:
+      entry = self.utils.parse_PDB(pdb_file)[0]
+      entry['name'] = key
+      all_chains = [item[-1:] for item in list(entry) if item[:9]=='seq_chain']
+      fixed_chains = [letter for letter in all_chains if letter not in self.designed_chains]
+      self.structure_cache[key] = (entry, (self.designed_chains, fixed_chains))
+    return self.structure_cache[key]
+
+  @torch.no_grad()
+  def score_entries(self, entries):
+    """Scores a list of (parsed structure, chain assignment) pairs, batch_size at a time, sorted by length to limit padding."""
+    scores = np.zeros(len(entries))
+    order = sorted(range(len(entries)), key=lambda i: len(entries[i][0]['seq']))
+    for start in range(0, len(order), self.batch_size):
+      batch_index = order[start:start + self.batch_size]
+      batch = [entries[i][0] for i in batch_index]
+      chain_dict = {entries[i][0]['name']: entries[i][1] for i in batch_index}
+      X, S, mask, lengths, chain_M, chain_encoding_all, chain_list_list, visible_list_list, masked_list_list, masked_chain_length_list_list, chain_M_pos, omit_AA_mask, residue_idx, dihedral_mask, tied_pos_list_of_lists_list, pssm_coef, pssm_bias, pssm_log_odds_all, bias_by_res_all, tied_beta = self.utils.tied_featurize(batch, self.device, chain_dict)
+      randn_1 = torch.randn(chain_M.shape, device=X.device)
+      log_probs = self.model(X, S, mask, chain_M*chain_M_pos, residue_idx, chain_encoding_all, randn_1)
+      mask_for_loss = mask*chain_M*chain_M_pos
+      scores[batch_index] = self.utils._scores(S, log_probs, mask_for_loss).cpu().numpy()
+    return scores
+
+  def score_structures(self, pdb_files):
+    """Negative log-likelihood of the native sequence of each PDB file."""
+    return self.score_entries([self.parse(pdb_file) for pdb_file in pdb_files])
+
+  def score_sequences(self, pdb_file, sequences):
+    """Negative log-likelihood of each sequence threaded onto the designed chain of pdb_file."""
+    entry, chains = self.parse(pdb_file)
+    assert len(self.designed_chains) == 1, "Threading sequences requires a single designed chain"
+    chain = self.designed_chains[0]
+    entries = []
+    for i, sequence in enumerate(sequences):
+      assert len(sequence) == len(entry['seq_chain_'+chain]), f"Sequence {i} does not match the length of chain {chain}"
+      threaded = dict(entry)
+      # tied_featurize builds S from the seq_chain_<X> entries; 'seq' (their concatenation in parse order) is kept in step
+      threaded['seq_chain_'+chain] = sequence
+      threaded['seq'] = ''.join(threaded[item] for item in threaded if item[:10] == 'seq_chain_')
+      threaded['name'] = f"{entry['name']}_{i}"
+      entries.append((threaded, chains))
+    return self.score_entries(entries)
+
+@lru_cache(maxsize=2)
+def get_ProteinMPNN_scorer(model_name="v_48_020", device=None, batch_size=8, backbone_noise=0.0, designed_chains=("A",)):
+  return ProteinMPNNScorer(model_name=model_name, device=device, batch_size=batch_size, backbone_noise=backbone_noise, designed_chains=designed_chains)
+
+def ProteinMPNN(pdb_files, results, out_folder=None):
+  scorer = get_ProteinMPNN_scorer()
+  native_scores = scorer.score_structures(pdb_files)
+  for pdb_file, native_score in zip(pdb_files, native_scores):
+    fstem = Path(pdb_file).stem
+    name = fstem
+    if out_folder is not None:
+      # Same per-structure output as protein_mpnn_run.py --score_only 1 --save_score 1
+      os.makedirs(os.path.join(out_folder, "score_only"), exist_ok=True)
+      np.save(os.path.join(out_folder, "score_only", name + ".npy"), np.array([native_score], dtype=np.float32))
+    score = -1 * float(np.format_float_positional(np.float32(native_score), unique=False, precision=4))
+    add_metric(results, name, "ProteinMPNN", score)
 
 # MIF-ST
+class MIFSTScorer:
+  """
+  Resident MIF-ST model scoring sequences conditioned on their backbone in length-sorted padded batches.
+  Structure features (distances and angles from sequence_models.pdb_utils) are cached by file content.
+  The score is the mean log-probability of the residues, as written by tmp/extract_mif.py mifst ... logits --include logp;
+  only the log-probabilities of the observed residues are gathered.
+  """
+  def __init__(self, model_name="mifst", device=None, max_tokens=4096, max_batch_size=16):
+    from sequence_models.pretrained import load_model_and_alphabet
+    from sequence_models.pdb_utils import parse_PDB, process_coords
+    self.parse_PDB = parse_PDB
+    self.process_coords = process_coords
+    self.device = torch.device(device if device is not None else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+    self.max_tokens = max_tokens
+    self.max_batch_size = max_batch_size
+    self.model, self.collater = load_model_and_alphabet(model_name)
+    self.model.to(self.device)
+    self.model.eval()
+    self.structure_cache = {}
+
+  def features(self, pdb_file):
+    """(dist, omega, theta, phi) tensors of the backbone of pdb_file, keyed by file content."""
+    key = file_hash(pdb_file)
+    if key not in self.structure_cache:
+      coords, _, _ = self.parse_PDB(pdb_file)
+      coords = {
+        'N': coords[:, 0],
+        'CA': coords[:, 1],
+        'C': coords[:, 2]
+      }
+      self.structure_cache[key] = tuple(torch.tensor(feature, dtype=torch.float) for feature in self.process_coords(coords))
+    return self.structure_cache[key]
+
+  @torch.no_grad()
+  def score(self, sequences, pdb_files):
+    """Mean residue log-probability of each sequence given the backbone of the matching PDB file."""
+    scores = np.zeros(len(sequences))
+    lengths = [len(sequence) for sequence in sequences]
+    for batch_index in length_batches(lengths, self.max_tokens, self.max_batch_size):
+      batch = [[sequences[i], *self.features(pdb_files[i])] for i in batch_index]
+      src, nodes, edges, connections, edge_mask = (tensor.to(self.device) for tensor in self.collater(batch))
+      logits = self.model(src, nodes, edges, connections, edge_mask, result='logits')
+      scores[batch_index] = mean_token_log_probability(logits, src, [lengths[i] for i in batch_index])
+    return scores
+
+@lru_cache(maxsize=2)
+def get_MIF_ST_scorer(model_name="mifst", device=None):
+  return MIFSTScorer(model_name=model_name, device=device)
+
 def MIF_ST(pdb_files, results, device): 
-  with tempfile.TemporaryDirectory() as output_dir:
-    spec_file_path = output_dir + "/spec_file.tsv"
-    with open(spec_file_path, 'w') as f:
-      f.write('name\tsequence\tpdb\n')
-      for pdb_file in pdb_files:
-        seq = get_pdb_sequence(pdb_file) 
-        name = Path(pdb_file).stem
-        f.write(name + '\t' + seq + '\t' + pdb_file + '\n')
-    #print(spec_file_path)
-    proc = subprocess.run(['python', os.path.join(os.path.dirname(os.path.realpath(__file__)), "tmp/extract_mif.py"), "mifst", spec_file_path, output_dir + "/", "logits", "--include", "logp", "--device", device], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    print(proc.stderr.decode("utf-8"))
-    print(proc.stdout.decode("utf-8"))
-    df = pd.read_table(output_dir + '/mifst_logp.tsv')
-    df = df.rename(columns={'name': 'id', 'logp': 'mifst_logp'}, )
-    for _, row in df.iterrows():
-      add_metric(results, row["id"], "MIF-ST", row["mifst_logp"])
+  sequences = [get_pdb_sequence(pdb_file) for pdb_file in pdb_files]
+  scores = get_MIF_ST_scorer("mifst", device).score(sequences, pdb_files)
+  for pdb_file, score in zip(pdb_files, scores):
+    name = Path(pdb_file).stem
+    add_metric(results, name, "MIF-ST", score)
 
 # pLDDT
 def AlphaFold2_pLDDT(pdb_files, results):
@@ -99,9 +281,9 @@ def AlphaFold2_pLDDT(pdb_files, results):
     add_metric(results, name, "AlphaFold2 pLDDT", plddt_sum/residue_count)
 
 def TM_score(pdb_files, reference_pdb, results):
-  for pdb_file in pdb_files:
+  # PDB1 = Reference; PDB2 = Target
+  tmscores = get_tm_batch(reference_pdb, pdb_files)
+  for pdb_file, tmscore in zip(pdb_files, tmscores):
     fstem = Path(pdb_file).stem
     name = fstem
-    # PDB1 = Reference; PDB2 = Target
-    tmscore = tmscoring.get_tm(reference_pdb, pdb_file)
     add_metric(results, name, "TM Score", tmscore)
@@ -0,0 +1,167 @@
+# TM-score engine
+# Scores many models against one reference: the reference is parsed once, CA coordinates are matched by
+# residue number (as tmscoring.get_tm does) and every model is superposed with a TM-score style
+# fragment search (Kabsch on seed fragments, iterative extension on residues within d0_search).
+# Models are scored in parallel with numba.
+
+import os
+from functools import lru_cache
+import numpy as np
+from numba import njit, prange
+
+def read_ca_coordinates(pdb_file):
+  """
+  Returns the residue numbers and CA coordinates of the first model of a PDB file.
+  Only the first CA of each residue number is kept, as in tmscoring.
+  """
+  residue_ids, coords, seen = [], [], set()
+  with open(pdb_file) as fh:
+    for line in fh:
+      if line.startswith("ENDMDL"):
+        break
+      if not line.startswith(("ATOM", "HETATM")) or line[12:16].strip() != "CA":
+        continue
+      residue_id = int(line[22:26])
+      if residue_id in seen:
+        continue
+      seen.add(residue_id)
+      residue_ids.append(residue_id)
+      coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+  return np.array(residue_ids, dtype=np.int64), np.array(coords, dtype=np.float64).reshape(-1, 3)
+
+def tm_d0(num_residues):
+  """d0 of the TM-score for a given normalisation length (floored at 0.5A for short chains)."""
+  if num_residues <= 15:
+    return 0.5
+  return max(1.24 * (num_residues - 15) ** (1.0 / 3.0) - 1.8, 0.5)
+
+@njit(cache=True)
+def _kabsch(x, y, selection):
+  """Rotation and translation superposing y[selection] onto x[selection]."""
+  n = selection.shape[0]
+  cx = np.zeros(3)
+  cy = np.zeros(3)
+  for k in range(n):
+    cx += x[selection[k]]
+    cy += y[selection[k]]
+  cx /= n
+  cy /= n
+  h = np.zeros((3, 3))
+  for k in range(n):
+    dx = x[selection[k]] - cx
+    dy = y[selection[k]] - cy
+    for a in range(3):
+      for b in range(3):
+        h[a, b] += dy[a] * dx[b]
+  u, s, vt = np.linalg.svd(h)
+  d = np.eye(3)
+  if np.linalg.det(vt.T @ u.T) < 0:
+    d[2, 2] = -1.0
+  rotation = vt.T @ d @ u.T
+  translation = cx - rotation @ cy
+  return rotation, translation
+
+@njit(cache=True)
+def _squared_distances(x, y, rotation, translation):
+  n = x.shape[0]
+  d2 = np.empty(n)
+  for k in range(n):
+    moved = rotation @ y[k] + translation
+    diff = moved - x[k]
+    d2[k] = diff[0] * diff[0] + diff[1] * diff[1] + diff[2] * diff[2]
+  return d2
+
+@njit(cache=True)
+def _tm_search(x, y, norm_length, d0, d0_search, max_iterations=20):
+  """Best TM-score of y onto x over seed fragments of decreasing length, each refined iteratively."""
+  n = x.shape[0]
+  if n < 3:
+    return 0.0
+  d02 = d0 * d0
+  best_tm = 0.0
+  fragment_length = n
+  min_fragment = min(n, 4)
+  while True:
+    step = max(1, min(n // 40, fragment_length // 2)) if fragment_length < n else 1
+    for start in range(0, n - fragment_length + 1, step):
+      selection = np.arange(start, start + fragment_length)
+      for _ in range(max_iterations):
+        rotation, translation = _kabsch(x, y, selection)
+        d2 = _squared_distances(x, y, rotation, translation)
+        tm = 0.0
+        for k in range(n):
+          tm += 1.0 / (1.0 + d2[k] / d02)
+        tm /= norm_length
+        if tm > best_tm:
+          best_tm = tm
+        # Extend the selection to the residues within d0_search, relaxing the cut-off until at least 3 are kept
+        cutoff = d0_search
+        new_selection = np.nonzero(d2 < cutoff * cutoff)[0]
+        while new_selection.shape[0] < 3 and cutoff < 100.0:
+          cutoff += 0.5
+          new_selection = np.nonzero(d2 < cutoff * cutoff)[0]
+        if new_selection.shape[0] < 3:
+          break
+        if new_selection.shape[0] == selection.shape[0] and np.all(new_selection == selection):
+          break
+        selection = new_selection
+    if fragment_length <= min_fragment:
+      break
+    fragment_length = max(fragment_length // 2, min_fragment)
+  return best_tm
+
+@njit(parallel=True, cache=True)
+def _tm_search_batch(x_padded, y_padded, lengths, norm_lengths, d0s, d0_searches):
+  scores = np.zeros(lengths.shape[0])
+  for i in prange(lengths.shape[0]):
+    n = lengths[i]
+    scores[i] = _tm_search(x_padded[i, :n], y_padded[i, :n], norm_lengths[i], d0s[i], d0_searches[i])
+  return scores
+
+class TMScorer:
+  """
+  One-to-many TM-score against a fixed reference structure.
+  Residues are paired by residue number and the score is normalised by the number of common residues,
+  matching tmscoring.get_tm(reference_pdb, model_pdb).
+  """
+  def __init__(self, reference_pdb):
+    self.reference_pdb = reference_pdb
+    self.reference_ids, self.reference_coords = read_ca_coordinates(reference_pdb)
+
+  def _pair(self, model_ids, model_coords):
+    _, reference_index, model_index = np.intersect1d(self.reference_ids, model_ids, assume_unique=True, return_indices=True)
+    return self.reference_coords[reference_index], model_coords[model_index]
+
+  def score_coordinates(self, models):
+    """TM-scores of a list of (residue_ids, ca_coords) models."""
+    pairs = [self._pair(model_ids, model_coords) for model_ids, model_coords in models]
+    lengths = np.array([len(x) for x, _ in pairs], dtype=np.int64)
+    max_length = max(lengths.max(), 1) if len(pairs) > 0 else 1
+    x_padded = np.zeros((len(pairs), max_length, 3))
+    y_padded = np.zeros((len(pairs), max_length, 3))
+    for i, (x, y) in enumerate(pairs):
+      x_padded[i, :len(x)] = x
+      y_padded[i, :len(y)] = y
+    d0s = np.array([tm_d0(n) for n in lengths])
+    d0_searches = np.clip(d0s, 4.5, 8.0)
+    return _tm_search_batch(x_padded, y_padded, lengths, lengths.astype(np.float64), d0s, d0_searches)
+
+  def score(self, pdb_files):
+    """TM-scores of a list of model PDB files against the reference."""
+    return self.score_coordinates([read_ca_coordinates(pdb_file) for pdb_file in pdb_files])
+
+@lru_cache(maxsize=8)
+def _tm_scorer(reference_pdb, size, mtime_ns):
+  return TMScorer(reference_pdb)
+
+def get_tm_scorer(reference_pdb):
+  """TMScorer of reference_pdb, reused until the file changes (size or modification time)."""
+  stat = os.stat(reference_pdb)
+  return _tm_scorer(os.path.realpath(reference_pdb), stat.st_size, stat.st_mtime_ns)
+
+def get_tm(reference_pdb, pdb_file):
+  """Drop-in replacement for tmscoring.get_tm that reuses the parsed reference."""
+  return float(get_tm_scorer(reference_pdb).score([pdb_file])[0])
+
+def get_tm_batch(reference_pdb, pdb_files):
+  return get_tm_scorer(reference_pdb).score(pdb_files)
@@ -1,7 +1,3 @@
-from biotite.structure import get_residue_count
-from biotite.structure.residues import get_residues
-from biotite.structure.io import pdb
-from biotite.sequence import ProteinSequence
 import numpy as np
 
 def add_metric(metrics_dict, protein_name, metric_name, value):
@@ -15,6 +11,10 @@ def add_sequence(metrics_dict, protein_name, sequence):
   metrics_dict[protein_name]['sequence'] = sequence
 
 def get_pdb_sequence(pdb_path):
+    # biotite is only needed for structures; importing it lazily keeps app.py's startup light
+    from biotite.structure.residues import get_residues
+    from biotite.structure.io import pdb
+    from biotite.sequence import ProteinSequence
     with open(pdb_path) as f:
         pdb_file = pdb.PDBFile.read(pdb_path)
         atoms  = pdb_file.get_structure()
@@ -22,6 +22,8 @@ def get_pdb_sequence(pdb_path):
     return ''.join([ProteinSequence.convert_letter_3to1(r) for r in residues])
 
 def residues_in_pdb(pdb_path):
+    from biotite.structure import get_residue_count
+    from biotite.structure.io import pdb
     with open(pdb_path) as f:
         pdb_file = pdb.PDBFile.read(pdb_path)
         atoms  = pdb_file.get_structure()
@@ -61,4 +63,33 @@ def extract_mutations(mutation_string, offset=0):
           mutations
       ))
   else:
-      return []
\ No newline at end of file
+      return []
+
+
+def length_batches(lengths, max_tokens=8192, max_batch_size=64):
+  """
+  Splits range(len(lengths)) into batches of indices sorted by length, so padding stays small.
+  A batch holds at most max_batch_size sequences and max_tokens padded positions (a longer sequence gets a batch of its own).
+  """
+  batches = []
+  batch = []
+  for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+    if batch and (len(batch) + 1 > max_batch_size or (len(batch) + 1) * lengths[i] > max_tokens):
+      batches.append(batch)
+      batch = []
+    batch.append(i)
+  if batch:
+    batches.append(batch)
+  return batches
+
+def mean_token_log_probability(logits, tokens, lengths):
+  """
+  Mean over the first lengths[b] positions of log p(tokens[b, i]) for padded logits (batch, positions, alphabet).
+  Only the log-probabilities of the observed tokens are formed (logit - logsumexp), not the full log-softmax.
+  """
+  import torch
+  logits = logits.float()
+  log_probabilities = logits.gather(-1, tokens.unsqueeze(-1)).squeeze(-1) - logits.logsumexp(-1)
+  lengths = torch.as_tensor(lengths, device=logits.device)
+  mask = torch.arange(tokens.shape[1], device=logits.device)[None, :] < lengths[:, None]
+  return ((log_probabilities * mask).sum(1) / lengths).cpu().numpy()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the repo's top-level modules and packages (app, journal, plmc_scheduler, tranception, ...) are imported from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
@@ -0,0 +1,194 @@
+import os
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from tranception.utils.msa_utils import MSAProfileAligner, PROFILE_ALPHABET
+
+AA = np.array(list(PROFILE_ALPHABET))
+
+
+def write_msa(path, sequences):
+    with open(path, "w") as msa_file:
+        for index, sequence in enumerate(sequences):
+            msa_file.write(">{}\n{}\n".format("REFERENCE" if index == 0 else "seq{}".format(index), sequence))
+    return str(path)
+
+
+def random_msa(rng, length=30, depth=40, substitution_rate=0.2, gap_rate=0.1):
+    reference = rng.choice(AA, length)
+    sequences = ["".join(reference)]
+    for _ in range(depth - 1):
+        variant = reference.copy()
+        substituted = rng.random(length) < substitution_rate
+        variant[substituted] = rng.choice(AA, substituted.sum())
+        variant[rng.random(length) < gap_rate] = "-"
+        sequences.append("".join(variant))
+    return sequences
+
+
+def random_variant(rng, reference, num_edits):
+    sequence = list(reference)
+    for _ in range(num_edits):
+        edit = rng.integers(3)
+        position = int(rng.integers(len(sequence) + 1))
+        if edit == 0 and position < len(sequence):
+            sequence[position] = str(rng.choice(AA))
+        elif edit == 1:
+            sequence.insert(position, str(rng.choice(AA)))
+        elif len(sequence) > 1 and position < len(sequence):
+            del sequence[position]
+    return "".join(sequence)
+
+
+def reference_column_map(aligner, sequence):
+    """Plain Python version of the Gotoh recursion of profile_alignment.align_sequence_to_profile (same tie-breaking)."""
+    seq = [int(aligner.lookup[ord(c)]) for c in sequence.upper()]
+    P, do, de = aligner.profile_scores, aligner.deletion_open, aligner.deletion_extend
+    io, ie = aligner.insertion_open, aligner.insertion_extend
+    n, m = len(seq), P.shape[0]
+    NEG = -1e30
+    M = [[NEG] * (m + 1) for _ in range(n + 1)]
+    X = [[NEG] * (m + 1) for _ in range(n + 1)]
+    Y = [[NEG] * (m + 1) for _ in range(n + 1)]
+    tM = [[0] * (m + 1) for _ in range(n + 1)]
+    tX = [[0] * (m + 1) for _ in range(n + 1)]
+    tY = [[0] * (m + 1) for _ in range(n + 1)]
+    M[0][0] = 0.0
+    for i in range(1, n + 1):
+        X[i][0] = -ie * i
+        tX[i][0] = 0 if i == 1 else 1
+    for j in range(1, m + 1):
+        Y[0][j] = Y[0][j - 1] - de[j - 1] if j > 1 else -de[0]
+        tY[0][j] = 0 if j == 1 else 2
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            candidates = [M[i - 1][j - 1], X[i - 1][j - 1], Y[i - 1][j - 1]]
+            tM[i][j] = max(range(3), key=lambda k: (candidates[k], -k))
+            M[i][j] = candidates[tM[i][j]] + P[j - 1, seq[i - 1]]
+            open_cost = ie if j == m else io
+            candidates = [M[i - 1][j] - open_cost, X[i - 1][j] - ie, Y[i - 1][j] - open_cost]
+            tX[i][j] = max(range(3), key=lambda k: (candidates[k], -k))
+            X[i][j] = candidates[tX[i][j]]
+            open_cost = de[j - 1] if i == n else do[j - 1]
+            candidates = [M[i][j - 1] - open_cost, X[i][j - 1] - open_cost, Y[i][j - 1] - de[j - 1]]
+            tY[i][j] = max(range(3), key=lambda k: (candidates[k], -k))
+            Y[i][j] = candidates[tY[i][j]]
+    column_map = [-1] * n
+    i, j = n, m
+    state = 0
+    if X[n][m] > M[n][m]:
+        state = 1
+    if Y[n][m] > max(M[n][m], X[n][m]):
+        state = 2
+    while i > 0 or j > 0:
+        if state == 0:
+            column_map[i - 1] = j - 1
+            state = tM[i][j]
+            i, j = i - 1, j - 1
+        elif state == 1:
+            column_map[i - 1] = -1
+            state = tX[i][j]
+            i -= 1
+        else:
+            state = tY[i][j]
+            j -= 1
+    column_map = np.array(column_map, dtype=np.int64)
+    return np.where(column_map >= 0, aligner.column_to_reference_position[np.maximum(column_map, 0)], -1)
+
+
+def clustal_reference_positions(msa_file, sequence, workdir):
+    """The previous implementation: profile alignment of the sequence to the MSA with Clustal Omega, read back as reference positions."""
+    sequence_file = os.path.join(workdir, "seq.fasta")
+    with open(sequence_file, "w") as fasta_out:
+        fasta_out.write(">SEQ_TO_SCORE\n{}\n".format(sequence))
+    expanded_file = os.path.join(workdir, "expanded.fasta")
+    subprocess.run(["clustalo", "--profile1", msa_file, "--profile2", sequence_file, "-o", expanded_file, "--force"], check=True, capture_output=True)
+    aligned = {}
+    with open(expanded_file) as fasta_in:
+        for block in fasta_in.read().split(">")[1:]:
+            name, _, body = block.partition("\n")
+            aligned[name.split()[0]] = body.replace("\n", "")
+    positions, reference_position = [], 0
+    for a, b in zip(aligned["SEQ_TO_SCORE"], aligned["REFERENCE"]):
+        if a != "-":
+            positions.append(reference_position if b != "-" else -1)
+        if b != "-":
+            reference_position += 1
+    return np.array(positions)
+
+
+@pytest.fixture(scope="module")
+def msa(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    sequences = random_msa(rng)
+    return write_msa(tmp_path_factory.mktemp("msa") / "msa.a2m", sequences), sequences
+
+
+def test_random_sequences_match_reference_recursion(msa):
+    msa_file, sequences = msa
+    aligner = MSAProfileAligner(msa_file)
+    rng = np.random.default_rng(1)
+    queries = [random_variant(rng, sequences[0], int(rng.integers(0, 6))) for _ in range(30)]
+    queries += ["".join(rng.choice(AA, int(rng.integers(1, 40)))) for _ in range(10)] # unrelated sequences of other lengths
+    for query, positions in zip(queries, aligner.align(queries)):
+        assert len(positions) == len(query)
+        np.testing.assert_array_equal(positions, reference_column_map(aligner, query))
+
+
+def test_identical_sequence_maps_to_itself(msa):
+    msa_file, sequences = msa
+    aligner = MSAProfileAligner(msa_file)
+    positions = aligner.align([sequences[0]] * 3)
+    for p in positions:
+        np.testing.assert_array_equal(p, np.arange(len(sequences[0])))
+
+
+def test_empty_inputs(msa):
+    msa_file, sequences = msa
+    aligner = MSAProfileAligner(msa_file)
+    assert aligner.align([]) == []
+    empty, full = aligner.align(["", sequences[0]])
+    assert len(empty) == 0
+    np.testing.assert_array_equal(full, np.arange(len(sequences[0])))
+
+
+def test_insertion_and_deletion(tmp_path):
+    reference = "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQ"
+    msa_file = write_msa(tmp_path / "msa.a2m", [reference] * 20)
+    aligner = MSAProfileAligner(msa_file)
+    inserted = reference[:10] + "W" + reference[10:]
+    deleted = reference[:10] + reference[11:]
+    insertion, deletion = aligner.align([inserted, deleted])
+    np.testing.assert_array_equal(insertion, np.concatenate([np.arange(10), [-1], np.arange(10, len(reference))]))
+    np.testing.assert_array_equal(deletion, np.concatenate([np.arange(10), np.arange(11, len(reference))]))
+
+
+def test_gapped_msa_columns(tmp_path):
+    # the reference has gaps (columns that are inserts for the reference): they map to no reference position
+    sequences = ["MKT--AYIAKQR", "MKTGGAYIAKQR", "MKTG-AYIAKQR", "MKT--AYLAKQR"]
+    aligner = MSAProfileAligner(write_msa(tmp_path / "msa.a2m", sequences))
+    reference = sequences[0].replace("-", "")
+    (positions,) = aligner.align([reference])
+    np.testing.assert_array_equal(positions, np.arange(len(reference)))
+    (positions,) = aligner.align(["MKTGGAYIAKQR"])
+    np.testing.assert_array_equal(positions, reference_column_map(aligner, "MKTGGAYIAKQR"))
+    assert (positions == -1).sum() == 2
+
+
+def test_alignments_are_memoized(msa):
+    msa_file, sequences = msa
+    aligner = MSAProfileAligner(msa_file)
+    first = aligner.align([sequences[0][1:]])[0]
+    assert sequences[0][1:] in aligner.cache
+    assert aligner.align([sequences[0][1:]])[0] is first
+
+
+@pytest.mark.skipif(shutil.which("clustalo") is None, reason="Clustal Omega (the previous implementation) is not installed")
+def test_matches_clustal_omega_on_single_edits(tmp_path):
+    rng = np.random.default_rng(2)
+    reference = "".join(rng.choice(AA, 60))
+    msa_file = write_msa(tmp_path / "msa.a2m", [reference] + random_msa(rng, length=60, depth=30, gap_rate=0.0)[1:])
+    aligner = MSAProfileAligner(msa_file)
+    for query in [reference, reference[:20] + "W" + reference[20:], reference[:30] + reference[31:], reference[:45] + "A" + reference[46:]]:
+        np.testing.assert_array_equal(aligner.align([query])[0], clustal_reference_positions(msa_file, query, str(tmp_path)))
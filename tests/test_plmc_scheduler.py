@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import signal
+import textwrap
+import numpy as np
+import pandas as pd
+import pytest
+import plmc_scheduler
+
+# Stand-in for the plmc binary: writes its outputs and plmc-style progress lines, or fails as the alignment name says
+FAKE_PLMC = textwrap.dedent("""\
+    #!{python}
+    import os, sys, json, time, signal
+    args = sys.argv[1:]
+    params, couplings, threads, msa = args[args.index('-o') + 1], args[args.index('-c') + 1], int(args[args.index('-n') + 1]), args[-1]
+    name = os.path.basename(msa)
+    with open(os.path.join(os.path.dirname(params), 'calls.jsonl'), 'a') as fh:
+        fh.write(json.dumps({{'msa': name, 'threads': threads, 'start': time.time()}}) + '\\n')
+    print('Effective number of samples: 12.5\\t(80% identical neighborhood = 0.200 samples)')
+    print('Gradient optimization: lbfgs')
+    for i in range(1, 4):
+        print(f'{{i}}\\t{{0.1 * i:.1f}}\\t1.0\\t2.0\\t{{100.0 - i}}\\t3.0', flush=True)
+    time.sleep(0.3)
+    if name.startswith('exit'):
+        sys.exit(3)
+    if name.startswith('killed'):
+        os.kill(os.getpid(), signal.SIGKILL)
+    if not name.startswith('no_output'):
+        for path in (params, couplings):
+            with open(path, 'w') as out:
+                out.write('parameters')
+""")
+
+
+def write_msa(path, length, depth):
+    rng = np.random.default_rng(length)
+    alphabet = np.array(list(plmc_scheduler.PLMC_ALPHABET[1:]))
+    with open(path, 'w') as fh:
+        for i in range(depth):
+            fh.write('>{}\n{}\n'.format('seq{}/1-{}'.format(i, length) if i == 0 else 'seq{}'.format(i), ''.join(rng.choice(alphabet, length))))
+    return str(path)
+
+
+@pytest.fixture
+def fake_plmc(tmp_path):
+    path = tmp_path / 'plmc'
+    path.write_text(FAKE_PLMC.format(python=sys.executable))
+    path.chmod(0o755)
+    return str(path)
+
+
+def make_jobs(tmp_path, families):
+    output_dir = str(tmp_path / 'out')
+    os.makedirs(output_dir, exist_ok=True)
+    return [plmc_scheduler.PlmcJob(write_msa(tmp_path / (name + '.a2m'), length, depth), name, output_dir, max_iter=3) for name, length, depth in families]
+
+
+def read_calls(tmp_path):
+    with open(tmp_path / 'out' / 'calls.jsonl') as fh:
+        return [json.loads(line) for line in fh]
+
+
+@pytest.mark.parametrize('wait_status, expected', [(0, 0), (3 << 8, 3), (255 << 8, 255), (signal.SIGKILL, -signal.SIGKILL), (signal.SIGSEGV, -signal.SIGSEGV)])
+def test_exit_code(wait_status, expected):
+    assert plmc_scheduler.exit_code(wait_status) == expected
+
+
+def test_read_alignment_stats(tmp_path):
+    msa = tmp_path / 'msa.a2m'
+    msa.write_text('>focus/1-6\nAC-DeF\n>other\nACGDEF\n')
+    assert plmc_scheduler.read_alignment_stats(str(msa)) == (2, 4, 'focus')
+    assert plmc_scheduler.read_alignment_stats(str(msa), focus='missing') == (2, 6, None)
+
+
+def test_threads_follow_estimated_work(tmp_path):
+    deep, large, medium, small = make_jobs(tmp_path, [('deep', 16, 2000), ('large', 64, 80), ('medium', 64, 40), ('small', 16, 20)])
+    scheduler = plmc_scheduler.PlmcScheduler([deep, large, medium, small], num_cores=8, memory_budget=2**34)
+    assert scheduler.allocate_threads([large, small], 8) == [7, 1]
+    # never more threads than sites allow: the cores a job cannot use go to the others
+    assert scheduler.allocate_threads([small], 8) == [small.max_threads] == [2]
+    assert deep.work > large.work and scheduler.allocate_threads([deep, large], 8) == [2, 6]
+    # more work never means fewer threads, and every core is used
+    for cores in range(3, 25):
+        threads = scheduler.allocate_threads([large, medium, small], cores)
+        assert threads[0] >= threads[1] >= 1 and threads[2] >= 1
+        assert sum(threads) == min(cores, sum(job.max_threads for job in [large, medium, small]))
+
+
+def test_jobs_start_largest_first_with_their_share_of_the_cores(tmp_path, fake_plmc):
+    jobs = make_jobs(tmp_path, [('small', 32, 36), ('large', 32, 44), ('medium', 32, 40)])
+    scheduler = plmc_scheduler.PlmcScheduler(jobs, num_cores=4, memory_budget=2**34, plmc_binary=fake_plmc, progress_every=0, poll_interval=0.05)
+    assert [job.name for job in scheduler.plan()] == ['large', 'medium', 'small']
+    scheduler.run()
+    assert [job.status for job in jobs] == ['complete'] * 3
+    # all three fit in the budget and start together, largest first, sharing the 4 cores by estimated work
+    large, medium, small = jobs[1], jobs[2], jobs[0]
+    assert large.start_time < medium.start_time < small.start_time < large.start_time + 0.3
+    assert (large.threads, medium.threads, small.threads) == (2, 1, 1)
+    assert {call['msa']: call['threads'] for call in read_calls(tmp_path)} == {'large.a2m': 2, 'medium.a2m': 1, 'small.a2m': 1}
+    for job in jobs:
+        assert os.path.isfile(job.path('.model_params')) and not os.path.exists(job.path('.model_params.tmp'))
+        with open(job.path('.metadata.json')) as fh:
+            metadata = json.load(fh)
+        assert metadata['status'] == 'complete' and metadata['iterations'] == 3 and metadata['effective_sequences'] == 12.5
+        assert metadata['optimization'] == 'lbfgs' and metadata['peak_rss'] > 0 and metadata['peak_rss_source'] in ('proc', 'rusage_upper_bound')
+
+
+def test_memory_budget_serializes_and_skips_jobs(tmp_path, fake_plmc):
+    jobs = make_jobs(tmp_path, [('a', 20, 10), ('b', 20, 12), ('huge', 80, 10)])
+    budget = max(jobs[0].memory, jobs[1].memory) + 1
+    scheduler = plmc_scheduler.PlmcScheduler(jobs, num_cores=4, memory_budget=budget, plmc_binary=fake_plmc, progress_every=0, poll_interval=0.05)
+    scheduler.run()
+    assert [job.status for job in jobs] == ['complete', 'complete', 'too_large']
+    calls = read_calls(tmp_path)
+    # only one of a and b fits at a time: the second starts after the first has finished
+    assert [call['msa'] for call in calls] == ['b.a2m', 'a.a2m'] and calls[1]['start'] - calls[0]['start'] >= 0.3
+
+
+def test_failures_are_reported_and_leave_no_outputs(tmp_path, fake_plmc):
+    jobs = make_jobs(tmp_path, [('exit', 20, 10), ('killed', 20, 10), ('no_output', 20, 10), ('ok', 20, 10)])
+    plmc_scheduler.PlmcScheduler(jobs, num_cores=4, memory_budget=2**34, plmc_binary=fake_plmc, progress_every=0, poll_interval=0.05).run()
+    assert {job.name: job.status for job in jobs} == {'exit': 'failed', 'killed': 'failed', 'no_output': 'failed', 'ok': 'complete'}
+    assert {job.name: job.process.returncode for job in jobs} == {'exit': 3, 'killed': -signal.SIGKILL, 'no_output': 0, 'ok': 0}
+    for job in jobs[:3]:
+        assert not os.path.exists(job.path('.model_params')) and not os.path.exists(job.path('.metadata.json'))
+        assert 'Gradient optimization' in open(job.path('.log')).read()
+
+
+def test_finished_jobs_are_skipped_until_their_alignment_changes(tmp_path, fake_plmc):
+    families = [('first', 20, 10), ('second', 24, 10)]
+    plmc_scheduler.PlmcScheduler(make_jobs(tmp_path, families), num_cores=2, memory_budget=2**34, plmc_binary=fake_plmc, progress_every=0, poll_interval=0.05).run()
+    jobs = make_jobs(tmp_path, families)
+    plmc_scheduler.PlmcScheduler(jobs, num_cores=2, memory_budget=2**34, plmc_binary=fake_plmc, progress_every=0, poll_interval=0.05).run()
+    assert [job.status for job in jobs] == ['cached', 'cached']
+    with open(jobs[1].msa, 'a') as fh:
+        fh.write('>extra\n' + 'A' * 24 + '\n')
+    jobs = [plmc_scheduler.PlmcJob(job.msa, job.name, job.output_dir, max_iter=3) for job in jobs]
+    plmc_scheduler.PlmcScheduler(jobs, num_cores=2, memory_budget=2**34, plmc_binary=fake_plmc, progress_every=0, poll_interval=0.05).run()
+    assert [job.status for job in jobs] == ['cached', 'complete']
+    assert sorted(call['msa'] for call in read_calls(tmp_path)) == ['first.a2m', 'second.a2m', 'second.a2m']
+
+
+def test_manifest(tmp_path):
+    write_msa(tmp_path / 'fam.a2m', 20, 10)
+    pd.DataFrame([{'msa': 'fam.a2m', 'name': None, 'max_iter': 7}, {'msa': 'fam.a2m', 'name': 'renamed', 'max_iter': None}]).to_csv(tmp_path / 'manifest.csv', index=False)
+    jobs = plmc_scheduler.load_manifest(str(tmp_path / 'manifest.csv'), str(tmp_path / 'out'), max_iter=50)
+    assert [(job.name, job.max_iter) for job in jobs] == [('fam', 7), ('renamed', 50)]
+    pd.DataFrame([{'msa': 'fam.a2m'}, {'msa': 'fam.a2m'}]).to_csv(tmp_path / 'duplicates.csv', index=False)
+    with pytest.raises(ValueError, match='duplicate'):
+        plmc_scheduler.load_manifest(str(tmp_path / 'duplicates.csv'), str(tmp_path / 'out'))
+
+
+@pytest.mark.skipif(not os.path.isfile(plmc_scheduler.PLMC_BINARY), reason='plmc is not built (make -C EVmutation/plmc all-openmp32)')
+def test_real_plmc(tmp_path):
+    jobs = make_jobs(tmp_path, [('real', 20, 50)])
+    plmc_scheduler.PlmcScheduler(jobs, num_cores=2, memory_budget=2**34, progress_every=0, poll_interval=0.05).run()
+    assert jobs[0].status == 'complete' and jobs[0].process.returncode == 0
+    assert os.path.getsize(jobs[0].path('.model_params')) > 0
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import resource
+import threading
+import functools
+
+class _NullSpan:
+    """Shared no-op context manager returned while tracing is disabled."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def current_rss():
+    """Resident set size in bytes (falls back to the peak on systems without /proc)."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+def peak_rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start', 'cpu_start', 'child_time', 'cuda_start')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.tracer._stack().append(self)
+        self.child_time = 0
+        self.cuda_start = self.tracer._cuda_event() if self.tracer.cuda else None
+        self.cpu_start = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        cpu = time.thread_time_ns() - self.cpu_start
+        cuda_end = self.tracer._cuda_event() if self.cuda_start is not None else None
+        stack = self.tracer._stack()
+        stack.pop()
+        duration = end - self.start
+        if stack:
+            stack[-1].child_time += duration
+        self.tracer._record(self, end, duration, cpu, cuda_end)
+        return False
+
+class Tracer:
+    """
+    Span-based tracer. Spans record wall time, thread CPU time, RSS / peak RSS at exit and, when enabled with cuda=True,
+    the GPU time between CUDA events and the peak allocated CUDA memory. Spans nest per thread; the self time of a span
+    excludes its children. While disabled, span() returns a shared no-op context manager and traced functions are
+    called directly.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.cuda = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter_ns()
+
+    def enable(self, cuda=False):
+        if cuda:
+            import torch
+            cuda = torch.cuda.is_available()
+        self.cuda = cuda
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+        self.origin = time.perf_counter_ns()
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _cuda_event(self):
+        import torch
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def _record(self, span, end, duration, cpu, cuda_end):
+        event = {'name': span.name, 'category': span.category, 'start': span.start - self.origin, 'duration': duration,
+                 'self': duration - span.child_time, 'cpu': cpu, 'rss': current_rss(), 'peak_rss': peak_rss(),
+                 'tid': threading.get_ident(), 'thread': threading.current_thread().name, 'args': span.args}
+        if cuda_end is not None:
+            import torch
+            event['cuda_events'] = (span.cuda_start, cuda_end)
+            event['cuda_peak_memory'] = torch.cuda.max_memory_allocated()
+        with self.lock:
+            self.events.append(event)
+
+    def span(self, name, category='app', **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, args)
+
+    def _resolve_cuda(self):
+        """Converts recorded CUDA event pairs to milliseconds (synchronises the device once)."""
+        pending = [event for event in self.events if 'cuda_events' in event]
+        if pending:
+            import torch
+            torch.cuda.synchronize()
+            for event in pending:
+                start, end = event.pop('cuda_events')
+                event['cuda_ms'] = start.elapsed_time(end)
+
+    def summary_rows(self):
+        """Per-span-name aggregates, sorted by total wall time."""
+        self._resolve_cuda()
+        rows = {}
+        for event in self.events:
+            row = rows.setdefault(event['name'], {'name': event['name'], 'category': event['category'], 'count': 0, 'total': 0, 'self': 0, 'cpu': 0, 'max': 0, 'peak_rss': 0, 'cuda_ms': 0.0})
+            row['count'] += 1
+            row['total'] += event['duration']
+            row['self'] += event['self']
+            row['cpu'] += event['cpu']
+            row['max'] = max(row['max'], event['duration'])
+            row['peak_rss'] = max(row['peak_rss'], event['peak_rss'])
+            row['cuda_ms'] += event.get('cuda_ms', 0.0)
+        return sorted(rows.values(), key=lambda row: -row['total'])
+
+    def summary(self):
+        rows = self.summary_rows()
+        if not rows:
+            print("No spans were recorded")
+            return
+        show_cuda = any(row['cuda_ms'] for row in rows)
+        print(f"{'span':<40} {'category':<10} {'count':>6} {'total s':>9} {'self s':>9} {'cpu s':>9} {'mean ms':>9} {'max ms':>9} {'peak RSS MB':>12}" + (f" {'cuda s':>8}" if show_cuda else ""))
+        for row in rows:
+            print(f"{row['name']:<40} {row['category']:<10} {row['count']:>6} {row['total'] / 1e9:>9.3f} {row['self'] / 1e9:>9.3f} {row['cpu'] / 1e9:>9.3f} "
+                  f"{row['total'] / row['count'] / 1e6:>9.2f} {row['max'] / 1e6:>9.2f} {row['peak_rss'] / 2**20:>12.1f}" + (f" {row['cuda_ms'] / 1e3:>8.3f}" if show_cuda else ""))
+
+    def export_chrome_trace(self, path):
+        """Writes the spans as Chrome trace event JSON (chrome://tracing, ui.perfetto.dev), with an RSS counter track."""
+        self._resolve_cuda()
+        pid = os.getpid()
+        trace_events, thread_names = [], {}
+        for event in sorted(self.events, key=lambda event: event['start']):
+            args = {'cpu_ms': event['cpu'] / 1e6, 'self_ms': event['self'] / 1e6, 'rss_mb': event['rss'] / 2**20, 'peak_rss_mb': event['peak_rss'] / 2**20}
+            if 'cuda_ms' in event:
+                args.update({'cuda_ms': event['cuda_ms'], 'cuda_peak_memory_mb': event['cuda_peak_memory'] / 2**20})
+            args.update({key: value if isinstance(value, (int, float, str, bool)) or value is None else str(value) for key, value in event['args'].items()})
+            trace_events.append({'name': event['name'], 'cat': event['category'], 'ph': 'X', 'ts': event['start'] / 1e3, 'dur': event['duration'] / 1e3,
+                                 'pid': pid, 'tid': event['tid'], 'args': args})
+            trace_events.append({'name': 'RSS', 'ph': 'C', 'ts': (event['start'] + event['duration']) / 1e3, 'pid': pid, 'args': {'MB': event['rss'] / 2**20}})
+            thread_names[event['tid']] = event['thread']
+        for tid, name in thread_names.items():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        os.makedirs(os.path.dirname(os.path.realpath(path)), exist_ok=True)
+        with open(path, 'w') as fh:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, fh)
+        return path
+
+tracer = Tracer()
+
+def span(name, category='app', **args):
+    """with span('forward', 'model', batch=32): ... records a span while tracing is enabled."""
+    return tracer.span(name, category, **args)
+
+def traced(name=None, category='app'):
+    """Decorator recording every call of the function as a span."""
+    def decorate(function):
+        span_name = name or function.__qualname__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with _Span(tracer, span_name, category, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def instrument(module, names, category):
+    """Wraps module.<name> for each name with traced(), e.g. the metric functions called by protein_scoring.py."""
+    for name in names:
+        setattr(module, name, traced(f"{module.__name__.split('.')[-1]}.{name}", category)(getattr(module, name)))
+
+def enable(cuda=False):
+    tracer.enable(cuda=cuda)
+
+def finish(path=None):
+    """Prints the per-span summary and, if path is given, exports the Chrome trace."""
+    tracer.summary()
+    if path is not None:
+        tracer.export_chrome_trace(path)
+        print(f"Trace saved to {path} (open in chrome://tracing or ui.perfetto.dev)")
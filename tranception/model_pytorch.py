@@ -795,11 +795,12 @@ class TranceptionLMHeadModel(GPT2PreTrainedModel):
                 batch_size = input_ids.size(0)
                 
                 if self.retrieval_aggregation_mode=="aggregate_indel":
-                    assert batch_size==1, "Aggregate indel is only supported for batch size of 1"
-                    truncated_sequence_text = mutated_sequence[0][start_slice[0]:end_slice[0]]
-                    if len(truncated_sequence_text)!=shift_logits.shape[1]-1: # shift_logits only has one extra token compared to truncated_sequence_text (the BOS token)
-                        print("Tokenization error -- seq length: {} and shift_logits length - 1 : {}".format(len(mutated_sequence),shift_logits.shape[1]-1))
-                    MSA_log_prior, MSA_start, MSA_end = msa_utils.update_retrieved_MSA_log_prior_indel(self, self.MSA_log_prior, self.MSA_start, self.MSA_end, mutated_sequence[0])  
+                    for seq_index in range(batch_size):
+                        truncated_sequence_text = mutated_sequence[seq_index][start_slice[seq_index]:end_slice[seq_index]]
+                        num_tokens = int(attention_mask[seq_index].sum().item()) if attention_mask is not None else shift_logits.shape[1]+1
+                        if len(truncated_sequence_text)!=num_tokens-2: # tokenized sequence has two extra tokens compared to truncated_sequence_text (the BOS and EOS tokens)
+                            print("Tokenization error -- seq length: {} and number of tokens - 2 : {}".format(len(truncated_sequence_text),num_tokens-2))
+                    indel_MSA_log_priors = msa_utils.update_retrieved_MSA_log_prior_indel_batch(self, self.MSA_log_prior, self.MSA_start, self.MSA_end, mutated_sequence)
                 
                 elif self.retrieval_aggregation_mode=="aggregate_substitution":
                     MSA_log_prior=self.MSA_log_prior
@@ -813,6 +814,8 @@ class TranceptionLMHeadModel(GPT2PreTrainedModel):
                 flip = flip > 0
                 
                 for seq_index in range(batch_size):
+                    if self.retrieval_aggregation_mode=="aggregate_indel":
+                        MSA_log_prior, MSA_start, MSA_end = indel_MSA_log_priors[seq_index]
                     min_prior_slice = max(start_slice[seq_index], MSA_start) 
                     max_prior_slice = min(end_slice[seq_index], MSA_end)
                     
@@ -830,14 +833,13 @@ class TranceptionLMHeadModel(GPT2PreTrainedModel):
                         min_logits_slice = max(0, MSA_start-start_slice[seq_index]) 
                         max_logits_slice = min_logits_slice + (max_prior_slice-min_prior_slice)
                         fused_shift_log_probas[seq_index,min_logits_slice:max_logits_slice,:] = (1-self.retrieval_inference_weight_LR)*shift_log_probas[seq_index,min_logits_slice:max_logits_slice,:] + self.retrieval_inference_weight_LR*slice_prior
-                
-                if self.retrieval_aggregation_mode=="aggregate_indel":
-                    try:
+                    
+                    if self.retrieval_aggregation_mode=="aggregate_indel":
                         # If a given residue colume is an added zero-column, then we overwrite prior fusion and only predict based on the autoregressive transformer inference mode.
-                        inserted_retrieval_positions = [True if slice_prior[i].sum()==0 else False for i in range(len(slice_prior))]+[True] #Last True is for the end of sentence token
-                        fused_shift_log_probas[:,inserted_retrieval_positions,:]=shift_log_probas[:,inserted_retrieval_positions,:]
-                    except:
-                        print("Error when adding zero column(s) to account for insertion mutations.")
+                        inserted_retrieval_positions = torch.nonzero(slice_prior.sum(dim=-1)==0).view(-1) + min_logits_slice
+                        if max_logits_slice < fused_shift_log_probas.shape[1]: # End of sentence token
+                            inserted_retrieval_positions = torch.cat((inserted_retrieval_positions, torch.tensor([max_logits_slice], device=inserted_retrieval_positions.device)))
+                        fused_shift_log_probas[seq_index,inserted_retrieval_positions,:]=shift_log_probas[seq_index,inserted_retrieval_positions,:]
                 
                 loss_fct = NLLLoss(reduction='none')
                 loss = loss_fct(input=fused_shift_log_probas.view(-1, fused_shift_log_probas.size(-1)), target=shift_labels.view(-1)).view(fused_shift_log_probas.shape[0],fused_shift_log_probas.shape[1])
@@ -4,7 +4,6 @@ from collections import defaultdict
 import random
 import os
 import torch
-from Bio.Align.Applications import ClustalOmegaCommandline
 
 def filter_msa(msa_data, num_sequences_kept=3):
     """
@@ -135,58 +134,87 @@ def get_msa_prior(MSA_data_file, MSA_weight_file_name, MSA_start, MSA_end, len_t
     return msa_prior
 
 
-def update_retrieved_MSA_log_prior_indel(model, MSA_log_prior, MSA_start, MSA_end, mutated_sequence):
+PROFILE_ALPHABET = "ACDEFGHIKLMNPQRSTVWY"
+
+class MSAProfileAligner:
+    def __init__(self, MSA_data_file, num_sequences_kept=100000, pseudocount_weight=0.1, gap_open=3.0, gap_extend=0.5):
+        """
+        In-process sequence-to-profile aligner used to realign the retrieved MSA when scoring indels.
+        The column profile is computed once from the retrieved MSA (sampled down to num_sequences_kept rows, always keeping the reference sequence).
+        Alignments are memoized by sequence, so repeated variants are only aligned once.
+        MSA_data_file: (string) path to MSA file (expects a2m format). The first sequence is the reference sequence.
+        num_sequences_kept: (int) Maximum number of MSA sequences used to build the profile.
+        pseudocount_weight: (float) Weight of the uniform background mixed into the column frequencies.
+        gap_open / gap_extend: (float) Affine gap penalties (in nats). Deletion penalties are scaled down in columns that are mostly gaps in the MSA.
+        """
+        msa_data = filter_msa(process_msa_data(MSA_data_file), num_sequences_kept=num_sequences_kept)
+        lookup = np.full(256, len(PROFILE_ALPHABET), dtype=np.uint8)
+        for index, letter in enumerate(PROFILE_ALPHABET):
+            lookup[ord(letter)] = index
+        self.lookup = lookup
+        sequences = [sequence.replace(".","-") for sequence in msa_data.values()]
+        msa_length = len(sequences[0])
+        msa_array = np.frombuffer("".join([sequence.ljust(msa_length,"-")[:msa_length] for sequence in sequences]).encode(), dtype=np.uint8).reshape(len(sequences), msa_length)
+        encoded_msa = lookup[msa_array]
+        counts = np.zeros((msa_length, len(PROFILE_ALPHABET)+1))
+        for symbol in range(len(PROFILE_ALPHABET)+1):
+            counts[:,symbol] = (encoded_msa==symbol).sum(axis=0)
+        residue_counts = counts[:,:len(PROFILE_ALPHABET)]
+        background = 1.0 / len(PROFILE_ALPHABET)
+        frequencies = residue_counts / np.maximum(residue_counts.sum(axis=1, keepdims=True), 1)
+        frequencies = (1 - pseudocount_weight) * frequencies + pseudocount_weight * background
+        self.profile_scores = np.zeros((msa_length, len(PROFILE_ALPHABET)+1)) # Last column scores unknown residues (neutral)
+        self.profile_scores[:,:len(PROFILE_ALPHABET)] = np.log(frequencies / background)
+        gap_fraction = (msa_array==ord("-")).mean(axis=0)
+        self.deletion_open = gap_open * (1 - gap_fraction)
+        self.deletion_extend = gap_extend * (1 - gap_fraction)
+        self.insertion_open = gap_open
+        self.insertion_extend = gap_extend
+        reference_residues = msa_array[0]!=ord("-")
+        self.column_to_reference_position = np.where(reference_residues, np.cumsum(reference_residues)-1, -1)
+        self.cache = {}
+
+    def align(self, sequences):
+        """
+        Returns, for each input sequence, an array mapping each residue to its aligned position in the reference sequence (0-indexing), or -1 for inserted residues.
+        """
+        to_align = list(dict.fromkeys([sequence for sequence in sequences if sequence not in self.cache]))
+        if len(to_align) > 0:
+            seq_lens = np.array([len(sequence) for sequence in to_align], dtype=np.int64)
+            padded = np.zeros((len(to_align), max(seq_lens.max(),1)), dtype=np.uint8)
+            for index, sequence in enumerate(to_align):
+                padded[index,:len(sequence)] = self.lookup[np.frombuffer(sequence.upper().encode(), dtype=np.uint8)]
+            # numba is only imported (and the kernels compiled) when indels are first aligned, it is slow to import
+            from .profile_alignment import align_sequences_to_profile
+            column_maps = align_sequences_to_profile(padded, seq_lens, self.profile_scores, self.deletion_open, self.deletion_extend, self.insertion_open, self.insertion_extend)
+            for index, sequence in enumerate(to_align):
+                column_map = column_maps[index,:seq_lens[index]]
+                self.cache[sequence] = np.where(column_map >= 0, self.column_to_reference_position[np.maximum(column_map,0)], -1)
+        return [self.cache[sequence] for sequence in sequences]
+
+def update_retrieved_MSA_log_prior_indel_batch(model, MSA_log_prior, MSA_start, MSA_end, mutated_sequences):
     """
-    Function to process MSA when scoring indels.
-    To identify positions to add / remove in the retrieved MSA, we append and align the sequence to be scored to the original MSA for that protein family with Clustal Omega.
+    Function to process MSA when scoring indels, for a batch of mutated sequences.
+    To identify positions to add / remove in the retrieved MSA, each sequence to be scored is aligned in-process to the column profile of the original MSA for that protein family.
     If the original MSA is relatively deep (over 100k sequences), we sample (by default) 100k rows at random from that MSA to speed computations.
-    MSA sampling is performed only once (for the first sequence to be scored). Subsequent scoring use the same MSA sample.
+    The profile is built only once (for the first batch to be scored) and alignments are cached per sequence on the model.
+    Returns a list of (MSA_log_prior, MSA_start, MSA_end) tuples, one per mutated sequence: inserted residues get an all-zero prior row, deleted positions are dropped.
     """
-    if not os.path.isdir(model.MSA_folder + os.sep + "Sampled"):
-        os.mkdir(model.MSA_folder + os.sep + "Sampled")
-    sampled_MSA_location = model.MSA_folder + os.sep + "Sampled" + os.sep + "Sampled_" + model.MSA_filename.split(os.sep)[-1]
-    
-    if not os.path.exists(sampled_MSA_location):
-        msa_data = process_msa_data(model.MSA_filename)
-        msa_data_sampled = filter_msa(msa_data, num_sequences_kept=100000) #If MSA has less than 100k sequences, the sample is identical to original MSA
-        with open(sampled_MSA_location, 'w') as sampled_write_location:
-            for index, key in enumerate(msa_data_sampled):
-                key_name = ">REFERENCE_SEQUENCE" if index==0 else key
-                msa_data_sampled[key] = msa_data_sampled[key].upper()
-                msa_data_sampled[key] = msa_data_sampled[key].replace(".","-")
-                sampled_write_location.write(key_name+"\n"+"\n".join([msa_data_sampled[key][i:i+80] for i in range(0, len(msa_data_sampled[key]), 80)])+"\n")
-    
-    seq_to_align_location = model.MSA_folder + os.sep + "Sampled" + os.sep + "Seq_to_align_" + model.MSA_filename.split(os.sep)[-1]
-    sequence_text_split = [mutated_sequence[i:i+80] for i in range(0, len(mutated_sequence), 80)]
-    sequence_text_split_split_join = "\n".join([">SEQ_TO_SCORE"]+sequence_text_split)
-    os.system("echo '"+sequence_text_split_split_join+"' > "+seq_to_align_location)
-    
-    expanded_MSA_location = model.MSA_folder + os.sep + "Sampled" + os.sep + "Expanded_" + model.MSA_filename.split(os.sep)[-1]
-    clustalw_cline = ClustalOmegaCommandline(cmd=model.config.clustal_omega_location,
-                                            profile1=sampled_MSA_location,
-                                            profile2=seq_to_align_location,
-                                            outfile=expanded_MSA_location,
-                                            force=True)                                        
-    stdout, stderr = clustalw_cline()
-    msa_data = process_msa_data(expanded_MSA_location)
-    aligned_seqA, aligned_seqB = msa_data[">SEQ_TO_SCORE"], msa_data[">REFERENCE_SEQUENCE"]
-    try:
-        keep_column=[]
-        for column_index_pairwise_alignment in range(len(aligned_seqA)):
-            if aligned_seqA[column_index_pairwise_alignment]=="-" and aligned_seqB[column_index_pairwise_alignment]=="-":
-                continue
-            elif aligned_seqA[column_index_pairwise_alignment]=="-":
-                keep_column.append(False)
-            elif aligned_seqB[column_index_pairwise_alignment]=="-":
-                MSA_log_prior=torch.cat((MSA_log_prior[:column_index_pairwise_alignment], torch.zeros(MSA_log_prior.shape[1]).view(1,-1).cuda(), MSA_log_prior[column_index_pairwise_alignment:]),dim=0)
-                keep_column.append(True) #keep the zero column we just added
-            else:
-                keep_column.append(True)
-        MSA_log_prior = MSA_log_prior[keep_column]
-        MSA_end = MSA_start + len(MSA_log_prior)
-    except: 
-        print("Error when processing the following alignment: {}".format(expanded_MSA_location))
-    return MSA_log_prior, MSA_start, MSA_end
+    if getattr(model, "MSA_profile_aligner", None) is None:
+        model.MSA_profile_aligner = MSAProfileAligner(model.MSA_filename)
+    padded_MSA_log_prior = torch.cat((MSA_log_prior, torch.zeros(1, MSA_log_prior.shape[1], device=MSA_log_prior.device, dtype=MSA_log_prior.dtype)), dim=0)
+    updated_priors = []
+    for reference_positions in model.MSA_profile_aligner.align(list(mutated_sequences)):
+        reference_positions = np.where((reference_positions >= 0) & (reference_positions < len(MSA_log_prior)), reference_positions, len(MSA_log_prior))
+        updated_MSA_log_prior = padded_MSA_log_prior[torch.as_tensor(reference_positions, device=MSA_log_prior.device)]
+        updated_priors.append((updated_MSA_log_prior, MSA_start, MSA_start + len(updated_MSA_log_prior)))
+    return updated_priors
+
+def update_retrieved_MSA_log_prior_indel(model, MSA_log_prior, MSA_start, MSA_end, mutated_sequence):
+    """
+    Function to process MSA when scoring indels (single sequence version of update_retrieved_MSA_log_prior_indel_batch).
+    """
+    return update_retrieved_MSA_log_prior_indel_batch(model, MSA_log_prior, MSA_start, MSA_end, [mutated_sequence])[0]
 
 class MSA_processing:
     def __init__(self,
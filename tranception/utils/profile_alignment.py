@@ -0,0 +1,74 @@
+import numpy as np
+from numba import njit, prange
+
+# numba kernels of msa_utils.MSAProfileAligner, kept in their own module so importing msa_utils does not import numba
+
+@njit
+def align_sequence_to_profile(seq, seq_len, profile_scores, deletion_open, deletion_extend, insertion_open, insertion_extend, column_map):
+    """
+    Global affine-gap (Gotoh) alignment of one integer-encoded sequence against a column profile.
+    Terminal gaps only pay the extension penalty. Fills column_map[i] with the profile column aligned to residue i (-1 for insertions).
+    """
+    NEG = -1e30
+    n = seq_len
+    m = profile_scores.shape[0]
+    M = np.full((n+1,m+1), NEG)
+    X = np.full((n+1,m+1), NEG) # residue i inserted (gap in profile)
+    Y = np.full((n+1,m+1), NEG) # column j deleted (gap in sequence)
+    tM = np.zeros((n+1,m+1), dtype=np.int8)
+    tX = np.zeros((n+1,m+1), dtype=np.int8)
+    tY = np.zeros((n+1,m+1), dtype=np.int8)
+    M[0,0] = 0.0
+    for i in range(1,n+1):
+        X[i,0] = -insertion_extend * i
+        tX[i,0] = 0 if i==1 else 1
+    for j in range(1,m+1):
+        Y[0,j] = Y[0,j-1] - deletion_extend[j-1] if j>1 else -deletion_extend[0]
+        tY[0,j] = 0 if j==1 else 2
+    for i in range(1,n+1):
+        a = seq[i-1]
+        for j in range(1,m+1):
+            # Match / substitution
+            best, state = M[i-1,j-1], 0
+            if X[i-1,j-1] > best: best, state = X[i-1,j-1], 1
+            if Y[i-1,j-1] > best: best, state = Y[i-1,j-1], 2
+            M[i,j] = best + profile_scores[j-1,a]
+            tM[i,j] = state
+            # Insertion of residue i (extension-only past the last column)
+            open_cost = insertion_extend if j==m else insertion_open
+            best, state = M[i-1,j] - open_cost, 0
+            if X[i-1,j] - insertion_extend > best: best, state = X[i-1,j] - insertion_extend, 1
+            if Y[i-1,j] - open_cost > best: best, state = Y[i-1,j] - open_cost, 2
+            X[i,j] = best
+            tX[i,j] = state
+            # Deletion of column j (extension-only past the last residue)
+            open_cost = deletion_extend[j-1] if i==n else deletion_open[j-1]
+            best, state = M[i,j-1] - open_cost, 0
+            if X[i,j-1] - open_cost > best: best, state = X[i,j-1] - open_cost, 1
+            if Y[i,j-1] - deletion_extend[j-1] > best: best, state = Y[i,j-1] - deletion_extend[j-1], 2
+            Y[i,j] = best
+            tY[i,j] = state
+    i, j = n, m
+    state = 0
+    if X[n,m] > M[n,m]: state = 1
+    if Y[n,m] > max(M[n,m], X[n,m]): state = 2
+    while i > 0 or j > 0:
+        if state == 0:
+            column_map[i-1] = j-1
+            state = tM[i,j]
+            i -= 1
+            j -= 1
+        elif state == 1:
+            column_map[i-1] = -1
+            state = tX[i,j]
+            i -= 1
+        else:
+            state = tY[i,j]
+            j -= 1
+
+@njit(parallel=True)
+def align_sequences_to_profile(seqs, seq_lens, profile_scores, deletion_open, deletion_extend, insertion_open, insertion_extend):
+    column_maps = np.full(seqs.shape, -1, dtype=np.int64)
+    for b in prange(seqs.shape[0]):
+        align_sequence_to_profile(seqs[b], seq_lens[b], profile_scores, deletion_open, deletion_extend, insertion_open, insertion_extend, column_maps[b])
+    return column_maps
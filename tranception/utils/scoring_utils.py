@@ -1,6 +1,7 @@
 import os
 import tqdm
 import re
+import random
 import numpy as np
 import pandas as pd
 
@@ -8,8 +9,7 @@ import torch
 from torch.nn import CrossEntropyLoss, NLLLoss
 from torch.utils.data.sampler import Sampler, SequentialSampler
 
-from transformers import DataCollatorForLanguageModeling, PreTrainedTokenizerFast
-from datasets import Dataset
+from transformers import PreTrainedTokenizerFast
 
 AA_vocab = "ACDEFGHIKLMNPQRSTVWY"
 
@@ -85,6 +85,13 @@ def get_tranception_scores_mutated_sequences(model, mutated_sequence_df, batch_s
     scores['window_start']=[]
     scores['window_end']=[]
     scores['score']=[]
+    # datasets and the collator (which pulls in scipy / sklearn) are only imported when scoring, they are slow to import.
+    # Some of the modules they import draw from the global random module (rich seeds an id counter with getrandbits), so
+    # its state is kept: otherwise the first scoring call of a resumed generation run (see journal.py) shifts its RNG sequence
+    rng_state = random.getstate()
+    from datasets import Dataset
+    from transformers import DataCollatorForLanguageModeling
+    random.setstate(rng_state)
     with torch.no_grad():
         ds = Dataset.from_pandas(mutated_sequence_df)
         ds.set_transform(model.encode_batch)